@@ -0,0 +1,14 @@
+"""Performance benchmarks for ssh2-python3.
+
+The benchmarks run offline against the embedded OpenSSH test server from
+``tests/embedded_server``, which listens on ``127.0.0.1:2222``. Run them from
+the repository root after building the extensions in place::
+
+    python -m benchmarks run -o before.json
+    # rebuild with the change under test
+    python -m benchmarks run -o after.json
+    python -m benchmarks compare before.json after.json
+
+Use ``python -m benchmarks list`` to see the available benchmarks and
+``--only`` to run a subset of them.
+"""
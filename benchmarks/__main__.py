@@ -0,0 +1,78 @@
+"""Command line interface for the benchmark suite.
+
+Usage::
+
+    python -m benchmarks list
+    python -m benchmarks run [-o results.json] [--quick] [--only NAME ...]
+    python -m benchmarks compare old.json new.json [--threshold 0.05]
+"""
+
+import sys
+import argparse
+
+from . import harness
+from . import suite  # noqa: F401 - registers the benchmarks
+
+
+def do_list(args):
+    for name, bench in sorted(harness.BENCHMARKS.items()):
+        print(f"{name:<20} {bench.unit:<12} {bench.doc}")
+    return 0
+
+
+def do_run(args):
+    unknown = set(args.only or ()) - set(harness.BENCHMARKS)
+    if unknown:
+        print(f"Unknown benchmarks: {', '.join(sorted(unknown))}", file=sys.stderr)
+        return 2
+    results = harness.run(args.only, quick=args.quick, start_server=not args.no_server)
+    if args.output:
+        harness.save(results, args.output)
+        print(f"Results written to {args.output}")
+    return 0
+
+
+def do_compare(args):
+    old = harness.load(args.old)
+    new = harness.load(args.new)
+    rows = harness.compare(old, new, threshold=args.threshold)
+    worse = 0
+    print(f"{'benchmark':<20} {'case':>24} {'old':>12} {'new':>12} {'change':>8}")
+    for name, label, old_v, new_v, change, verdict in rows:
+        print(f"{name:<20} {label:>24} {old_v:>12.3f} {new_v:>12.3f} {change:>+8.1%} {verdict}")
+        worse += verdict == "worse"
+    return 1 if worse and args.fail_on_regression else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks",
+                                     description="ssh2-python3 benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    cmd = commands.add_parser("list", help="List available benchmarks")
+    cmd.set_defaults(func=do_list)
+
+    cmd = commands.add_parser("run", help="Run benchmarks")
+    cmd.add_argument("-o", "--output", help="Write JSON results to this file")
+    cmd.add_argument("--only", nargs="+", metavar="NAME", help="Benchmarks to run")
+    cmd.add_argument("--quick", action="store_true",
+                     help="Small sizes and counts, to check the suite runs")
+    cmd.add_argument("--no-server", action="store_true",
+                     help="Use an already running server on 127.0.0.1:2222")
+    cmd.set_defaults(func=do_run)
+
+    cmd = commands.add_parser("compare", help="Compare two result files")
+    cmd.add_argument("old", help="Baseline results file")
+    cmd.add_argument("new", help="New results file")
+    cmd.add_argument("--threshold", type=float, default=0.05,
+                     help="Relative change considered noise (default 0.05)")
+    cmd.add_argument("--fail-on-regression", action="store_true",
+                     help="Exit with status 1 if any case got worse")
+    cmd.set_defaults(func=do_compare)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
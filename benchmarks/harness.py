@@ -0,0 +1,220 @@
+"""Benchmark registry, runner and result file handling."""
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import getpass
+import platform
+import tempfile
+import statistics
+
+from tests.embedded_server.openssh import OpenSSHServer
+
+import ssh2
+from ssh2.session import Session
+from ssh2.utils import version as libssh2_version
+
+
+BASE_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TESTS_PATH = os.path.join(BASE_PATH, "tests")
+
+RESULT_FORMAT = 1
+
+BENCHMARKS = {}
+
+
+class Benchmark(object):
+    """A registered benchmark.
+
+    The benchmark function takes a :py:class:`BenchContext` and returns a dict
+    of case label to measured value. Each case is compared separately.
+    """
+
+    def __init__(self, name, func, unit, higher_is_better):
+        self.name = name
+        self.func = func
+        self.unit = unit
+        self.higher_is_better = higher_is_better
+        self.doc = (func.__doc__ or "").strip().splitlines()[0] if func.__doc__ else ""
+
+    def run(self, ctx):
+        cases = self.func(ctx)
+        return {
+            "unit": self.unit,
+            "higher_is_better": self.higher_is_better,
+            "cases": {str(label): value for label, value in cases.items()},
+        }
+
+
+def benchmark(name, unit, higher_is_better=True):
+    """Decorator registering a benchmark function under name."""
+    def decorator(func):
+        BENCHMARKS[name] = Benchmark(name, func, unit, higher_is_better)
+        return func
+    return decorator
+
+
+class BenchContext(object):
+    """Connection settings and helpers shared by all benchmarks.
+
+    :param quick: Use small iteration counts and data sizes, for smoke testing
+      the suite itself rather than getting stable numbers.
+    """
+
+    def __init__(self, host="127.0.0.1", port=2222, quick=False):
+        self.host = host
+        self.port = port
+        self.quick = quick
+        self.user = getpass.getuser()
+        self.user_key = os.path.join(TESTS_PATH, "unit_test_key")
+        os.chmod(self.user_key, 0o600)
+        self.tmpdir = None
+
+    def scale(self, full, quick):
+        """Pick the full or quick variant of an iteration count or size."""
+        return quick if self.quick else full
+
+    def connect(self, auth=True):
+        """Connect, handshake and optionally authenticate a new session.
+
+        :rtype: tuple(:py:class:`socket.socket`, :py:class:`ssh2.session.Session`)
+        """
+        sock = socket.create_connection((self.host, self.port))
+        session = Session()
+        session.handshake(sock)
+        if auth:
+            session.userauth_publickey_fromfile(self.user, self.user_key)
+        return sock, session
+
+    def mkdtemp(self):
+        """Make a scratch directory on the (local) server file system."""
+        return tempfile.mkdtemp(prefix="ssh2bench-", dir=self.tmpdir)
+
+    def __enter__(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="ssh2bench-")
+        return self
+
+    def __exit__(self, *args):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+        self.tmpdir = None
+
+
+def timed(func, *args, **kwargs):
+    """Call func and return its elapsed wall clock time in seconds."""
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def rate(count, func, *args, **kwargs):
+    """Call func(*args, **kwargs) count times, returning calls per second."""
+    start = time.perf_counter()
+    for _ in range(count):
+        func(*args, **kwargs)
+    return count / (time.perf_counter() - start)
+
+
+def latency_stats(samples):
+    """Summarise latency samples, in seconds, as milliseconds."""
+    samples = sorted(samples)
+    p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+    return {
+        "mean": statistics.fmean(samples) * 1000,
+        "median": statistics.median(samples) * 1000,
+        "p95": p95 * 1000,
+    }
+
+
+def metadata():
+    return {
+        "format": RESULT_FORMAT,
+        "ssh2_version": ssh2.__version__,
+        "libssh2_version": (libssh2_version() or b"").decode(),
+        "python": sys.version.split()[0],
+        "implementation": platform.python_implementation(),
+        "gil": getattr(sys, "_is_gil_enabled", lambda: True)(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }
+
+
+def run(names=None, quick=False, start_server=True, log=print):
+    """Run the named benchmarks, or all of them, and return a results dict."""
+    selected = [BENCHMARKS[name] for name in (names or sorted(BENCHMARKS))]
+    server = None
+    if start_server:
+        server = OpenSSHServer()
+        server.start_server()
+    results = {}
+    try:
+        with BenchContext(quick=quick) as ctx:
+            for bench in selected:
+                log(f"Running {bench.name} ...")
+                results[bench.name] = result = bench.run(ctx)
+                for label, value in result["cases"].items():
+                    log(f"    {label:>24}: {format_value(value)} {bench.unit}")
+    finally:
+        if server is not None:
+            server.stop()
+    return {"meta": metadata(), "results": results}
+
+
+def format_value(value):
+    if isinstance(value, dict):
+        return ", ".join(f"{k}={v:.3f}" for k, v in value.items())
+    return f"{value:.3f}"
+
+
+def save(results, filename):
+    with open(filename, "w") as fo:
+        json.dump(results, fo, indent=2, sort_keys=True)
+        fo.write("\n")
+
+
+def load(filename):
+    with open(filename) as fo:
+        results = json.load(fo)
+    if results.get("meta", {}).get("format") != RESULT_FORMAT:
+        raise ValueError(f"{filename} is not a benchmark result file of format {RESULT_FORMAT}")
+    return results
+
+
+def _primary(value):
+    # Latency cases are recorded as stats dicts; compare on the median.
+    if isinstance(value, dict):
+        return value["median"]
+    return value
+
+
+def compare(old, new, threshold=0.05):
+    """Compare two result sets.
+
+    Returns a list of (benchmark, case, old value, new value, relative change,
+    verdict) tuples. Relative change is positive for an improvement whatever
+    the direction of the unit. Verdict is one of "better", "worse" or "same",
+    using threshold as the noise band.
+    """
+    rows = []
+    for name, new_result in sorted(new["results"].items()):
+        old_result = old["results"].get(name)
+        if old_result is None:
+            continue
+        sign = 1 if new_result["higher_is_better"] else -1
+        for label, new_value in new_result["cases"].items():
+            if label not in old_result["cases"]:
+                continue
+            old_v = _primary(old_result["cases"][label])
+            new_v = _primary(new_value)
+            change = sign * (new_v - old_v) / old_v if old_v else 0.0
+            if change > threshold:
+                verdict = "better"
+            elif change < -threshold:
+                verdict = "worse"
+            else:
+                verdict = "same"
+            rows.append((name, label, old_v, new_v, change, verdict))
+    return rows
@@ -0,0 +1,574 @@
+"""Benchmark cases run against the embedded OpenSSH server."""
+
+import os
+import re
+import hmac
+import time
+import select
+import socket
+import threading
+from base64 import b64encode
+from hashlib import sha1, sha256
+
+from ssh2.session import Session
+from ssh2.knownhost import (KnownHostStore, LIBSSH2_KNOWNHOST_TYPE_PLAIN,
+                            LIBSSH2_KNOWNHOST_KEYENC_RAW, LIBSSH2_KNOWNHOST_KEY_SSHRSA)
+from ssh2.sftp import (LIBSSH2_FXF_READ, LIBSSH2_FXF_WRITE, LIBSSH2_FXF_CREAT,
+                       LIBSSH2_FXF_TRUNC, LIBSSH2_SFTP_S_IRUSR, LIBSSH2_SFTP_S_IWUSR)
+
+from .harness import benchmark, rate, timed, latency_stats
+
+
+MB = 1024 * 1024
+
+CHANNEL_BUFFER_SIZES = (1024, 8192, 32768, 65536, 262144, 2 * MB)
+SFTP_CHUNK_SIZES = (4096, 32768, 65536, 262144, 2 * MB)
+
+
+def run_command(session, command, size=2 * MB):
+    """Execute command on a new channel and drain its output.
+
+    Returns number of bytes read from stdout.
+    """
+    chan = session.open_session()
+    chan.execute(command)
+    total = 0
+    rc, data = chan.read(size)
+    while rc > 0:
+        total += rc
+        rc, data = chan.read(size)
+    chan.wait_eof()
+    chan.close()
+    chan.wait_closed()
+    return total
+
+
+@benchmark("handshake", "sessions/s")
+def bench_handshake(ctx):
+    """Connect and handshake rate, with and without authentication."""
+    count = ctx.scale(200, 5)
+
+    def connect(auth):
+        sock, session = ctx.connect(auth=auth)
+        session.disconnect()
+        sock.close()
+
+    connect(False)
+    return {
+        "handshake": rate(count, connect, False),
+        "handshake+auth": rate(count, connect, True),
+    }
+
+
+@benchmark("session_create", "sessions/s")
+def bench_session_create(ctx):
+    """Session object create and destroy rate, alone and while other
+    sessions are alive."""
+    count = ctx.scale(200000, 1000)
+    results = {"create": rate(count, Session)}
+    alive = [Session() for _ in range(100)]
+    results["create+100-alive"] = rate(count, Session)
+    del alive
+    return results
+
+
+@benchmark("exec_rtt", "ms", higher_is_better=False)
+def bench_exec_rtt(ctx):
+    """Round trip latency of open channel, execute, read and close."""
+    count = ctx.scale(200, 5)
+    sock, session = ctx.connect()
+    try:
+        run_command(session, "true")
+        samples = [timed(run_command, session, "echo me") for _ in range(count)]
+    finally:
+        session.disconnect()
+        sock.close()
+    return {"echo": latency_stats(samples)}
+
+
+@benchmark("multiplex", "commands/s")
+def bench_multiplex(ctx):
+    """Rate of running a batch of commands on one session, one after the
+    other and with :py:class:`ssh2.multiplex.Multiplexer`."""
+    count = ctx.scale(50, 10)
+    sock, session = ctx.connect()
+    results = {}
+    try:
+        run_command(session, "true")
+        start = time.perf_counter()
+        for _ in range(count):
+            run_command(session, "echo me")
+        results["sequential"] = count / (time.perf_counter() - start)
+        for max_channels in (1, 10):
+            mux = session.multiplexer(max_channels=max_channels)
+            for _ in range(count):
+                mux.submit("echo me")
+            start = time.perf_counter()
+            done = sum(1 for _ in mux.run())
+            assert done == count, f"ran {done} of {count}"
+            results[f"mux-{max_channels}"] = count / (time.perf_counter() - start)
+    finally:
+        session.disconnect()
+        sock.close()
+    return results
+
+
+@benchmark("shell_executor", "commands/s")
+def bench_shell_executor(ctx):
+    """Rate of running a batch of commands on one session with a channel
+    each and in one shell with :py:class:`ssh2.executor.ShellExecutor`."""
+    count = ctx.scale(200, 20)
+    sock, session = ctx.connect()
+    results = {}
+    try:
+        run_command(session, "true")
+        start = time.perf_counter()
+        for _ in range(count):
+            run_command(session, "echo me")
+        results["channels"] = count / (time.perf_counter() - start)
+        with session.shell_executor(shell="sh") as executor:
+            start = time.perf_counter()
+            for _ in range(count):
+                executor.execute("echo me")
+            results["execute"] = count / (time.perf_counter() - start)
+            start = time.perf_counter()
+            for _ in range(count):
+                executor.submit("echo me")
+            done = sum(1 for _ in executor.run())
+            assert done == count, f"ran {done} of {count}"
+            results["submit"] = count / (time.perf_counter() - start)
+    finally:
+        session.disconnect()
+        sock.close()
+    return results
+
+
+@benchmark("expect", "MB/s")
+def bench_expect(ctx):
+    """Rate of waiting for a prompt after a long output read in 8KB chunks,
+    re-searching all output read on each chunk and with
+    :py:func:`ssh2.channel.Channel.expect`."""
+    lines = ctx.scale(200000, 20000)
+    command = f'seq 1 {lines}; echo "host> "'
+    prompt = re.compile(rb"[\w-]+> ")
+    sock, session = ctx.connect()
+    results = {}
+    try:
+        chan = session.open_session()
+        chan.execute(command)
+        start = time.perf_counter()
+        buf = b""
+        match = None
+        while match is None:
+            rc, data = chan.read(8192)
+            assert rc > 0, "no prompt"
+            buf += data
+            match = prompt.search(buf)
+        results["read+search"] = len(buf) / MB / (time.perf_counter() - start)
+        chan.close()
+        chan = session.open_session()
+        chan.execute(command)
+        start = time.perf_counter()
+        _, match, before = chan.expect(prompt, size=8192)
+        results["expect"] = len(before) / MB / (time.perf_counter() - start)
+        chan.close()
+    finally:
+        session.disconnect()
+        sock.close()
+    return results
+
+
+@benchmark("channel_throughput", "MB/s")
+def bench_channel_throughput(ctx):
+    """Channel stdout throughput by read buffer size."""
+    total = ctx.scale(256 * MB, 4 * MB)
+    command = f"head -c {total} /dev/zero"
+    sock, session = ctx.connect()
+    results = {}
+    try:
+        for size in CHANNEL_BUFFER_SIZES:
+            start = time.perf_counter()
+            nbytes = run_command(session, command, size)
+            elapsed = time.perf_counter() - start
+            assert nbytes == total, f"short read: {nbytes} != {total}"
+            results[size] = total / elapsed / MB
+    finally:
+        session.disconnect()
+        sock.close()
+    return results
+
+
+@benchmark("thread_throughput", "MB/s")
+def bench_thread_throughput(ctx):
+    """Combined channel stdout throughput of threads with a session each, by
+    number of threads. Reads are small so that the time spent outside of
+    libssh2 counts - that only runs in parallel on free-threaded Python."""
+    total = ctx.scale(64 * MB, 2 * MB)
+    command = f"head -c {total} /dev/zero"
+    counts = sorted({1, 2, 4, min(os.cpu_count() or 1, 16)})
+    connections = [ctx.connect() for _ in range(counts[-1])]
+    results = {}
+    try:
+        for _, session in connections:
+            run_command(session, "true")
+        for nthreads in counts:
+            nbytes = []
+
+            def read(session):
+                nbytes.append(run_command(session, command, 8192))
+
+            threads = [threading.Thread(target=read, args=(session,))
+                       for _, session in connections[:nthreads]]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+            assert nbytes == [total] * nthreads, f"short reads: {nbytes}"
+            results[nthreads] = total * nthreads / elapsed / MB
+    finally:
+        for sock, session in connections:
+            session.disconnect()
+            sock.close()
+    return results
+
+
+@benchmark("io_thread", "MB/s")
+def bench_io_thread(ctx):
+    """Channel stdout throughput with each chunk hashed as it is read, with
+    reads on the calling thread and on the session's I/O thread."""
+    total = ctx.scale(256 * MB, 4 * MB)
+    command = f"head -c {total} /dev/zero"
+    sock, session = ctx.connect()
+    results = {}
+    try:
+        run_command(session, "true")
+        digest = sha256()
+        start = time.perf_counter()
+        chan = session.open_session()
+        chan.execute(command)
+        nbytes = 0
+        rc, data = chan.read(65536)
+        while rc > 0:
+            digest.update(data)
+            nbytes += rc
+            rc, data = chan.read(65536)
+        chan.close()
+        chan.wait_closed()
+        assert nbytes == total, f"short read: {nbytes} != {total}"
+        results["read"] = total / (time.perf_counter() - start) / MB
+        digest = sha256()
+        with session.start_io_thread() as io:
+            start = time.perf_counter()
+            chan = session.open_session()
+            chan.execute(command)
+            nbytes = 0
+            for data in io.add(chan):
+                digest.update(data)
+                nbytes += len(data)
+            chan.close()
+            chan.wait_closed()
+            assert nbytes == total, f"short read: {nbytes} != {total}"
+            results["io_thread"] = total / (time.perf_counter() - start) / MB
+    finally:
+        session.disconnect()
+        sock.close()
+    return results
+
+
+@benchmark("reactor", "MB/s")
+def bench_reactor(ctx):
+    """Combined stdout throughput of channels read by polling each in
+    non-blocking mode and by :py:class:`ssh2.reactor.Reactor` callbacks."""
+    nchannels = 8
+    total = ctx.scale(16 * MB, MB)
+    command = f"head -c {total} /dev/zero"
+    sock, session = ctx.connect()
+    results = {}
+    try:
+        run_command(session, "true")
+        channels = []
+        for _ in range(nchannels):
+            chan = session.open_session()
+            chan.execute(command)
+            channels.append(chan)
+        start = time.perf_counter()
+        session.set_blocking(False)
+        nbytes = 0
+        while channels:
+            progress = False
+            for chan in list(channels):
+                rc, data = chan.read(65536)
+                if rc > 0:
+                    nbytes += rc
+                    progress = True
+                elif rc == 0 and chan.eof():
+                    channels.remove(chan)
+            if channels and not progress:
+                select.select([sock], [], [], 1)
+        session.set_blocking(True)
+        assert nbytes == total * nchannels, f"short read: {nbytes}"
+        results["polling"] = nbytes / (time.perf_counter() - start) / MB
+        reactor = session.reactor()
+        nbytes = []
+        for _ in range(nchannels):
+            chan = session.open_session()
+            chan.execute(command)
+            reactor.add(chan, on_stdout=lambda data: nbytes.append(len(data)))
+        start = time.perf_counter()
+        reactor.run()
+        assert sum(nbytes) == total * nchannels, f"short read: {sum(nbytes)}"
+        results["reactor"] = sum(nbytes) / (time.perf_counter() - start) / MB
+    finally:
+        session.disconnect()
+        sock.close()
+    return results
+
+
+@benchmark("sftp_read", "MB/s")
+def bench_sftp_read(ctx):
+    """SFTP file read throughput by chunk size."""
+    total = ctx.scale(256 * MB, 4 * MB)
+    filename = os.path.join(ctx.mkdtemp(), "read_file")
+    with open(filename, "wb") as fo:
+        fo.truncate(total)
+    sock, session = ctx.connect()
+    results = {}
+    try:
+        sftp = session.sftp_init()
+        for chunk in SFTP_CHUNK_SIZES:
+            start = time.perf_counter()
+            nbytes = 0
+            with sftp.open(filename, LIBSSH2_FXF_READ, LIBSSH2_SFTP_S_IRUSR) as fh:
+                rc, data = fh.read(chunk)
+                while rc > 0:
+                    nbytes += rc
+                    rc, data = fh.read(chunk)
+            elapsed = time.perf_counter() - start
+            assert nbytes == total, f"short read: {nbytes} != {total}"
+            results[chunk] = total / elapsed / MB
+    finally:
+        session.disconnect()
+        sock.close()
+    return results
+
+
+@benchmark("sftp_write", "MB/s")
+def bench_sftp_write(ctx):
+    """SFTP file write throughput by chunk size."""
+    total = ctx.scale(256 * MB, 4 * MB)
+    filename = os.path.join(ctx.mkdtemp(), "write_file")
+    flags = LIBSSH2_FXF_WRITE | LIBSSH2_FXF_CREAT | LIBSSH2_FXF_TRUNC
+    mode = LIBSSH2_SFTP_S_IRUSR | LIBSSH2_SFTP_S_IWUSR
+    sock, session = ctx.connect()
+    results = {}
+    try:
+        sftp = session.sftp_init()
+        for chunk in SFTP_CHUNK_SIZES:
+            data = bytes(chunk)
+            start = time.perf_counter()
+            with sftp.open(filename, flags, mode) as fh:
+                for _ in range(total // chunk):
+                    fh.write(data)
+            elapsed = time.perf_counter() - start
+            assert os.stat(filename).st_size == total
+            results[chunk] = total / elapsed / MB
+    finally:
+        session.disconnect()
+        sock.close()
+    return results
+
+
+@benchmark("sftp_readdir", "entries/s")
+def bench_sftp_readdir(ctx):
+    """SFTP directory listing rate by directory size."""
+    sizes = ctx.scale((1000, 10000, 50000), (100,))
+    sock, session = ctx.connect()
+    results = {}
+    try:
+        sftp = session.sftp_init()
+        for nfiles in sizes:
+            dirname = ctx.mkdtemp()
+            for i in range(nfiles):
+                open(os.path.join(dirname, f"file_{i:08d}"), "wb").close()
+            start = time.perf_counter()
+            count = 0
+            with sftp.opendir(dirname) as dh:
+                for size, name, attrs in dh.readdir():
+                    count += 1
+            elapsed = time.perf_counter() - start
+            # Includes the . and .. entries.
+            assert count == nfiles + 2, f"listed {count} of {nfiles + 2}"
+            results[nfiles] = count / elapsed
+    finally:
+        session.disconnect()
+        sock.close()
+    return results
+
+
+def write_known_hosts(filename, nhosts, host, key, hashed=False):
+    """Write a known hosts file with nhosts random entries followed by the
+    entry for host, so that a check for host is the worst case for a linear
+    scan."""
+    with open(filename, "wb") as fo:
+        for i in range(nhosts):
+            name = f"10.{(i >> 16) & 0xff}.{(i >> 8) & 0xff}.{i & 0xff}".encode()
+            fo.write(_known_hosts_line(name, os.urandom(len(key)), hashed))
+        fo.write(_known_hosts_line(host, key, hashed))
+
+
+def _known_hosts_line(host, key, hashed):
+    if hashed:
+        salt = os.urandom(sha1().digest_size)
+        digest = hmac.digest(salt, host, "sha1")
+        host = b"|1|" + b64encode(salt) + b"|" + b64encode(digest)
+    return host + b" ssh-rsa " + b64encode(key) + b"\n"
+
+
+def _server_host_key(ctx):
+    sock, session = ctx.connect(auth=False)
+    try:
+        return session.hostkey()[0]
+    finally:
+        session.disconnect()
+        sock.close()
+
+
+@benchmark("knownhost_check", "checks/s")
+def bench_knownhost_check(ctx):
+    """Known hosts check rate by file size, plain and hashed host names, with
+    libssh2 and with :py:class:`ssh2.knownhost.KnownHostStore`."""
+    sizes = ctx.scale((1000, 10000, 100000), (100,))
+    count = ctx.scale(200, 5)
+    host = f"[{ctx.host}]:{ctx.port}".encode()
+    key = _server_host_key(ctx)
+    typemask = (LIBSSH2_KNOWNHOST_TYPE_PLAIN | LIBSSH2_KNOWNHOST_KEYENC_RAW |
+                LIBSSH2_KNOWNHOST_KEY_SSHRSA)
+    sock, session = ctx.connect(auth=False)
+    results = {}
+    try:
+        for hashed in (False, True):
+            for nhosts in sizes:
+                filename = os.path.join(ctx.mkdtemp(), "known_hosts")
+                write_known_hosts(filename, nhosts, host, key, hashed=hashed)
+                kh = session.knownhost_init()
+                kh.readfile(filename)
+                label = f"{'hashed' if hashed else 'plain'}-{nhosts}"
+                results[label] = rate(count, kh.checkp, ctx.host.encode(), ctx.port,
+                                      key, typemask)
+                store = KnownHostStore(filename)
+                results["store-" + label] = rate(count, store.checkp, ctx.host.encode(),
+                                                 ctx.port, key, typemask)
+    finally:
+        session.disconnect()
+        sock.close()
+    return results
+
+
+@benchmark("knownhost_load", "entries/s")
+def bench_knownhost_load(ctx):
+    """Known hosts file load rate by file size."""
+    sizes = ctx.scale((1000, 10000, 100000), (100,))
+    host = f"[{ctx.host}]:{ctx.port}".encode()
+    key = _server_host_key(ctx)
+    sock, session = ctx.connect(auth=False)
+    results = {}
+    try:
+        for nhosts in sizes:
+            filename = os.path.join(ctx.mkdtemp(), "known_hosts")
+            write_known_hosts(filename, nhosts, host, key)
+            kh = session.knownhost_init()
+            results[nhosts] = (nhosts + 1) / timed(kh.readfile, filename)
+            results[f"store-{nhosts}"] = (nhosts + 1) / timed(KnownHostStore, filename)
+    finally:
+        session.disconnect()
+        sock.close()
+    return results
+
+
+@benchmark("proxy_jump", "ms", higher_is_better=False)
+def bench_proxy_jump(ctx):
+    """Exec round trip latency by number of jump hosts the session is
+    tunnelled through."""
+    count = ctx.scale(200, 5)
+    sock, session = ctx.connect()
+    sessions = [session]
+    results = {}
+    try:
+        for hops in range(3):
+            if hops:
+                session = session.proxy_jump(ctx.host, ctx.port)
+                session.userauth_publickey_fromfile(ctx.user, ctx.user_key)
+                sessions.append(session)
+            run_command(session, "true")
+            results[f"{hops}-hops"] = latency_stats(
+                [timed(run_command, session, "echo me") for _ in range(count)])
+    finally:
+        for session in reversed(sessions):
+            session.disconnect()
+        sock.close()
+    return results
+
+
+def _sink_server():
+    """Local TCP server that discards what it receives. Returns its socket."""
+    server = socket.create_server(("127.0.0.1", 0))
+
+    def drain(conn):
+        with conn:
+            while conn.recv(MB):
+                pass
+
+    def serve():
+        while True:
+            try:
+                conn, _ = server.accept()
+            except OSError:
+                return
+            threading.Thread(target=drain, args=(conn,), daemon=True).start()
+    threading.Thread(target=serve, daemon=True).start()
+    return server
+
+
+def _send_zeros(address, total):
+    data = bytes(MB)
+    with socket.create_connection(address) as sock:
+        for _ in range(total // MB):
+            sock.sendall(data)
+
+
+@benchmark("forward_local", "MB/s")
+def bench_forward_local(ctx):
+    """Local port forwarding throughput by number of concurrent connections."""
+    total = ctx.scale(256 * MB, 4 * MB)
+    sink = _sink_server()
+    sock, session = ctx.connect()
+    results = {}
+    try:
+        fwd = session.forward_local("127.0.0.1", sink.getsockname()[1])
+        runner = threading.Thread(target=fwd.run)
+        runner.start()
+        try:
+            for nconns in (1, 8):
+                clients = [threading.Thread(target=_send_zeros,
+                                            args=(fwd.local_address, total // nconns))
+                           for _ in range(nconns)]
+                start = time.perf_counter()
+                for client in clients:
+                    client.start()
+                for client in clients:
+                    client.join()
+                # Sent data has reached the sink once its channels are closed.
+                while fwd.active:
+                    time.sleep(0.001)
+                results[nconns] = total / (time.perf_counter() - start) / MB
+        finally:
+            fwd.stop()
+            runner.join()
+            fwd.close()
+    finally:
+        sink.close()
+        session.disconnect()
+        sock.close()
+    return results
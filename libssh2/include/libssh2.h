@@ -997,6 +997,17 @@ LIBSSH2_API int libssh2_base64_decode(LIBSSH2_SESSION *session, char **dest,
                                       unsigned int *dest_len,
                                       const char *src, unsigned int src_len);
 
+/*
+ * libssh2_bcrypt_pbkdf()
+ *
+ * bcrypt_pbkdf key derivation as used by OpenSSH private key files, for
+ * language wrappers decrypting keys once outside of a session.
+ */
+LIBSSH2_API int libssh2_bcrypt_pbkdf(const char *pass, size_t passlen,
+                                     const unsigned char *salt, size_t saltlen,
+                                     unsigned char *key, size_t keylen,
+                                     unsigned int rounds);
+
 LIBSSH2_API
 const char *libssh2_version(int req_version_num);
 
@@ -1344,6 +1355,19 @@ libssh2_agent_disconnect(LIBSSH2_AGENT *agent);
 LIBSSH2_API void
 libssh2_agent_free(LIBSSH2_AGENT *agent);
 
+/*
+ * libssh2_agent_set_session()
+ *
+ * Moves an agent handle to another session, keeping its agent connection
+ * and fetched identities, so that one agent connection can authenticate
+ * many sessions. All sessions involved must use the same memory allocation
+ * functions.
+ *
+ * Returns the session the agent belonged to before.
+ */
+LIBSSH2_API LIBSSH2_SESSION *
+libssh2_agent_set_session(LIBSSH2_AGENT *agent, LIBSSH2_SESSION *session);
+
 /*
  * libssh2_agent_set_identity_path()
  *
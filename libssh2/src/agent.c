@@ -862,6 +862,20 @@ libssh2_agent_free(LIBSSH2_AGENT *agent)
     LIBSSH2_FREE(agent->session, agent);
 }
 
+/*
+ * libssh2_agent_set_session()
+ *
+ * Moves an agent handle to another session
+ *
+ */
+LIBSSH2_API LIBSSH2_SESSION *
+libssh2_agent_set_session(LIBSSH2_AGENT *agent, LIBSSH2_SESSION *session)
+{
+    LIBSSH2_SESSION *prev = agent->session;
+    agent->session = session;
+    return prev;
+}
+
 /*
  * libssh2_agent_set_identity_path()
  *
@@ -947,3 +947,13 @@ int _libssh2_bcrypt_pbkdf(const char *pass,
                         keylen,
                         rounds);
 }
+
+LIBSSH2_API int
+libssh2_bcrypt_pbkdf(const char *pass, size_t passlen,
+                     const unsigned char *salt, size_t saltlen,
+                     unsigned char *key, size_t keylen,
+                     unsigned int rounds)
+{
+    return _libssh2_bcrypt_pbkdf(pass, passlen, salt, saltlen, key, keylen,
+                                 rounds);
+}
@@ -762,7 +762,9 @@ LIBSSH2_CHANNEL_CLOSE_FUNC(libssh2_sftp_dtor)
  *
  * Startup an SFTP session
  */
-static LIBSSH2_SFTP *sftp_init(LIBSSH2_SESSION *session)
+static LIBSSH2_SFTP *sftp_init(LIBSSH2_SESSION *session,
+                               unsigned int window_size,
+                               unsigned int packet_size)
 {
     unsigned char *data;
     size_t data_len = 0;
@@ -797,8 +799,7 @@ static LIBSSH2_SFTP *sftp_init(LIBSSH2_SESSION *session)
     if(session->sftpInit_state == libssh2_NB_state_created) {
         session->sftpInit_channel =
             _libssh2_channel_open(session, "session", sizeof("session") - 1,
-                                  LIBSSH2_CHANNEL_WINDOW_DEFAULT,
-                                  LIBSSH2_CHANNEL_PACKET_DEFAULT, NULL, 0);
+                                  window_size, packet_size, NULL, 0);
         if(!session->sftpInit_channel) {
             if(libssh2_session_last_errno(session) == LIBSSH2_ERROR_EAGAIN) {
                 _libssh2_error(session, LIBSSH2_ERROR_EAGAIN,
@@ -989,6 +990,17 @@ static LIBSSH2_SFTP *sftp_init(LIBSSH2_SESSION *session)
  * Startup an SFTP session
  */
 LIBSSH2_API LIBSSH2_SFTP *libssh2_sftp_init(LIBSSH2_SESSION *session)
+{
+    return libssh2_sftp_init_ex(session, LIBSSH2_CHANNEL_WINDOW_DEFAULT,
+                                LIBSSH2_CHANNEL_PACKET_DEFAULT);
+}
+
+/* libssh2_sftp_init_ex
+ * Startup an SFTP session with the given channel window and packet sizes
+ */
+LIBSSH2_API LIBSSH2_SFTP *
+libssh2_sftp_init_ex(LIBSSH2_SESSION *session, unsigned int window_size,
+                     unsigned int packet_size)
 {
     LIBSSH2_SFTP *ptr;
 
@@ -1001,7 +1013,8 @@ LIBSSH2_API LIBSSH2_SFTP *libssh2_sftp_init(LIBSSH2_SESSION *session)
         return NULL;
     }
 
-    BLOCK_ADJUST_ERRNO(ptr, session, sftp_init(session));
+    BLOCK_ADJUST_ERRNO(ptr, session,
+                       sftp_init(session, window_size, packet_size));
     return ptr;
 }
 
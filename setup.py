@@ -4,6 +4,7 @@ from glob import glob
 
 from setuptools import setup, find_packages
 
+from Cython.Build import cythonize
 from Cython.Distutils.extension import Extension
 from Cython.Distutils import build_ext
 
@@ -18,6 +19,8 @@ _libs = ['ssh2', 'ssl', 'crypto', 'z']
 _fwd_default = 0
 _comp_args = ["-O3"]
 _have_agent_fwd = bool(int(os.environ.get('HAVE_AGENT_FWD', _fwd_default)))
+# Link all modules into the single extension ssh2._ssh2 - see ssh2/__init__.py
+_combined = bool(int(os.environ.get('SSH2_COMBINED', 0)))
 
 cython_directives = {
     'embedsignature': True,
@@ -25,6 +28,7 @@ cython_directives = {
     'optimize.use_switch': True,
     'wraparound': False,
     'language_level': "3",
+    'freethreading_compatible': True,
 }
 
 cython_args = {
@@ -50,6 +54,68 @@ extensions = [
               **cython_args)
     for pyx in sources]
 
+
+# Init function of the combined extension, which exports the init functions
+# of all modules and lists them in its ``modules`` attribute.
+_COMBINED_INIT = """\
+#include <Python.h>
+
+static int exec_module(PyObject *module) {
+    PyObject *modules = Py_BuildValue("(%(format)s)", %(names)s);
+    if (modules == NULL)
+        return -1;
+    if (PyModule_AddObject(module, "modules", modules) < 0) {
+        Py_DECREF(modules);
+        return -1;
+    }
+    return 0;
+}
+
+static PyModuleDef_Slot slots[] = {
+    {Py_mod_exec, exec_module},
+#ifdef Py_GIL_DISABLED
+    {Py_mod_gil, Py_MOD_GIL_NOT_USED},
+#endif
+    {0, NULL}
+};
+
+static struct PyModuleDef module = {
+    PyModuleDef_HEAD_INIT, "ssh2._ssh2",
+    "All ssh2 extension modules in one shared object", 0, NULL, slots,
+};
+
+PyMODINIT_FUNC PyInit__ssh2(void) {
+    return PyModuleDef_Init(&module);
+}
+"""
+
+
+def combine(extensions):
+    """Cythonize extensions and link their C sources into one extension."""
+    names = [ext.name.rpartition('.')[2] for ext in extensions]
+    init = os.path.join("build", "_ssh2.c")
+    os.makedirs("build", exist_ok=True)
+    with open(init, "w") as fh:
+        fh.write(_COMBINED_INIT % {
+            "format": "s" * len(names),
+            "names": ", ".join('"%s"' % (name,) for name in names)})
+    sources = [init]
+    for ext in cythonize(extensions,
+                         include_path=cython_args['include_path'],
+                         compiler_directives=cython_directives,
+                         compile_time_env=cython_args['cython_compile_time_env']):
+        sources.extend(ext.sources)
+    return [Extension('ssh2._ssh2',
+                      sources=sources,
+                      include_dirs=include_dirs,
+                      libraries=_libs,
+                      library_dirs=[_lib_dir],
+                      extra_compile_args=_comp_args)]
+
+
+if _combined:
+    extensions = combine(extensions)
+
 package_data = {'ssh2': ['*.pxd']}
 
 
@@ -59,6 +125,7 @@ setup(
     packages=find_packages(
         '.', exclude=('embedded_server', 'embedded_server.*',
                       'tests', 'tests.*',
+                      'benchmarks', 'benchmarks.*',
                       '*.tests', '*.tests.*')),
     zip_safe=False,
     include_package_data=True,
@@ -1,6 +1,65 @@
-from ._version import get_versions
-__version__ = get_versions()['version']
-del get_versions
+"""Python bindings for libssh2.
 
-from . import _version
-__version__ = _version.get_versions()['version']
+Extension modules are imported on first use, either with ``import
+ssh2.session`` or as attributes of the package, ``ssh2.session``.
+
+When built with ``SSH2_COMBINED=1`` all extension modules are linked into the
+single shared object ``ssh2._ssh2``, which is loaded once and from which the
+modules are then initialised as they are imported."""
+
+import sys
+from importlib import import_module
+from importlib.machinery import ExtensionFileLoader, ModuleSpec
+
+try:
+    _ssh2 = import_module('._ssh2', __name__)
+except ModuleNotFoundError as exc:
+    if exc.name != __name__ + '._ssh2':
+        raise
+    _ssh2 = None
+
+
+# Extension modules that can be imported as attributes of the package
+_SUBMODULES = frozenset((
+    'agent', 'channel', 'error_codes', 'exceptions', 'executor', 'fileinfo',
+    'forward', 'iothread', 'knownhost', 'listener', 'multiplex', 'pkey',
+    'publickey', 'reactor', 'session', 'sftp', 'sftp_handle', 'statinfo',
+    'utils',
+))
+
+
+class _CombinedFinder(object):
+    """Finds the extension modules of the package in the shared object of a
+    combined build."""
+
+    def __init__(self, path, modules):
+        self.path = path
+        self.modules = frozenset(modules)
+
+    def find_spec(self, fullname, path=None, target=None):
+        package, _, name = fullname.rpartition('.')
+        if package != __name__ or name not in self.modules:
+            return None
+        spec = ModuleSpec(fullname, ExtensionFileLoader(fullname, self.path),
+                          origin=self.path)
+        spec.has_location = True
+        return spec
+
+
+if _ssh2 is not None:
+    sys.meta_path.insert(0, _CombinedFinder(_ssh2.__file__, _ssh2.modules))
+
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        return import_module('.' + name, __name__)
+    if name == '__version__':
+        # Finding the version may run git, so is left until asked for
+        from ._version import get_versions
+        version = globals()['__version__'] = get_versions()['version']
+        return version
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | _SUBMODULES | {'__version__'})
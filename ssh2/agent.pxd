@@ -26,6 +26,21 @@ cdef class Agent:
     cdef Session _session
 
 
+cdef class SharedAgent:
+    cdef c_ssh2.LIBSSH2_AGENT *_agent
+    cdef Session _owner
+    cdef bint _connected
+    cdef readonly double ttl
+    cdef double _listed
+    cdef list _identities
+    cdef dict _history
+    cdef object _lock
+
+    cdef int _connect(self) except -1
+    cdef list _get_identities(self, bint refresh)
+    cdef c_ssh2.libssh2_agent_publickey *_identity_at(self, Py_ssize_t index)
+
+
 cdef int auth_identity(const char *username,
                        c_ssh2.LIBSSH2_AGENT *agent,
                        c_ssh2.libssh2_agent_publickey **identity,
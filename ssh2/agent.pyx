@@ -15,7 +15,10 @@
 # License along with this library; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
 
-from ssh2.pkey cimport PublicKey, PyPublicKey
+from _thread import allocate_lock
+from time import monotonic
+
+from ssh2.pkey cimport PublicKey, PyPublicKey, PyPublicKeyCopy
 from ssh2.utils cimport to_bytes
 
 from .exceptions import AgentConnectionError, AgentListIdentitiesError, \
@@ -140,7 +143,8 @@ cdef class Agent:
         cdef int rc
         cdef bytes b_username = to_bytes(username)
         cdef char *_username = b_username
-
+        if pkey._pkey is NULL or pkey._pkey.node is NULL:
+            raise ValueError("Public key was not listed by an agent")
         with nogil:
             rc = c_ssh2.libssh2_agent_userauth(self._agent, _username, pkey._pkey)
             if rc != 0 and rc != c_ssh2.LIBSSH2_ERROR_EAGAIN:
@@ -171,3 +175,189 @@ cdef class Agent:
         if rc != 0:
             raise AgentConnectionError("Unable to connect to agent")
         return rc
+
+
+# Hosts remembered per shared agent for ordering identities
+DEF _MAX_HISTORY = 4096
+DEF _SHARED_AGENT_EMBEDDED = (
+    "SharedAgent needs libssh2_agent_set_session of the embedded libssh2")
+
+
+cdef class SharedAgent:
+    """SSH agent connection and identity list shared by many sessions.
+
+    :py:func:`ssh2.session.Session.agent_auth` connects to the agent and lists
+    its identities for every session. A shared agent stays connected, lists
+    identities at most once per ``ttl`` seconds and remembers, per host and
+    user, the identity that last authenticated successfully so that it is
+    tried first next time.
+
+    Authentication through a shared agent is serialised, as it uses a single
+    agent connection. Sessions must be in blocking mode while authenticating.
+
+    Needs the embedded libssh2, and raises :py:class:`NotImplementedError`
+    when built against a system libssh2.
+
+    :param ttl: Time in seconds identities are cached for before being
+      listed from the agent again.
+    :type ttl: float"""
+
+    def __cinit__(self, double ttl=300):
+        IF not EMBEDDED_LIB:
+            raise NotImplementedError(_SHARED_AGENT_EMBEDDED)
+        self._owner = Session()
+        with nogil:
+            self._agent = agent_init(self._owner._session)
+        self._connected = False
+        self.ttl = ttl
+        self._listed = 0
+        self._identities = None
+        self._history = {}
+        self._lock = allocate_lock()
+
+    def __dealloc__(self):
+        if self._agent is not NULL:
+            with nogil:
+                clear_agent(self._agent)
+
+    cdef int _connect(self) except -1:
+        cdef int rc
+        if self._connected:
+            with nogil:
+                c_ssh2.libssh2_agent_disconnect(self._agent)
+            self._connected = False
+        with nogil:
+            rc = c_ssh2.libssh2_agent_connect(self._agent)
+        if rc != 0:
+            raise AgentConnectionError("Unable to connect to agent")
+        self._connected = True
+        return 0
+
+    cdef list _get_identities(self, bint refresh):
+        # Called with the lock held
+        cdef int rc = -1
+        cdef int attempt
+        cdef list identities = []
+        cdef c_ssh2.libssh2_agent_publickey *identity = NULL
+        cdef c_ssh2.libssh2_agent_publickey *prev = NULL
+        if not refresh and self._identities is not None and \
+                monotonic() - self._listed < self.ttl:
+            return self._identities
+        # Frees the identities of the previous listing, so keys handed out
+        # are copies that do not refer to them
+        self._identities = None
+        for attempt in range(2):
+            if not self._connected or attempt > 0:
+                # Reconnect once in case the agent was restarted.
+                self._connect()
+            with nogil:
+                rc = c_ssh2.libssh2_agent_list_identities(self._agent)
+            if rc == 0:
+                break
+        if rc != 0:
+            raise AgentListIdentitiesError(
+                "Failure requesting identities from agent")
+        while c_ssh2.libssh2_agent_get_identity(
+                self._agent, &identity, prev) == 0:
+            identities.append(PyPublicKeyCopy(identity))
+            prev = identity
+        self._identities = identities
+        self._listed = monotonic()
+        return identities
+
+    cdef c_ssh2.libssh2_agent_publickey *_identity_at(self, Py_ssize_t index):
+        # Identity of the current listing at index of the cached identities,
+        # which are in listing order. Called with the lock held.
+        cdef c_ssh2.libssh2_agent_publickey *identity = NULL
+        cdef c_ssh2.libssh2_agent_publickey *prev = NULL
+        cdef Py_ssize_t i
+        for i in range(index + 1):
+            if c_ssh2.libssh2_agent_get_identity(
+                    self._agent, &identity, prev) != 0:
+                return NULL
+            prev = identity
+        return identity
+
+    def get_identities(self, bint refresh=False):
+        """Get identities from agent, listing them only if the cached list is
+        older than ``ttl`` or ``refresh`` is set.
+
+        Keys returned own a copy of their data and stay valid after
+        identities are listed again.
+
+        :raises: :py:class:`ssh2.exceptions.AgentConnectionError` on errors
+          connecting to agent.
+        :raises: :py:class:`ssh2.exceptions.AgentListIdentitiesError` on
+          errors listing identities.
+
+        :rtype: list(:py:class:`ssh2.pkey.PublicKey`)"""
+        with self._lock:
+            return list(self._get_identities(refresh))
+
+    def userauth(self, Session session not None, username not None, host=None):
+        """Authenticate session as user with the agent's identities, trying
+        the identity last successful for host first.
+
+        :param session: Session to authenticate. Must be in blocking mode.
+        :type session: :py:class:`ssh2.session.Session`
+        :param username: User name to authenticate as.
+        :type username: str
+        :param host: Key for the success history, for example the host name.
+          Defaults to the address of the session's socket peer, if any.
+        :type host: str
+
+        :raises: :py:class:`ssh2.exceptions.AgentConnectionError` on errors
+          connecting to agent.
+        :raises: :py:class:`ssh2.exceptions.AgentListIdentitiesError` on
+          errors listing identities.
+        :raises: :py:class:`ssh2.exceptions.AgentAuthenticationError` on no
+          successful authentication with all available identities.
+
+        :returns: The identity authenticated with.
+        :rtype: :py:class:`ssh2.pkey.PublicKey`"""
+        cdef bytes b_username = to_bytes(username)
+        cdef char *_username = b_username
+        cdef c_ssh2.LIBSSH2_SESSION *_session = session._session
+        cdef c_ssh2.LIBSSH2_SESSION *_owner = self._owner._session
+        cdef c_ssh2.libssh2_agent_publickey *identity
+        cdef PublicKey pkey
+        cdef list identities
+        cdef list order
+        cdef Py_ssize_t index
+        cdef tuple key
+        cdef bytes last
+        cdef int rc
+        if host is None:
+            try:
+                host = session.sock.getpeername()[0]
+            except (AttributeError, OSError):
+                pass
+        key = (host, b_username)
+        with self._lock:
+            identities = self._get_identities(False)
+            order = list(range(len(identities)))
+            last = self._history.get(key)
+            if last is not None:
+                order.sort(key=lambda i: identities[i].blob != last)
+            for index in order:
+                pkey = identities[index]
+                identity = self._identity_at(index)
+                if identity is NULL:
+                    break
+                IF EMBEDDED_LIB:
+                    with nogil:
+                        c_ssh2.libssh2_agent_set_session(self._agent, _session)
+                        rc = c_ssh2.libssh2_agent_userauth(
+                            self._agent, _username, identity)
+                        c_ssh2.libssh2_agent_set_session(self._agent, _owner)
+                ELSE:
+                    raise NotImplementedError(_SHARED_AGENT_EMBEDDED)
+                if rc == 0:
+                    if host is not None:
+                        self._history.pop(key, None)
+                        if len(self._history) >= _MAX_HISTORY:
+                            del self._history[next(iter(self._history))]
+                        self._history[key] = pkey.blob
+                    return pkey
+        raise AgentAuthenticationError(
+            "No identities match for user %s", username)
@@ -0,0 +1,98 @@
+# This file is part of ssh2-python.
+# Copyright (C) 2017 Panos Kittenis
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, version 2.1.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+# OpenSSL is the crypto backend of the embedded libssh2 and is already linked
+# into every extension module.
+
+cdef extern from * nogil:
+    """
+    /* The low level digest functions are deprecated in OpenSSL 3 but remain
+       the cheapest way to resume a digest from a saved state. */
+    #define OPENSSL_SUPPRESS_DEPRECATED
+    #include <openssl/sha.h>
+    """
+    ctypedef unsigned int SHA_LONG
+    ctypedef struct SHA_CTX:
+        SHA_LONG h0, h1, h2, h3, h4
+        SHA_LONG Nl, Nh
+        unsigned int num
+    enum:
+        SHA_DIGEST_LENGTH
+        SHA_CBLOCK
+    int SHA1_Init(SHA_CTX *c)
+    int SHA1_Update(SHA_CTX *c, const void *data, size_t length)
+    int SHA1_Final(unsigned char *md, SHA_CTX *c)
+    unsigned char *SHA1(const unsigned char *d, size_t n, unsigned char *md)
+
+
+cdef extern from "openssl/evp.h" nogil:
+    ctypedef struct EVP_CIPHER:
+        pass
+    ctypedef struct EVP_CIPHER_CTX:
+        pass
+    ctypedef struct EVP_PKEY:
+        pass
+    const EVP_CIPHER *EVP_aes_128_ctr()
+    const EVP_CIPHER *EVP_aes_192_ctr()
+    const EVP_CIPHER *EVP_aes_256_ctr()
+    const EVP_CIPHER *EVP_aes_128_cbc()
+    const EVP_CIPHER *EVP_aes_192_cbc()
+    const EVP_CIPHER *EVP_aes_256_cbc()
+    EVP_CIPHER_CTX *EVP_CIPHER_CTX_new()
+    void EVP_CIPHER_CTX_free(EVP_CIPHER_CTX *ctx)
+    int EVP_CIPHER_CTX_set_padding(EVP_CIPHER_CTX *ctx, int pad)
+    int EVP_DecryptInit_ex(EVP_CIPHER_CTX *ctx, const EVP_CIPHER *cipher,
+                           void *impl, const unsigned char *key,
+                           const unsigned char *iv)
+    int EVP_DecryptUpdate(EVP_CIPHER_CTX *ctx, unsigned char *out, int *outl,
+                          const unsigned char *_in, int inl)
+    int EVP_DecryptFinal_ex(EVP_CIPHER_CTX *ctx, unsigned char *outm, int *outl)
+    int EVP_EncodeBlock(unsigned char *t, const unsigned char *f, int n)
+    void EVP_PKEY_free(EVP_PKEY *pkey)
+
+
+cdef extern from "openssl/crypto.h" nogil:
+    void OPENSSL_cleanse(void *ptr, size_t len)
+
+
+cdef extern from "openssl/bio.h" nogil:
+    ctypedef struct BIO:
+        pass
+    ctypedef struct BIO_METHOD:
+        pass
+    BIO *BIO_new(const BIO_METHOD *type)
+    BIO *BIO_new_mem_buf(const void *buf, int len)
+    const BIO_METHOD *BIO_s_secmem()
+    long BIO_get_mem_data(BIO *b, char **pp)
+    int BIO_free(BIO *a)
+
+
+cdef extern from "openssl/pem.h" nogil:
+    ctypedef int pem_password_cb(char *buf, int size, int rwflag, void *u)
+    EVP_PKEY *PEM_read_bio_PrivateKey(BIO *bp, EVP_PKEY **x,
+                                      pem_password_cb *cb, void *u)
+    int PEM_write_bio_PrivateKey(BIO *bp, const EVP_PKEY *x,
+                                 const EVP_CIPHER *enc,
+                                 const unsigned char *kstr, int klen,
+                                 pem_password_cb *cb, void *u)
+    int PEM_write_bio_PrivateKey_traditional(BIO *bp, const EVP_PKEY *x,
+                                             const EVP_CIPHER *enc,
+                                             const unsigned char *kstr, int klen,
+                                             pem_password_cb *cb, void *u)
+
+
+cdef extern from "openssl/err.h" nogil:
+    void ERR_clear_error()
@@ -87,6 +87,11 @@ cdef extern from "libssh2_sftp.h" nogil:
     int LIBSSH2_SFTP_S_ISFIFO(unsigned long m)
     int LIBSSH2_SFTP_S_ISSOCK(unsigned long m)
     LIBSSH2_SFTP *libssh2_sftp_init(LIBSSH2_SESSION *session)
+    IF EMBEDDED_LIB:
+        # Added to the embedded libssh2, see patches/
+        LIBSSH2_SFTP *libssh2_sftp_init_ex(LIBSSH2_SESSION *session,
+                                           unsigned int window_size,
+                                           unsigned int packet_size)
     int libssh2_sftp_shutdown(LIBSSH2_SFTP *sftp)
     unsigned long libssh2_sftp_last_error(LIBSSH2_SFTP *sftp)
     LIBSSH2_CHANNEL *libssh2_sftp_get_channel(LIBSSH2_SFTP *sftp)
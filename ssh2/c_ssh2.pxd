@@ -26,6 +26,8 @@ cdef extern from "libssh2.h" nogil:
     enum:
         LIBSSH2_SESSION_BLOCK_INBOUND
         LIBSSH2_SESSION_BLOCK_OUTBOUND
+        LIBSSH2_CALLBACK_SEND
+        LIBSSH2_CALLBACK_RECV
         LIBSSH2_VERSION_MAJOR
         LIBSSH2_VERSION_MINOR
         LIBSSH2_VERSION_PATCH
@@ -355,6 +357,12 @@ cdef extern from "libssh2.h" nogil:
     int libssh2_base64_decode(LIBSSH2_SESSION *session, char **dest,
                               unsigned int *dest_len,
                               const char *src, unsigned int src_len)
+    IF EMBEDDED_LIB:
+        # Added to the embedded libssh2, see patches/
+        int libssh2_bcrypt_pbkdf(const char *passphrase, size_t passlen,
+                                 const unsigned char *salt, size_t saltlen,
+                                 unsigned char *key, size_t keylen,
+                                 unsigned int rounds)
     const char *libssh2_version(int req_version_num)
 
     # Known host API
@@ -423,6 +431,10 @@ cdef extern from "libssh2.h" nogil:
         LIBSSH2_KNOWNHOST_KEY_SSHDSS
     IF EMBEDDED_LIB:
         enum:
+            LIBSSH2_KNOWNHOST_KEY_ECDSA_256
+            LIBSSH2_KNOWNHOST_KEY_ECDSA_384
+            LIBSSH2_KNOWNHOST_KEY_ECDSA_521
+            LIBSSH2_KNOWNHOST_KEY_ED25519
             LIBSSH2_KNOWNHOST_KEY_UNKNOWN
 
     # Public Key API
@@ -443,6 +455,10 @@ cdef extern from "libssh2.h" nogil:
                                libssh2_agent_publickey *identity)
     int libssh2_agent_disconnect(LIBSSH2_AGENT *agent)
     void libssh2_agent_free(LIBSSH2_AGENT *agent)
+    IF EMBEDDED_LIB:
+        # Added to the embedded libssh2, see patches/
+        LIBSSH2_SESSION *libssh2_agent_set_session(LIBSSH2_AGENT *agent,
+                                                   LIBSSH2_SESSION *session)
     void libssh2_keepalive_config(LIBSSH2_SESSION *session,
                                   int want_reply,
                                   unsigned interval)
@@ -17,10 +17,33 @@
 
 from ssh2.session cimport Session
 from ssh2 cimport c_ssh2
+from ssh2.utils cimport scratch_buffer
 
 cdef object PyChannel(c_ssh2.LIBSSH2_CHANNEL *channel, Session session)
 
 
+# Receive window tuning from the channel's round trip time and drain rate
+cdef struct _window_tuner:
+    unsigned long window
+    unsigned long max_window
+    double rtt
+    double sample_start
+    size_t sample_bytes
+    unsigned long pending
+
+
 cdef class Channel:
     cdef c_ssh2.LIBSSH2_CHANNEL *_channel
     cdef Session _session
+    cdef _window_tuner _tuner
+    cdef scratch_buffer _scratch
+    # Output read by expect and not matched yet, of which the first
+    # _expect_scan bytes were searched for the _expect_searched patterns
+    cdef bytearray _expect_buf
+    cdef Py_ssize_t _expect_scan
+    cdef list _expect_searched
+
+    cdef void _init_window(self, unsigned long window_size,
+                           unsigned long max_window_size, double rtt) noexcept
+    cdef tuple _expect_feed(self, list compiled, bytes data,
+                            Py_ssize_t max_match)
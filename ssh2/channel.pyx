@@ -15,11 +15,16 @@
 # License along with this library; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
 
-from cpython.mem cimport PyMem_RawMalloc, PyMem_RawFree
+from cpython.buffer cimport PyObject_GetBuffer, PyBuffer_Release, PyBUF_WRITABLE
+from cpython.bytes cimport PyBytes_AS_STRING
+from cpython.bytearray cimport PyByteArray_AS_STRING
+from cpython.ref cimport PyObject, Py_XDECREF
 
-from ssh2.session cimport Session
-from ssh2.exceptions import ChannelError
-from ssh2.utils cimport to_bytes, handle_error_codes
+from ssh2.session cimport Session, _session_call, session_lock, session_unlock, \
+    session_again, session_again_size, session_blocking
+from ssh2.exceptions import ChannelError, Timeout
+from ssh2.utils cimport to_bytes, handle_error_codes, monotonic_time, \
+    scratch_acquire, scratch_release, scratch_clear, new_bytes, finish_bytes
 
 from ssh2 cimport c_ssh2
 from ssh2 cimport sftp
@@ -27,6 +32,83 @@ from ssh2 cimport error_codes
 
 cimport cython
 
+
+# Drain rate is measured over at least this many round trips and seconds
+DEF _SAMPLE_RTTS = 4
+DEF _MIN_SAMPLE_TIME = 0.05
+
+# Returned as is on EAGAIN so that retrying a read allocates nothing
+cdef object _EAGAIN = c_ssh2.LIBSSH2_ERROR_EAGAIN
+cdef tuple _EAGAIN_READ = (c_ssh2.LIBSSH2_ERROR_EAGAIN, b'')
+
+
+cdef list _expect_patterns(patterns):
+    import re
+    if isinstance(patterns, (bytes, str)) or hasattr(patterns, 'search'):
+        patterns = (patterns,)
+    cdef list compiled = [
+        pattern if hasattr(pattern, 'search') else re.compile(to_bytes(pattern))
+        for pattern in patterns]
+    if not compiled:
+        raise ValueError("No patterns given")
+    return compiled
+
+
+cdef tuple _expect_search(list compiled, object buf, Py_ssize_t start):
+    """Earliest match of any of the patterns from start onwards, first
+    pattern given on a tie."""
+    cdef Py_ssize_t index
+    best = None
+    best_index = -1
+    for index in range(len(compiled)):
+        match = compiled[index].search(buf, start)
+        if match is not None and (best is None or match.start() < best.start()):
+            best = match
+            best_index = index
+    if best is None:
+        return None
+    return best_index, best
+
+
+cdef int _keep_window(_window_tuner *tuner,
+                      c_ssh2.LIBSSH2_CHANNEL *channel) noexcept nogil:
+    """Top the receive window up to its target size once a quarter of it
+    is used. Returns 0 or a negative error code - an adjustment returning
+    EAGAIN is resent by the next call."""
+    cdef unsigned long remaining
+    cdef unsigned int window
+    cdef int rc
+    if tuner.pending == 0:
+        remaining = c_ssh2.libssh2_channel_window_read(channel)
+        if remaining >= tuner.window - tuner.window // 4:
+            return 0
+        tuner.pending = tuner.window - remaining
+    rc = c_ssh2.libssh2_channel_receive_window_adjust2(
+        channel, tuner.pending, 1, &window)
+    if rc != c_ssh2.LIBSSH2_ERROR_EAGAIN:
+        tuner.pending = 0
+    return rc
+
+
+cdef void _sample_window(_window_tuner *tuner, size_t nread) noexcept nogil:
+    """Grow the receive window target to twice the bandwidth delay product
+    measured from the drain rate. When the window is what limits the
+    transfer, the measured product is close to the window, which doubles
+    it until the window stops being the limit."""
+    cdef double now = monotonic_time()
+    cdef double elapsed = now - tuner.sample_start
+    cdef double target
+    tuner.sample_bytes += nread
+    if elapsed < _MIN_SAMPLE_TIME or elapsed < tuner.rtt * _SAMPLE_RTTS:
+        return
+    target = 2 * tuner.sample_bytes / elapsed * tuner.rtt
+    if target > tuner.window:
+        tuner.window = tuner.max_window if target > tuner.max_window \
+            else <unsigned long>target
+    tuner.sample_start = now
+    tuner.sample_bytes = 0
+
+
 cdef object PyChannel(c_ssh2.LIBSSH2_CHANNEL *channel, Session session):
     cdef Channel _channel = Channel.__new__(Channel, session)
     _channel._channel = channel
@@ -40,15 +122,65 @@ cdef class Channel:
         self._session = session
 
     def __dealloc__(self):
+        cdef _session_call call
+        cdef int rc
         if self._channel is not NULL:
-            c_ssh2.libssh2_channel_free(self._channel)
+            with nogil:
+                session_lock(&self._session._state, &call, NULL)
+                rc = c_ssh2.libssh2_channel_free(self._channel)
+                while session_again(&self._session._state, &call, &rc):
+                    rc = c_ssh2.libssh2_channel_free(self._channel)
         self._channel = NULL
+        scratch_clear(&self._scratch)
+
+    cdef void _init_window(self, unsigned long window_size,
+                           unsigned long max_window_size, double rtt) noexcept:
+        self._tuner.window = window_size
+        self._tuner.max_window = max_window_size
+        self._tuner.rtt = rtt
+        self._tuner.sample_start = monotonic_time()
 
     @property
     def session(self):
         """Originating session."""
         return self._session
 
+    @property
+    def rtt(self):
+        """Round trip time measured when opening the channel, in seconds, or
+        ``None`` if not measured.
+
+        :rtype: float"""
+        if self._tuner.rtt == 0:
+            return None
+        return self._tuner.rtt
+
+    @property
+    def max_window_size(self):
+        """Size up to which the receive window is grown automatically, zero
+        if it is not.
+
+        :rtype: int"""
+        return self._tuner.max_window
+
+    @property
+    def receive_window_size(self):
+        """Receive window size kept open for the remote side to send into.
+        Grows with the measured bandwidth delay product up to
+        :py:attr:`max_window_size` when automatic tuning is on.
+
+        :rtype: int"""
+        cdef unsigned long window_size_initial = 0
+        cdef _session_call call
+        if self._tuner.max_window != 0:
+            return self._tuner.window
+        with nogil:
+            session_lock(&self._session._state, &call, NULL)
+            c_ssh2.libssh2_channel_window_read_ex(
+                self._channel, NULL, &window_size_initial)
+            session_unlock(&self._session._state, &call)
+        return window_size_initial
+
     def pty(self, term="vt100"):
         """Request a PTY (physical terminal emulation) on the channel.
 
@@ -58,9 +190,15 @@ cdef class Channel:
         cdef bytes b_term = to_bytes(term)
         cdef const char *_term = b_term
         cdef int rc
+        cdef _session_call call
         with nogil:
+            session_lock(&self._session._state, &call,
+                         &self._session._state.lock.op)
             rc = c_ssh2.libssh2_channel_request_pty(
                 self._channel, _term)
+            while session_again(&self._session._state, &call, &rc):
+                rc = c_ssh2.libssh2_channel_request_pty(
+                    self._channel, _term)
         return handle_error_codes(rc)
 
     def execute(self, command not None, env=None):
@@ -82,18 +220,36 @@ cdef class Channel:
         cdef char *_command = b_command
         cdef bytes b_varname
         cdef bytes b_value
+        cdef const char *_varname
+        cdef const char *_value
+        cdef unsigned int varname_len, value_len
+        cdef _session_call call
 
         if env is not None:
             for key, value in env.items():
                 b_varname = to_bytes(key)
                 b_value = to_bytes(value)
-                c_ssh2.libssh2_channel_setenv_ex(self._channel,
-                                                 b_varname, len(b_varname),
-                                                 b_value, len(b_value))
+                _varname = b_varname
+                _value = b_value
+                varname_len = len(b_varname)
+                value_len = len(b_value)
+                with nogil:
+                    session_lock(&self._session._state, &call,
+                                 &self._session._state.lock.op)
+                    rc = c_ssh2.libssh2_channel_setenv_ex(
+                        self._channel, _varname, varname_len, _value, value_len)
+                    while session_again(&self._session._state, &call, &rc):
+                        rc = c_ssh2.libssh2_channel_setenv_ex(
+                            self._channel, _varname, varname_len, _value, value_len)
 
         with nogil:
+            session_lock(&self._session._state, &call,
+                         &self._session._state.lock.op)
             rc = c_ssh2.libssh2_channel_exec(
                 self._channel, _command)
+            while session_again(&self._session._state, &call, &rc):
+                rc = c_ssh2.libssh2_channel_exec(
+                    self._channel, _command)
         return handle_error_codes(rc)
 
     def subsystem(self, subsystem not None):
@@ -104,9 +260,15 @@ cdef class Channel:
         cdef int rc
         cdef bytes b_subsystem = to_bytes(subsystem)
         cdef char *_subsystem = b_subsystem
+        cdef _session_call call
         with nogil:
+            session_lock(&self._session._state, &call,
+                         &self._session._state.lock.op)
             rc = c_ssh2.libssh2_channel_subsystem(
                 self._channel, _subsystem)
+            while session_again(&self._session._state, &call, &rc):
+                rc = c_ssh2.libssh2_channel_subsystem(
+                    self._channel, _subsystem)
         return handle_error_codes(rc)
 
     def shell(self):
@@ -116,8 +278,13 @@ cdef class Channel:
           interactive shell.
         """
         cdef int rc
+        cdef _session_call call
         with nogil:
+            session_lock(&self._session._state, &call,
+                         &self._session._state.lock.op)
             rc = c_ssh2.libssh2_channel_shell(self._channel)
+            while session_again(&self._session._state, &call, &rc):
+                rc = c_ssh2.libssh2_channel_shell(self._channel)
         return handle_error_codes(rc)
 
     def read(self, size_t size=1024):
@@ -145,23 +312,105 @@ cdef class Channel:
 
         :rtype: (int, bytes)"""
         cdef bytes buf = b''
-        cdef char *cbuf
-        cdef ssize_t rc
+        cdef char *cbuf = NULL
+        cdef PyObject *raw = NULL
+        cdef unsigned long queued = 0
+        cdef ssize_t rc = 0
+        cdef _session_call call
         with nogil:
-            cbuf = <char *>PyMem_RawMalloc(sizeof(char)*size)
-            if cbuf is NULL:
-                with gil:
+            if self._tuner.max_window != 0:
+                session_lock(&self._session._state, &call, NULL)
+                rc = _keep_window(&self._tuner, self._channel)
+                while session_again_size(&self._session._state, &call, &rc):
+                    rc = _keep_window(&self._tuner, self._channel)
+            if rc == 0:
+                session_lock(&self._session._state, &call, NULL)
+                c_ssh2.libssh2_channel_window_read_ex(
+                    self._channel, &queued, NULL)
+                session_unlock(&self._session._state, &call)
+        if rc == 0:
+            if queued < size:
+                # Less than size is known to be there - possibly EAGAIN or a
+                # short read - so use the scratch buffer and copy out only
+                # what is read. The read still gets all of size, as more may
+                # arrive while reading.
+                cbuf = scratch_acquire(&self._scratch, size)
+                if cbuf is NULL:
                     raise MemoryError
-            rc = c_ssh2.libssh2_channel_read_ex(
-                self._channel, stream_id, cbuf, size)
-        try:
-            if rc > 0:
-                buf = cbuf[:rc]
-        finally:
-            PyMem_RawFree(cbuf)
+            else:
+                # Read straight into the returned bytes
+                raw = new_bytes(size)
+                cbuf = PyBytes_AS_STRING(<object>raw)
+            with nogil:
+                session_lock(&self._session._state, &call, NULL)
+                rc = c_ssh2.libssh2_channel_read_ex(
+                    self._channel, stream_id, cbuf, size)
+                while session_again_size(&self._session._state, &call, &rc):
+                    rc = c_ssh2.libssh2_channel_read_ex(
+                        self._channel, stream_id, cbuf, size)
+                if rc > 0 and self._tuner.max_window != 0:
+                    _sample_window(&self._tuner, rc)
+            if raw is not NULL:
+                if rc > 0:
+                    buf = finish_bytes(raw, rc)
+                else:
+                    Py_XDECREF(raw)
+            else:
+                try:
+                    if rc > 0:
+                        buf = cbuf[:rc]
+                finally:
+                    scratch_release(&self._scratch, cbuf)
+        if rc == c_ssh2.LIBSSH2_ERROR_EAGAIN:
+            return _EAGAIN_READ
+        elif rc == 0:
+            # Nothing left to read, do not hold on to the buffer
+            scratch_clear(&self._scratch)
         handle_error_codes(rc)
         return rc, buf
 
+    def read_into(self, buffer not None, int stream_id=0):
+        """Read the stream with given id into a writable buffer.
+
+        Allocation free alternative to :py:func:`read_ex` for non-blocking
+        clients - neither a bytes object nor a tuple is created, including on
+        ``LIBSSH2_ERROR_EAGAIN``.
+
+        Return code is the number of bytes written to ``buffer`` when
+        positive, zero on end of file. Negative values are error codes.
+
+        :param buffer: Writable contiguous buffer, for example a
+          ``bytearray`` or a ``memoryview`` of one.
+        :param stream_id: Id of stream to read.
+        :type stream_id: int
+
+        :rtype: int"""
+        cdef Py_buffer view
+        cdef ssize_t rc = 0
+        cdef _session_call call
+        PyObject_GetBuffer(buffer, &view, PyBUF_WRITABLE)
+        with nogil:
+            if self._tuner.max_window != 0:
+                session_lock(&self._session._state, &call, NULL)
+                rc = _keep_window(&self._tuner, self._channel)
+                while session_again_size(&self._session._state, &call, &rc):
+                    rc = _keep_window(&self._tuner, self._channel)
+            if rc == 0:
+                session_lock(&self._session._state, &call, NULL)
+                rc = c_ssh2.libssh2_channel_read_ex(
+                    self._channel, stream_id, <char *>view.buf, view.len)
+                while session_again_size(&self._session._state, &call, &rc):
+                    rc = c_ssh2.libssh2_channel_read_ex(
+                        self._channel, stream_id, <char *>view.buf, view.len)
+                if rc > 0 and self._tuner.max_window != 0:
+                    _sample_window(&self._tuner, rc)
+        PyBuffer_Release(&view)
+        if rc == c_ssh2.LIBSSH2_ERROR_EAGAIN:
+            return _EAGAIN
+        elif rc < 0:
+            handle_error_codes(rc)
+        return rc
+
     def read_stderr(self, size_t size=1024):
         """Read the stderr stream.
         Returns return code and output buffer tuple.
@@ -173,13 +422,153 @@ cdef class Channel:
         return self.read_ex(
             size=size, stream_id=c_ssh2.SSH_EXTENDED_DATA_STDERR)
 
+    def expect(self, patterns not None, timeout=None, Py_ssize_t max_match=4096,
+               size_t size=65536):
+        """Read the stdout stream until output matches one of the given
+        regular expressions, for example a prompt of a shell started with
+        :py:func:`pty` and :py:func:`shell`.
+
+        Output read is kept on the channel and only output read since the
+        last search for the same patterns is searched, plus the last
+        ``max_match`` bytes before it, so waiting costs the same however much
+        output came before the match. Output after a match is kept for the
+        next call. The match is made on a copy of the output searched, so its
+        positions are relative to its ``string`` rather than to the output
+        before it.
+
+        In non-blocking mode returns ``LIBSSH2_ERROR_EAGAIN`` when there is
+        no match in the output available so far - wait on the socket and call
+        again.
+
+        :param patterns: Pattern or list of patterns to match, as ``bytes``
+          or ``str`` regular expressions or compiled ``bytes`` ones.
+        :param timeout: Seconds to wait for a match in blocking mode,
+          defaults to the session's timeout. Applies to the session as a whole
+          while waiting.
+        :type timeout: float
+        :param max_match: Longest match, including any look behind, that is
+          still found when split across reads.
+        :type max_match: int
+        :param size: Max buffer size to read.
+        :type size: int
+
+        :returns: Tuple of the index of the pattern matched, the match and the
+          output before it, or ``None`` on end of stdout without a match.
+        :rtype: (int, :py:class:`re.Match`, bytes)
+        :raises: :py:class:`ssh2.exceptions.Timeout` if timeout expires
+          without a match."""
+        cdef list compiled = _expect_patterns(patterns)
+        cdef tuple result
+        cdef double deadline = 0
+        cdef long previous_timeout = 0
+        cdef long remaining
+        cdef bint limited
+        if max_match <= 0:
+            raise ValueError("max_match must be greater than zero")
+        if timeout is not None and timeout <= 0:
+            raise ValueError("timeout must be greater than zero")
+        result = self._expect_feed(compiled, b'', max_match)
+        if result is not None:
+            return result
+        limited = timeout is not None and session_blocking(&self._session._state)
+        if limited:
+            deadline = monotonic_time() + timeout
+            previous_timeout = c_ssh2.libssh2_session_get_timeout(
+                self._session._session)
+        try:
+            while result is None:
+                if limited:
+                    remaining = <long>((deadline - monotonic_time()) * 1000)
+                    if remaining <= 0:
+                        raise Timeout("Timed out waiting for a match")
+                    if 0 < previous_timeout < remaining:
+                        remaining = previous_timeout
+                    c_ssh2.libssh2_session_set_timeout(
+                        self._session._session, remaining)
+                rc, data = self.read_ex(size)
+                if rc == c_ssh2.LIBSSH2_ERROR_EAGAIN:
+                    return rc
+                elif rc == 0:
+                    # End of stdout - stderr still queued keeps eof() false
+                    return None
+                result = self._expect_feed(compiled, data, max_match)
+        finally:
+            if limited:
+                c_ssh2.libssh2_session_set_timeout(
+                    self._session._session, previous_timeout)
+        return result
+
+    cdef tuple _expect_feed(self, list compiled, bytes data,
+                            Py_ssize_t max_match):
+        """Add output read to the expect buffer and search the part not
+        searched for these patterns yet. Consumes the output up to the end of
+        the earliest match and returns the result for :py:func:`expect`."""
+        cdef bytearray buf
+        cdef bytes window
+        cdef bytes before
+        cdef tuple found
+        cdef Py_ssize_t start
+        cdef Py_ssize_t base
+        cdef Py_ssize_t end
+        cdef Py_ssize_t match_start
+        cdef Py_ssize_t match_end
+        with cython.critical_section(self):
+            if self._expect_buf is None:
+                self._expect_buf = bytearray()
+            buf = self._expect_buf
+            if compiled != self._expect_searched:
+                self._expect_searched = compiled
+                self._expect_scan = 0
+            elif not data and self._expect_scan == len(buf):
+                return None
+            buf += data
+            end = len(buf)
+            start = max(0, self._expect_scan - max_match)
+            # Searched as an immutable copy, so that the match returned does
+            # not change with the buffer. One byte before the start is kept
+            # for anchors and word boundaries at it.
+            base = max(0, start - 1)
+            window = PyByteArray_AS_STRING(buf)[base:end]
+        # Pattern matching calls back into Python, so is done outside of the
+        # critical section on the copy
+        found = _expect_search(compiled, window, start - base)
+        if found is None:
+            with cython.critical_section(self):
+                self._expect_scan = end
+            return None
+        match = found[1]
+        match_start = base + match.start()
+        match_end = base + match.end()
+        with cython.critical_section(self):
+            before = PyByteArray_AS_STRING(buf)[:match_start]
+            del buf[:match_end]
+            # Output left after the match was not searched from its start
+            self._expect_scan = 0
+        return found[0], match, before
+
+    def flush_expect(self):
+        """Discard output read by :py:func:`expect` and not matched yet.
+
+        :returns: Output discarded.
+        :rtype: bytes"""
+        with cython.critical_section(self):
+            if self._expect_buf is None:
+                return b''
+            data = bytes(self._expect_buf)
+            self._expect_buf = None
+            self._expect_scan = 0
+        return data
+
     def eof(self):
         """Get channel EOF status.
 
         :rtype: bool"""
         cdef int rc
+        cdef _session_call call
         with nogil:
+            session_lock(&self._session._state, &call, NULL)
             rc = c_ssh2.libssh2_channel_eof(self._channel)
+            session_unlock(&self._session._state, &call)
         return bool(rc)
 
     def send_eof(self):
@@ -193,8 +582,12 @@ cdef class Channel:
         :rtype: int
         """
         cdef int rc
+        cdef _session_call call
         with nogil:
+            session_lock(&self._session._state, &call, NULL)
             rc = c_ssh2.libssh2_channel_send_eof(self._channel)
+            while session_again(&self._session._state, &call, &rc):
+                rc = c_ssh2.libssh2_channel_send_eof(self._channel)
         return handle_error_codes(rc)
 
     def wait_eof(self):
@@ -207,43 +600,67 @@ cdef class Channel:
         :rtype: int
         """
         cdef int rc
+        cdef _session_call call
         with nogil:
+            session_lock(&self._session._state, &call, NULL)
             rc = c_ssh2.libssh2_channel_wait_eof(self._channel)
+            while session_again(&self._session._state, &call, &rc):
+                rc = c_ssh2.libssh2_channel_wait_eof(self._channel)
         return handle_error_codes(rc)
 
     def close(self):
         """Close channel. Typically done to be able to get exit status."""
         cdef int rc
+        cdef _session_call call
         with nogil:
+            session_lock(&self._session._state, &call, NULL)
             rc = c_ssh2.libssh2_channel_close(self._channel)
+            while session_again(&self._session._state, &call, &rc):
+                rc = c_ssh2.libssh2_channel_close(self._channel)
         return handle_error_codes(rc)
 
     def flush(self):
         """Flush stdout stream"""
         cdef int rc
+        cdef _session_call call
         with nogil:
+            session_lock(&self._session._state, &call, NULL)
             rc = c_ssh2.libssh2_channel_flush(self._channel)
+            while session_again(&self._session._state, &call, &rc):
+                rc = c_ssh2.libssh2_channel_flush(self._channel)
         return handle_error_codes(rc)
 
     def flush_ex(self, int stream_id):
         """Flush stream with id"""
         cdef int rc
+        cdef _session_call call
         with nogil:
+            session_lock(&self._session._state, &call, NULL)
             rc = c_ssh2.libssh2_channel_flush_ex(self._channel, stream_id)
+            while session_again(&self._session._state, &call, &rc):
+                rc = c_ssh2.libssh2_channel_flush_ex(self._channel, stream_id)
         return handle_error_codes(rc)
 
     def flush_stderr(self):
         """Flush stderr stream"""
         cdef int rc
+        cdef _session_call call
         with nogil:
+            session_lock(&self._session._state, &call, NULL)
             rc = c_ssh2.libssh2_channel_flush_stderr(self._channel)
+            while session_again(&self._session._state, &call, &rc):
+                rc = c_ssh2.libssh2_channel_flush_stderr(self._channel)
         return handle_error_codes(rc)
 
     def wait_closed(self):
         """Wait for server to acknowledge channel close command."""
         cdef int rc
+        cdef _session_call call
         with nogil:
+            session_lock(&self._session._state, &call, NULL)
             rc = c_ssh2.libssh2_channel_wait_closed(self._channel)
+            while session_again(&self._session._state, &call, &rc):
+                rc = c_ssh2.libssh2_channel_wait_closed(self._channel)
         return handle_error_codes(rc)
 
     def get_exit_status(self):
@@ -254,8 +671,11 @@ cdef class Channel:
         Best used in non-blocking mode to avoid it being impossible to tell if
         ``0`` indicates failure or an actual exit status of ``0``"""
         cdef int rc
+        cdef _session_call call
         with nogil:
+            session_lock(&self._session._state, &call, NULL)
             rc = c_ssh2.libssh2_channel_get_exit_status(self._channel)
+            session_unlock(&self._session._state, &call)
         return handle_error_codes(rc)
 
     def get_exit_signal(self):
@@ -278,10 +698,13 @@ cdef class Channel:
         cdef size_t py_siglen = 0
         cdef size_t py_errlen = 0
         cdef size_t py_langlen = 0
+        cdef _session_call call
         with nogil:
+            session_lock(&self._session._state, &call, NULL)
             rc = c_ssh2.libssh2_channel_get_exit_signal(
                 self._channel, &exitsignal, exitsignal_len, &errmsg,
                 errmsg_len, &langtag, langtag_len)
+            session_unlock(&self._session._state, &call)
             if exitsignal_len is not NULL:
                 py_siglen = <size_t>exitsignal_len
             if errmsg_len is not NULL:
@@ -310,53 +733,79 @@ cdef class Channel:
         cdef bytes b_value = to_bytes(value)
         cdef char *_varname = b_varname
         cdef char *_value = b_value
+        cdef _session_call call
         with nogil:
+            session_lock(&self._session._state, &call,
+                         &self._session._state.lock.op)
             rc = c_ssh2.libssh2_channel_setenv(
                 self._channel, _varname, _value)
+            while session_again(&self._session._state, &call, &rc):
+                rc = c_ssh2.libssh2_channel_setenv(
+                    self._channel, _varname, _value)
         return handle_error_codes(rc)
 
     def window_read_ex(self, unsigned long read_avail,
                        unsigned long window_size_initial):
         cdef unsigned long rc
+        cdef _session_call call
         with nogil:
+            session_lock(&self._session._state, &call, NULL)
             rc = c_ssh2.libssh2_channel_window_read_ex(
                 self._channel, &read_avail, &window_size_initial)
+            session_unlock(&self._session._state, &call)
         return handle_error_codes(rc)
 
     def window_read(self):
         cdef unsigned long rc
+        cdef _session_call call
         with nogil:
+            session_lock(&self._session._state, &call, NULL)
             rc = c_ssh2.libssh2_channel_window_read(self._channel)
+            session_unlock(&self._session._state, &call)
         return handle_error_codes(rc)
 
     def window_write_ex(self, unsigned long window_size_initial):
         cdef unsigned long rc
+        cdef _session_call call
         with nogil:
+            session_lock(&self._session._state, &call, NULL)
             rc = c_ssh2.libssh2_channel_window_write_ex(
                 self._channel, &window_size_initial)
+            session_unlock(&self._session._state, &call)
         return handle_error_codes(rc)
 
     def window_write(self):
         cdef unsigned long rc
+        cdef _session_call call
         with nogil:
+            session_lock(&self._session._state, &call, NULL)
             rc = c_ssh2.libssh2_channel_window_write(self._channel)
+            session_unlock(&self._session._state, &call)
         return handle_error_codes(rc)
 
     def receive_window_adjust(self, unsigned long adjustment,
                               unsigned long force):
         cdef unsigned long rc
+        cdef _session_call call
         with nogil:
+            session_lock(&self._session._state, &call, NULL)
             rc = c_ssh2.libssh2_channel_receive_window_adjust(
                 self._channel, adjustment, force)
+            session_unlock(&self._session._state, &call)
         return handle_error_codes(rc)
 
     def receive_window_adjust2(self, unsigned long adjustment,
                                unsigned long force):
-        cdef unsigned long rc
+        cdef int rc
         cdef unsigned int storewindow = 0
+        cdef _session_call call
         with nogil:
+            session_lock(&self._session._state, &call, NULL)
             rc = c_ssh2.libssh2_channel_receive_window_adjust2(
                 self._channel, adjustment, force, &storewindow)
+            while session_again(&self._session._state, &call, &rc):
+                rc = c_ssh2.libssh2_channel_receive_window_adjust2(
+                    self._channel, adjustment, force, &storewindow)
         return handle_error_codes(rc)
 
     def write(self, buf not None):
@@ -390,10 +839,15 @@ cdef class Channel:
         cdef size_t buf_tot_size = buf_remainder
         cdef ssize_t rc = -1
         cdef size_t bytes_written = 0
+        cdef _session_call call
         with nogil:
             while buf_remainder > 0:
+                session_lock(&self._session._state, &call, NULL)
                 rc = c_ssh2.libssh2_channel_write(
                     self._channel, _buf, buf_remainder)
+                while session_again_size(&self._session._state, &call, &rc):
+                    rc = c_ssh2.libssh2_channel_write(
+                        self._channel, _buf, buf_remainder)
                 if rc < 0 and rc != c_ssh2.LIBSSH2_ERROR_EAGAIN:
                     # Error that will raise exception
                     with gil:
@@ -438,11 +892,16 @@ cdef class Channel:
         cdef size_t buf_tot_size = buf_remainder
         cdef ssize_t rc = -1
         cdef size_t bytes_written = 0
+        cdef _session_call call
         with nogil:
             # Write until buffer has been fully written or socket is blocked
             while buf_remainder > 0:
+                session_lock(&self._session._state, &call, NULL)
                 rc = c_ssh2.libssh2_channel_write_ex(
                     self._channel, stream_id, _buf, buf_remainder)
+                while session_again_size(&self._session._state, &call, &rc):
+                    rc = c_ssh2.libssh2_channel_write_ex(
+                        self._channel, stream_id, _buf, buf_remainder)
                 if rc < 0 and rc != c_ssh2.LIBSSH2_ERROR_EAGAIN:
                     # Error that will raise exception
                     with gil:
@@ -485,10 +944,15 @@ cdef class Channel:
         cdef size_t buf_tot_size = buf_remainder
         cdef ssize_t rc = -1
         cdef size_t bytes_written = 0
+        cdef _session_call call
         with nogil:
             while buf_remainder > 0:
+                session_lock(&self._session._state, &call, NULL)
                 rc = c_ssh2.libssh2_channel_write_stderr(
                     self._channel, _buf, buf_remainder)
+                while session_again_size(&self._session._state, &call, &rc):
+                    rc = c_ssh2.libssh2_channel_write_stderr(
+                        self._channel, _buf, buf_remainder)
                 if rc < 0 and rc != c_ssh2.LIBSSH2_ERROR_EAGAIN:
                     # Error that will raise exception
                     with gil:
@@ -502,9 +966,15 @@ cdef class Channel:
 
     def x11_req(self, int screen_number):
         cdef int rc
+        cdef _session_call call
         with nogil:
+            session_lock(&self._session._state, &call,
+                         &self._session._state.lock.op)
             rc = c_ssh2.libssh2_channel_x11_req(
                 self._channel, screen_number)
+            while session_again(&self._session._state, &call, &rc):
+                rc = c_ssh2.libssh2_channel_x11_req(
+                    self._channel, screen_number)
         return handle_error_codes(rc)
 
     def x11_req_ex(self, int single_connection,
@@ -512,10 +982,17 @@ cdef class Channel:
                    const char *auth_cookie,
                    int screen_number):
         cdef int rc
+        cdef _session_call call
         with nogil:
+            session_lock(&self._session._state, &call,
+                         &self._session._state.lock.op)
             rc = c_ssh2.libssh2_channel_x11_req_ex(
                 self._channel, single_connection,
                 auth_proto, auth_cookie, screen_number)
+            while session_again(&self._session._state, &call, &rc):
+                rc = c_ssh2.libssh2_channel_x11_req_ex(
+                    self._channel, single_connection,
+                    auth_proto, auth_cookie, screen_number)
         return handle_error_codes(rc)
 
     def process_startup(self, request, message=None):
@@ -541,9 +1018,15 @@ cdef class Channel:
             _message = b_message
             m_len = len(b_message)
         cdef int rc
+        cdef _session_call call
         with nogil:
+            session_lock(&self._session._state, &call,
+                         &self._session._state.lock.op)
             rc = c_ssh2.libssh2_channel_process_startup(
                 self._channel, _request, r_len, _message, m_len)
+            while session_again(&self._session._state, &call, &rc):
+                rc = c_ssh2.libssh2_channel_process_startup(
+                    self._channel, _request, r_len, _message, m_len)
         return handle_error_codes(rc)
 
     def signal(self, signame):
@@ -558,40 +1041,63 @@ cdef class Channel:
         cdef char *_signame = b_signame
         cdef size_t signame_len = len(b_signame)
         cdef int rc
+        cdef _session_call call
         with nogil:
+            session_lock(&self._session._state, &call, NULL)
             rc = c_ssh2.libssh2_channel_signal_ex(self._channel, _signame, signame_len)
+            while session_again(&self._session._state, &call, &rc):
+                rc = c_ssh2.libssh2_channel_signal_ex(self._channel, _signame, signame_len)
         return handle_error_codes(rc)
 
     def poll_channel_read(self, int extended):
         """Deprecated - use session.block_directions and socket polling
         instead"""
         cdef int rc
+        cdef _session_call call
         with nogil:
+            session_lock(&self._session._state, &call, NULL)
             rc = c_ssh2.libssh2_poll_channel_read(self._channel, extended)
+            session_unlock(&self._session._state, &call)
         return handle_error_codes(rc)
 
     def handle_extended_data(self, int ignore_mode):
         """Deprecated, use handle_extended_data2"""
+        cdef _session_call call
         with nogil:
+            session_lock(&self._session._state, &call, NULL)
             c_ssh2.libssh2_channel_handle_extended_data(
                 self._channel, ignore_mode)
+            session_unlock(&self._session._state, &call)
 
     def handle_extended_data2(self, int ignore_mode):
         cdef int rc
+        cdef _session_call call
         with nogil:
+            session_lock(&self._session._state, &call, NULL)
             rc = c_ssh2.libssh2_channel_handle_extended_data2(
                 self._channel, ignore_mode)
+            while session_again(&self._session._state, &call, &rc):
+                rc = c_ssh2.libssh2_channel_handle_extended_data2(
+                    self._channel, ignore_mode)
         return handle_error_codes(rc)
 
     def ignore_extended_data(self, int ignore_mode):
         """Deprecated, use handle_extended_data2"""
+        cdef _session_call call
         with nogil:
+            session_lock(&self._session._state, &call, NULL)
             c_ssh2.libssh2_channel_handle_extended_data(
                 self._channel, ignore_mode)
+            session_unlock(&self._session._state, &call)
 
     def request_auth_agent(self):
         """Request SSH agent authentication forwarding on channel."""
         cdef int rc
+        cdef _session_call call
         with nogil:
+            session_lock(&self._session._state, &call,
+                         &self._session._state.lock.op)
             rc = c_ssh2.libssh2_channel_request_auth_agent(self._channel)
+            while session_again(&self._session._state, &call, &rc):
+                rc = c_ssh2.libssh2_channel_request_auth_agent(self._channel)
         return handle_error_codes(rc)
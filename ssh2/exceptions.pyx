@@ -116,6 +116,10 @@ class PublicKeyError(SSH2Error):
     """Base class for all public key protocol errors"""
 
 
+class PrivateKeyError(SSH2Error):
+    """Raised on errors loading or decrypting a private key"""
+
+
 class PublicKeyInitError(PublicKeyError):
     """Raised on errors initialising public key system"""
 
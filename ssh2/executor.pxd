@@ -0,0 +1,70 @@
+# This file is part of ssh2-python.
+# Copyright (C) 2017 Panos Kittenis
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, version 2.1.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+from ssh2.session cimport Session
+from ssh2 cimport c_ssh2
+
+
+cdef struct _shell_buf:
+    char *data
+    size_t length
+    size_t size
+    # Where the search for the next marker carries on from
+    size_t scan
+    # Length of output before a marker found, -1 if none found yet
+    Py_ssize_t found
+    # Length up to the end of the marker found
+    size_t end
+
+
+cdef class ShellExecutor:
+    cdef Session _session
+    cdef c_ssh2.LIBSSH2_SESSION *_c_session
+    cdef readonly object channel
+    cdef c_ssh2.LIBSSH2_CHANNEL *_c_channel
+    cdef bint _pty
+    cdef bytes _token
+    cdef const char *_c_token
+    cdef size_t _token_len
+    cdef object _commands
+    cdef object _done
+    cdef size_t _next_id
+    cdef bint _running
+    cdef bint _closed
+    cdef bint _eof
+    cdef bint _eof_sent
+    cdef bint _draining
+    cdef int _error
+    cdef int _blocked
+    cdef int _status
+    cdef _shell_buf _in
+    cdef _shell_buf _out
+    cdef _shell_buf _err
+
+    cdef _send(self, bytes command)
+    cdef _append(self, bytes data)
+    cdef object _result(self)
+    cdef object _finish(self)
+    cdef bint _complete(self) noexcept nogil
+    cdef int _run(self) noexcept nogil
+    cdef int _pass(self) noexcept nogil
+    cdef ssize_t _write(self) noexcept nogil
+    cdef ssize_t _read(self, int stream_id) noexcept nogil
+    cdef bint _again(self, int op) noexcept nogil
+    cdef int _wait(self) noexcept nogil
+
+
+cdef object shell_executor(Session session, bint pty, shell)
@@ -0,0 +1,546 @@
+# This file is part of ssh2-python.
+# cython: language_level=3
+# Copyright (C) 2017 Panos Kittenis
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, version 2.1.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Running many commands one after the other in one remote shell.
+
+Create a :py:class:`ShellExecutor` with
+:py:func:`ssh2.session.Session.shell_executor` and run commands with
+:py:func:`ShellExecutor.execute`, or submit them and iterate over
+:py:func:`ShellExecutor.run` for their results."""
+
+from collections import deque
+from os import urandom
+
+from cpython.bytes cimport PyBytes_FromStringAndSize
+from cpython.mem cimport PyMem_RawRealloc, PyMem_RawFree
+from libc.errno cimport errno, EINTR
+from libc.string cimport memcpy, memmove
+
+from ssh2.exceptions import BadUseError, ChannelClosedError
+from ssh2.channel cimport Channel
+from ssh2.multiplex cimport CommandResult, _read_stream
+from ssh2.utils cimport to_bytes, handle_error_codes
+
+from ssh2 cimport c_ssh2
+from ssh2 cimport c_net
+from ssh2 cimport error_codes
+
+
+cdef extern from "<string.h>" nogil:
+    void *memmem(const void *haystack, size_t haystacklen,
+                 const void *needle, size_t needlelen)
+
+
+# Operations that have to be repeated first after a partly sent packet
+cdef enum:
+    _WRITE = 1
+    _READ_STDOUT = 2
+    _READ_STDERR = 3
+    _SEND_EOF = 4
+
+cdef enum:
+    _READ_SIZE = 65536
+    # LIBSSH2_ERROR_ALLOC, for buffers that could not be grown
+    _ERROR_ALLOC = -6
+
+
+cdef bint _find_marker(_shell_buf *buf, const char *token, size_t token_len,
+                       bint status, bint crlf, int *exit_status) noexcept nogil:
+    """Search buf for a line of token, followed by a space and exit status if
+    status, carrying on from where the last search left off. A partial line
+    at the end is searched again once more data is read.
+
+    Sets ``buf.found`` to the length of output before the line and
+    ``buf.end`` to the length up to its end when found."""
+    cdef const char *pos
+    cdef size_t start
+    cdef size_t i
+    cdef int value
+    while buf.scan + token_len <= buf.length:
+        pos = <const char *>memmem(buf.data + buf.scan, buf.length - buf.scan,
+                                   token, token_len)
+        if pos is NULL:
+            buf.scan = buf.length - token_len + 1
+            return 0
+        start = pos - buf.data
+        # The line break before the token is part of the marker
+        if start == 0 or buf.data[start - 1] != c'\n':
+            buf.scan = start + 1
+            continue
+        i = start + token_len
+        value = 0
+        if status:
+            if i < buf.length and buf.data[i] != c' ':
+                buf.scan = start + 1
+                continue
+            i += 1
+            while i < buf.length and c'0' <= buf.data[i] <= c'9':
+                value = value * 10 + buf.data[i] - c'0'
+                i += 1
+        if crlf and i < buf.length and buf.data[i] == c'\r':
+            i += 1
+        if i >= buf.length:
+            buf.scan = start
+            return 0
+        elif buf.data[i] != c'\n':
+            buf.scan = start + 1
+            continue
+        buf.found = start - 1
+        if crlf and buf.found > 0 and buf.data[buf.found - 1] == c'\r':
+            buf.found -= 1
+        buf.end = i + 1
+        exit_status[0] = value
+        return 1
+    return 0
+
+
+cdef void _consume(_shell_buf *buf, size_t length) noexcept nogil:
+    if length < buf.length:
+        memmove(buf.data, buf.data + length, buf.length - length)
+    buf.length -= length
+    buf.scan = 0
+    buf.found = -1
+    buf.end = 0
+
+
+cdef object shell_executor(Session session, bint pty, shell):
+    cdef ShellExecutor executor
+    channel = session.open_session()
+    if pty:
+        channel.pty()
+    if shell is None:
+        channel.shell()
+    else:
+        channel.execute(shell)
+    executor = ShellExecutor.__new__(ShellExecutor, session, channel, pty)
+    if pty:
+        # Run before anything else is sent, so that no later input is
+        # echoed back
+        executor._commands.append((None, None))
+        executor._send(
+            b"stty -echo < /dev/tty 2>/dev/null; PS1=; PS2=; unset PROMPT_COMMAND; "
+            b"bind 'set enable-bracketed-paste off' 2>/dev/null")
+        while executor._result() is not None:
+            pass
+    return executor
+
+
+cdef class ShellExecutor:
+    """Runs commands one after the other in a shell on one channel.
+
+    Each command is sent to the shell followed by a line printing a marker
+    that is unique to the executor, with the command's exit status. The
+    output of each command is split off at the markers as it is read, so
+    no channel is opened or closed per command. Commands are sent while
+    the output of earlier ones is still being read.
+
+    Commands run in the same shell, so changes to its working directory
+    or variables carry over to later commands. Their standard input is
+    ``/dev/null``. A command that is not complete, like one with an
+    unterminated quote, makes the shell wait for more input and the
+    executor wait for its marker.
+
+    With a pty, the shell is set up not to echo input or print prompts.
+    Output then has terminal line endings and stderr is merged into
+    stdout."""
+
+    def __cinit__(self, Session session, channel, bint pty):
+        self._session = session
+        self._c_session = session._session
+        self.channel = channel
+        self._c_channel = (<Channel>channel)._channel
+        self._pty = pty
+        self._token = ('__ssh2_%s' % (urandom(8).hex(),)).encode()
+        self._c_token = self._token
+        self._token_len = len(self._token)
+        self._commands = deque()
+        self._done = deque()
+        self._out.found = self._err.found = -1
+
+    def __dealloc__(self):
+        PyMem_RawFree(self._in.data)
+        PyMem_RawFree(self._out.data)
+        PyMem_RawFree(self._err.data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def session(self):
+        """Originating session."""
+        return self._session
+
+    @property
+    def queued(self):
+        """Number of commands submitted without their result having been
+        returned yet.
+
+        :rtype: int"""
+        return len(self._commands) + len(self._done)
+
+    def submit(self, command not None):
+        """Queue command to be run by :py:func:`run`. It is sent to the
+        shell with the next command run.
+
+        :param command: Shell command.
+        :type command: str
+
+        :returns: Id of the command, increasing in submission order, as in
+          its :py:class:`ssh2.multiplex.CommandResult`.
+        :rtype: int
+
+        :raises: :py:class:`ssh2.exceptions.BadUseError` if the executor is
+          closed."""
+        cdef size_t cmd_id
+        if self._closed:
+            raise BadUseError("Shell executor is closed")
+        cmd_id = self._next_id
+        self._send(to_bytes(command))
+        self._commands.append((cmd_id, command))
+        self._next_id += 1
+        return cmd_id
+
+    def execute(self, command not None):
+        """Run command and return its result. Commands submitted before it
+        are run first, and their results kept for :py:func:`run`.
+
+        :param command: Shell command.
+        :type command: str
+
+        :rtype: :py:class:`ssh2.multiplex.CommandResult`"""
+        if self._running:
+            raise BadUseError("Shell executor is already running")
+        cmd_id = self.submit(command)
+        self._running = True
+        try:
+            while True:
+                for result in self._done:
+                    if result.id == cmd_id:
+                        self._done.remove(result)
+                        return result
+                result = self._result()
+                if result is not None:
+                    self._done.append(result)
+        finally:
+            self._running = False
+
+    def run(self):
+        """Run submitted commands and yield a
+        :py:class:`ssh2.multiplex.CommandResult` for each, in submission
+        order.
+
+        The session is set to non-blocking mode while the channel is
+        serviced and its previous mode restored before each result is
+        yielded. The GIL is released while servicing the channel, but the
+        session and executor must not be used by other threads until the
+        iteration is finished.
+
+        Should the shell exit, the command running gets the shell's exit
+        status and the output read so far. Commands after it get a
+        :py:class:`ssh2.exceptions.ChannelClosedError` as their result's
+        ``error``.
+
+        :raises: :py:class:`ssh2.exceptions.BadUseError` if already running.
+        :raises: Appropriate exception from :py:mod:`ssh2.exceptions` on
+          session and channel errors, including
+          :py:class:`ssh2.exceptions.Timeout` if the session has a timeout
+          set and nothing is received for that long.
+
+        :rtype: iter(:py:class:`ssh2.multiplex.CommandResult`)"""
+        if self._running:
+            raise BadUseError("Shell executor is already running")
+        self._running = True
+        try:
+            while self._done or self._commands:
+                if self._done:
+                    yield self._done.popleft()
+                    continue
+                result = self._result()
+                if result is not None:
+                    yield result
+        finally:
+            self._running = False
+
+    def close(self):
+        """Close the shell's channel. Commands not yet run are dropped.
+
+        The shell is told to exit and sent end of file once all input has
+        been sent, and its output is read and dropped until it exits."""
+        cdef int blocking
+        cdef int rc
+        if self._closed:
+            return
+        self._closed = True
+        self._commands.clear()
+        # A shell on a pty does not exit on end of file
+        self._append(b"exit\n")
+        self._draining = 1
+        with nogil:
+            blocking = c_ssh2.libssh2_session_get_blocking(self._c_session)
+            c_ssh2.libssh2_session_set_blocking(self._c_session, 0)
+            rc = self._run()
+            c_ssh2.libssh2_session_set_blocking(self._c_session, blocking)
+        if rc < 0:
+            if self._error == _ERROR_ALLOC:
+                raise MemoryError()
+            handle_error_codes(self._error)
+        self.channel.close()
+        self.channel.wait_closed()
+
+    cdef _send(self, bytes command):
+        """Add command and the line printing its marker to the input to be
+        sent."""
+        cdef bytes half_a = self._token[:8]
+        cdef bytes half_b = self._token[8:]
+        cdef bytes line
+        # The token is printed from two halves so that echoed input does not
+        # contain it. ':' keeps an empty command valid.
+        line = b"{ :\n" + command + b"\n} < /dev/null\n" \
+            b"__ssh2_rc=$?; printf '\\n%s%s %d\\n' '" + half_a + b"' '" + \
+            half_b + b"' \"$__ssh2_rc\""
+        if not self._pty:
+            line += b"; printf '\\n%s%s\\n' '" + half_a + b"' '" + half_b + \
+                b"' >&2"
+        self._append(line + b"\n")
+
+    cdef _append(self, bytes data):
+        """Add data to the input to be sent."""
+        cdef size_t length = len(data)
+        cdef size_t size
+        cdef char *buf
+        if self._in.scan > 0:
+            _consume(&self._in, self._in.scan)
+        if self._in.size - self._in.length < length:
+            size = self._in.size * 2 if self._in.size else _READ_SIZE
+            while size - self._in.length < length:
+                size *= 2
+            buf = <char *>PyMem_RawRealloc(self._in.data, size)
+            if buf is NULL:
+                raise MemoryError()
+            self._in.data = buf
+            self._in.size = size
+        memcpy(self._in.data + self._in.length, <const char *>data, length)
+        self._in.length += length
+
+    cdef object _result(self):
+        """Run the channel until the first queued command's marker is read
+        and return its result, or ``None`` for set up commands."""
+        cdef CommandResult result
+        cdef int blocking
+        cdef int rc
+        with nogil:
+            blocking = c_ssh2.libssh2_session_get_blocking(self._c_session)
+            c_ssh2.libssh2_session_set_blocking(self._c_session, 0)
+            rc = self._run()
+            c_ssh2.libssh2_session_set_blocking(self._c_session, blocking)
+        if rc < 0:
+            if self._error == _ERROR_ALLOC:
+                raise MemoryError()
+            handle_error_codes(self._error)
+        if not self._complete():
+            return self._finish()
+        cmd_id, command = self._commands.popleft()
+        result = CommandResult.__new__(CommandResult)
+        result.stdout = PyBytes_FromStringAndSize(self._out.data, self._out.found)
+        if not self._pty:
+            result.stderr = PyBytes_FromStringAndSize(self._err.data, self._err.found)
+            _consume(&self._err, self._err.end)
+        else:
+            result.stderr = b''
+        _consume(&self._out, self._out.end)
+        if cmd_id is None:
+            return None
+        result.id = cmd_id
+        result.command = command
+        result.exit_status = self._status
+        result.error = None
+        return result
+
+    cdef object _finish(self):
+        """Close the channel of an exited shell and return the result of the
+        command that was running, keeping those of the others."""
+        cdef CommandResult result
+        self._closed = True
+        self.channel.close()
+        self.channel.wait_closed()
+        exit_status = self.channel.get_exit_status()
+        first = None
+        while self._commands:
+            cmd_id, command = self._commands.popleft()
+            if cmd_id is None:
+                continue
+            result = CommandResult.__new__(CommandResult)
+            result.id = cmd_id
+            result.command = command
+            if first is None:
+                result.stdout = PyBytes_FromStringAndSize(
+                    self._out.data, self._out.length)
+                result.stderr = PyBytes_FromStringAndSize(
+                    self._err.data, self._err.length)
+                result.exit_status = exit_status
+                result.error = None
+                first = result
+            else:
+                result.stdout = result.stderr = b''
+                result.exit_status = -1
+                result.error = ChannelClosedError(
+                    "Shell exited before command was run")
+                self._done.append(result)
+        _consume(&self._out, self._out.length)
+        _consume(&self._err, self._err.length)
+        return first
+
+    cdef bint _complete(self) noexcept nogil:
+        """Whether the markers of the first queued command were read."""
+        cdef int status
+        if self._out.found < 0 and not _find_marker(
+                &self._out, self._c_token, self._token_len, 1, self._pty,
+                &self._status):
+            return 0
+        if not self._pty and self._err.found < 0 and not _find_marker(
+                &self._err, self._c_token, self._token_len, 0, 0, &status):
+            return 0
+        return 1
+
+    cdef int _run(self) noexcept nogil:
+        """Service the channel until the first queued command is complete or
+        the shell has exited, or only the latter when draining. Returns -1 on
+        errors."""
+        cdef int rc
+        self._error = 0
+        while not self._eof and (self._draining or not self._complete()):
+            rc = self._pass()
+            if rc < 0:
+                return -1
+            elif self._draining:
+                _consume(&self._out, self._out.length)
+                _consume(&self._err, self._err.length)
+            if rc == 0 and self._wait() < 0:
+                return -1
+        return 0
+
+    cdef int _pass(self) noexcept nogil:
+        """Write pending input and read what is available of stdout and
+        stderr.
+
+        Returns 1 if anything moved, 0 if not or -1 on errors."""
+        cdef ssize_t rc_out = error_codes._LIBSSH2_ERROR_EAGAIN
+        cdef ssize_t rc_err = error_codes._LIBSSH2_ERROR_EAGAIN
+        cdef ssize_t rc
+        cdef int progress = 0
+        cdef int op = self._blocked
+        self._blocked = 0
+        # An operation part way through sending a packet must be repeated
+        # before any other call on the session.
+        if op == 0 or op == _WRITE:
+            if self._in.scan < self._in.length:
+                rc = self._write()
+                if rc > 0:
+                    progress = 1
+                elif rc != error_codes._LIBSSH2_ERROR_EAGAIN:
+                    self._error = rc
+                    return -1
+                elif self._again(_WRITE):
+                    return progress
+        if op == 0 or op == _SEND_EOF:
+            if self._draining and not self._eof_sent \
+                    and self._in.scan == self._in.length:
+                rc = c_ssh2.libssh2_channel_send_eof(self._c_channel)
+                if rc == 0:
+                    self._eof_sent = 1
+                    progress = 1
+                elif rc != error_codes._LIBSSH2_ERROR_EAGAIN:
+                    self._error = rc
+                    return -1
+                elif self._again(_SEND_EOF):
+                    return progress
+        if op == 0 or op == _READ_STDOUT:
+            rc_out = self._read(0)
+            if rc_out > 0:
+                progress = 1
+            elif rc_out == error_codes._LIBSSH2_ERROR_EAGAIN:
+                if self._again(_READ_STDOUT):
+                    return progress
+            elif rc_out < 0:
+                self._error = rc_out
+                return -1
+        if op == 0 or op == _READ_STDERR:
+            rc_err = self._read(c_ssh2.SSH_EXTENDED_DATA_STDERR)
+            if rc_err > 0:
+                progress = 1
+            elif rc_err == error_codes._LIBSSH2_ERROR_EAGAIN:
+                if self._again(_READ_STDERR):
+                    return progress
+            elif rc_err < 0:
+                self._error = rc_err
+                return -1
+        if rc_out == 0 and rc_err == 0 and c_ssh2.libssh2_channel_eof(self._c_channel):
+            self._eof = 1
+            progress = 1
+        return progress
+
+    cdef ssize_t _write(self) noexcept nogil:
+        cdef ssize_t rc = c_ssh2.libssh2_channel_write_ex(
+            self._c_channel, 0, self._in.data + self._in.scan,
+            self._in.length - self._in.scan)
+        if rc > 0:
+            self._in.scan += rc
+            if self._in.scan == self._in.length:
+                self._in.scan = self._in.length = 0
+        return rc
+
+    cdef ssize_t _read(self, int stream_id) noexcept nogil:
+        cdef _shell_buf *buf = &self._err if stream_id else &self._out
+        return _read_stream(self._c_channel, stream_id, &buf.data,
+                            &buf.length, &buf.size, _READ_SIZE)
+
+    cdef bint _again(self, int op) noexcept nogil:
+        """Note op as to be repeated first if libssh2 is blocked sending.
+        Returns whether it is."""
+        if c_ssh2.libssh2_session_block_directions(self._c_session) \
+                & c_ssh2.LIBSSH2_SESSION_BLOCK_OUTBOUND:
+            self._blocked = op
+            return 1
+        return 0
+
+    cdef int _wait(self) noexcept nogil:
+        """Wait for the session socket in the direction libssh2 is blocked
+        on, up to the session's timeout."""
+        cdef c_net.pollfd pfd
+        cdef int directions = c_ssh2.libssh2_session_block_directions(self._c_session)
+        cdef long timeout = c_ssh2.libssh2_session_get_timeout(self._c_session)
+        cdef int rc
+        pfd.fd = self._session._sock
+        pfd.events = 0
+        pfd.revents = 0
+        if directions & c_ssh2.LIBSSH2_SESSION_BLOCK_INBOUND:
+            pfd.events |= c_net.POLLIN
+        if directions & c_ssh2.LIBSSH2_SESSION_BLOCK_OUTBOUND:
+            pfd.events |= c_net.POLLOUT
+        if pfd.events == 0:
+            pfd.events = c_net.POLLIN
+        rc = c_net.poll(&pfd, 1, timeout if timeout > 0 else -1)
+        if rc == 0:
+            self._error = error_codes._LIBSSH2_ERROR_TIMEOUT
+            return -1
+        elif rc < 0 and errno != EINTR:
+            self._error = error_codes._LIBSSH2_ERROR_SOCKET_RECV
+            return -1
+        return 0
@@ -15,23 +15,15 @@
 # License along with this library; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
 
-from libc.stddef cimport size_t
-from cpython.mem cimport PyMem_RawMalloc, PyMem_RawFree
-
 from ssh2 cimport c_ssh2
 
+cimport cython
+
 
+@cython.freelist(64)
 cdef class FileInfo:
     """Representation of libssh2 stat structure."""
 
-    def __cinit__(self):
-        self._stat = <c_ssh2.libssh2_struct_stat *> PyMem_RawMalloc(<size_t> sizeof(c_ssh2.libssh2_struct_stat))
-        if self._stat is NULL:
-            raise MemoryError()
-
-    def __dealloc__(self):
-        PyMem_RawFree(self._stat)
-
     @property
     def st_size(self):
         return self._stat.st_size
@@ -0,0 +1,127 @@
+# This file is part of ssh2-python.
+# Copyright (C) 2017 Panos Kittenis
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, version 2.1.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+from libc.stdint cimport uint32_t
+
+from ssh2.session cimport Session
+from ssh2 cimport c_ssh2
+from ssh2 cimport c_net
+
+
+cdef struct _fwd_conn:
+    int fd
+    int state
+    uint32_t events
+    bint readable
+    bint writable
+    bint sock_eof
+    bint eof_sent
+    bint chan_eof
+    bint shut_wr
+    c_ssh2.LIBSSH2_CHANNEL *channel
+    c_net.addrinfo *addr
+    # Socket to channel
+    char *up
+    size_t up_off
+    size_t up_len
+    # Channel to socket
+    char *down
+    size_t down_off
+    size_t down_len
+    char shost[64]
+    int sport
+    # Target of the channel, for SOCKS connections
+    char host[256]
+    int port
+    _fwd_conn *prev
+    _fwd_conn *next
+    # Next connection waiting for its channel to open
+    _fwd_conn *open_next
+
+
+cdef class Forwarder:
+    cdef Session _session
+    cdef c_ssh2.LIBSSH2_SESSION *_c_session
+    cdef int _mode
+    cdef readonly object sock
+    cdef int _listen_fd
+    cdef uint32_t _listen_events
+    cdef int _max_channels
+    cdef object _listener
+    cdef c_ssh2.LIBSSH2_LISTENER *_c_listener
+    cdef c_ssh2.LIBSSH2_CHANNEL *_accepted
+    cdef readonly int bound_port
+    cdef bytes _host
+    cdef const char *_c_host
+    cdef int _port
+    cdef c_net.addrinfo *_target
+    cdef size_t _buffer_size
+    cdef int _stop_fd
+    cdef int _ep
+    cdef bint _running
+    cdef bint _stopping
+    cdef _fwd_conn *_head
+    cdef _fwd_conn *_tail
+    cdef _fwd_conn *_open_head
+    cdef _fwd_conn *_open_tail
+    cdef _fwd_conn *_blocked
+    cdef int _blocked_op
+    cdef bint _session_readable
+    cdef bint _listen_readable
+    cdef uint32_t _session_events
+    cdef int _error
+    cdef int _os_error
+    cdef readonly unsigned long long bytes_sent
+    cdef readonly unsigned long long bytes_received
+    cdef readonly unsigned long long connections
+    cdef readonly int active
+
+    cdef int _run(self) noexcept nogil
+    cdef int _pass(self) noexcept nogil
+    cdef int _service(self, _fwd_conn *conn) noexcept nogil
+    cdef int _op(self, _fwd_conn *conn, int op) noexcept nogil
+    cdef bint _may(self, _fwd_conn *conn, int op) noexcept nogil
+    cdef int _retry_blocked(self) noexcept nogil
+    cdef int _do_drain(self, _fwd_conn *conn) noexcept nogil
+    cdef int _do_accept(self) noexcept nogil
+    cdef int _do_open(self) noexcept nogil
+    cdef int _do_write(self, _fwd_conn *conn) noexcept nogil
+    cdef int _do_eof(self, _fwd_conn *conn) noexcept nogil
+    cdef int _do_read(self, _fwd_conn *conn) noexcept nogil
+    cdef int _do_free(self, _fwd_conn *conn) noexcept nogil
+    cdef int _channel_error(self, _fwd_conn *conn, int rc) noexcept nogil
+    cdef int _accept_clients(self) noexcept nogil
+    cdef int _socks_handshake(self, _fwd_conn *conn) noexcept nogil
+    cdef void _queue_open(self, _fwd_conn *conn) noexcept nogil
+    cdef int _connect(self, _fwd_conn *conn) noexcept nogil
+    cdef _fwd_conn *_new_conn(self, int fd, int state) noexcept nogil
+    cdef void _abort(self, _fwd_conn *conn) noexcept nogil
+    cdef void _release(self, _fwd_conn *conn) noexcept nogil
+    cdef bint _pending(self) noexcept nogil
+    cdef int _update_events(self) noexcept nogil
+    cdef void _shutdown(self) noexcept nogil
+
+
+cdef object forward_local(Session session, host, int port, local_host,
+                          int local_port, int max_channels, int backlog,
+                          size_t buffer_size)
+
+cdef object forward_socks(Session session, local_host, int local_port,
+                          int max_channels, int backlog, size_t buffer_size)
+
+cdef object forward_remote(Session session, host, int port, remote_host,
+                           int remote_port, int queue_maxsize,
+                           size_t buffer_size)
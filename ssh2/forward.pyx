@@ -0,0 +1,1031 @@
+# This file is part of ssh2-python.
+# cython: language_level=3
+# Copyright (C) 2017 Panos Kittenis
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, version 2.1.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Port forwarding engine.
+
+A :py:class:`Forwarder` moves data between local sockets and SSH channels of
+one session in a single ``epoll`` loop that runs without the GIL. Create one
+with :py:func:`ssh2.session.Session.forward_local`,
+:py:func:`ssh2.session.Session.forward_remote` or
+:py:func:`ssh2.session.Session.forward_socks`."""
+
+import os
+
+from cpython.mem cimport PyMem_RawMalloc, PyMem_RawFree
+from libc.errno cimport errno, EAGAIN, EINTR, EINPROGRESS, \
+    ENOMEM, ECONNABORTED
+from libc.stdint cimport uint64_t
+from libc.string cimport memchr, memcpy, memmove, memset
+from posix.time cimport clock_gettime, timespec, CLOCK_MONOTONIC
+from posix.unistd cimport close, read, write
+
+from ssh2.exceptions import BadUseError
+from ssh2.listener cimport PyListener
+from ssh2.session cimport _session_call, session_lock, session_again_ptr
+from ssh2.utils cimport to_bytes, handle_error_codes
+
+from ssh2 cimport c_ssh2
+from ssh2 cimport c_net
+from ssh2 cimport error_codes
+
+
+cdef enum:
+    _MODE_LOCAL = 1
+    _MODE_REMOTE = 2
+    _MODE_SOCKS = 3
+
+# Connection states
+cdef enum:
+    # Waiting for the direct TCP/IP channel to open - local forwarding
+    _OPENING = 1
+    # Waiting for the connection to the target - remote forwarding
+    _CONNECTING = 2
+    _OPEN = 3
+    # Both directions done, waiting for the channel to close
+    _CLOSING = 4
+    # Reading the SOCKS method selection and then the connect request
+    _SOCKS_METHOD = 5
+    _SOCKS_REQUEST = 6
+
+# libssh2 operations. An operation that returns EAGAIN part way through
+# sending a packet must be repeated before any other call on the session.
+cdef enum:
+    _OP_NONE = 0
+    _OP_DRAIN = 1
+    _OP_ACCEPT = 2
+    _OP_OPEN = 3
+    _OP_WRITE = 4
+    _OP_EOF = 5
+    _OP_READ = 6
+    _OP_FREE = 7
+
+# epoll data of the file descriptors that are not connections
+cdef enum:
+    _EV_STOP = 1
+    _EV_SESSION = 2
+    _EV_LISTEN = 3
+
+cdef enum:
+    _MAX_EVENTS = 256
+    _SHUTDOWN_TIMEOUT_MS = 5000
+    _SHUTDOWN_POLL_MS = 100
+    _MAX_BUFFER_SIZE = 16 * 1024 * 1024
+    # Large enough for the longest SOCKS5 request
+    _MIN_SOCKS_BUFFER_SIZE = 512
+
+# SOCKS5, RFC 1928
+cdef enum:
+    _SOCKS_VERSION = 5
+    _SOCKS_NO_AUTH = 0
+    _SOCKS_NO_METHOD = 0xff
+    _SOCKS_CONNECT = 1
+    _SOCKS_ATYP_IPV4 = 1
+    _SOCKS_ATYP_DOMAIN = 3
+    _SOCKS_ATYP_IPV6 = 4
+    _SOCKS_SUCCEEDED = 0
+    _SOCKS_GENERAL_FAILURE = 1
+    _SOCKS_COMMAND_NOT_SUPPORTED = 7
+    _SOCKS_ATYP_NOT_SUPPORTED = 8
+
+
+cdef long _monotonic_ms() noexcept nogil:
+    cdef timespec ts
+    clock_gettime(CLOCK_MONOTONIC, &ts)
+    return ts.tv_sec * 1000 + ts.tv_nsec // 1000000
+
+
+cdef void _set_nodelay(int fd) noexcept nogil:
+    cdef int one = 1
+    c_net.setsockopt(fd, c_net.IPPROTO_TCP, c_net.TCP_NODELAY, &one, sizeof(one))
+
+
+cdef bint _is_channel_error(int rc) noexcept nogil:
+    return rc == error_codes._LIBSSH2_ERROR_CHANNEL_OUTOFORDER \
+        or rc == error_codes._LIBSSH2_ERROR_CHANNEL_FAILURE \
+        or rc == error_codes._LIBSSH2_ERROR_CHANNEL_REQUEST_DENIED \
+        or rc == error_codes._LIBSSH2_ERROR_CHANNEL_UNKNOWN \
+        or rc == error_codes._LIBSSH2_ERROR_CHANNEL_WINDOW_EXCEEDED \
+        or rc == error_codes._LIBSSH2_ERROR_CHANNEL_PACKET_EXCEEDED \
+        or rc == error_codes._LIBSSH2_ERROR_CHANNEL_CLOSED \
+        or rc == error_codes._LIBSSH2_ERROR_CHANNEL_EOF_SENT
+
+
+cdef size_t _check_buffer_size(size_t buffer_size, size_t minimum=1) except 0:
+    if buffer_size < minimum or buffer_size > _MAX_BUFFER_SIZE:
+        raise ValueError("buffer_size must be between %s and %s" % (
+            minimum, _MAX_BUFFER_SIZE))
+    return buffer_size
+
+
+cdef int _socks_reply(int fd, unsigned char reply) noexcept nogil:
+    """Send a SOCKS5 reply with an all zero bound address. Replies are
+    tiny and sent right after the client's request, so they fit in an
+    empty socket buffer."""
+    cdef unsigned char msg[10]
+    memset(msg, 0, sizeof(msg))
+    msg[0] = _SOCKS_VERSION
+    msg[1] = reply
+    msg[3] = _SOCKS_ATYP_IPV4
+    return c_net.send(fd, msg, sizeof(msg), c_net.MSG_NOSIGNAL) == sizeof(msg)
+
+
+cdef _listen(Forwarder fwd, local_host, int local_port, int max_channels,
+             int backlog):
+    # Imported on first use rather than with the module, for import time
+    import socket
+    fwd._max_channels = max_channels
+    fwd.sock = socket.create_server((local_host, local_port), backlog=backlog)
+    fwd.sock.setblocking(False)
+    fwd._listen_fd = fwd.sock.fileno()
+
+
+cdef object forward_local(Session session, host, int port, local_host,
+                          int local_port, int max_channels, int backlog,
+                          size_t buffer_size):
+    cdef Forwarder fwd = Forwarder.__new__(Forwarder, session)
+    fwd._mode = _MODE_LOCAL
+    fwd._buffer_size = _check_buffer_size(buffer_size)
+    fwd._host = to_bytes(host)
+    fwd._c_host = fwd._host
+    fwd._port = port
+    _listen(fwd, local_host, local_port, max_channels, backlog)
+    return fwd
+
+
+cdef object forward_socks(Session session, local_host, int local_port,
+                          int max_channels, int backlog, size_t buffer_size):
+    cdef Forwarder fwd = Forwarder.__new__(Forwarder, session)
+    fwd._mode = _MODE_SOCKS
+    fwd._buffer_size = _check_buffer_size(buffer_size, _MIN_SOCKS_BUFFER_SIZE)
+    _listen(fwd, local_host, local_port, max_channels, backlog)
+    return fwd
+
+
+cdef object forward_remote(Session session, host, int port, remote_host,
+                           int remote_port, int queue_maxsize,
+                           size_t buffer_size):
+    cdef Forwarder fwd = Forwarder.__new__(Forwarder, session)
+    cdef bytes b_host = to_bytes(host)
+    cdef bytes b_port = str(port).encode()
+    cdef bytes b_remote_host = to_bytes(remote_host)
+    cdef const char *_host = b_host
+    cdef const char *_port = b_port
+    cdef const char *_remote_host = b_remote_host
+    cdef c_net.addrinfo hints
+    cdef c_ssh2.LIBSSH2_LISTENER *listener
+    cdef _session_call call
+    cdef int bound_port = 0
+    cdef int rc
+    fwd._mode = _MODE_REMOTE
+    fwd._buffer_size = _check_buffer_size(buffer_size)
+    fwd._host = b_host
+    fwd._c_host = fwd._host
+    fwd._port = port
+    memset(&hints, 0, sizeof(hints))
+    hints.ai_family = c_net.AF_UNSPEC
+    hints.ai_socktype = c_net.SOCK_STREAM
+    hints.ai_flags = c_net.AI_NUMERICSERV
+    with nogil:
+        rc = c_net.getaddrinfo(_host, _port, &hints, &fwd._target)
+    if rc != 0:
+        import socket
+        raise socket.gaierror(rc, c_net.gai_strerror(rc).decode())
+    with nogil:
+        session_lock(&session._state, &call, &session._state.lock.op)
+        listener = c_ssh2.libssh2_channel_forward_listen_ex(
+            session._session, _remote_host, remote_port, &bound_port,
+            queue_maxsize)
+        while session_again_ptr(&session._state, &call, listener, &rc):
+            listener = c_ssh2.libssh2_channel_forward_listen_ex(
+                session._session, _remote_host, remote_port, &bound_port,
+                queue_maxsize)
+    if listener is NULL:
+        return handle_error_codes(rc)
+    fwd._listener = PyListener(listener, session)
+    fwd._c_listener = listener
+    fwd.bound_port = bound_port
+    return fwd
+
+
+cdef class Forwarder:
+    """Forwards connections over the channels of one session.
+
+    Local forwarding (``ssh -L``) accepts connections on a local socket and
+    opens a direct TCP/IP channel for each. Dynamic forwarding (``ssh -D``)
+    does the same, to the target of each connection's SOCKS5 connect
+    request. Remote forwarding (``ssh -R``) accepts channels from a listener
+    on the server and connects each to a local target.
+
+    :py:func:`run` does all socket and channel I/O in one ``epoll`` loop
+    with the GIL released. Each connection has a fixed buffer per direction
+    and reading from either side pauses while the other side is not taking
+    data, so memory use is bounded by the number of connections."""
+
+    def __cinit__(self, Session session):
+        self._session = session
+        self._c_session = session._session
+        self._listen_fd = -1
+        self._ep = -1
+        self._stop_fd = c_net.eventfd(0, c_net.EFD_CLOEXEC | c_net.EFD_NONBLOCK)
+        if self._stop_fd < 0:
+            raise OSError(errno, os.strerror(errno))
+
+    def __dealloc__(self):
+        if self._stop_fd >= 0:
+            close(self._stop_fd)
+        if self._target is not NULL:
+            c_net.freeaddrinfo(self._target)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def session(self):
+        """Originating session."""
+        return self._session
+
+    @property
+    def local_address(self):
+        """Address of the local listening socket for local forwarding,
+        ``None`` for remote forwarding.
+
+        :rtype: tuple"""
+        if self.sock is None:
+            return None
+        return self.sock.getsockname()
+
+    @property
+    def max_channels(self):
+        """Maximum number of connections forwarded at once, each over its
+        own channel. Zero for no limit. Further connections wait in the
+        listen backlog until one is closed.
+
+        :rtype: int"""
+        return self._max_channels
+
+    def run(self):
+        """Forward connections until :py:func:`stop` is called.
+
+        The session is set to non-blocking mode while forwarding and its
+        previous mode restored on return. The GIL is released for the
+        duration, so other threads keep running, but the session must not be
+        used by any other thread until this returns.
+
+        On stop, open connections are closed and their channels given a few
+        seconds to close cleanly.
+
+        :raises: :py:class:`ssh2.exceptions.BadUseError` if already running.
+        :raises: Appropriate exception from :py:mod:`ssh2.exceptions` on
+          session errors, :py:class:`OSError` on local socket errors.
+          Errors of a single channel or connection only close that
+          connection."""
+        cdef int blocking
+        if self._running:
+            raise BadUseError("Forwarder is already running")
+        if self._mode == _MODE_REMOTE and self._c_listener is NULL:
+            raise BadUseError("Forwarder is closed")
+        self._running = True
+        try:
+            with nogil:
+                blocking = c_ssh2.libssh2_session_get_blocking(self._c_session)
+                c_ssh2.libssh2_session_set_blocking(self._c_session, 0)
+                self._run()
+                c_ssh2.libssh2_session_set_blocking(self._c_session, blocking)
+        finally:
+            self._running = False
+        if self._os_error != 0:
+            raise OSError(self._os_error, os.strerror(self._os_error))
+        return handle_error_codes(self._error)
+
+    def stop(self):
+        """Make :py:func:`run` return. Safe to call from any thread.
+
+        A stop requested before :py:func:`run` is called makes the next run
+        return immediately."""
+        cdef uint64_t one = 1
+        with nogil:
+            write(self._stop_fd, &one, sizeof(one))
+
+    def close(self):
+        """Stop accepting new connections - closes the local listening
+        socket, or cancels the listener on the server for remote forwarding.
+
+        Must not be called while :py:func:`run` is running.
+
+        :rtype: int"""
+        if self._running:
+            raise BadUseError("Forwarder is running")
+        if self.sock is not None:
+            self.sock.close()
+            self._listen_fd = -1
+        if self._listener is not None:
+            rc = self._listener.forward_cancel()
+            self._listener = None
+            self._c_listener = NULL
+            return rc
+        return 0
+
+    cdef int _run(self) noexcept nogil:
+        cdef c_net.epoll_event events[_MAX_EVENTS]
+        cdef c_net.epoll_event ev
+        cdef uint64_t counter
+        cdef _fwd_conn *conn
+        cdef int i, n, rc
+        self._error = 0
+        self._os_error = 0
+        self._stopping = False
+        self._ep = c_net.epoll_create1(c_net.EPOLL_CLOEXEC)
+        if self._ep < 0:
+            self._os_error = errno
+            return -1
+        ev.events = c_net.EPOLLIN
+        ev.data.u64 = _EV_STOP
+        c_net.epoll_ctl(self._ep, c_net.EPOLL_CTL_ADD, self._stop_fd, &ev)
+        ev.data.u64 = _EV_SESSION
+        c_net.epoll_ctl(self._ep, c_net.EPOLL_CTL_ADD, self._session._sock, &ev)
+        self._session_events = c_net.EPOLLIN
+        if self._listen_fd >= 0:
+            ev.data.u64 = _EV_LISTEN
+            c_net.epoll_ctl(self._ep, c_net.EPOLL_CTL_ADD, self._listen_fd, &ev)
+            self._listen_events = c_net.EPOLLIN
+        self._session_readable = True
+        self._listen_readable = self._listen_fd >= 0
+        while not self._stopping:
+            # Keep going while anything moves, including data libssh2 has
+            # already read off the session socket for other channels.
+            while True:
+                rc = self._pass()
+                if rc < 0:
+                    break
+                elif rc == 0 and (self._blocked_op != _OP_NONE or not self._pending()):
+                    break
+            if rc < 0 or self._update_events() < 0:
+                break
+            n = c_net.epoll_wait(self._ep, events, _MAX_EVENTS, -1)
+            if n < 0:
+                if errno == EINTR:
+                    continue
+                self._os_error = errno
+                break
+            for i in range(n):
+                if events[i].data.u64 == _EV_STOP:
+                    read(self._stop_fd, &counter, sizeof(counter))
+                    self._stopping = True
+                elif events[i].data.u64 == _EV_SESSION:
+                    self._session_readable = True
+                elif events[i].data.u64 == _EV_LISTEN:
+                    self._listen_readable = True
+                else:
+                    conn = <_fwd_conn *>events[i].data.ptr
+                    if events[i].events & (c_net.EPOLLIN | c_net.EPOLLERR | c_net.EPOLLHUP):
+                        conn.readable = True
+                    if events[i].events & (c_net.EPOLLOUT | c_net.EPOLLERR | c_net.EPOLLHUP):
+                        conn.writable = True
+        self._stopping = True
+        self._shutdown()
+        close(self._ep)
+        self._ep = -1
+        return 0
+
+    cdef int _pass(self) noexcept nogil:
+        """Do one round of work on everything.
+
+        Returns 1 if anything moved, 0 if not or -1 on a session error."""
+        cdef _fwd_conn *conn
+        cdef _fwd_conn *next_conn
+        cdef int progress = 0
+        cdef int rc
+        rc = self._retry_blocked()
+        if rc < 0:
+            return -1
+        progress |= rc
+        if self._mode != _MODE_REMOTE:
+            if self._session_readable and self._blocked_op == _OP_NONE:
+                self._session_readable = False
+                # Read incoming packets off the session socket so that they
+                # are seen as pending on their channels.
+                conn = self._head
+                while conn is not NULL and conn.state != _OPEN:
+                    conn = conn.next
+                if conn is not NULL and self._do_drain(conn) < 0:
+                    return -1
+            if self._listen_readable and not self._stopping:
+                rc = self._accept_clients()
+                if rc < 0:
+                    return -1
+                progress |= rc
+            rc = self._do_open()
+            if rc < 0:
+                return -1
+            progress |= rc
+        conn = self._head
+        while conn is not NULL:
+            next_conn = conn.next
+            rc = self._service(conn)
+            if rc < 0:
+                return -1
+            progress |= rc
+            conn = next_conn
+        if self._mode == _MODE_REMOTE and not self._stopping:
+            rc = self._do_accept()
+            if rc < 0:
+                return -1
+            progress |= rc
+        return progress
+
+    cdef int _service(self, _fwd_conn *conn) noexcept nogil:
+        """Move data for one connection as far as it goes without blocking.
+
+        Returns 1 if anything moved, 0 if not or -1 on a session error.
+        Releases conn once its channel is closed."""
+        cdef int progress = 0
+        cdef int rc
+        cdef ssize_t n
+        cdef int err = 0
+        cdef c_net.socklen_t errlen = sizeof(err)
+        if conn.state == _SOCKS_METHOD or conn.state == _SOCKS_REQUEST:
+            return self._socks_handshake(conn)
+        if conn.state == _CONNECTING:
+            if not conn.writable:
+                return 0
+            c_net.getsockopt(conn.fd, c_net.SOL_SOCKET, c_net.SO_ERROR, &err, &errlen)
+            if err != 0:
+                close(conn.fd)
+                conn.fd = -1
+                conn.addr = conn.addr.ai_next
+                self._connect(conn)
+                return 1
+            _set_nodelay(conn.fd)
+            conn.state = _OPEN
+            conn.readable = True
+            progress = 1
+        if conn.state == _OPEN:
+            if conn.up_len == 0 and not conn.sock_eof and conn.readable:
+                n = c_net.recv(conn.fd, conn.up, self._buffer_size, 0)
+                if n > 0:
+                    conn.up_len = n
+                    progress = 1
+                elif n == 0:
+                    conn.sock_eof = True
+                    progress = 1
+                elif errno == EAGAIN:
+                    conn.readable = False
+                elif errno != EINTR:
+                    self._abort(conn)
+                    progress = 1
+        if conn.state == _OPEN and conn.up_len > conn.up_off:
+            rc = self._do_write(conn)
+            if rc < 0:
+                return -1
+            progress |= rc
+        if conn.state == _OPEN and conn.sock_eof and conn.up_len == 0 \
+           and not conn.eof_sent:
+            rc = self._do_eof(conn)
+            if rc < 0:
+                return -1
+            progress |= rc
+        if conn.state == _OPEN and conn.down_len == 0 and not conn.chan_eof \
+           and (c_ssh2.libssh2_poll_channel_read(conn.channel, 0) > 0
+                or c_ssh2.libssh2_channel_eof(conn.channel) == 1):
+            rc = self._do_read(conn)
+            if rc < 0:
+                return -1
+            progress |= rc
+        if conn.state == _OPEN and conn.down_len > conn.down_off and conn.writable:
+            n = c_net.send(conn.fd, conn.down + conn.down_off,
+                           conn.down_len - conn.down_off, c_net.MSG_NOSIGNAL)
+            if n >= 0:
+                conn.down_off += n
+                if conn.down_off == conn.down_len:
+                    conn.down_off = conn.down_len = 0
+                progress = 1
+            elif errno == EAGAIN:
+                conn.writable = False
+            elif errno != EINTR:
+                self._abort(conn)
+                progress = 1
+        if conn.state == _OPEN and conn.chan_eof and conn.down_len == 0 \
+           and not conn.shut_wr:
+            c_net.shutdown(conn.fd, c_net.SHUT_WR)
+            conn.shut_wr = True
+            progress = 1
+        if conn.state == _OPEN and conn.eof_sent and conn.shut_wr:
+            conn.state = _CLOSING
+            progress = 1
+        if conn.state == _CLOSING:
+            rc = self._do_free(conn)
+            if rc < 0:
+                return -1
+            progress |= rc
+        return progress
+
+    cdef int _op(self, _fwd_conn *conn, int op) noexcept nogil:
+        """Run one libssh2 operation.
+
+        If it blocks part way through sending a packet it is recorded as the
+        one operation to retry before anything else is done on the session.
+        A newly accepted channel is left in ``_accepted``."""
+        cdef ssize_t rc = 0
+        cdef c_ssh2.LIBSSH2_CHANNEL *channel
+        if self._blocked_op == op and self._blocked == conn:
+            self._blocked = NULL
+            self._blocked_op = _OP_NONE
+        if op == _OP_DRAIN:
+            rc = c_ssh2.libssh2_channel_read(conn.channel, conn.down, 0)
+        elif op == _OP_ACCEPT:
+            self._accepted = c_ssh2.libssh2_channel_forward_accept(self._c_listener)
+            if self._accepted is NULL:
+                rc = c_ssh2.libssh2_session_last_errno(self._c_session)
+        elif op == _OP_OPEN:
+            if self._mode == _MODE_SOCKS:
+                channel = c_ssh2.libssh2_channel_direct_tcpip_ex(
+                    self._c_session, conn.host, conn.port, conn.shost, conn.sport)
+            else:
+                channel = c_ssh2.libssh2_channel_direct_tcpip_ex(
+                    self._c_session, self._c_host, self._port, conn.shost, conn.sport)
+            if channel is NULL:
+                rc = c_ssh2.libssh2_session_last_errno(self._c_session)
+                if rc == 0:
+                    rc = error_codes._LIBSSH2_ERROR_CHANNEL_FAILURE
+            conn.channel = channel
+        elif op == _OP_WRITE:
+            rc = c_ssh2.libssh2_channel_write(
+                conn.channel, conn.up + conn.up_off, conn.up_len - conn.up_off)
+        elif op == _OP_EOF:
+            rc = c_ssh2.libssh2_channel_send_eof(conn.channel)
+        elif op == _OP_READ:
+            rc = c_ssh2.libssh2_channel_read(conn.channel, conn.down, self._buffer_size)
+        elif op == _OP_FREE:
+            rc = c_ssh2.libssh2_channel_free(conn.channel)
+        if rc == c_ssh2.LIBSSH2_ERROR_EAGAIN and (
+                c_ssh2.libssh2_session_block_directions(self._c_session)
+                & c_ssh2.LIBSSH2_SESSION_BLOCK_OUTBOUND):
+            self._blocked = conn
+            self._blocked_op = op
+        return rc
+
+    cdef bint _may(self, _fwd_conn *conn, int op) noexcept nogil:
+        return self._blocked_op == _OP_NONE or (
+            self._blocked == conn and self._blocked_op == op)
+
+    cdef int _retry_blocked(self) noexcept nogil:
+        cdef _fwd_conn *conn = self._blocked
+        cdef int op = self._blocked_op
+        if op == _OP_NONE:
+            return 0
+        elif op == _OP_DRAIN:
+            return self._do_drain(conn)
+        elif op == _OP_ACCEPT:
+            return self._do_accept()
+        elif op == _OP_OPEN:
+            return self._do_open()
+        elif op == _OP_WRITE:
+            return self._do_write(conn)
+        elif op == _OP_EOF:
+            return self._do_eof(conn)
+        elif op == _OP_READ:
+            return self._do_read(conn)
+        return self._do_free(conn)
+
+    cdef int _do_drain(self, _fwd_conn *conn) noexcept nogil:
+        cdef int rc
+        if not self._may(conn, _OP_DRAIN):
+            return 0
+        rc = self._op(conn, _OP_DRAIN)
+        if rc >= 0 or rc == c_ssh2.LIBSSH2_ERROR_EAGAIN:
+            return 0
+        return self._channel_error(conn, rc)
+
+    cdef int _do_accept(self) noexcept nogil:
+        cdef _fwd_conn *conn
+        cdef int progress = 0
+        cdef int rc
+        while self._may(NULL, _OP_ACCEPT):
+            rc = self._op(NULL, _OP_ACCEPT)
+            if rc == c_ssh2.LIBSSH2_ERROR_EAGAIN:
+                break
+            elif rc < 0:
+                self._error = rc
+                return -1
+            conn = self._new_conn(-1, _CONNECTING)
+            if conn is NULL:
+                c_ssh2.libssh2_channel_free(self._accepted)
+                self._os_error = ENOMEM
+                return -1
+            conn.channel = self._accepted
+            conn.addr = self._target
+            self._connect(conn)
+            progress = 1
+        return progress
+
+    cdef int _do_open(self) noexcept nogil:
+        cdef _fwd_conn *conn = self._open_head
+        cdef int rc
+        if conn is NULL or not self._may(conn, _OP_OPEN):
+            return 0
+        rc = self._op(conn, _OP_OPEN)
+        if rc == c_ssh2.LIBSSH2_ERROR_EAGAIN:
+            return 0
+        # Only one channel can be opening at a time - move on to the next
+        # connection in the queue.
+        self._open_head = conn.open_next
+        if self._open_head is NULL:
+            self._open_tail = NULL
+        conn.open_next = NULL
+        if rc == 0:
+            conn.state = _OPEN
+            conn.readable = True
+            if self._mode == _MODE_SOCKS and not _socks_reply(conn.fd, _SOCKS_SUCCEEDED):
+                self._abort(conn)
+            return 1
+        if self._mode == _MODE_SOCKS:
+            _socks_reply(conn.fd, _SOCKS_GENERAL_FAILURE)
+        return self._channel_error(conn, rc)
+
+    cdef void _queue_open(self, _fwd_conn *conn) noexcept nogil:
+        conn.state = _OPENING
+        conn.open_next = NULL
+        if self._open_tail is not NULL:
+            self._open_tail.open_next = conn
+        else:
+            self._open_head = conn
+        self._open_tail = conn
+
+    cdef int _do_write(self, _fwd_conn *conn) noexcept nogil:
+        cdef int rc
+        if not self._may(conn, _OP_WRITE):
+            return 0
+        rc = self._op(conn, _OP_WRITE)
+        if rc > 0:
+            conn.up_off += rc
+            if conn.up_off == conn.up_len:
+                conn.up_off = conn.up_len = 0
+            self.bytes_sent += rc
+            return 1
+        elif rc == 0 or rc == c_ssh2.LIBSSH2_ERROR_EAGAIN:
+            return 0
+        return self._channel_error(conn, rc)
+
+    cdef int _do_eof(self, _fwd_conn *conn) noexcept nogil:
+        cdef int rc
+        if not self._may(conn, _OP_EOF):
+            return 0
+        rc = self._op(conn, _OP_EOF)
+        if rc == 0:
+            conn.eof_sent = True
+            return 1
+        elif rc == c_ssh2.LIBSSH2_ERROR_EAGAIN:
+            return 0
+        return self._channel_error(conn, rc)
+
+    cdef int _do_read(self, _fwd_conn *conn) noexcept nogil:
+        cdef int rc
+        if not self._may(conn, _OP_READ):
+            return 0
+        rc = self._op(conn, _OP_READ)
+        if rc > 0:
+            conn.down_off = 0
+            conn.down_len = rc
+            self.bytes_received += rc
+            return 1
+        elif rc == 0:
+            conn.chan_eof = True
+            return 1
+        elif rc == c_ssh2.LIBSSH2_ERROR_EAGAIN:
+            return 0
+        return self._channel_error(conn, rc)
+
+    cdef int _do_free(self, _fwd_conn *conn) noexcept nogil:
+        cdef int rc
+        if not self._may(conn, _OP_FREE):
+            return 0
+        rc = self._op(conn, _OP_FREE)
+        if rc == c_ssh2.LIBSSH2_ERROR_EAGAIN:
+            return 0
+        # The channel is freed on any other return code.
+        conn.channel = NULL
+        self._release(conn)
+        return 1
+
+    cdef int _channel_error(self, _fwd_conn *conn, int rc) noexcept nogil:
+        """Close conn on an error of its channel, returning 1. Returns -1 on
+        an error of the session."""
+        if _is_channel_error(rc):
+            self._abort(conn)
+            return 1
+        self._error = rc
+        return -1
+
+    cdef int _accept_clients(self) noexcept nogil:
+        cdef c_net.sockaddr_storage addr
+        cdef c_net.socklen_t addrlen
+        cdef _fwd_conn *conn
+        cdef int progress = 0
+        cdef int fd
+        while self._max_channels <= 0 or self.active < self._max_channels:
+            addrlen = sizeof(addr)
+            fd = c_net.accept4(self._listen_fd, <c_net.sockaddr *>&addr, &addrlen,
+                               c_net.SOCK_NONBLOCK | c_net.SOCK_CLOEXEC)
+            if fd < 0:
+                if errno == EINTR or errno == ECONNABORTED:
+                    continue
+                self._listen_readable = False
+                break
+            _set_nodelay(fd)
+            conn = self._new_conn(fd, _SOCKS_METHOD if self._mode == _MODE_SOCKS else _OPENING)
+            if conn is NULL:
+                close(fd)
+                self._os_error = ENOMEM
+                return -1
+            if addr.ss_family == c_net.AF_INET:
+                c_net.inet_ntop(c_net.AF_INET, &(<c_net.sockaddr_in *>&addr).sin_addr,
+                                conn.shost, sizeof(conn.shost))
+                conn.sport = c_net.ntohs((<c_net.sockaddr_in *>&addr).sin_port)
+            elif addr.ss_family == c_net.AF_INET6:
+                c_net.inet_ntop(c_net.AF_INET6, &(<c_net.sockaddr_in6 *>&addr).sin6_addr,
+                                conn.shost, sizeof(conn.shost))
+                conn.sport = c_net.ntohs((<c_net.sockaddr_in6 *>&addr).sin6_port)
+            if conn.state == _OPENING:
+                self._queue_open(conn)
+            progress = 1
+        return progress
+
+    cdef int _socks_handshake(self, _fwd_conn *conn) noexcept nogil:
+        """Read and answer the SOCKS5 method selection and connect request
+        of conn, then queue its channel to be opened. Only the no
+        authentication method and the connect command are supported.
+
+        Returns 1 if anything moved, 0 if not. Releases conn on errors."""
+        cdef unsigned char *buf = <unsigned char *>conn.up
+        cdef unsigned char reply[2]
+        cdef size_t need, addr_len
+        cdef int progress = 0
+        cdef ssize_t n
+        if conn.readable and conn.up_len < self._buffer_size:
+            n = c_net.recv(conn.fd, conn.up + conn.up_len,
+                           self._buffer_size - conn.up_len, 0)
+            if n > 0:
+                conn.up_len += n
+                progress = 1
+            elif n < 0 and errno == EAGAIN:
+                conn.readable = False
+            elif n == 0 or errno != EINTR:
+                self._abort(conn)
+                return 1
+        if conn.state == _SOCKS_METHOD:
+            if conn.up_len < 2:
+                return progress
+            if buf[0] != _SOCKS_VERSION:
+                self._abort(conn)
+                return 1
+            need = 2 + buf[1]
+            if conn.up_len < need:
+                return progress
+            reply[0] = _SOCKS_VERSION
+            reply[1] = _SOCKS_NO_AUTH
+            if memchr(buf + 2, _SOCKS_NO_AUTH, buf[1]) is NULL:
+                reply[1] = _SOCKS_NO_METHOD
+            if c_net.send(conn.fd, reply, 2, c_net.MSG_NOSIGNAL) != 2 \
+               or reply[1] == _SOCKS_NO_METHOD:
+                self._abort(conn)
+                return 1
+            conn.up_len -= need
+            memmove(buf, buf + need, conn.up_len)
+            conn.state = _SOCKS_REQUEST
+            progress = 1
+        # Version, command, reserved, address type, address, port
+        if conn.up_len < 5:
+            return progress
+        if buf[0] != _SOCKS_VERSION:
+            self._abort(conn)
+            return 1
+        if buf[3] == _SOCKS_ATYP_IPV4:
+            addr_len = 4
+        elif buf[3] == _SOCKS_ATYP_IPV6:
+            addr_len = 16
+        elif buf[3] == _SOCKS_ATYP_DOMAIN and buf[4] > 0:
+            addr_len = 1 + buf[4]
+        else:
+            _socks_reply(conn.fd, _SOCKS_ATYP_NOT_SUPPORTED)
+            self._abort(conn)
+            return 1
+        need = 4 + addr_len + 2
+        if conn.up_len < need:
+            return progress
+        if buf[1] != _SOCKS_CONNECT:
+            _socks_reply(conn.fd, _SOCKS_COMMAND_NOT_SUPPORTED)
+            self._abort(conn)
+            return 1
+        if buf[3] == _SOCKS_ATYP_IPV4:
+            c_net.inet_ntop(c_net.AF_INET, buf + 4, conn.host, sizeof(conn.host))
+        elif buf[3] == _SOCKS_ATYP_IPV6:
+            c_net.inet_ntop(c_net.AF_INET6, buf + 4, conn.host, sizeof(conn.host))
+        else:
+            # Host names are resolved on the remote side
+            memcpy(conn.host, buf + 5, buf[4])
+            conn.host[buf[4]] = 0
+        conn.port = (buf[4 + addr_len] << 8) | buf[5 + addr_len]
+        # Anything sent after the request goes to the channel once open
+        conn.up_len -= need
+        memmove(buf, buf + need, conn.up_len)
+        self._queue_open(conn)
+        return 1
+
+    cdef int _connect(self, _fwd_conn *conn) noexcept nogil:
+        """Start connecting conn to its next target address. Aborts conn
+        when there is none left."""
+        cdef c_net.epoll_event ev
+        cdef int fd
+        while conn.addr is not NULL:
+            fd = c_net.socket(conn.addr.ai_family,
+                              c_net.SOCK_STREAM | c_net.SOCK_NONBLOCK | c_net.SOCK_CLOEXEC,
+                              conn.addr.ai_protocol)
+            if fd >= 0:
+                if c_net.connect(fd, conn.addr.ai_addr, conn.addr.ai_addrlen) == 0 \
+                   or errno == EINPROGRESS:
+                    ev.events = 0
+                    ev.data.ptr = conn
+                    if c_net.epoll_ctl(self._ep, c_net.EPOLL_CTL_ADD, fd, &ev) == 0:
+                        conn.fd = fd
+                        conn.events = 0
+                        conn.writable = False
+                        return 0
+                close(fd)
+            conn.addr = conn.addr.ai_next
+        self._abort(conn)
+        return -1
+
+    cdef _fwd_conn *_new_conn(self, int fd, int state) noexcept nogil:
+        cdef _fwd_conn *conn = <_fwd_conn *>PyMem_RawMalloc(
+            sizeof(_fwd_conn) + 2 * self._buffer_size)
+        cdef c_net.epoll_event ev
+        if conn is NULL:
+            return NULL
+        memset(conn, 0, sizeof(_fwd_conn))
+        conn.up = <char *>conn + sizeof(_fwd_conn)
+        conn.down = conn.up + self._buffer_size
+        conn.state = state
+        conn.fd = fd
+        conn.writable = True
+        if fd >= 0:
+            ev.events = 0
+            ev.data.ptr = conn
+            if c_net.epoll_ctl(self._ep, c_net.EPOLL_CTL_ADD, fd, &ev) != 0:
+                PyMem_RawFree(conn)
+                return NULL
+        conn.prev = self._tail
+        if self._tail is not NULL:
+            self._tail.next = conn
+        else:
+            self._head = conn
+        self._tail = conn
+        self.connections += 1
+        self.active += 1
+        return conn
+
+    cdef void _abort(self, _fwd_conn *conn) noexcept nogil:
+        """Drop conn - closes its socket and starts closing its channel."""
+        conn.sock_eof = conn.eof_sent = conn.chan_eof = conn.shut_wr = True
+        if conn.fd >= 0:
+            close(conn.fd)
+            conn.fd = -1
+        if conn.channel is NULL:
+            self._release(conn)
+        else:
+            conn.state = _CLOSING
+
+    cdef void _release(self, _fwd_conn *conn) noexcept nogil:
+        if conn.fd >= 0:
+            close(conn.fd)
+        if self._blocked == conn:
+            self._blocked = NULL
+            self._blocked_op = _OP_NONE
+        if self._open_head == conn:
+            self._open_head = conn.open_next
+            if self._open_head is NULL:
+                self._open_tail = NULL
+        if conn.prev is not NULL:
+            conn.prev.next = conn.next
+        else:
+            self._head = conn.next
+        if conn.next is not NULL:
+            conn.next.prev = conn.prev
+        else:
+            self._tail = conn.prev
+        self.active -= 1
+        PyMem_RawFree(conn)
+
+    cdef bint _pending(self) noexcept nogil:
+        """Whether any channel has data or EOF that libssh2 has already
+        received but not been read yet."""
+        cdef _fwd_conn *conn = self._head
+        while conn is not NULL:
+            if conn.state == _OPEN and conn.down_len == 0 and not conn.chan_eof \
+               and (c_ssh2.libssh2_poll_channel_read(conn.channel, 0) > 0
+                    or c_ssh2.libssh2_channel_eof(conn.channel) == 1):
+                return True
+            conn = conn.next
+        return False
+
+    cdef int _update_events(self) noexcept nogil:
+        """Set the events waited for on each socket from the state of its
+        connection and on the session socket from libssh2's block
+        directions."""
+        cdef c_net.epoll_event ev
+        cdef _fwd_conn *conn = self._head
+        cdef uint32_t want
+        while conn is not NULL:
+            want = 0
+            if conn.state == _CONNECTING:
+                want = c_net.EPOLLOUT
+            elif conn.state == _SOCKS_METHOD or conn.state == _SOCKS_REQUEST:
+                want = c_net.EPOLLIN
+            elif conn.state == _OPEN:
+                if conn.up_len == 0 and not conn.sock_eof:
+                    want |= c_net.EPOLLIN
+                if conn.down_len > conn.down_off:
+                    want |= c_net.EPOLLOUT
+            if conn.fd >= 0 and want != conn.events:
+                ev.events = want
+                ev.data.ptr = conn
+                if c_net.epoll_ctl(self._ep, c_net.EPOLL_CTL_MOD, conn.fd, &ev) != 0:
+                    self._os_error = errno
+                    return -1
+                conn.events = want
+            conn = conn.next
+        if self._listen_fd >= 0:
+            want = c_net.EPOLLIN
+            if self._stopping or (
+                    self._max_channels > 0 and self.active >= self._max_channels):
+                want = 0
+            if want != self._listen_events:
+                ev.events = want
+                ev.data.u64 = _EV_LISTEN
+                if c_net.epoll_ctl(self._ep, c_net.EPOLL_CTL_MOD, self._listen_fd,
+                                   &ev) != 0:
+                    self._os_error = errno
+                    return -1
+                self._listen_events = want
+        # Incoming data is only waited for when there is something to read
+        # it, otherwise the level triggered session socket would spin.
+        want = 0
+        if self._blocked_op == _OP_NONE and (
+                self._head is not NULL or self._mode == _MODE_REMOTE):
+            want = c_net.EPOLLIN
+        if c_ssh2.libssh2_session_block_directions(self._c_session) \
+           & c_ssh2.LIBSSH2_SESSION_BLOCK_OUTBOUND:
+            want |= c_net.EPOLLOUT
+        if want != self._session_events:
+            ev.events = want
+            ev.data.u64 = _EV_SESSION
+            if c_net.epoll_ctl(self._ep, c_net.EPOLL_CTL_MOD, self._session._sock,
+                               &ev) != 0:
+                self._os_error = errno
+                return -1
+            self._session_events = want
+        return 0
+
+    cdef void _shutdown(self) noexcept nogil:
+        """Close all connections, waiting a while for their channels to
+        close."""
+        cdef c_net.epoll_event events[_MAX_EVENTS]
+        cdef _fwd_conn *conn = self._head
+        cdef _fwd_conn *next_conn
+        cdef long deadline
+        cdef int rc
+        self._open_head = self._open_tail = NULL
+        while conn is not NULL:
+            next_conn = conn.next
+            self._abort(conn)
+            conn = next_conn
+        deadline = _monotonic_ms() + _SHUTDOWN_TIMEOUT_MS
+        while self._head is not NULL and self._error == 0 and self._os_error == 0 \
+                and _monotonic_ms() < deadline:
+            rc = self._pass()
+            if rc < 0:
+                break
+            elif rc == 0:
+                if self._update_events() < 0:
+                    break
+                c_net.epoll_wait(self._ep, events, _MAX_EVENTS, _SHUTDOWN_POLL_MS)
+        # Channels that did not close in time are freed with the session.
+        while self._head is not NULL:
+            self._head.channel = NULL
+            self._release(self._head)
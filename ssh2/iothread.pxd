@@ -0,0 +1,75 @@
+# This file is part of ssh2-python.
+# Copyright (C) 2017 Panos Kittenis
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, version 2.1.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+from ssh2.session cimport Session, _session_state
+from ssh2 cimport c_ssh2
+from ssh2 cimport c_pthread
+
+
+# Single producer, single consumer byte ring. head and tail count bytes read
+# and written in total, their difference is the number of bytes held.
+cdef struct _ring:
+    char *data
+    size_t size
+    size_t head
+    size_t tail
+
+
+cdef struct _io_stream:
+    c_ssh2.LIBSSH2_CHANNEL *channel
+    _ring out
+    _ring err
+    int error
+    bint eof
+    bint detached
+    # Skipped by the I/O thread for lack of space, until a read frees some
+    bint full
+    _io_stream *next
+
+
+# State shared with the I/O thread, which does not touch Python objects
+cdef struct _io_thread:
+    _session_state *session
+    # Guards the fields below and the ring positions, signalled on reads by
+    # the I/O thread and when it stops
+    c_pthread.pthread_mutex_t mutex
+    c_pthread.pthread_cond_t cond
+    _io_stream *streams
+    bint running
+    bint stopping
+    int error
+
+
+cdef class ChannelStream:
+    cdef IOThread _io
+    cdef _io_stream *_stream
+    cdef readonly object channel
+
+    cdef bytes _read(self, _ring *ring, size_t size, long timeout)
+
+
+cdef class IOThread:
+    cdef Session _session
+    cdef _io_thread _io
+    cdef c_pthread.pthread_t _thread
+    cdef size_t _buffer_size
+    cdef bint _joined
+    cdef list _channels
+
+    cdef int _join(self) noexcept nogil
+
+
+cdef object io_thread(Session session, size_t buffer_size)
@@ -0,0 +1,487 @@
+# This file is part of ssh2-python.
+# cython: language_level=3
+# Copyright (C) 2017 Panos Kittenis
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, version 2.1.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Reading channels of a session on a native background thread.
+
+Start an :py:class:`IOThread` with
+:py:func:`ssh2.session.Session.start_io_thread` and add channels to it with
+:py:func:`IOThread.add`. The thread reads the channels' output into a
+:py:class:`ChannelStream` for each while Python code processes what was
+read before."""
+
+from cpython.bytes cimport PyBytes_FromStringAndSize, PyBytes_AS_STRING
+from cpython.mem cimport PyMem_RawMalloc, PyMem_RawFree
+from libc.string cimport memcpy, memset
+from posix.time cimport clock_gettime, timespec, CLOCK_MONOTONIC
+
+from ssh2.exceptions import BadUseError
+from ssh2.channel cimport Channel
+from ssh2.multiplex cimport _is_channel_error
+from ssh2.session cimport _session_lock, _session_call, _session_acquire, \
+    _session_release, _session_wait, _session_wake
+from ssh2.utils cimport handle_error_codes
+
+from ssh2 cimport c_ssh2
+from ssh2 cimport c_net
+from ssh2 cimport c_pthread
+from ssh2 cimport error_codes
+
+
+cdef enum:
+    _MAX_BUFFER_SIZE = 256 * 1024 * 1024
+
+
+cdef void _free_streams(_io_stream *stream) noexcept nogil:
+    cdef _io_stream *next_stream
+    while stream is not NULL:
+        next_stream = stream.next
+        PyMem_RawFree(stream.out.data)
+        PyMem_RawFree(stream.err.data)
+        PyMem_RawFree(stream)
+        stream = next_stream
+
+
+cdef ssize_t _read_ring(_io_thread *io, _io_stream *stream, _ring *ring,
+                        int stream_id, bint *full) noexcept nogil:
+    """Read from a stream of the channel into the free space at the end of
+    ring. Called with the session locked."""
+    cdef c_net.pollfd pfd
+    cdef size_t offset
+    cdef size_t length
+    cdef ssize_t rc
+    c_pthread.pthread_mutex_lock(&io.mutex)
+    length = ring.size - (ring.tail - ring.head)
+    if length == 0:
+        stream.full = 1
+        full[0] = 1
+        c_pthread.pthread_mutex_unlock(&io.mutex)
+        return 0
+    c_pthread.pthread_mutex_unlock(&io.mutex)
+    # Only this thread writes past the tail, so the free space can be read
+    # into without holding the mutex
+    offset = ring.tail % ring.size
+    if length > ring.size - offset:
+        length = ring.size - offset
+    rc = c_ssh2.libssh2_channel_read_ex(
+        stream.channel, stream_id, ring.data + offset, length)
+    while rc == error_codes._LIBSSH2_ERROR_EAGAIN and \
+            c_ssh2.libssh2_session_block_directions(io.session.lock.session) \
+            & c_ssh2.LIBSSH2_SESSION_BLOCK_OUTBOUND:
+        # A window adjustment was partly sent - the same call has to finish
+        # it before anything else is sent on the session
+        pfd.fd = io.session.lock.sock
+        pfd.events = c_net.POLLOUT
+        pfd.revents = 0
+        c_net.poll(&pfd, 1, -1)
+        rc = c_ssh2.libssh2_channel_read_ex(
+            stream.channel, stream_id, ring.data + offset, length)
+    if rc > 0:
+        c_pthread.pthread_mutex_lock(&io.mutex)
+        ring.tail += rc
+        c_pthread.pthread_cond_broadcast(&io.cond)
+        c_pthread.pthread_mutex_unlock(&io.mutex)
+    return rc
+
+
+cdef int _io_pass(_io_thread *io, bint *waiting) noexcept nogil:
+    """Read once from stdout and stderr of each stream with space left.
+    Called with the session locked.
+
+    Returns 1 if anything was read, 0 if not or a negative error code on
+    session errors. Sets waiting if any stream is waiting on the socket."""
+    cdef _io_stream *stream
+    cdef ssize_t rc_out
+    cdef ssize_t rc_err
+    cdef ssize_t rc
+    cdef bint full
+    cdef int progress = 0
+    c_pthread.pthread_mutex_lock(&io.mutex)
+    stream = io.streams
+    c_pthread.pthread_mutex_unlock(&io.mutex)
+    # Streams are only ever added at the head and freed after the thread
+    # has stopped
+    while stream is not NULL:
+        c_pthread.pthread_mutex_lock(&io.mutex)
+        if stream.eof or stream.detached or stream.error != 0:
+            c_pthread.pthread_mutex_unlock(&io.mutex)
+            stream = stream.next
+            continue
+        stream.full = 0
+        c_pthread.pthread_mutex_unlock(&io.mutex)
+        full = 0
+        rc_out = _read_ring(io, stream, &stream.out, 0, &full)
+        if rc_out >= 0 or rc_out == error_codes._LIBSSH2_ERROR_EAGAIN:
+            rc_err = _read_ring(io, stream, &stream.err,
+                                c_ssh2.SSH_EXTENDED_DATA_STDERR, &full)
+        else:
+            rc_err = 0
+        if rc_out > 0 or rc_err > 0:
+            progress = 1
+        rc = rc_out if rc_out < 0 and rc_out != error_codes._LIBSSH2_ERROR_EAGAIN \
+            else rc_err
+        if rc < 0 and rc != error_codes._LIBSSH2_ERROR_EAGAIN:
+            if not _is_channel_error(rc):
+                return rc
+            c_pthread.pthread_mutex_lock(&io.mutex)
+            stream.error = rc
+            c_pthread.pthread_cond_broadcast(&io.cond)
+            c_pthread.pthread_mutex_unlock(&io.mutex)
+            progress = 1
+        elif rc_out == 0 and rc_err == 0 and not full:
+            if c_ssh2.libssh2_channel_eof(stream.channel):
+                c_pthread.pthread_mutex_lock(&io.mutex)
+                stream.eof = 1
+                c_pthread.pthread_cond_broadcast(&io.cond)
+                c_pthread.pthread_mutex_unlock(&io.mutex)
+                progress = 1
+        elif rc_out == error_codes._LIBSSH2_ERROR_EAGAIN \
+                or rc_err == error_codes._LIBSSH2_ERROR_EAGAIN:
+            waiting[0] = 1
+        stream = stream.next
+    return progress
+
+
+cdef void *_io_main(void *arg) noexcept nogil:
+    """Body of the I/O thread - reads streams until stopped or the session
+    fails, waiting on the socket whenever nothing could be read."""
+    cdef _io_thread *io = <_io_thread *>arg
+    cdef _session_lock *lock = &io.session.lock
+    cdef _session_call call
+    cdef bint waiting
+    cdef int rc
+    call.op = NULL
+    call.locked = 1
+    while True:
+        c_pthread.pthread_mutex_lock(&io.mutex)
+        if io.stopping:
+            c_pthread.pthread_mutex_unlock(&io.mutex)
+            break
+        c_pthread.pthread_mutex_unlock(&io.mutex)
+        waiting = 0
+        _session_acquire(io.session, &call)
+        rc = _io_pass(io, &waiting)
+        _session_release(io.session, &call, 0)
+        if rc < 0:
+            c_pthread.pthread_mutex_lock(&io.mutex)
+            io.error = rc
+            c_pthread.pthread_mutex_unlock(&io.mutex)
+            break
+        elif rc > 0:
+            continue
+        if waiting:
+            call.start = -1
+            _session_wait(lock, &call)
+        else:
+            # Every stream is full, done or detached - wait for a read or a
+            # new stream, both of which wake the session's waiters
+            c_pthread.pthread_mutex_lock(&lock.wait_mutex)
+            while lock.reads == call.reads:
+                c_pthread.pthread_cond_wait(&lock.wait_cond, &lock.wait_mutex)
+            c_pthread.pthread_mutex_unlock(&lock.wait_mutex)
+    c_pthread.pthread_mutex_lock(&io.mutex)
+    io.running = 0
+    c_pthread.pthread_cond_broadcast(&io.cond)
+    c_pthread.pthread_mutex_unlock(&io.mutex)
+    return NULL
+
+
+cdef object io_thread(Session session, size_t buffer_size):
+    cdef IOThread io = IOThread.__new__(IOThread, session)
+    cdef int rc
+    if buffer_size < 1 or buffer_size > _MAX_BUFFER_SIZE:
+        raise ValueError("buffer_size must be between 1 and %s" % (
+            _MAX_BUFFER_SIZE,))
+    io._buffer_size = buffer_size
+    session.set_locking(True)
+    io._io.running = 1
+    rc = c_pthread.pthread_create(&io._thread, NULL, _io_main, &io._io)
+    if rc != 0:
+        io._io.running = 0
+        io._joined = 1
+        raise OSError(rc, "Could not start I/O thread")
+    io._joined = 0
+    return io
+
+
+cdef class ChannelStream:
+    """Output of a channel read by an :py:class:`IOThread`, as returned by
+    :py:func:`IOThread.add`.
+
+    stdout and stderr each have a buffer of the thread's ``buffer_size``.
+    Reading from a full buffer is left until it has been read from here, so
+    the channel's receive window then holds back the remote side."""
+
+    def __cinit__(self, IOThread io, channel):
+        self._io = io
+        self.channel = channel
+
+    def __iter__(self):
+        """Iterate over stdout data as it is read, until end of file."""
+        data = self.read()
+        while data:
+            yield data
+            data = self.read()
+
+    def read(self, size_t size=65536, long timeout=0):
+        """Read stdout data, waiting for some to be read by the I/O thread.
+
+        :param size: Maximum number of bytes to return.
+        :type size: int
+        :param timeout: Milliseconds to wait for data, or zero to wait
+          until there is some.
+        :type timeout: int
+
+        :returns: Data read so far, up to ``size`` bytes, or empty bytes at
+          end of file.
+        :rtype: bytes
+
+        :raises: :py:class:`ssh2.exceptions.Timeout` if no data is read in
+          ``timeout`` milliseconds.
+        :raises: :py:class:`ssh2.exceptions.BadUseError` if the stream was
+          closed or the I/O thread stopped and all data read by it has been
+          returned.
+        :raises: Appropriate exception from :py:mod:`ssh2.exceptions` on a
+          channel or session error, once the data read before it has been
+          returned."""
+        return self._read(&self._stream.out, size, timeout)
+
+    def read_stderr(self, size_t size=65536, long timeout=0):
+        """Read stderr data, waiting for some to be read by the I/O thread.
+        As :py:func:`read`.
+
+        :rtype: bytes"""
+        return self._read(&self._stream.err, size, timeout)
+
+    def eof(self):
+        """Get whether the channel has reached end of file and all of its
+        stdout and stderr data has been read.
+
+        :rtype: bool"""
+        cdef bint eof
+        with nogil:
+            c_pthread.pthread_mutex_lock(&self._io._io.mutex)
+            eof = self._stream.eof \
+                and self._stream.out.tail == self._stream.out.head \
+                and self._stream.err.tail == self._stream.err.head
+            c_pthread.pthread_mutex_unlock(&self._io._io.mutex)
+        return bool(eof)
+
+    def close(self):
+        """Stop reading the channel on the I/O thread. Data already read is
+        still returned by :py:func:`read` and :py:func:`read_stderr`, after
+        which the channel can be read directly again."""
+        with nogil:
+            c_pthread.pthread_mutex_lock(&self._io._io.mutex)
+            self._stream.detached = 1
+            c_pthread.pthread_cond_broadcast(&self._io._io.cond)
+            c_pthread.pthread_mutex_unlock(&self._io._io.mutex)
+
+    cdef bytes _read(self, _ring *ring, size_t size, long timeout):
+        cdef _io_thread *io = &self._io._io
+        cdef _io_stream *stream = self._stream
+        cdef timespec deadline
+        cdef bytes buf
+        cdef char *cbuf
+        cdef size_t length = 0
+        cdef size_t offset
+        cdef size_t first
+        cdef bint wake
+        cdef int rc = 0
+        if size == 0:
+            return b''
+        with nogil:
+            if timeout > 0:
+                clock_gettime(CLOCK_MONOTONIC, &deadline)
+                deadline.tv_sec += timeout // 1000 + (
+                    deadline.tv_nsec + timeout % 1000 * 1000000) // 1000000000
+                deadline.tv_nsec = (
+                    deadline.tv_nsec + timeout % 1000 * 1000000) % 1000000000
+            c_pthread.pthread_mutex_lock(&io.mutex)
+            while ring.tail == ring.head:
+                if stream.error != 0:
+                    rc = stream.error
+                elif io.error != 0:
+                    rc = io.error
+                elif stream.eof:
+                    rc = 0
+                elif stream.detached or not io.running:
+                    rc = error_codes._LIBSSH2_ERROR_BAD_USE
+                elif timeout <= 0:
+                    c_pthread.pthread_cond_wait(&io.cond, &io.mutex)
+                    continue
+                elif c_pthread.pthread_cond_timedwait(
+                        &io.cond, &io.mutex, &deadline) == 0:
+                    continue
+                elif ring.tail == ring.head:
+                    rc = error_codes._LIBSSH2_ERROR_TIMEOUT
+                else:
+                    continue
+                break
+            length = ring.tail - ring.head
+            c_pthread.pthread_mutex_unlock(&io.mutex)
+        if length == 0:
+            if rc == error_codes._LIBSSH2_ERROR_BAD_USE:
+                if stream.detached:
+                    raise BadUseError("Channel stream is closed")
+                raise BadUseError("I/O thread is not running")
+            handle_error_codes(rc)
+            return b''
+        if length > size:
+            length = size
+        # Only this thread moves the head, so the held data can be copied out
+        # without holding the mutex
+        buf = PyBytes_FromStringAndSize(NULL, length)
+        cbuf = PyBytes_AS_STRING(buf)
+        with nogil:
+            offset = ring.head % ring.size
+            first = ring.size - offset
+            if first >= length:
+                memcpy(cbuf, ring.data + offset, length)
+            else:
+                memcpy(cbuf, ring.data + offset, first)
+                memcpy(cbuf + first, ring.data, length - first)
+            c_pthread.pthread_mutex_lock(&io.mutex)
+            ring.head += length
+            wake = stream.full
+            stream.full = 0
+            c_pthread.pthread_mutex_unlock(&io.mutex)
+            if wake:
+                _session_wake(&io.session.lock)
+        return buf
+
+
+cdef class IOThread:
+    """Native thread reading the channels of a session into buffers.
+
+    The thread does all reads of the added channels' stdout and stderr and
+    runs without the GIL, reading and decrypting incoming data while Python
+    code is busy with data read before. Python code takes that data from
+    each channel's :py:class:`ChannelStream`, waiting only when none has
+    been read yet.
+
+    The session is put in locked mode, see
+    :py:func:`ssh2.session.Session.set_locking`, so other threads can still
+    write to channels, open new ones or use SFTP. Added channels must not
+    be read from directly while their stream is open.
+
+    Stop the thread with :py:func:`stop`, or by using it as a context
+    manager, before closing the session."""
+
+    def __cinit__(self, Session session):
+        cdef c_pthread.pthread_condattr_t attr
+        self._session = session
+        self._channels = []
+        self._io.session = &session._state
+        c_pthread.pthread_mutex_init(&self._io.mutex, NULL)
+        c_pthread.pthread_condattr_init(&attr)
+        c_pthread.pthread_condattr_setclock(&attr, CLOCK_MONOTONIC)
+        c_pthread.pthread_cond_init(&self._io.cond, &attr)
+        c_pthread.pthread_condattr_destroy(&attr)
+        self._joined = 1
+
+    def __dealloc__(self):
+        if not self._joined:
+            with nogil:
+                self._join()
+        _free_streams(self._io.streams)
+        c_pthread.pthread_mutex_destroy(&self._io.mutex)
+        c_pthread.pthread_cond_destroy(&self._io.cond)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    @property
+    def session(self):
+        """Originating session."""
+        return self._session
+
+    @property
+    def running(self):
+        """Whether the thread is running - it stops on :py:func:`stop` and
+        on session errors.
+
+        :rtype: bool"""
+        return bool(self._io.running)
+
+    def add(self, Channel channel not None):
+        """Start reading channel on the I/O thread.
+
+        :param channel: Channel of this thread's session.
+        :type channel: :py:class:`ssh2.channel.Channel`
+
+        :raises: :py:class:`ValueError` if channel is of another session.
+        :raises: :py:class:`ssh2.exceptions.BadUseError` if the channel was
+          already added or the thread is not running.
+
+        :rtype: :py:class:`ChannelStream`"""
+        cdef ChannelStream stream
+        cdef _io_stream *c_stream
+        if channel._session is not self._session:
+            raise ValueError("Channel is not of this thread's session")
+        if not self._io.running:
+            raise BadUseError("I/O thread is not running")
+        for added in self._channels:
+            if added is channel:
+                raise BadUseError("Channel was already added")
+        c_stream = <_io_stream *>PyMem_RawMalloc(sizeof(_io_stream))
+        if c_stream is NULL:
+            raise MemoryError()
+        memset(c_stream, 0, sizeof(_io_stream))
+        c_stream.channel = channel._channel
+        c_stream.out.size = c_stream.err.size = self._buffer_size
+        c_stream.out.data = <char *>PyMem_RawMalloc(self._buffer_size)
+        c_stream.err.data = <char *>PyMem_RawMalloc(self._buffer_size)
+        if c_stream.out.data is NULL or c_stream.err.data is NULL:
+            _free_streams(c_stream)
+            raise MemoryError()
+        stream = ChannelStream.__new__(ChannelStream, self, channel)
+        stream._stream = c_stream
+        # Keeps the channel alive while the thread may read it
+        self._channels.append(channel)
+        with nogil:
+            c_pthread.pthread_mutex_lock(&self._io.mutex)
+            c_stream.next = self._io.streams
+            self._io.streams = c_stream
+            c_pthread.pthread_mutex_unlock(&self._io.mutex)
+            _session_wake(&self._io.session.lock)
+        return stream
+
+    def stop(self):
+        """Stop the thread and wait for it to finish. Data already read is
+        still returned by the streams.
+
+        :raises: Appropriate exception from :py:mod:`ssh2.exceptions` if the
+          thread stopped on a session error."""
+        cdef int rc = 0
+        if not self._joined:
+            with nogil:
+                rc = self._join()
+        if rc != 0:
+            handle_error_codes(rc)
+
+    cdef int _join(self) noexcept nogil:
+        """Stop and join the thread. Returns its session error, if any."""
+        c_pthread.pthread_mutex_lock(&self._io.mutex)
+        self._io.stopping = 1
+        c_pthread.pthread_mutex_unlock(&self._io.mutex)
+        _session_wake(&self._io.session.lock)
+        c_pthread.pthread_join(self._thread, NULL)
+        self._joined = 1
+        return self._io.error
@@ -28,3 +28,74 @@ cdef class KnownHostEntry:
 cdef class KnownHost:
     cdef c_ssh2.LIBSSH2_KNOWNHOSTS *_ptr
     cdef Session _session
+
+
+cdef class KnownHostIterator:
+    cdef KnownHost _known_host
+    cdef c_ssh2.libssh2_knownhost **_batch
+    cdef c_ssh2.libssh2_knownhost *_prev
+    cdef Py_ssize_t _pos
+    cdef Py_ssize_t _count
+    cdef bint _done
+
+
+cdef struct _SaltState:
+    # HMAC-SHA1 inner and outer digest states after the key pad block
+    unsigned int inner[5]
+    unsigned int outer[5]
+    # Range of this salt's host hashes in the digest array
+    Py_ssize_t first
+    Py_ssize_t count
+
+
+cdef struct _HashedHost:
+    unsigned char digest[20]
+    Py_ssize_t index
+
+
+cdef class _HashIndex:
+    cdef _SaltState *_salts
+    cdef _HashedHost *_hosts
+    cdef Py_ssize_t _nsalts
+    cdef Py_ssize_t _nhosts
+
+    cdef Py_ssize_t match(self, const unsigned char *host, size_t host_len,
+                          Py_ssize_t *found, Py_ssize_t max_found) noexcept nogil
+
+
+cdef class KnownHostStoreEntry:
+    cdef readonly bytes name
+    cdef bytes _key
+    cdef readonly int typemask
+    cdef readonly bytes comment
+
+
+cdef class KnownHostStore:
+    cdef list _entries
+    cdef dict _plain
+    cdef dict _custom
+    cdef dict _salted
+    cdef _HashIndex _index
+    cdef dict _cache
+    cdef object _lock
+
+    cdef int _add_entry(self, KnownHostStoreEntry entry, bytes salt, bytes digest) except -1
+    cdef int _add_line(self, bytes line) except -1
+    cdef _HashIndex _get_index(self)
+    cdef tuple _candidates(self, bytes host, int host_type)
+    cdef int _check(self, bytes host, int port, bytes key, int typemask,
+                    Py_ssize_t *found) except -1
+
+
+cdef class HostKeyVerifier:
+    cdef readonly object filename
+    cdef readonly double check_interval
+    cdef KnownHostStore _store
+    cdef tuple _signature
+    cdef double _checked
+    cdef object _lock
+
+    cdef KnownHostStore _current(self)
+    cdef KnownHostStore _load(self, tuple signature, double now)
+    cpdef int check(self, bytes host, int port, bytes key, int key_type) except -1
+    cpdef KnownHostStoreEntry verify(self, bytes host, int port, bytes key, int key_type)
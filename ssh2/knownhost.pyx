@@ -15,8 +15,12 @@
 # License along with this library; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
 
-from base64 import b64decode
-from cpython.mem cimport PyMem_RawMalloc, PyMem_RawFree
+import os
+from _thread import allocate_lock
+from time import monotonic
+from binascii import a2b_base64, b2a_base64, Error as Base64Error
+from cpython.mem cimport PyMem_RawMalloc, PyMem_RawRealloc, PyMem_RawFree
+from libc.string cimport memcpy, memcmp, memset
 
 from ssh2.session cimport Session
 from ssh2.utils cimport to_bytes
@@ -28,8 +32,12 @@ from .exceptions import KnownHostAddError, KnownHostCheckMisMatchError, \
 from ssh2.error_codes cimport _LIBSSH2_ERROR_BUFFER_TOO_SMALL
 
 from ssh2 cimport c_ssh2
+from ssh2 cimport c_openssl
 
 
+# Entries added or retrieved per release of the GIL by bulk operations.
+DEF _BULK_BATCH = 256
+
 # Host format type masks
 LIBSSH2_KNOWNHOST_TYPE_MASK = c_ssh2.LIBSSH2_KNOWNHOST_TYPE_MASK
 LIBSSH2_KNOWNHOST_TYPE_PLAIN = c_ssh2.LIBSSH2_KNOWNHOST_TYPE_PLAIN
@@ -48,8 +56,34 @@ LIBSSH2_KNOWNHOST_KEY_RSA1 = c_ssh2.LIBSSH2_KNOWNHOST_KEY_RSA1
 LIBSSH2_KNOWNHOST_KEY_SSHRSA = c_ssh2.LIBSSH2_KNOWNHOST_KEY_SSHRSA
 LIBSSH2_KNOWNHOST_KEY_SSHDSS = c_ssh2.LIBSSH2_KNOWNHOST_KEY_SSHDSS
 IF EMBEDDED_LIB:
+    LIBSSH2_KNOWNHOST_KEY_ECDSA_256 = c_ssh2.LIBSSH2_KNOWNHOST_KEY_ECDSA_256
+    LIBSSH2_KNOWNHOST_KEY_ECDSA_384 = c_ssh2.LIBSSH2_KNOWNHOST_KEY_ECDSA_384
+    LIBSSH2_KNOWNHOST_KEY_ECDSA_521 = c_ssh2.LIBSSH2_KNOWNHOST_KEY_ECDSA_521
+    LIBSSH2_KNOWNHOST_KEY_ED25519 = c_ssh2.LIBSSH2_KNOWNHOST_KEY_ED25519
     LIBSSH2_KNOWNHOST_KEY_UNKNOWN = c_ssh2.LIBSSH2_KNOWNHOST_KEY_UNKNOWN
 
+# Host check results
+LIBSSH2_KNOWNHOST_CHECK_MATCH = c_ssh2.LIBSSH2_KNOWNHOST_CHECK_MATCH
+LIBSSH2_KNOWNHOST_CHECK_MISMATCH = c_ssh2.LIBSSH2_KNOWNHOST_CHECK_MISMATCH
+LIBSSH2_KNOWNHOST_CHECK_NOTFOUND = c_ssh2.LIBSSH2_KNOWNHOST_CHECK_NOTFOUND
+LIBSSH2_KNOWNHOST_CHECK_FAILURE = c_ssh2.LIBSSH2_KNOWNHOST_CHECK_FAILURE
+
+# Key type names in OpenSSH known_hosts files
+cdef dict _KEY_TYPE_NAMES = {
+    b"ssh-dss": c_ssh2.LIBSSH2_KNOWNHOST_KEY_SSHDSS,
+    b"ssh-rsa": c_ssh2.LIBSSH2_KNOWNHOST_KEY_SSHRSA,
+}
+IF EMBEDDED_LIB:
+    _KEY_TYPE_NAMES.update({
+        b"ecdsa-sha2-nistp256": c_ssh2.LIBSSH2_KNOWNHOST_KEY_ECDSA_256,
+        b"ecdsa-sha2-nistp384": c_ssh2.LIBSSH2_KNOWNHOST_KEY_ECDSA_384,
+        b"ecdsa-sha2-nistp521": c_ssh2.LIBSSH2_KNOWNHOST_KEY_ECDSA_521,
+        b"ssh-ed25519": c_ssh2.LIBSSH2_KNOWNHOST_KEY_ED25519,
+    })
+    _KEY_UNKNOWN = c_ssh2.LIBSSH2_KNOWNHOST_KEY_UNKNOWN
+ELSE:
+    _KEY_UNKNOWN = c_ssh2.LIBSSH2_KNOWNHOST_KEY_MASK
+
 
 cdef KnownHost PyKnownHost(Session session, c_ssh2.LIBSSH2_KNOWNHOSTS *_ptr):
     cdef KnownHost known_host = KnownHost.__new__(KnownHost, session)
@@ -116,7 +150,7 @@ cdef class KnownHostEntry:
         :py:func:`ssh2.knownhost.KnownHost.readline`, the stored key is not
         base64 encoded, contrary to documentation, and ``KnownHostEntry.key``
         will need to be re-encoded as base64 to get actual key."""
-        return b64decode(self._store.key) \
+        return a2b_base64(self._store.key) \
             if self._store.key is not NULL else None
 
     @property
@@ -395,22 +429,879 @@ cdef class KnownHost:
           retrieving known host collection.
 
         :rtype: list(:py:class:`ssh2.knownhost.KnownHostEntry`)"""
+        return list(KnownHostIterator(self, prev))
+
+    def __iter__(self):
+        """Iterate over host entries without creating them all up front.
+
+        Entries are retrieved from ``libssh2`` in batches. The collection must
+        not have entries deleted while it is being iterated over.
+
+        :rtype: :py:class:`ssh2.knownhost.KnownHostIterator`"""
+        return KnownHostIterator(self)
+
+    def addc_many(self, entries not None):
+        """Add many hosts and their keys to known hosts collection.
+
+        Entries are added in batches, with one release of the GIL per batch.
+        No entry objects are created, which makes this considerably faster than
+        calling :py:func:`KnownHost.addc` per host for large collections.
+
+        :param entries: Iterable of ``(host, key, typemask)`` or
+          ``(host, key, typemask, salt, comment)`` tuples, with the same
+          meaning as the arguments of :py:func:`KnownHost.addc`.
+        :type entries: iterable
+
+        :raises: :py:class:`ssh2.exceptions.KnownHostAddError` on errors adding
+          a known host entry. Entries before the failed one remain added.
+
+        :returns: Number of entries added.
+        :rtype: int"""
+        cdef _AddArgs *args = <_AddArgs *>PyMem_RawMalloc(
+            sizeof(_AddArgs) * _BULK_BATCH)
+        cdef list refs = []
+        cdef Py_ssize_t n = 0
+        cdef Py_ssize_t added = 0
+        cdef Py_ssize_t i
+        cdef int rc = 0
+        cdef bytes host, key, salt, comment
+        if args is NULL:
+            raise MemoryError
+        try:
+            entries = iter(entries)
+            while True:
+                # Bytes objects in refs keep the pointers in args valid
+                del refs[:]
+                n = 0
+                for entry in entries:
+                    host, key, typemask = entry[:3]
+                    salt = entry[3] if len(entry) > 3 else None
+                    comment = entry[4] if len(entry) > 4 else None
+                    if host is None or key is None:
+                        raise KnownHostAddError(
+                            "Error adding known host entry %s - host and key "
+                            "are required", added + n)
+                    refs.append(entry)
+                    refs.append(host)
+                    refs.append(key)
+                    refs.append(salt)
+                    refs.append(comment)
+                    args[n].host = host
+                    args[n].salt = b""
+                    if salt is not None:
+                        args[n].salt = salt
+                    args[n].key = key
+                    args[n].key_len = len(key)
+                    args[n].comment = NULL
+                    args[n].comment_len = 0
+                    if comment is not None:
+                        args[n].comment = comment
+                        args[n].comment_len = len(comment)
+                    args[n].typemask = typemask
+                    n += 1
+                    if n == _BULK_BATCH:
+                        break
+                if n == 0:
+                    break
+                with nogil:
+                    for i in range(n):
+                        rc = c_ssh2.libssh2_knownhost_addc(
+                            self._ptr, args[i].host, args[i].salt, args[i].key,
+                            args[i].key_len, args[i].comment, args[i].comment_len,
+                            args[i].typemask, NULL)
+                        if rc != 0:
+                            break
+                        added += 1
+                if rc != 0:
+                    raise KnownHostAddError(
+                        "Error adding known host entry %s for host %s - "
+                        "error code %s", added, refs[i * 5 + 1], rc)
+                if n < _BULK_BATCH:
+                    break
+        finally:
+            PyMem_RawFree(args)
+        return added
+
+    def writebuf(self, int f_type=c_ssh2.LIBSSH2_KNOWNHOST_FILE_OPENSSH):
+        """Convert all known host entries to lines of output for writing, as
+        :py:func:`KnownHost.writefile` would write them to file. Only OpenSSH
+        known hosts file format is currently supported.
+
+        The whole collection is converted without the GIL.
+
+        :raises: :py:class:`ssh2.exceptions.KnownHostWriteLineError` on errors
+          writing lines.
+
+        :rtype: bytes"""
+        cdef size_t buf_len = 65536
+        cdef size_t used = 0
+        cdef size_t outlen = 0
+        cdef char *buf = <char *>PyMem_RawMalloc(buf_len)
+        cdef char *new_buf
         cdef c_ssh2.libssh2_knownhost *_store = NULL
         cdef c_ssh2.libssh2_knownhost *_prev = NULL
-        cdef int rc
-        cdef list entries = []
-        if prev is not None:
-            _prev = prev._store
-        with nogil:
-            rc = c_ssh2.libssh2_knownhost_get(
-                self._ptr, &_store, _prev)
-        while rc == 0:
-            entries.append(PyKnownHostEntry(_store))
-            _prev = _store
+        cdef int rc = 0
+        if buf is NULL:
+            raise MemoryError
+        try:
             with nogil:
-                rc = c_ssh2.libssh2_knownhost_get(
-                    self._ptr, &_store, _prev)
-        if rc < 0:
-            raise KnownHostGetError(
-                "Error retrieving known hosts - error code %s", rc)
-        return entries
+                rc = c_ssh2.libssh2_knownhost_get(self._ptr, &_store, _prev)
+                while rc == 0:
+                    rc = c_ssh2.libssh2_knownhost_writeline(
+                        self._ptr, _store, buf + used, buf_len - used, &outlen,
+                        f_type)
+                    if rc == _LIBSSH2_ERROR_BUFFER_TOO_SMALL:
+                        buf_len = max(buf_len * 2, used + outlen + 1)
+                        new_buf = <char *>PyMem_RawRealloc(buf, buf_len)
+                        if new_buf is NULL:
+                            with gil:
+                                raise MemoryError
+                        buf = new_buf
+                        rc = 0
+                        continue
+                    elif rc != 0:
+                        break
+                    used += outlen
+                    _prev = _store
+                    rc = c_ssh2.libssh2_knownhost_get(self._ptr, &_store, _prev)
+            if rc < 0:
+                raise KnownHostWriteLineError(
+                    "Error writing lines for known hosts - error code %s", rc)
+            return buf[:used]
+        finally:
+            PyMem_RawFree(buf)
+
+
+cdef struct _AddArgs:
+    const char *host
+    const char *salt
+    const char *key
+    size_t key_len
+    const char *comment
+    size_t comment_len
+    int typemask
+
+
+cdef class KnownHostIterator:
+    """Iterator over the entries of a :py:class:`KnownHost` collection.
+
+    Entries are retrieved from ``libssh2`` in batches, with one release of the
+    GIL per batch, and entry objects are only created as they are iterated
+    over."""
+
+    def __cinit__(self, KnownHost known_host not None,
+                  KnownHostEntry prev=None):
+        self._known_host = known_host
+        self._batch = <c_ssh2.libssh2_knownhost **>PyMem_RawMalloc(
+            sizeof(c_ssh2.libssh2_knownhost *) * _BULK_BATCH)
+        if self._batch is NULL:
+            raise MemoryError
+        self._prev = prev._store if prev is not None else NULL
+        self._pos = 0
+        self._count = 0
+        self._done = False
+
+    def __dealloc__(self):
+        PyMem_RawFree(self._batch)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        cdef c_ssh2.libssh2_knownhost *_store = NULL
+        cdef c_ssh2.LIBSSH2_KNOWNHOSTS *_ptr = self._known_host._ptr
+        cdef Py_ssize_t count = 0
+        cdef int rc = 0
+        if self._pos == self._count:
+            if self._done:
+                raise StopIteration
+            with nogil:
+                while count < _BULK_BATCH:
+                    rc = c_ssh2.libssh2_knownhost_get(_ptr, &_store, self._prev)
+                    if rc != 0:
+                        break
+                    self._batch[count] = _store
+                    self._prev = _store
+                    count += 1
+            if rc < 0:
+                self._done = True
+                raise KnownHostGetError(
+                    "Error retrieving known hosts - error code %s", rc)
+            self._done = rc != 0
+            self._pos = 0
+            self._count = count
+            if count == 0:
+                raise StopIteration
+        self._pos += 1
+        return PyKnownHostEntry(self._batch[self._pos - 1])
+
+
+# Longest host name libssh2 accepts for a host check, including the
+# [host]:port form.
+DEF _MAX_HOST_LEN = 269
+# Upper bound on distinct hashed entries matching a single host name that are
+# collected without the GIL.
+DEF _MAX_HASH_MATCHES = 64
+# Host check results cached per store before the cache is reset.
+DEF _MAX_CACHED_HOSTS = 65536
+
+
+cdef inline void _sha1_save(const c_openssl.SHA_CTX *ctx, unsigned int *state) noexcept nogil:
+    state[0] = ctx.h0
+    state[1] = ctx.h1
+    state[2] = ctx.h2
+    state[3] = ctx.h3
+    state[4] = ctx.h4
+
+
+cdef inline void _sha1_resume(c_openssl.SHA_CTX *ctx, const unsigned int *state) noexcept nogil:
+    # Digest state after exactly one block of input.
+    memset(ctx, 0, sizeof(c_openssl.SHA_CTX))
+    ctx.h0 = state[0]
+    ctx.h1 = state[1]
+    ctx.h2 = state[2]
+    ctx.h3 = state[3]
+    ctx.h4 = state[4]
+    ctx.Nl = c_openssl.SHA_CBLOCK * 8
+
+
+cdef void _hmac_sha1_init(const unsigned char *key, size_t key_len,
+                          _SaltState *salt) noexcept nogil:
+    cdef unsigned char block[c_openssl.SHA_CBLOCK]
+    cdef unsigned char pad[c_openssl.SHA_CBLOCK]
+    cdef c_openssl.SHA_CTX ctx
+    cdef size_t i
+    memset(block, 0, sizeof(block))
+    if key_len > sizeof(block):
+        c_openssl.SHA1(key, key_len, block)
+    else:
+        memcpy(block, key, key_len)
+    for i in range(sizeof(block)):
+        pad[i] = block[i] ^ 0x36
+    c_openssl.SHA1_Init(&ctx)
+    c_openssl.SHA1_Update(&ctx, pad, sizeof(pad))
+    _sha1_save(&ctx, salt.inner)
+    for i in range(sizeof(block)):
+        pad[i] = block[i] ^ 0x5c
+    c_openssl.SHA1_Init(&ctx)
+    c_openssl.SHA1_Update(&ctx, pad, sizeof(pad))
+    _sha1_save(&ctx, salt.outer)
+
+
+cdef void _hmac_sha1(const _SaltState *salt, const unsigned char *msg, size_t msg_len,
+                     unsigned char *digest) noexcept nogil:
+    cdef c_openssl.SHA_CTX ctx
+    _sha1_resume(&ctx, salt.inner)
+    c_openssl.SHA1_Update(&ctx, msg, msg_len)
+    c_openssl.SHA1_Final(digest, &ctx)
+    _sha1_resume(&ctx, salt.outer)
+    c_openssl.SHA1_Update(&ctx, digest, c_openssl.SHA_DIGEST_LENGTH)
+    c_openssl.SHA1_Final(digest, &ctx)
+
+
+cdef class _HashIndex:
+    """Hashed host names grouped by salt, with the HMAC key schedule of each
+    salt computed once up front.
+
+    An index is immutable once built. The store replaces it with a new one
+    when hashed entries are added, so lookups running without the GIL keep
+    using the index they started with."""
+
+    def __cinit__(self, dict salted):
+        cdef Py_ssize_t nsalts = len(salted)
+        cdef Py_ssize_t nhosts = 0
+        cdef Py_ssize_t i = 0
+        cdef Py_ssize_t n = 0
+        cdef bytes salt
+        cdef bytes digest
+        cdef list hosts
+        for hosts in salted.values():
+            nhosts += len(hosts)
+        self._salts = <_SaltState *>PyMem_RawMalloc(
+            sizeof(_SaltState) * max(nsalts, 1))
+        self._hosts = <_HashedHost *>PyMem_RawMalloc(
+            sizeof(_HashedHost) * max(nhosts, 1))
+        if self._salts is NULL or self._hosts is NULL:
+            raise MemoryError
+        for salt, hosts in salted.items():
+            _hmac_sha1_init(salt, len(salt), &self._salts[i])
+            self._salts[i].first = n
+            self._salts[i].count = len(hosts)
+            for digest, index in hosts:
+                memcpy(self._hosts[n].digest, <const char *>digest,
+                       c_openssl.SHA_DIGEST_LENGTH)
+                self._hosts[n].index = index
+                n += 1
+            i += 1
+        self._nsalts = nsalts
+        self._nhosts = nhosts
+
+    def __dealloc__(self):
+        PyMem_RawFree(self._salts)
+        PyMem_RawFree(self._hosts)
+
+    cdef Py_ssize_t match(self, const unsigned char *host, size_t host_len,
+                          Py_ssize_t *found, Py_ssize_t max_found) noexcept nogil:
+        """Store entry indices of hashed entries for host in found.
+
+        Returns the number of matches, which may be larger than max_found."""
+        cdef unsigned char digest[c_openssl.SHA_DIGEST_LENGTH]
+        cdef const _SaltState *salt
+        cdef Py_ssize_t i, j
+        cdef Py_ssize_t nfound = 0
+        for i in range(self._nsalts):
+            salt = &self._salts[i]
+            _hmac_sha1(salt, host, host_len, digest)
+            for j in range(salt.first, salt.first + salt.count):
+                if memcmp(digest, self._hosts[j].digest, sizeof(digest)) == 0:
+                    if nfound < max_found:
+                        found[nfound] = self._hosts[j].index
+                    nfound += 1
+        return nfound
+
+
+cdef class KnownHostStoreEntry:
+    """A single host entry of a :py:class:`KnownHostStore`."""
+
+    def __repr__(self):
+        return "Known host store entry for host: %s" % (self.name)
+
+    def __str__(self):
+        return self.__repr__()
+
+    @property
+    def key(self):
+        """Key byte string, base64 decoded as for
+        :py:attr:`KnownHostEntry.key`."""
+        return a2b_base64(self._key)
+
+
+cdef KnownHostStoreEntry _new_store_entry(bytes name, bytes key, int typemask,
+                                          bytes comment):
+    cdef KnownHostStoreEntry entry = KnownHostStoreEntry.__new__(KnownHostStoreEntry)
+    entry.name = name
+    entry._key = key
+    entry.typemask = typemask
+    entry.comment = comment
+    return entry
+
+
+cdef class KnownHostStore:
+    """In memory known hosts collection optimised for large known_hosts files.
+
+    Unlike :py:class:`KnownHost` a store does not belong to a session, so one
+    store loaded once can be used to verify any number of sessions. Checks
+    follow :py:func:`KnownHost.checkp` and return the same
+    ``LIBSSH2_KNOWNHOST_CHECK_*`` results, but plain host names are found
+    through a hash table, and hashed (``|1|salt|hash``) host names through an
+    index with the HMAC key schedule of each salt precomputed. Results are
+    cached per host name until the store is next modified.
+
+    :param filename: Optional OpenSSH known hosts file to read.
+    :type filename: str"""
+
+    def __cinit__(self, filename=None):
+        self._entries = []
+        self._plain = {}
+        self._custom = {}
+        self._salted = {}
+        self._index = None
+        self._cache = {}
+        self._lock = allocate_lock()
+
+    def __init__(self, filename=None):
+        if filename is not None:
+            self.readfile(filename)
+
+    def __len__(self):
+        return len(self._entries)
+
+    cdef int _add_entry(self, KnownHostStoreEntry entry, bytes salt,
+                        bytes digest) except -1:
+        cdef Py_ssize_t index = len(self._entries)
+        cdef int host_type = entry.typemask & c_ssh2.LIBSSH2_KNOWNHOST_TYPE_MASK
+        self._entries.append(entry)
+        if host_type == c_ssh2.LIBSSH2_KNOWNHOST_TYPE_PLAIN:
+            self._plain.setdefault(entry.name, []).append(index)
+        elif host_type == c_ssh2.LIBSSH2_KNOWNHOST_TYPE_CUSTOM:
+            self._custom.setdefault(entry.name, []).append(index)
+        elif len(digest) == c_openssl.SHA_DIGEST_LENGTH:
+            # Hashes of any other length can never match, as with libssh2.
+            self._salted.setdefault(salt, []).append((digest, index))
+            self._index = None
+        self._cache = {}
+        return 0
+
+    cdef int _add_line(self, bytes line) except -1:
+        cdef list fields
+        cdef bytes hostfield, keyfield, name, key, salt, digest
+        cdef bytes comment = None
+        cdef int key_type
+        line = line.lstrip(b" \t").rstrip(b"\r\n")
+        if not line or line.startswith(b"#"):
+            return 0
+        fields = line.split(None, 1)
+        if len(fields) != 2:
+            raise ValueError("Failed to parse known_hosts line")
+        hostfield, keyfield = fields
+        if len(keyfield) < 20:
+            raise ValueError("Failed to parse known_hosts line (key too short)")
+        if keyfield[:1].isdigit():
+            # Old style RSA1 "bits exponent modulus", compared as text.
+            key = keyfield
+            key_type = c_ssh2.LIBSSH2_KNOWNHOST_KEY_RSA1
+        else:
+            fields = keyfield.split(None, 2)
+            key = fields[1] if len(fields) > 1 else b""
+            if len(fields) > 2:
+                comment = fields[2]
+            key_type = _KEY_TYPE_NAMES.get(fields[0], _KEY_UNKNOWN)
+        key_type |= c_ssh2.LIBSSH2_KNOWNHOST_KEYENC_BASE64
+        if hostfield.startswith(b"|1|"):
+            salt, sep, digest = hostfield[3:].partition(b"|")
+            if not sep:
+                # Ignored by libssh2 as well.
+                return 0
+            try:
+                self._add_entry(
+                    _new_store_entry(hostfield, key,
+                                     key_type | c_ssh2.LIBSSH2_KNOWNHOST_TYPE_SHA1, comment),
+                    a2b_base64(salt), a2b_base64(digest))
+            except Base64Error:
+                raise ValueError("Failed to parse known_hosts line (bad host hash)")
+            return 0
+        for name in hostfield.split(b","):
+            if name:
+                self._add_entry(
+                    _new_store_entry(name, key,
+                                     key_type | c_ssh2.LIBSSH2_KNOWNHOST_TYPE_PLAIN, comment),
+                    None, None)
+        return 0
+
+    def readline(self, bytes line not None,
+                 int f_type=c_ssh2.LIBSSH2_KNOWNHOST_FILE_OPENSSH):
+        """Read line from known hosts file and add to the store.
+        Only OpenSSH known hosts file format is supported.
+
+        :param line: Byte string representing line to read.
+        :type line: bytes
+
+        :raises: :py:class:`ssh2.exceptions.KnownHostReadLineError` on errors
+          reading line."""
+        if f_type != c_ssh2.LIBSSH2_KNOWNHOST_FILE_OPENSSH:
+            raise KnownHostReadLineError(
+                "Unsupported type of known hosts information - %s", f_type)
+        with self._lock:
+            try:
+                self._add_line(line)
+            except ValueError as exc:
+                raise KnownHostReadLineError(
+                    "Error reading line from known hosts - %s", exc)
+
+    def readfile(self, filename not None,
+                 int f_type=c_ssh2.LIBSSH2_KNOWNHOST_FILE_OPENSSH):
+        """Read known hosts file and add hosts to the store.
+        Only OpenSSH known hosts file format is supported.
+
+        Returns number of lines read, as :py:func:`KnownHost.readfile` does.
+
+        :param filename: File name to read.
+        :type filename: str
+
+        :raises: :py:class:`ssh2.exceptions.KnownHostReadFileError` on errors
+          opening or parsing file.
+
+        :rtype: int"""
+        cdef int num = 0
+        cdef bytes line
+        if f_type != c_ssh2.LIBSSH2_KNOWNHOST_FILE_OPENSSH:
+            raise KnownHostReadFileError(
+                "Unsupported type of known hosts information - %s", f_type)
+        with self._lock:
+            try:
+                with open(filename, "rb") as fh:
+                    for line in fh:
+                        self._add_line(line)
+                        num += 1
+            except (OSError, ValueError) as exc:
+                raise KnownHostReadFileError(
+                    "Error reading known hosts file %s - %s", filename, exc)
+        return num
+
+    def addc(self, bytes host not None, bytes key not None,
+             int typemask, bytes salt=None, bytes comment=None):
+        """Adds a host and its key to the store, with the same arguments as
+        :py:func:`KnownHost.addc`.
+
+        :raises: :py:class:`ssh2.exceptions.KnownHostAddError` on errors adding
+          known host entry.
+
+        :rtype: :py:class:`KnownHostStoreEntry`"""
+        cdef int host_type = typemask & c_ssh2.LIBSSH2_KNOWNHOST_TYPE_MASK
+        cdef bytes b64_key = key if typemask & c_ssh2.LIBSSH2_KNOWNHOST_KEYENC_BASE64 \
+            else b2a_base64(key, newline=False)
+        cdef bytes name = host
+        cdef KnownHostStoreEntry entry
+        if not typemask & c_ssh2.LIBSSH2_KNOWNHOST_KEY_MASK:
+            raise KnownHostAddError(
+                "Error adding known host entry for host %s - no key type set", host)
+        typemask = (typemask & ~c_ssh2.LIBSSH2_KNOWNHOST_KEYENC_MASK) | \
+            c_ssh2.LIBSSH2_KNOWNHOST_KEYENC_BASE64
+        with self._lock:
+            if host_type == c_ssh2.LIBSSH2_KNOWNHOST_TYPE_SHA1:
+                if salt is None:
+                    raise KnownHostAddError(
+                        "Error adding known host entry for host %s - "
+                        "hashed host without salt", host)
+                name = b"|1|" + salt + b"|" + host
+                entry = _new_store_entry(name, b64_key, typemask, comment)
+                try:
+                    self._add_entry(entry, a2b_base64(salt), a2b_base64(host))
+                except Base64Error:
+                    raise KnownHostAddError(
+                        "Error adding known host entry for host %s - "
+                        "invalid host hash or salt", host)
+            elif host_type == c_ssh2.LIBSSH2_KNOWNHOST_TYPE_PLAIN or \
+                    host_type == c_ssh2.LIBSSH2_KNOWNHOST_TYPE_CUSTOM:
+                entry = _new_store_entry(name, b64_key, typemask, comment)
+                self._add_entry(entry, None, None)
+            else:
+                raise KnownHostAddError(
+                    "Error adding known host entry for host %s - "
+                    "unknown host name type", host)
+        return entry
+
+    def get(self):
+        """Retrieve all host entries in the store.
+
+        :rtype: list(:py:class:`ssh2.knownhost.KnownHostStoreEntry`)"""
+        return list(self._entries)
+
+    cdef _HashIndex _get_index(self):
+        cdef _HashIndex index = self._index
+        if index is None:
+            with self._lock:
+                index = self._index
+                if index is None:
+                    index = self._index = _HashIndex(self._salted)
+        return index
+
+    cdef tuple _candidates(self, bytes host, int host_type):
+        """Indices of entries whose host name matches, in store order."""
+        cdef tuple key = (host, host_type)
+        cdef tuple candidates = self._cache.get(key)
+        cdef list found
+        cdef _HashIndex index
+        cdef const unsigned char *_host = host
+        cdef size_t host_len = len(host)
+        cdef Py_ssize_t hashed[_MAX_HASH_MATCHES]
+        cdef Py_ssize_t nhashed, i
+        if candidates is not None:
+            return candidates
+        if host_type == c_ssh2.LIBSSH2_KNOWNHOST_TYPE_PLAIN:
+            found = list(self._plain.get(host, ()))
+            index = self._get_index()
+            with nogil:
+                nhashed = index.match(_host, host_len, hashed, _MAX_HASH_MATCHES)
+            if nhashed > _MAX_HASH_MATCHES:
+                found.extend(_slow_hash_matches(self._salted, host))
+            else:
+                for i in range(nhashed):
+                    found.append(hashed[i])
+            found.sort()
+            candidates = tuple(found)
+        elif host_type == c_ssh2.LIBSSH2_KNOWNHOST_TYPE_CUSTOM:
+            candidates = tuple(self._custom.get(host, ()))
+        else:
+            candidates = ()
+        if len(self._cache) >= _MAX_CACHED_HOSTS:
+            self._cache = {}
+        self._cache[key] = candidates
+        return candidates
+
+    cdef int _check(self, bytes host, int port, bytes key, int typemask,
+                    Py_ssize_t *found) except -1:
+        cdef int host_type = typemask & c_ssh2.LIBSSH2_KNOWNHOST_TYPE_MASK
+        cdef int key_type = typemask & c_ssh2.LIBSSH2_KNOWNHOST_KEY_MASK
+        cdef Py_ssize_t badkey = -1
+        cdef Py_ssize_t index
+        cdef KnownHostStoreEntry entry
+        cdef tuple hosts
+        if host_type == c_ssh2.LIBSSH2_KNOWNHOST_TYPE_SHA1:
+            # Hashed host names cannot be checked against
+            return c_ssh2.LIBSSH2_KNOWNHOST_CHECK_MISMATCH
+        if port >= 0:
+            hosts = (b"[%s]:%d" % (host, port), host)
+            if len(hosts[0]) > _MAX_HOST_LEN:
+                return c_ssh2.LIBSSH2_KNOWNHOST_CHECK_FAILURE
+        else:
+            hosts = (host,)
+        if not typemask & c_ssh2.LIBSSH2_KNOWNHOST_KEYENC_BASE64:
+            key = b2a_base64(key, newline=False)
+        if key_type == _KEY_UNKNOWN:
+            # Never matches, as with libssh2
+            return c_ssh2.LIBSSH2_KNOWNHOST_CHECK_NOTFOUND
+        for host in hosts:
+            for index in self._candidates(host, host_type):
+                entry = self._entries[index]
+                if key_type != 0 and \
+                        key_type != entry.typemask & c_ssh2.LIBSSH2_KNOWNHOST_KEY_MASK:
+                    continue
+                if entry._key == key:
+                    found[0] = index
+                    return c_ssh2.LIBSSH2_KNOWNHOST_CHECK_MATCH
+                if badkey < 0:
+                    badkey = index
+        if badkey >= 0:
+            found[0] = badkey
+            return c_ssh2.LIBSSH2_KNOWNHOST_CHECK_MISMATCH
+        return c_ssh2.LIBSSH2_KNOWNHOST_CHECK_NOTFOUND
+
+    def check(self, bytes host not None, int port, bytes key not None,
+              int typemask):
+        """Check a host and its key against the store and return the
+        ``LIBSSH2_KNOWNHOST_CHECK_*`` result, without raising an exception.
+
+        Arguments are the same as for :py:func:`KnownHost.checkp`. A port of
+        ``-1`` checks only the host name, not ``[host]:port``.
+
+        :rtype: int"""
+        cdef Py_ssize_t found = -1
+        return self._check(host, port, key, typemask, &found)
+
+    def checkp(self, bytes host not None, int port, bytes key not None,
+               int typemask):
+        """Check a host and its key against the store and return the
+        matching entry.
+
+        Arguments, results and exceptions are the same as for
+        :py:func:`KnownHost.checkp`.
+
+        :raises: :py:class:`ssh2.exceptions.KnownHostCheckMisMatchError` on
+          provided key mis-match error with found key from known hosts.
+        :raises: :py:class:`ssh2.exceptions.KnownHostCheckNotFoundError` on
+          host not found in known hosts.
+        :raises: :py:class:`ssh2.exceptions.KnownHostCheckFailure` on failure
+          checking known host entry.
+
+        :rtype: :py:class:`ssh2.knownhost.KnownHostStoreEntry`"""
+        cdef Py_ssize_t found = -1
+        cdef int rc = self._check(host, port, key, typemask, &found)
+        if rc == c_ssh2.LIBSSH2_KNOWNHOST_CHECK_MATCH:
+            return self._entries[found]
+        elif rc == c_ssh2.LIBSSH2_KNOWNHOST_CHECK_FAILURE:
+            raise KnownHostCheckFailure(
+                "Could not check known host entry for host %s "
+                "- error code %s", host, rc)
+        elif rc == c_ssh2.LIBSSH2_KNOWNHOST_CHECK_NOTFOUND:
+            raise KnownHostCheckNotFoundError(
+                "Host %s not found in known hosts collection", host)
+        elif rc == c_ssh2.LIBSSH2_KNOWNHOST_CHECK_MISMATCH:
+            raise KnownHostCheckMisMatchError(
+                "Known host key for host %s does not match provided key - "
+                "error code %s", host, rc)
+        raise KnownHostCheckError(
+            "Unknown error occurred checking known host %s", host)
+
+
+cdef list _slow_hash_matches(dict salted, bytes host):
+    # Only reached for a host name with more hashed entries than fit the
+    # fixed size match buffer.
+    import hmac
+    cdef list found = []
+    for salt, hosts in salted.items():
+        digest = hmac.digest(salt, host, "sha1")
+        for host_digest, index in hosts:
+            if host_digest == digest:
+                found.append(index)
+    return found
+
+
+cdef dict _shared_stores = {}
+_shared_stores_lock = allocate_lock()
+
+
+def shared_store(filename not None):
+    """Get the process wide :py:class:`KnownHostStore` for a known hosts file.
+
+    The file is read on first use only and the same store is returned to all
+    callers, so that many sessions can be verified without re-reading it.
+
+    :param filename: Known hosts file name.
+    :type filename: str
+
+    :raises: :py:class:`ssh2.exceptions.KnownHostReadFileError` on errors
+      reading file.
+
+    :rtype: :py:class:`KnownHostStore`"""
+    cdef str path = os.path.abspath(os.fsdecode(filename))
+    cdef KnownHostStore store = _shared_stores.get(path)
+    if store is None:
+        with _shared_stores_lock:
+            store = _shared_stores.get(path)
+            if store is None:
+                store = KnownHostStore(path)
+                _shared_stores[path] = store
+    return store
+
+
+# Server host key types as returned by Session.hostkey to known host key types
+cdef dict _HOSTKEY_TYPES = {
+    c_ssh2.LIBSSH2_HOSTKEY_TYPE_RSA: c_ssh2.LIBSSH2_KNOWNHOST_KEY_SSHRSA,
+    c_ssh2.LIBSSH2_HOSTKEY_TYPE_DSS: c_ssh2.LIBSSH2_KNOWNHOST_KEY_SSHDSS,
+}
+IF EMBEDDED_LIB:
+    _HOSTKEY_TYPES.update({
+        c_ssh2.LIBSSH2_HOSTKEY_TYPE_ECDSA_256: c_ssh2.LIBSSH2_KNOWNHOST_KEY_ECDSA_256,
+        c_ssh2.LIBSSH2_HOSTKEY_TYPE_ECDSA_384: c_ssh2.LIBSSH2_KNOWNHOST_KEY_ECDSA_384,
+        c_ssh2.LIBSSH2_HOSTKEY_TYPE_ECDSA_521: c_ssh2.LIBSSH2_KNOWNHOST_KEY_ECDSA_521,
+        c_ssh2.LIBSSH2_HOSTKEY_TYPE_ED25519: c_ssh2.LIBSSH2_KNOWNHOST_KEY_ED25519,
+    })
+
+
+cdef tuple _file_signature(filename):
+    try:
+        st = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+cdef class HostKeyVerifier:
+    """Server host key verification against a known hosts file.
+
+    The file is parsed into a :py:class:`KnownHostStore` on first use and
+    re-read only when its modification time, size or inode changes. A missing
+    file is treated as empty.
+
+    Verification does not take any lock: the current store is replaced as a
+    whole on reload, so concurrent verifications from many threads use either
+    the old or the new store. Only threads that see a changed file wait on the
+    reload, which is serialised per verifier.
+
+    Use :py:func:`get_verifier` for the process wide verifier of a file.
+
+    :param filename: Known hosts file name.
+    :type filename: str
+    :param check_interval: Minimum time in seconds between checks of the file
+      for changes. The default of ``0`` checks on every verification.
+    :type check_interval: float"""
+
+    def __cinit__(self, filename not None, double check_interval=0):
+        self.filename = os.path.abspath(os.fsdecode(filename))
+        self.check_interval = check_interval
+        self._store = None
+        self._signature = None
+        self._checked = 0
+        self._lock = allocate_lock()
+
+    def __repr__(self):
+        return "Host key verifier for %s" % (self.filename,)
+
+    @property
+    def store(self):
+        """Known host store currently in use, after reloading it if the
+        file has changed.
+
+        :rtype: :py:class:`KnownHostStore`"""
+        return self._current()
+
+    cdef KnownHostStore _current(self):
+        cdef KnownHostStore store = self._store
+        cdef double now = monotonic()
+        cdef tuple signature
+        if store is not None and now - self._checked < self.check_interval:
+            return store
+        signature = _file_signature(self.filename)
+        if store is not None and signature == self._signature:
+            self._checked = now
+            return store
+        with self._lock:
+            if self._store is not None and signature == self._signature:
+                return self._store
+            return self._load(signature, now)
+
+    cdef KnownHostStore _load(self, tuple signature, double now):
+        # Called with the lock held
+        cdef KnownHostStore store = KnownHostStore()
+        if signature is not None:
+            store.readfile(self.filename)
+        # Build the hashed host index before the store is published.
+        store._get_index()
+        self._store = store
+        self._signature = signature
+        self._checked = now
+        return store
+
+    def reload(self):
+        """Re-read the known hosts file whether it has changed or not."""
+        with self._lock:
+            self._load(_file_signature(self.filename), monotonic())
+
+    cpdef int check(self, bytes host, int port, bytes key, int key_type) except -1:
+        """Check a server host key, as returned by
+        :py:func:`ssh2.session.Session.hostkey`, and return the
+        ``LIBSSH2_KNOWNHOST_CHECK_*`` result.
+
+        :param host: Host name or address.
+        :type host: bytes
+        :param port: Port of host, ``-1`` to check the host name only.
+        :type port: int
+        :param key: Raw host key.
+        :type key: bytes
+        :param key_type: One of ``ssh2.session.LIBSSH2_HOSTKEY_TYPE_*``.
+        :type key_type: int
+
+        :rtype: int"""
+        cdef Py_ssize_t found = -1
+        cdef int typemask = c_ssh2.LIBSSH2_KNOWNHOST_TYPE_PLAIN | \
+            c_ssh2.LIBSSH2_KNOWNHOST_KEYENC_RAW | _HOSTKEY_TYPES.get(key_type, _KEY_UNKNOWN)
+        return self._current()._check(host, port, key, typemask, &found)
+
+    cpdef KnownHostStoreEntry verify(self, bytes host, int port, bytes key,
+                                     int key_type):
+        """Verify a server host key, as returned by
+        :py:func:`ssh2.session.Session.hostkey`, and return the matching
+        entry.
+
+        Arguments are as for :py:func:`HostKeyVerifier.check`.
+
+        :raises: :py:class:`ssh2.exceptions.KnownHostCheckMisMatchError` on
+          provided key mis-match error with found key from known hosts.
+        :raises: :py:class:`ssh2.exceptions.KnownHostCheckNotFoundError` on
+          host not found in known hosts.
+        :raises: :py:class:`ssh2.exceptions.KnownHostCheckFailure` on failure
+          checking known host entry.
+        :raises: :py:class:`ssh2.exceptions.KnownHostReadFileError` on errors
+          reading the known hosts file.
+
+        :rtype: :py:class:`KnownHostStoreEntry`"""
+        cdef int typemask = c_ssh2.LIBSSH2_KNOWNHOST_TYPE_PLAIN | \
+            c_ssh2.LIBSSH2_KNOWNHOST_KEYENC_RAW | _HOSTKEY_TYPES.get(key_type, _KEY_UNKNOWN)
+        return self._current().checkp(host, port, key, typemask)
+
+
+cdef dict _verifiers = {}
+_verifiers_lock = allocate_lock()
+
+
+def get_verifier(filename=None):
+    """Get the process wide :py:class:`HostKeyVerifier` for a known hosts
+    file, creating it on first use.
+
+    :param filename: Known hosts file name. Defaults to the user's
+      ``~/.ssh/known_hosts``.
+    :type filename: str
+
+    :rtype: :py:class:`HostKeyVerifier`"""
+    if filename is None:
+        filename = os.path.expanduser("~/.ssh/known_hosts")
+    cdef str path = os.path.abspath(os.fsdecode(filename))
+    cdef HostKeyVerifier verifier = _verifiers.get(path)
+    if verifier is None:
+        with _verifiers_lock:
+            verifier = _verifiers.get(path)
+            if verifier is None:
+                verifier = HostKeyVerifier(path)
+                _verifiers[path] = verifier
+    return verifier
@@ -15,7 +15,8 @@
 # License along with this library; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
 
-from ssh2.session cimport Session
+from ssh2.session cimport Session, _session_call, session_lock, \
+    session_again, session_again_ptr
 from ssh2.channel cimport PyChannel
 from ssh2.utils cimport handle_error_codes
 
@@ -36,17 +37,27 @@ cdef class Listener:
 
     def forward_accept(self):
         cdef c_ssh2.LIBSSH2_CHANNEL *channel
+        cdef _session_call call
+        cdef int rc
         with nogil:
+            session_lock(&self._session._state, &call, NULL)
             channel = c_ssh2.libssh2_channel_forward_accept(
                 self._listener)
+            while session_again_ptr(&self._session._state, &call, channel, &rc):
+                channel = c_ssh2.libssh2_channel_forward_accept(
+                    self._listener)
         if channel is NULL:
-            return handle_error_codes(c_ssh2.libssh2_session_last_errno(
-                self._session._session))
+            return handle_error_codes(rc)
         return PyChannel(channel, self._session)
 
     def forward_cancel(self):
+        cdef _session_call call
         cdef int rc
         with nogil:
+            session_lock(&self._session._state, &call, NULL)
             rc = c_ssh2.libssh2_channel_forward_cancel(
                 self._listener)
+            while session_again(&self._session._state, &call, &rc):
+                rc = c_ssh2.libssh2_channel_forward_cancel(
+                    self._listener)
         return handle_error_codes(rc)
@@ -0,0 +1,91 @@
+# This file is part of ssh2-python.
+# Copyright (C) 2017 Panos Kittenis
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, version 2.1.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+from ssh2.session cimport Session
+from ssh2 cimport c_ssh2
+
+
+cdef struct _mux_cmd:
+    size_t id
+    int state
+    int error
+    int exit_status
+    c_ssh2.LIBSSH2_CHANNEL *channel
+    const char *command
+    unsigned int command_len
+    char *out
+    size_t out_len
+    size_t out_size
+    char *err
+    size_t err_len
+    size_t err_size
+    _mux_cmd *prev
+    _mux_cmd *next
+
+
+cdef bint _is_channel_error(int rc) noexcept nogil
+cdef ssize_t _read_stream(c_ssh2.LIBSSH2_CHANNEL *channel, int stream_id,
+                          char **buf, size_t *length, size_t *size,
+                          size_t read_size) noexcept nogil
+
+
+cdef class CommandResult:
+    cdef readonly size_t id
+    cdef readonly object command
+    cdef readonly bytes stdout
+    cdef readonly bytes stderr
+    cdef readonly int exit_status
+    cdef readonly object error
+
+
+cdef class Multiplexer:
+    cdef Session _session
+    cdef c_ssh2.LIBSSH2_SESSION *_c_session
+    cdef int _max_channels
+    cdef int _limit
+    cdef size_t _buffer_size
+    cdef size_t _next_id
+    cdef dict _commands
+    cdef bint _running
+    cdef int _error
+    cdef readonly int active
+    cdef readonly int queued
+    cdef _mux_cmd *_queue_head
+    cdef _mux_cmd *_queue_tail
+    cdef _mux_cmd *_active_head
+    cdef _mux_cmd *_active_tail
+    cdef _mux_cmd *_done_head
+    cdef _mux_cmd *_done_tail
+    cdef _mux_cmd *_opening
+    cdef _mux_cmd *_blocked
+
+    cdef int _run(self) noexcept nogil
+    cdef int _pass(self) noexcept nogil
+    cdef int _step(self, _mux_cmd *cmd) noexcept nogil
+    cdef int _do_open(self, _mux_cmd *cmd) noexcept nogil
+    cdef int _do_exec(self, _mux_cmd *cmd) noexcept nogil
+    cdef int _do_read(self, _mux_cmd *cmd) noexcept nogil
+    cdef int _do_close(self, _mux_cmd *cmd) noexcept nogil
+    cdef int _do_wait_closed(self, _mux_cmd *cmd) noexcept nogil
+    cdef int _do_free(self, _mux_cmd *cmd) noexcept nogil
+    cdef int _again(self, _mux_cmd *cmd) noexcept nogil
+    cdef int _fail(self, _mux_cmd *cmd, int rc) noexcept nogil
+    cdef void _finish(self, _mux_cmd *cmd) noexcept nogil
+    cdef int _wait(self) noexcept nogil
+    cdef CommandResult _result(self, _mux_cmd *cmd)
+
+
+cdef object multiplexer(Session session, int max_channels, size_t buffer_size)
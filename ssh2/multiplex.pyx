@@ -0,0 +1,508 @@
+# This file is part of ssh2-python.
+# cython: language_level=3
+# Copyright (C) 2017 Panos Kittenis
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, version 2.1.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Running many commands concurrently over the channels of one session.
+
+Create a :py:class:`Multiplexer` with
+:py:func:`ssh2.session.Session.multiplexer`, submit commands to it and
+iterate over :py:func:`Multiplexer.run` for their results."""
+
+from cpython.bytes cimport PyBytes_FromStringAndSize
+from cpython.mem cimport PyMem_RawMalloc, PyMem_RawRealloc, PyMem_RawFree
+from libc.errno cimport errno, EINTR
+from libc.limits cimport INT_MAX
+from libc.string cimport memset
+
+from ssh2.exceptions import BadUseError
+from ssh2.utils cimport to_bytes, handle_error_codes
+
+from ssh2 cimport c_ssh2
+from ssh2 cimport c_net
+from ssh2 cimport error_codes
+
+
+# Command states
+cdef enum:
+    _QUEUED = 1
+    _OPENING = 2
+    _EXEC = 3
+    _READING = 4
+    _CLOSING = 5
+    _WAIT_CLOSED = 6
+    _FREEING = 7
+    _DONE = 8
+
+cdef enum:
+    _MAX_BUFFER_SIZE = 16 * 1024 * 1024
+    # LIBSSH2_ERROR_ALLOC, for output buffers that could not be grown
+    _ERROR_ALLOC = -6
+
+
+cdef bint _is_channel_error(int rc) noexcept nogil:
+    return rc == error_codes._LIBSSH2_ERROR_CHANNEL_OUTOFORDER \
+        or rc == error_codes._LIBSSH2_ERROR_CHANNEL_FAILURE \
+        or rc == error_codes._LIBSSH2_ERROR_CHANNEL_REQUEST_DENIED \
+        or rc == error_codes._LIBSSH2_ERROR_CHANNEL_UNKNOWN \
+        or rc == error_codes._LIBSSH2_ERROR_CHANNEL_WINDOW_EXCEEDED \
+        or rc == error_codes._LIBSSH2_ERROR_CHANNEL_PACKET_EXCEEDED \
+        or rc == error_codes._LIBSSH2_ERROR_CHANNEL_CLOSED \
+        or rc == error_codes._LIBSSH2_ERROR_CHANNEL_EOF_SENT
+
+
+cdef ssize_t _read_stream(c_ssh2.LIBSSH2_CHANNEL *channel, int stream_id,
+                          char **buf, size_t *length, size_t *size,
+                          size_t read_size) noexcept nogil:
+    """Read up to read_size bytes of a stream onto the end of buf, growing
+    it as needed."""
+    cdef size_t new_size
+    cdef char *new_buf
+    cdef ssize_t rc
+    if size[0] - length[0] < read_size:
+        new_size = size[0] * 2 if size[0] else read_size
+        while new_size - length[0] < read_size:
+            new_size *= 2
+        new_buf = <char *>PyMem_RawRealloc(buf[0], new_size)
+        if new_buf is NULL:
+            return _ERROR_ALLOC
+        buf[0] = new_buf
+        size[0] = new_size
+    rc = c_ssh2.libssh2_channel_read_ex(channel, stream_id, buf[0] + length[0],
+                                        read_size)
+    if rc > 0:
+        length[0] += rc
+    return rc
+
+
+cdef void _free_cmd(_mux_cmd *cmd) noexcept nogil:
+    if cmd.channel is not NULL:
+        c_ssh2.libssh2_channel_free(cmd.channel)
+    PyMem_RawFree(cmd.out)
+    PyMem_RawFree(cmd.err)
+    PyMem_RawFree(cmd)
+
+
+cdef void _free_list(_mux_cmd *cmd) noexcept nogil:
+    cdef _mux_cmd *next_cmd
+    while cmd is not NULL:
+        next_cmd = cmd.next
+        _free_cmd(cmd)
+        cmd = next_cmd
+
+
+cdef object _exception(int rc):
+    try:
+        handle_error_codes(rc)
+    except Exception as ex:
+        return ex
+
+
+cdef object multiplexer(Session session, int max_channels, size_t buffer_size):
+    cdef Multiplexer mux = Multiplexer.__new__(Multiplexer, session)
+    if max_channels < 0:
+        raise ValueError("max_channels must not be negative")
+    if buffer_size < 1 or buffer_size > _MAX_BUFFER_SIZE:
+        raise ValueError("buffer_size must be between 1 and %s" % (
+            _MAX_BUFFER_SIZE,))
+    mux._max_channels = max_channels
+    mux._limit = max_channels if max_channels > 0 else INT_MAX
+    mux._buffer_size = buffer_size
+    return mux
+
+
+cdef class CommandResult:
+    """Output and exit status of a command run by a :py:class:`Multiplexer`.
+
+    ``error`` is the exception for the command's channel failing, for
+    example the channel being refused or the command being denied by the
+    server, or ``None``. Output is what was read before the failure."""
+
+    def __repr__(self):
+        return "CommandResult(id=%s, command=%r, exit_status=%s, error=%r)" % (
+            self.id, self.command, self.exit_status, self.error)
+
+
+cdef class Multiplexer:
+    """Runs commands concurrently, each on its own channel of one session.
+
+    Commands are queued with :py:func:`submit` and run by :py:func:`run`
+    on up to :py:attr:`max_channels` channels at once. All channels are
+    driven in non-blocking mode in one loop without the GIL, reading from
+    each in turn, so a slow command does not hold up the others and no
+    threads are needed.
+
+    Servers limit the number of channels per session, OpenSSH to ten by
+    default with ``MaxSessions``. When the server refuses a channel while
+    others are open, the command is queued again and the number of channels
+    used at once is lowered to the number that were open."""
+
+    def __cinit__(self, Session session):
+        self._session = session
+        self._c_session = session._session
+        self._commands = {}
+
+    def __dealloc__(self):
+        _free_list(self._queue_head)
+        _free_list(self._active_head)
+        _free_list(self._done_head)
+
+    @property
+    def session(self):
+        """Originating session."""
+        return self._session
+
+    @property
+    def max_channels(self):
+        """Maximum number of channels used at once. Zero for no limit other
+        than the server's. Lowered if the server refuses a channel while
+        others are open.
+
+        :rtype: int"""
+        if self._limit == INT_MAX:
+            return 0
+        return self._limit
+
+    def submit(self, command not None):
+        """Queue command to be run on its own channel by :py:func:`run`.
+
+        Can be called while iterating over :py:func:`run` to add to the
+        commands being run.
+
+        :param command: Command to execute.
+        :type command: str
+
+        :returns: Id of the command, increasing in submission order, as in
+          its :py:class:`CommandResult`.
+        :rtype: int"""
+        cdef bytes b_command = to_bytes(command)
+        cdef _mux_cmd *cmd = <_mux_cmd *>PyMem_RawMalloc(sizeof(_mux_cmd))
+        if cmd is NULL:
+            raise MemoryError()
+        memset(cmd, 0, sizeof(_mux_cmd))
+        cmd.id = self._next_id
+        cmd.state = _QUEUED
+        cmd.command = b_command
+        cmd.command_len = len(b_command)
+        self._next_id += 1
+        self._commands[cmd.id] = (command, b_command)
+        if self._queue_tail is NULL:
+            self._queue_head = cmd
+        else:
+            self._queue_tail.next = cmd
+        self._queue_tail = cmd
+        self.queued += 1
+        return cmd.id
+
+    def run(self):
+        """Run submitted commands and yield a :py:class:`CommandResult` for
+        each as it completes.
+
+        The session is set to non-blocking mode while channels are being
+        serviced and its previous mode restored before each result is
+        yielded. The GIL is released while servicing channels, but the
+        session and multiplexer must not be used by other threads until
+        the iteration is finished.
+
+        Stopping iteration early leaves unfinished commands in place for a
+        later call to carry on with.
+
+        :raises: :py:class:`ssh2.exceptions.BadUseError` if already running.
+        :raises: Appropriate exception from :py:mod:`ssh2.exceptions` on
+          session errors, including
+          :py:class:`ssh2.exceptions.Timeout` if the session has a timeout
+          set and nothing is received for that long. Errors of a single
+          channel are reported in its command's result instead.
+
+        :rtype: iter(:py:class:`CommandResult`)"""
+        cdef _mux_cmd *cmd
+        cdef int blocking
+        cdef int rc
+        if self._running:
+            raise BadUseError("Multiplexer is already running")
+        self._running = True
+        try:
+            while self._done_head is not NULL or self._queue_head is not NULL \
+                    or self._active_head is not NULL:
+                if self._done_head is NULL:
+                    with nogil:
+                        blocking = c_ssh2.libssh2_session_get_blocking(self._c_session)
+                        c_ssh2.libssh2_session_set_blocking(self._c_session, 0)
+                        rc = self._run()
+                        c_ssh2.libssh2_session_set_blocking(self._c_session, blocking)
+                    if rc < 0:
+                        if self._error == _ERROR_ALLOC:
+                            raise MemoryError()
+                        handle_error_codes(self._error)
+                while self._done_head is not NULL:
+                    cmd = self._done_head
+                    self._done_head = cmd.next
+                    if self._done_head is NULL:
+                        self._done_tail = NULL
+                    try:
+                        result = self._result(cmd)
+                    finally:
+                        _free_cmd(cmd)
+                    yield result
+        finally:
+            self._running = False
+
+    cdef CommandResult _result(self, _mux_cmd *cmd):
+        cdef CommandResult result = CommandResult.__new__(CommandResult)
+        result.id = cmd.id
+        result.command = self._commands.pop(cmd.id)[0]
+        result.stdout = PyBytes_FromStringAndSize(cmd.out, cmd.out_len)
+        result.stderr = PyBytes_FromStringAndSize(cmd.err, cmd.err_len)
+        result.exit_status = cmd.exit_status
+        result.error = _exception(cmd.error) if cmd.error != 0 else None
+        return result
+
+    cdef int _run(self) noexcept nogil:
+        """Service channels until at least one command is done or none are
+        left. Returns -1 on a session error."""
+        cdef int rc
+        self._error = 0
+        while self._done_head is NULL and (
+                self._queue_head is not NULL or self._active_head is not NULL):
+            rc = self._pass()
+            if rc < 0:
+                return -1
+            elif rc == 0 and self._done_head is NULL and self._wait() < 0:
+                return -1
+        return 0
+
+    cdef int _pass(self) noexcept nogil:
+        """Take each command one step further, channels in turn.
+
+        Returns 1 if anything moved, 0 if not or -1 on a session error."""
+        cdef _mux_cmd *cmd
+        cdef _mux_cmd *next_cmd
+        cdef int progress = 0
+        cdef int rc
+        if self._blocked is not NULL:
+            # An operation part way through sending a packet must be
+            # repeated before any other call on the session.
+            cmd = self._blocked
+            self._blocked = NULL
+            rc = self._step(cmd)
+            if rc < 0 or self._blocked is not NULL:
+                return rc
+            progress = rc
+        # Only one channel open can be in progress on a session
+        if self._opening is NULL and self._queue_head is not NULL \
+                and self.active < self._limit:
+            cmd = self._queue_head
+            self._queue_head = cmd.next
+            if self._queue_head is NULL:
+                self._queue_tail = NULL
+            self.queued -= 1
+            cmd.state = _OPENING
+            cmd.next = NULL
+            cmd.prev = self._active_tail
+            if self._active_tail is NULL:
+                self._active_head = cmd
+            else:
+                self._active_tail.next = cmd
+            self._active_tail = cmd
+            self.active += 1
+            self._opening = cmd
+            progress = 1
+        cmd = self._active_head
+        while cmd is not NULL:
+            next_cmd = cmd.next
+            rc = self._step(cmd)
+            if rc < 0:
+                return -1
+            progress |= rc
+            if self._blocked is not NULL:
+                break
+            cmd = next_cmd
+        return progress
+
+    cdef int _step(self, _mux_cmd *cmd) noexcept nogil:
+        if cmd.state == _OPENING:
+            return self._do_open(cmd)
+        elif cmd.state == _EXEC:
+            return self._do_exec(cmd)
+        elif cmd.state == _READING:
+            return self._do_read(cmd)
+        elif cmd.state == _CLOSING:
+            return self._do_close(cmd)
+        elif cmd.state == _WAIT_CLOSED:
+            return self._do_wait_closed(cmd)
+        elif cmd.state == _FREEING:
+            return self._do_free(cmd)
+        return 0
+
+    cdef int _do_open(self, _mux_cmd *cmd) noexcept nogil:
+        cdef c_ssh2.LIBSSH2_CHANNEL *channel
+        cdef int rc
+        channel = c_ssh2.libssh2_channel_open_session(self._c_session)
+        if channel is NULL:
+            rc = c_ssh2.libssh2_session_last_errno(self._c_session)
+            if rc == error_codes._LIBSSH2_ERROR_EAGAIN:
+                return self._again(cmd)
+            self._opening = NULL
+            if rc == error_codes._LIBSSH2_ERROR_CHANNEL_FAILURE and self.active > 1:
+                # Server's limit of channels per session reached - queue
+                # again until a channel closes, and keep to that limit.
+                if cmd.prev is NULL:
+                    self._active_head = cmd.next
+                else:
+                    cmd.prev.next = cmd.next
+                if cmd.next is NULL:
+                    self._active_tail = cmd.prev
+                else:
+                    cmd.next.prev = cmd.prev
+                self.active -= 1
+                self._limit = self.active
+                cmd.state = _QUEUED
+                cmd.prev = NULL
+                cmd.next = self._queue_head
+                self._queue_head = cmd
+                if self._queue_tail is NULL:
+                    self._queue_tail = cmd
+                self.queued += 1
+                return 1
+            return self._fail(cmd, rc)
+        self._opening = NULL
+        cmd.channel = channel
+        cmd.state = _EXEC
+        return 1
+
+    cdef int _do_exec(self, _mux_cmd *cmd) noexcept nogil:
+        cdef int rc = c_ssh2.libssh2_channel_process_startup(
+            cmd.channel, "exec", 4, cmd.command, cmd.command_len)
+        if rc == error_codes._LIBSSH2_ERROR_EAGAIN:
+            return self._again(cmd)
+        elif rc < 0:
+            return self._fail(cmd, rc)
+        cmd.state = _READING
+        return 1
+
+    cdef int _do_read(self, _mux_cmd *cmd) noexcept nogil:
+        """One read of each of stdout and stderr, so that every channel gets
+        its turn."""
+        cdef ssize_t rc_out
+        cdef ssize_t rc_err
+        rc_out = _read_stream(cmd.channel, 0, &cmd.out, &cmd.out_len,
+                              &cmd.out_size, self._buffer_size)
+        if rc_out == error_codes._LIBSSH2_ERROR_EAGAIN:
+            self._again(cmd)
+            if self._blocked is cmd:
+                return 0
+        elif rc_out < 0:
+            return self._fail(cmd, rc_out)
+        rc_err = _read_stream(cmd.channel, c_ssh2.SSH_EXTENDED_DATA_STDERR,
+                              &cmd.err, &cmd.err_len, &cmd.err_size,
+                              self._buffer_size)
+        if rc_err == error_codes._LIBSSH2_ERROR_EAGAIN:
+            self._again(cmd)
+        elif rc_err < 0:
+            return self._fail(cmd, rc_err)
+        if rc_out == 0 and rc_err == 0 and c_ssh2.libssh2_channel_eof(cmd.channel):
+            cmd.state = _CLOSING
+            return 1
+        return rc_out > 0 or rc_err > 0
+
+    cdef int _do_close(self, _mux_cmd *cmd) noexcept nogil:
+        cdef int rc = c_ssh2.libssh2_channel_close(cmd.channel)
+        if rc == error_codes._LIBSSH2_ERROR_EAGAIN:
+            return self._again(cmd)
+        elif rc < 0:
+            return self._fail(cmd, rc)
+        cmd.state = _WAIT_CLOSED
+        return 1
+
+    cdef int _do_wait_closed(self, _mux_cmd *cmd) noexcept nogil:
+        # Exit status may come after end of file, before the channel closes
+        cdef int rc = c_ssh2.libssh2_channel_wait_closed(cmd.channel)
+        if rc == error_codes._LIBSSH2_ERROR_EAGAIN:
+            return self._again(cmd)
+        elif rc < 0:
+            return self._fail(cmd, rc)
+        cmd.exit_status = c_ssh2.libssh2_channel_get_exit_status(cmd.channel)
+        cmd.state = _FREEING
+        return 1
+
+    cdef int _do_free(self, _mux_cmd *cmd) noexcept nogil:
+        # Channel is freed on any return other than EAGAIN
+        if c_ssh2.libssh2_channel_free(cmd.channel) == error_codes._LIBSSH2_ERROR_EAGAIN:
+            return self._again(cmd)
+        cmd.channel = NULL
+        self._finish(cmd)
+        return 1
+
+    cdef int _again(self, _mux_cmd *cmd) noexcept nogil:
+        if c_ssh2.libssh2_session_block_directions(self._c_session) \
+                & c_ssh2.LIBSSH2_SESSION_BLOCK_OUTBOUND:
+            self._blocked = cmd
+        return 0
+
+    cdef int _fail(self, _mux_cmd *cmd, int rc) noexcept nogil:
+        if not _is_channel_error(rc):
+            self._error = rc
+            return -1
+        if cmd.error == 0:
+            cmd.error = rc
+        if cmd.channel is NULL:
+            self._finish(cmd)
+        else:
+            cmd.state = _FREEING
+        return 1
+
+    cdef void _finish(self, _mux_cmd *cmd) noexcept nogil:
+        if cmd.prev is NULL:
+            self._active_head = cmd.next
+        else:
+            cmd.prev.next = cmd.next
+        if cmd.next is NULL:
+            self._active_tail = cmd.prev
+        else:
+            cmd.next.prev = cmd.prev
+        self.active -= 1
+        cmd.state = _DONE
+        cmd.prev = NULL
+        cmd.next = NULL
+        if self._done_tail is NULL:
+            self._done_head = cmd
+        else:
+            self._done_tail.next = cmd
+        self._done_tail = cmd
+
+    cdef int _wait(self) noexcept nogil:
+        """Wait for the session socket in the direction libssh2 is blocked
+        on, up to the session's timeout."""
+        cdef c_net.pollfd pfd
+        cdef int directions = c_ssh2.libssh2_session_block_directions(self._c_session)
+        cdef long timeout = c_ssh2.libssh2_session_get_timeout(self._c_session)
+        cdef int rc
+        pfd.fd = self._session._sock
+        pfd.events = 0
+        pfd.revents = 0
+        if directions & c_ssh2.LIBSSH2_SESSION_BLOCK_INBOUND:
+            pfd.events |= c_net.POLLIN
+        if directions & c_ssh2.LIBSSH2_SESSION_BLOCK_OUTBOUND:
+            pfd.events |= c_net.POLLOUT
+        if pfd.events == 0:
+            pfd.events = c_net.POLLIN
+        rc = c_net.poll(&pfd, 1, timeout if timeout > 0 else -1)
+        if rc == 0:
+            self._error = error_codes._LIBSSH2_ERROR_TIMEOUT
+            return -1
+        elif rc < 0 and errno != EINTR:
+            self._error = error_codes._LIBSSH2_ERROR_SOCKET_RECV
+            return -1
+        return 0
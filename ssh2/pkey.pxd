@@ -18,7 +18,26 @@ from ssh2 cimport c_ssh2
 
 
 cdef object PyPublicKey(c_ssh2.libssh2_agent_publickey *pkey)
+cdef object PyPublicKeyCopy(c_ssh2.libssh2_agent_publickey *pkey)
 
 
 cdef class PublicKey:
     cdef c_ssh2.libssh2_agent_publickey *_pkey
+    # Identity data owned by the key itself, for keys that outlive the
+    # agent's identity list
+    cdef c_ssh2.libssh2_agent_publickey _copy
+    cdef bytes _blob
+    cdef bytes _comment
+
+
+cdef class PrivateKey:
+    cdef char *_data
+    cdef size_t _len
+    cdef size_t _size
+    cdef readonly bint locked
+    cdef readonly bytes publickeydata
+
+    cdef char *_alloc(self, size_t size) except NULL
+    cdef int _load_copy(self, const char *data, size_t data_len) except -1
+    cdef int _load_openssh(self, bytes data, bytes passphrase) except -1
+    cdef int _load_pem(self, bytes data, bytes passphrase) except -1
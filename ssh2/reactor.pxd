@@ -0,0 +1,72 @@
+# This file is part of ssh2-python.
+# Copyright (C) 2017 Panos Kittenis
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, version 2.1.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+from ssh2.session cimport Session
+from ssh2 cimport c_ssh2
+
+
+cdef struct _reactor_chan:
+    size_t id
+    int state
+    int error
+    c_ssh2.LIBSSH2_CHANNEL *channel
+    char *out
+    size_t out_len
+    size_t out_size
+    char *err
+    size_t err_len
+    size_t err_size
+    # End of file and exit not yet passed to callbacks
+    bint eof
+    bint exited
+    int exit_status
+    char *exit_signal
+    size_t exit_signal_len
+    bint ready
+    _reactor_chan *ready_next
+    _reactor_chan *prev
+    _reactor_chan *next
+
+
+cdef class Reactor:
+    cdef Session _session
+    cdef c_ssh2.LIBSSH2_SESSION *_c_session
+    cdef size_t _buffer_size
+    cdef size_t _next_id
+    cdef dict _channels
+    cdef bint _running
+    cdef int _error
+    cdef _reactor_chan *_head
+    cdef _reactor_chan *_tail
+    cdef _reactor_chan *_ready_head
+    cdef _reactor_chan *_ready_tail
+    cdef _reactor_chan *_blocked
+
+    cdef int _run(self, long timeout) noexcept nogil
+    cdef int _pass(self) noexcept nogil
+    cdef int _step(self, _reactor_chan *chan) noexcept nogil
+    cdef int _do_read(self, _reactor_chan *chan) noexcept nogil
+    cdef int _do_close(self, _reactor_chan *chan) noexcept nogil
+    cdef int _do_wait_closed(self, _reactor_chan *chan) noexcept nogil
+    cdef int _again(self, _reactor_chan *chan) noexcept nogil
+    cdef int _fail(self, _reactor_chan *chan, int rc) noexcept nogil
+    cdef void _ready(self, _reactor_chan *chan) noexcept nogil
+    cdef int _wait(self, long timeout) noexcept nogil
+    cdef int _dispatch(self, _reactor_chan *chan) except -1
+    cdef void _remove(self, _reactor_chan *chan)
+
+
+cdef object reactor(Session session, size_t buffer_size)
@@ -0,0 +1,455 @@
+# This file is part of ssh2-python.
+# cython: language_level=3
+# Copyright (C) 2017 Panos Kittenis
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, version 2.1.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Callbacks for output, end of file and exit of the channels of a session.
+
+Create a :py:class:`Reactor` with :py:func:`ssh2.session.Session.reactor`,
+add channels to it with their callbacks and call :py:func:`Reactor.run`."""
+
+from cpython.bytes cimport PyBytes_FromStringAndSize
+from cpython.mem cimport PyMem_RawMalloc, PyMem_RawFree
+from libc.errno cimport errno, EINTR
+from libc.string cimport memset
+
+from ssh2.exceptions import BadUseError
+from ssh2.channel cimport Channel
+from ssh2.multiplex cimport _is_channel_error, _read_stream
+from ssh2.utils cimport to_str, handle_error_codes, monotonic_time
+
+from ssh2 cimport c_ssh2
+from ssh2 cimport c_net
+from ssh2 cimport error_codes
+
+
+# Channel states
+cdef enum:
+    _READING = 1
+    _CLOSING = 2
+    _WAIT_CLOSED = 3
+    _DONE = 4
+
+cdef enum:
+    _MAX_BUFFER_SIZE = 16 * 1024 * 1024
+    # LIBSSH2_ERROR_ALLOC, for output buffers that could not be grown
+    _ERROR_ALLOC = -6
+
+
+cdef void _free_chan(c_ssh2.LIBSSH2_SESSION *session,
+                     _reactor_chan *chan) noexcept nogil:
+    # The channel itself belongs to its Channel object
+    PyMem_RawFree(chan.out)
+    PyMem_RawFree(chan.err)
+    if chan.exit_signal is not NULL:
+        c_ssh2.libssh2_free(session, chan.exit_signal)
+    PyMem_RawFree(chan)
+
+
+cdef object reactor(Session session, size_t buffer_size):
+    cdef Reactor _reactor = Reactor.__new__(Reactor, session)
+    if buffer_size < 1 or buffer_size > _MAX_BUFFER_SIZE:
+        raise ValueError("buffer_size must be between 1 and %s" % (
+            _MAX_BUFFER_SIZE,))
+    _reactor._buffer_size = buffer_size
+    return _reactor
+
+
+cdef class Reactor:
+    """Calls back with the output, end of file and exit status of channels.
+
+    Channels are added with their callbacks by :py:func:`add`.
+    :py:func:`run` then drives all of them in non-blocking mode from one
+    loop without the GIL, reading whatever output is available on each.
+    Channels without anything to read cost no more than the loop passing
+    over them. The GIL is taken once per batch of events, and the
+    callbacks of every channel with output or state changes are called
+    together.
+
+    A channel's output callbacks receive at most ``buffer_size`` bytes per
+    call. After end of file the reactor closes the channel, waits for the
+    remote side to close it and calls its exit callback, after which the
+    channel is no longer watched."""
+
+    def __cinit__(self, Session session):
+        self._session = session
+        self._c_session = session._session
+        self._channels = {}
+
+    def __dealloc__(self):
+        cdef _reactor_chan *chan = self._head
+        cdef _reactor_chan *next_chan
+        while chan is not NULL:
+            next_chan = chan.next
+            _free_chan(self._c_session, chan)
+            chan = next_chan
+
+    @property
+    def session(self):
+        """Originating session."""
+        return self._session
+
+    @property
+    def active(self):
+        """Number of channels being watched.
+
+        :rtype: int"""
+        return len(self._channels)
+
+    def add(self, Channel channel not None, on_stdout=None, on_stderr=None,
+            on_eof=None, on_exit=None):
+        """Watch channel and call back on its events from :py:func:`run`.
+
+        Channels can be added from callbacks. An added channel must not be
+        read from directly.
+
+        :param channel: Channel of this reactor's session, for example with
+          a command executing.
+        :type channel: :py:class:`ssh2.channel.Channel`
+        :param on_stdout: Called with each batch of stdout data as bytes.
+        :type on_stdout: callable
+        :param on_stderr: Called with each batch of stderr data as bytes.
+        :type on_stderr: callable
+        :param on_eof: Called without arguments on end of file, after the
+          last output callback.
+        :type on_eof: callable
+        :param on_exit: Called with exit status and exit signal name, or
+          ``None``, once the channel has closed.
+        :type on_exit: callable
+
+        :raises: :py:class:`ValueError` if channel is of another session.
+        :raises: :py:class:`ssh2.exceptions.BadUseError` if the channel was
+          already added."""
+        cdef _reactor_chan *chan
+        if channel._session is not self._session:
+            raise ValueError("Channel is not of this reactor's session")
+        for added in self._channels.values():
+            if added[0] is channel:
+                raise BadUseError("Channel was already added")
+        chan = <_reactor_chan *>PyMem_RawMalloc(sizeof(_reactor_chan))
+        if chan is NULL:
+            raise MemoryError()
+        memset(chan, 0, sizeof(_reactor_chan))
+        chan.id = self._next_id
+        chan.state = _READING
+        chan.channel = channel._channel
+        self._next_id += 1
+        self._channels[chan.id] = (channel, on_stdout, on_stderr, on_eof, on_exit)
+        chan.prev = self._tail
+        if self._tail is NULL:
+            self._head = chan
+        else:
+            self._tail.next = chan
+        self._tail = chan
+
+    def run(self):
+        """Call back on channel events until no channels are left.
+
+        Exceptions raised by callbacks stop the run and are raised from
+        here. Events not yet called back on are kept for the next run.
+
+        :raises: :py:class:`ssh2.exceptions.BadUseError` if already running.
+        :raises: Appropriate exception from :py:mod:`ssh2.exceptions` on
+          session errors, including :py:class:`ssh2.exceptions.Timeout` if
+          the session has a timeout set and nothing is received for that
+          long, and on channel errors, after which the failed channel is no
+          longer watched."""
+        while self._channels:
+            self.run_once()
+
+    def run_once(self, long timeout=0):
+        """Wait for at least one event and call back on all of those
+        available. As :py:func:`run`.
+
+        The session is set to non-blocking mode while channels are being
+        read and its previous mode restored before any callbacks. The GIL
+        is released while reading, but the session and reactor must not be
+        used by other threads until this returns.
+
+        :param timeout: Milliseconds to wait for events, or zero to wait
+          up to the session's timeout, if any.
+        :type timeout: int
+
+        :returns: Number of callbacks called, zero if timeout was reached.
+        :rtype: int"""
+        cdef _reactor_chan *chan
+        cdef int blocking
+        cdef int count = 0
+        cdef int rc = 0
+        if self._running:
+            raise BadUseError("Reactor is already running")
+        self._running = True
+        try:
+            if self._ready_head is NULL and self._head is not NULL:
+                with nogil:
+                    blocking = c_ssh2.libssh2_session_get_blocking(self._c_session)
+                    c_ssh2.libssh2_session_set_blocking(self._c_session, 0)
+                    rc = self._run(timeout)
+                    c_ssh2.libssh2_session_set_blocking(self._c_session, blocking)
+                if rc < 0:
+                    if self._error == _ERROR_ALLOC:
+                        raise MemoryError()
+                    handle_error_codes(self._error)
+            while self._ready_head is not NULL:
+                chan = self._ready_head
+                self._ready_head = chan.ready_next
+                if self._ready_head is NULL:
+                    self._ready_tail = NULL
+                chan.ready = 0
+                chan.ready_next = NULL
+                count += self._dispatch(chan)
+        finally:
+            self._running = False
+        return count
+
+    cdef int _dispatch(self, _reactor_chan *chan) except -1:
+        """Call back on the events of chan, in the order they happened."""
+        cdef int count = 0
+        cdef int rc
+        cdef bint removed = False
+        channel, on_stdout, on_stderr, on_eof, on_exit = self._channels[chan.id]
+        try:
+            if chan.out_len > 0:
+                data = PyBytes_FromStringAndSize(chan.out, chan.out_len)
+                chan.out_len = 0
+                if on_stdout is not None:
+                    count += 1
+                    on_stdout(data)
+            if chan.err_len > 0:
+                data = PyBytes_FromStringAndSize(chan.err, chan.err_len)
+                chan.err_len = 0
+                if on_stderr is not None:
+                    count += 1
+                    on_stderr(data)
+            if chan.eof:
+                chan.eof = 0
+                if on_eof is not None:
+                    count += 1
+                    on_eof()
+            if chan.error != 0:
+                rc = chan.error
+                removed = True
+                self._remove(chan)
+                handle_error_codes(rc)
+            if chan.exited:
+                exit_status = chan.exit_status
+                exit_signal = to_str(chan.exit_signal[:chan.exit_signal_len]) \
+                    if chan.exit_signal is not NULL else None
+                removed = True
+                self._remove(chan)
+                if on_exit is not None:
+                    count += 1
+                    on_exit(exit_status, exit_signal)
+        finally:
+            if not removed and (chan.out_len > 0 or chan.err_len > 0
+                                or chan.eof or chan.exited or chan.error != 0):
+                self._ready(chan)
+        return count
+
+    cdef void _remove(self, _reactor_chan *chan):
+        if chan.prev is NULL:
+            self._head = chan.next
+        else:
+            chan.prev.next = chan.next
+        if chan.next is NULL:
+            self._tail = chan.prev
+        else:
+            chan.next.prev = chan.prev
+        if self._blocked is chan:
+            self._blocked = NULL
+        del self._channels[chan.id]
+        _free_chan(self._c_session, chan)
+
+    cdef int _run(self, long timeout) noexcept nogil:
+        """Read channels until at least one has events, or timeout
+        milliseconds have passed if positive. Returns -1 on a session
+        error."""
+        cdef double deadline = monotonic_time() + timeout / 1000.0
+        cdef long remaining = 0
+        cdef int rc
+        self._error = 0
+        while self._ready_head is NULL and self._head is not NULL:
+            rc = self._pass()
+            if rc < 0:
+                return -1
+            elif rc > 0 or self._ready_head is not NULL:
+                continue
+            if timeout > 0:
+                remaining = <long>((deadline - monotonic_time()) * 1000)
+                if remaining <= 0:
+                    return 0
+            rc = self._wait(remaining)
+            if rc < 0:
+                return -1
+            elif rc == 0:
+                return 0
+        return 0
+
+    cdef int _pass(self) noexcept nogil:
+        """Take each channel one step further, in turn.
+
+        Returns 1 if anything moved, 0 if not or -1 on a session error."""
+        cdef _reactor_chan *chan
+        cdef _reactor_chan *next_chan
+        cdef int progress = 0
+        cdef int rc
+        if self._blocked is not NULL:
+            # An operation part way through sending a packet must be
+            # repeated before any other call on the session.
+            chan = self._blocked
+            self._blocked = NULL
+            rc = self._step(chan)
+            if rc < 0 or self._blocked is not NULL:
+                return rc
+            progress = rc
+        chan = self._head
+        while chan is not NULL:
+            next_chan = chan.next
+            rc = self._step(chan)
+            if rc < 0:
+                return -1
+            progress |= rc
+            if self._blocked is not NULL:
+                break
+            chan = next_chan
+        return progress
+
+    cdef int _step(self, _reactor_chan *chan) noexcept nogil:
+        if chan.state == _READING:
+            return self._do_read(chan)
+        elif chan.state == _CLOSING:
+            return self._do_close(chan)
+        elif chan.state == _WAIT_CLOSED:
+            return self._do_wait_closed(chan)
+        return 0
+
+    cdef int _do_read(self, _reactor_chan *chan) noexcept nogil:
+        """Read all available output of chan, up to the buffer size of each
+        stream, so that it is passed to callbacks in one batch."""
+        cdef ssize_t rc_out = 0
+        cdef ssize_t rc_err = 0
+        cdef int progress = 0
+        while chan.out_len < self._buffer_size:
+            rc_out = _read_stream(chan.channel, 0, &chan.out, &chan.out_len,
+                                  &chan.out_size, self._buffer_size - chan.out_len)
+            if rc_out <= 0:
+                break
+            progress = 1
+        if rc_out == error_codes._LIBSSH2_ERROR_EAGAIN:
+            self._again(chan)
+            if self._blocked is chan:
+                return progress
+        elif rc_out < 0:
+            return self._fail(chan, rc_out)
+        while chan.err_len < self._buffer_size:
+            rc_err = _read_stream(chan.channel, c_ssh2.SSH_EXTENDED_DATA_STDERR,
+                                  &chan.err, &chan.err_len, &chan.err_size,
+                                  self._buffer_size - chan.err_len)
+            if rc_err <= 0:
+                break
+            progress = 1
+        if rc_err == error_codes._LIBSSH2_ERROR_EAGAIN:
+            self._again(chan)
+        elif rc_err < 0:
+            return self._fail(chan, rc_err)
+        if rc_out == 0 and rc_err == 0 and c_ssh2.libssh2_channel_eof(chan.channel):
+            chan.eof = 1
+            chan.state = _CLOSING
+            progress = 1
+        if progress:
+            self._ready(chan)
+        return progress
+
+    cdef int _do_close(self, _reactor_chan *chan) noexcept nogil:
+        cdef int rc = c_ssh2.libssh2_channel_close(chan.channel)
+        if rc == error_codes._LIBSSH2_ERROR_EAGAIN:
+            return self._again(chan)
+        elif rc < 0:
+            return self._fail(chan, rc)
+        chan.state = _WAIT_CLOSED
+        return 1
+
+    cdef int _do_wait_closed(self, _reactor_chan *chan) noexcept nogil:
+        # Exit status may come after end of file, before the channel closes
+        cdef int rc = c_ssh2.libssh2_channel_wait_closed(chan.channel)
+        if rc == error_codes._LIBSSH2_ERROR_EAGAIN:
+            return self._again(chan)
+        elif rc < 0:
+            return self._fail(chan, rc)
+        chan.exit_status = c_ssh2.libssh2_channel_get_exit_status(chan.channel)
+        c_ssh2.libssh2_channel_get_exit_signal(
+            chan.channel, &chan.exit_signal, &chan.exit_signal_len,
+            NULL, NULL, NULL, NULL)
+        chan.exited = 1
+        chan.state = _DONE
+        self._ready(chan)
+        return 1
+
+    cdef int _again(self, _reactor_chan *chan) noexcept nogil:
+        if c_ssh2.libssh2_session_block_directions(self._c_session) \
+                & c_ssh2.LIBSSH2_SESSION_BLOCK_OUTBOUND:
+            self._blocked = chan
+        return 0
+
+    cdef int _fail(self, _reactor_chan *chan, int rc) noexcept nogil:
+        if not _is_channel_error(rc):
+            self._error = rc
+            return -1
+        chan.error = rc
+        chan.state = _DONE
+        self._ready(chan)
+        return 1
+
+    cdef void _ready(self, _reactor_chan *chan) noexcept nogil:
+        if chan.ready:
+            return
+        chan.ready = 1
+        if self._ready_tail is NULL:
+            self._ready_head = chan
+        else:
+            self._ready_tail.ready_next = chan
+        self._ready_tail = chan
+
+    cdef int _wait(self, long timeout) noexcept nogil:
+        """Wait for the session socket in the direction libssh2 is blocked
+        on, up to timeout milliseconds if positive or the session's timeout
+        otherwise. Returns 1 when ready, 0 when timeout was reached and -1
+        on errors, including the session's timeout."""
+        cdef c_net.pollfd pfd
+        cdef int directions = c_ssh2.libssh2_session_block_directions(self._c_session)
+        cdef long session_timeout = c_ssh2.libssh2_session_get_timeout(self._c_session)
+        cdef int rc
+        pfd.fd = self._session._sock
+        pfd.events = 0
+        pfd.revents = 0
+        if directions & c_ssh2.LIBSSH2_SESSION_BLOCK_INBOUND:
+            pfd.events |= c_net.POLLIN
+        if directions & c_ssh2.LIBSSH2_SESSION_BLOCK_OUTBOUND:
+            pfd.events |= c_net.POLLOUT
+        if pfd.events == 0:
+            pfd.events = c_net.POLLIN
+        if timeout > 0:
+            rc = c_net.poll(&pfd, 1, timeout)
+            if rc == 0:
+                return 0
+        else:
+            rc = c_net.poll(&pfd, 1, session_timeout if session_timeout > 0 else -1)
+            if rc == 0:
+                self._error = error_codes._LIBSSH2_ERROR_TIMEOUT
+                return -1
+        if rc < 0 and errno != EINTR:
+            self._error = error_codes._LIBSSH2_ERROR_SOCKET_RECV
+            return -1
+        return 1
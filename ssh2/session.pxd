@@ -15,8 +15,166 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
 
 from ssh2 cimport c_ssh2
+from ssh2 cimport c_pthread
+from ssh2 cimport error_codes
+
+
+# Transport of a session tunnelled over a channel of another session
+cdef struct _jump_transport:
+    c_ssh2.LIBSSH2_SESSION *session
+    c_ssh2.LIBSSH2_SESSION *outer
+    c_ssh2.LIBSSH2_CHANNEL *channel
+    int sock
+
+
+cdef enum:
+    # Free lists of 64 byte to 64KB blocks
+    _POOL_BINS = 11
+
+
+# Accounting and buffer pool of the session's libssh2 allocations
+cdef struct _session_memory:
+    Py_ssize_t current
+    Py_ssize_t peak
+    size_t allocations
+    size_t frees
+    size_t pool_hits
+    size_t pool_size
+    bint pool
+    void *bins[_POOL_BINS]
+
+
+# Passed to libssh2 callbacks through the session's abstract pointer
+cdef struct _session_lock:
+    # Held around each libssh2 call on the session in locked mode
+    c_pthread.pthread_mutex_t mutex
+    # Held for the whole of calls whose progress libssh2 keeps per session,
+    # like opening a channel
+    c_pthread.pthread_mutex_t op
+    # Guards the fields below and signals waiters
+    c_pthread.pthread_mutex_t wait_mutex
+    c_pthread.pthread_cond_t wait_cond
+    c_ssh2.LIBSSH2_SESSION *session
+    # Mutexes and condition above are set up on first use of locked mode
+    bint initialised
+    bint enabled
+    # Blocking mode seen by callers - libssh2 is non-blocking in locked mode
+    bint blocking
+    bint polling
+    # Signalled on reads while a waiting thread polls the socket
+    int wake_fd
+    # Transport reads so far, for waiters to tell if another thread read
+    # what they are waiting for
+    unsigned long reads
+    int sock
+
+
+cdef struct _session_state:
+    _session_memory memory
+    _jump_transport jump
+    _session_lock lock
+
+
+cdef struct _session_call:
+    c_pthread.pthread_mutex_t *op
+    unsigned long reads
+    long start
+    bint locked
+
+
+cdef void _session_acquire(_session_state *state, _session_call *call) noexcept nogil
+cdef int _session_release(_session_state *state, _session_call *call,
+                          bint again) noexcept nogil
+cdef bint _session_wait(_session_lock *lock, _session_call *call) noexcept nogil
+cdef void _session_wake(_session_lock *lock) noexcept nogil
+
+
+cdef inline void session_lock(_session_state *state, _session_call *call,
+                              c_pthread.pthread_mutex_t *op) noexcept nogil:
+    """Lock the session for a libssh2 call in locked mode, and op, if not
+    NULL, until the call is done. Every call must be followed by
+    :c:func:`session_again` or :c:func:`session_unlock`."""
+    call.locked = state.lock.enabled
+    if call.locked:
+        call.op = op
+        call.start = -1
+        if op is not NULL:
+            c_pthread.pthread_mutex_lock(op)
+        _session_acquire(state, call)
+
+
+cdef inline bint session_blocking(_session_state *state) noexcept nogil:
+    """Blocking mode of the session as seen by callers."""
+    if state.lock.enabled:
+        return state.lock.blocking
+    return c_ssh2.libssh2_session_get_blocking(state.lock.session)
+
+
+cdef inline void session_unlock(_session_state *state, _session_call *call) noexcept nogil:
+    if call.locked:
+        _session_release(state, call, 0)
+
+
+cdef inline bint session_again(_session_state *state, _session_call *call,
+                               int *rc) noexcept nogil:
+    """Returns whether to repeat a call that returned rc, after waiting on
+    the socket without the session lock when the call would block and the
+    session is in blocking mode. Sets rc to ``LIBSSH2_ERROR_TIMEOUT`` if the
+    wait timed out."""
+    cdef int result
+    if not call.locked:
+        return 0
+    result = _session_release(state, call, rc[0] == c_ssh2.LIBSSH2_ERROR_EAGAIN)
+    if result < 0:
+        rc[0] = error_codes._LIBSSH2_ERROR_TIMEOUT
+    return result > 0
+
+
+cdef inline bint session_again_size(_session_state *state, _session_call *call,
+                                    ssize_t *rc) noexcept nogil:
+    cdef int result
+    if not call.locked:
+        return 0
+    result = _session_release(state, call, rc[0] == c_ssh2.LIBSSH2_ERROR_EAGAIN)
+    if result < 0:
+        rc[0] = error_codes._LIBSSH2_ERROR_TIMEOUT
+    return result > 0
+
+
+cdef inline bint session_again_ptr(_session_state *state, _session_call *call,
+                                   void *ptr, int *rc) noexcept nogil:
+    """As :c:func:`session_again` for calls returning a pointer, NULL on
+    errors. Sets rc to the session's last error while still locked when ptr
+    is NULL, zero otherwise."""
+    cdef int result
+    rc[0] = 0 if ptr is not NULL else c_ssh2.libssh2_session_last_errno(
+        state.lock.session)
+    if not call.locked:
+        return 0
+    result = _session_release(state, call, rc[0] == c_ssh2.LIBSSH2_ERROR_EAGAIN)
+    if result < 0:
+        rc[0] = error_codes._LIBSSH2_ERROR_TIMEOUT
+    return result > 0
+
+
+cdef class MemoryStats:
+    cdef readonly Py_ssize_t current
+    cdef readonly Py_ssize_t peak
+    cdef readonly size_t allocations
+    cdef readonly size_t frees
+    cdef readonly size_t pool_hits
+    cdef readonly size_t pool_size
+
 
 cdef class Session:
     cdef c_ssh2.LIBSSH2_SESSION *_session
     cdef int _sock
     cdef readonly object sock
+    cdef _session_state _state
+    cdef object _jump_channel
+    cdef double _open_started
+
+    cdef object _open_channel(self, bytes channeltype, bytes message,
+                              unsigned long window_size,
+                              unsigned long packet_size,
+                              unsigned long max_window_size)
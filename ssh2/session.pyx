@@ -15,24 +15,44 @@
 # License along with this library; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
 
+import atexit
+import os
+
 from cpython cimport PyObject_AsFileDescriptor
 from cpython.mem cimport PyMem_RawMalloc, PyMem_RawRealloc, PyMem_RawFree
+from libc cimport errno
+from libc.stdint cimport uint64_t
+from libc.string cimport memcpy, memset
 from libc.time cimport time_t
+from posix.time cimport clock_gettime, timespec, CLOCK_MONOTONIC
+from posix.unistd cimport close, read, write
 
-from ssh2.agent cimport PyAgent, agent_auth, agent_init, init_connect_agent
-from ssh2.channel cimport PyChannel
-from ssh2.exceptions import SessionHostKeyError, KnownHostError, PublicKeyInitError, ChannelError
+from ssh2.agent cimport PyAgent, SharedAgent, agent_auth, agent_init, init_connect_agent
+from ssh2.channel cimport Channel, PyChannel
+from ssh2.exceptions import SessionHostKeyError, KnownHostError, PublicKeyInitError, ChannelError, \
+    Timeout
 from ssh2.listener cimport PyListener
 from ssh2.sftp cimport PySFTP
 from ssh2.publickey cimport PyPublicKeySystem
-from ssh2.utils cimport to_bytes, to_str, handle_error_codes
+from ssh2.utils cimport to_bytes, to_str, handle_error_codes, monotonic_time
 from ssh2.statinfo cimport StatInfo
-from ssh2.knownhost cimport PyKnownHost
+from ssh2.knownhost cimport PyKnownHost, HostKeyVerifier
 from ssh2.fileinfo cimport FileInfo
+from ssh2.forward cimport forward_local, forward_remote, forward_socks
+from ssh2.multiplex cimport multiplexer
+from ssh2.iothread cimport io_thread
+from ssh2.reactor cimport reactor
+from ssh2.executor cimport shell_executor
+from ssh2.pkey cimport PrivateKey
 
 from ssh2 cimport c_ssh2
 from ssh2 cimport c_sftp
 from ssh2 cimport c_pkey
+from ssh2 cimport c_net
+from ssh2 cimport c_pthread
+from ssh2 cimport error_codes
+
+cimport cython
 
 
 LIBSSH2_SESSION_BLOCK_INBOUND = c_ssh2.LIBSSH2_SESSION_BLOCK_INBOUND
@@ -50,14 +70,589 @@ IF EMBEDDED_LIB:
     LIBSSH2_HOSTKEY_TYPE_ED25519 = c_ssh2.LIBSSH2_HOSTKEY_TYPE_ED25519
 
 
+cdef extern from "Python.h":
+    Py_ssize_t PY_SSIZE_T_MAX
+
+
+# References to libssh2's global state - held by this module until exit and
+# by each session, so that libssh2_exit runs once, after the last of them.
+# Sessions may be created and freed by threads running in parallel on
+# free-threaded Python.
+cdef size_t _libssh2_refs = 0
+cdef bint _module_ref = 0
+cdef cython.pymutex _libssh2_refs_lock
+
+
+cdef void _libssh2_ref() noexcept:
+    global _libssh2_refs
+    with _libssh2_refs_lock:
+        if _libssh2_refs == 0:
+            c_ssh2.libssh2_init(0)
+        _libssh2_refs += 1
+
+
+cdef void _libssh2_unref() noexcept:
+    global _libssh2_refs
+    with _libssh2_refs_lock:
+        if _libssh2_refs == 0:
+            return
+        _libssh2_refs -= 1
+        if _libssh2_refs == 0:
+            c_ssh2.libssh2_exit()
+
+
+def _release_libssh2():
+    global _module_ref
+    with _libssh2_refs_lock:
+        if not _module_ref:
+            return
+        _module_ref = 0
+    _libssh2_unref()
+
+
+_libssh2_ref()
+_module_ref = 1
+atexit.register(_release_libssh2)
+
+
+# Size of the smallest pooled block
+DEF _POOL_MIN_SIZE = 64
+# Bytes of free blocks a session keeps for re-use
+DEF _POOL_MAX_SIZE = 1024 * 1024
+
+
+# Header in front of every block given to libssh2
+cdef struct _block:
+    size_t size
+    Py_ssize_t bin
+
+
+cdef inline _session_memory *_memory(void **abstract) noexcept nogil:
+    return &(<_session_state *>abstract[0]).memory
+
+
+cdef inline Py_ssize_t _pool_bin(size_t count) noexcept nogil:
+    """Free list for blocks of count bytes - _POOL_BINS if too large."""
+    cdef Py_ssize_t bin = 0
+    cdef size_t size = _POOL_MIN_SIZE
+    while size < count and bin < _POOL_BINS:
+        size <<= 1
+        bin += 1
+    return bin
+
+
+cdef inline size_t _bin_size(Py_ssize_t bin) noexcept nogil:
+    return (<size_t>_POOL_MIN_SIZE) << bin
+
+
+cdef inline void _account(_session_memory *memory, Py_ssize_t change) noexcept nogil:
+    memory.current += change
+    if memory.current > memory.peak:
+        memory.peak = memory.current
+
+
+cdef void _pool_drain(_session_memory *memory) noexcept nogil:
+    cdef void *block
+    cdef Py_ssize_t bin
+    for bin in range(_POOL_BINS):
+        block = memory.bins[bin]
+        while block is not NULL:
+            memory.bins[bin] = (<void **>(<_block *>block + 1))[0]
+            PyMem_RawFree(block)
+            block = memory.bins[bin]
+    memory.pool_size = 0
+
+
 cdef void *PySSH2_Malloc(size_t count, void **abstract) noexcept nogil:
-    return PyMem_RawMalloc(count)
+    cdef _session_memory *memory = _memory(abstract)
+    cdef Py_ssize_t bin = _POOL_BINS
+    cdef _block *block
+    if count > <size_t>PY_SSIZE_T_MAX - sizeof(_block):
+        return NULL
+    if memory.pool:
+        bin = _pool_bin(count)
+    if bin < _POOL_BINS and memory.bins[bin] is not NULL:
+        block = <_block *>memory.bins[bin]
+        memory.bins[bin] = (<void **>(block + 1))[0]
+        memory.pool_size -= _bin_size(bin)
+        memory.pool_hits += 1
+    else:
+        block = <_block *>PyMem_RawMalloc(
+            sizeof(_block) + (count if bin == _POOL_BINS else _bin_size(bin)))
+        if block is NULL:
+            return NULL
+    block.size = count
+    block.bin = bin
+    memory.allocations += 1
+    _account(memory, count)
+    return block + 1
+
 
 cdef void *PySSH2_Realloc(void *ptr, size_t count, void **abstract) noexcept nogil:
-    return PyMem_RawRealloc(ptr, count)
+    cdef _session_memory *memory = _memory(abstract)
+    cdef _block *block
+    cdef void *new_ptr
+    if ptr is NULL:
+        return PySSH2_Malloc(count, abstract)
+    block = <_block *>ptr - 1
+    if block.bin < _POOL_BINS:
+        if count <= _bin_size(block.bin):
+            _account(memory, <Py_ssize_t>count - <Py_ssize_t>block.size)
+            block.size = count
+            return ptr
+        new_ptr = PySSH2_Malloc(count, abstract)
+        if new_ptr is not NULL:
+            memcpy(new_ptr, ptr, block.size)
+            PySSH2_Free(ptr, abstract)
+        return new_ptr
+    if count > <size_t>PY_SSIZE_T_MAX - sizeof(_block):
+        return NULL
+    _account(memory, -<Py_ssize_t>block.size)
+    new_ptr = PyMem_RawRealloc(block, sizeof(_block) + count)
+    if new_ptr is NULL:
+        _account(memory, block.size)
+        return NULL
+    block = <_block *>new_ptr
+    block.size = count
+    _account(memory, count)
+    return block + 1
+
 
 cdef void PySSH2_Free(void *ptr, void **abstract) noexcept nogil:
-    PyMem_RawFree(ptr)
+    cdef _session_memory *memory = _memory(abstract)
+    cdef _block *block
+    if ptr is NULL:
+        return
+    block = <_block *>ptr - 1
+    memory.frees += 1
+    _account(memory, -<Py_ssize_t>block.size)
+    if block.bin < _POOL_BINS and memory.pool and \
+            memory.pool_size + _bin_size(block.bin) <= _POOL_MAX_SIZE:
+        (<void **>ptr)[0] = memory.bins[block.bin]
+        memory.bins[block.bin] = block
+        memory.pool_size += _bin_size(block.bin)
+    else:
+        PyMem_RawFree(block)
+
+
+# Larger packets are dropped by libssh2 as over LIBSSH2_PACKET_MAXPAYLOAD
+DEF _MAX_PACKET_SIZE = 32768
+DEF _MAX_WINDOW_SIZE = 1024 * 1024 * 1024
+
+
+cdef int _check_window_sizes(unsigned long window_size,
+                             unsigned long packet_size,
+                             unsigned long max_window_size) except -1:
+    if window_size < 1 or window_size > _MAX_WINDOW_SIZE:
+        raise ValueError("window_size must be between 1 and %s" % (
+            _MAX_WINDOW_SIZE,))
+    if packet_size < 1 or packet_size > _MAX_PACKET_SIZE:
+        raise ValueError("packet_size must be between 1 and %s" % (
+            _MAX_PACKET_SIZE,))
+    if max_window_size != 0 and (
+            max_window_size < window_size or max_window_size > _MAX_WINDOW_SIZE):
+        raise ValueError("max_window_size must be zero or between window_size "
+                         "and %s" % (_MAX_WINDOW_SIZE,))
+    return 0
+
+
+cdef c_sftp.LIBSSH2_SFTP *_sftp_init(c_ssh2.LIBSSH2_SESSION *session,
+                                     unsigned int window_size,
+                                     unsigned int packet_size) noexcept nogil:
+    IF EMBEDDED_LIB:
+        return c_sftp.libssh2_sftp_init_ex(session, window_size, packet_size)
+    ELSE:
+        # Sizes other than the defaults are rejected by sftp_init
+        return c_sftp.libssh2_sftp_init(session)
+
+
+cdef bint _jump_wait(_jump_transport *jump, bint inbound) noexcept nogil:
+    """Wait on the outer session's socket after a call on the tunnel channel
+    returned EAGAIN. Returns whether to retry the call."""
+    cdef c_net.pollfd pfd
+    cdef int timeout = -1
+    cdef int directions = c_ssh2.libssh2_session_block_directions(jump.outer)
+    if directions & c_ssh2.LIBSSH2_SESSION_BLOCK_OUTBOUND:
+        # A partly sent packet has to be flushed by repeating the same call
+        # before anything else is sent on the outer session.
+        pfd.events = c_net.POLLOUT
+    elif inbound and c_ssh2.libssh2_session_get_blocking(jump.session):
+        # Channel window is full, wait for the window adjustment.
+        pfd.events = c_net.POLLIN
+        timeout = c_ssh2.libssh2_session_get_timeout(jump.session)
+        if timeout == 0:
+            timeout = -1
+    else:
+        return 0
+    pfd.fd = jump.sock
+    pfd.revents = 0
+    return c_net.poll(&pfd, 1, timeout) > 0
+
+
+cdef ssize_t _jump_recv(c_ssh2.libssh2_socket_t sock, void *buffer,
+                        size_t length, int flags,
+                        void **abstract) noexcept nogil:
+    cdef _jump_transport *jump = &(<_session_state *>abstract[0]).jump
+    cdef int blocking = c_ssh2.libssh2_session_get_blocking(jump.outer)
+    cdef ssize_t rc
+    # Tunnelled session drains its transport until EAGAIN, so reads never
+    # block and it waits on the outer socket itself when in blocking mode.
+    c_ssh2.libssh2_session_set_blocking(jump.outer, 0)
+    rc = c_ssh2.libssh2_channel_read(jump.channel, <char *>buffer, length)
+    while rc == c_ssh2.LIBSSH2_ERROR_EAGAIN and _jump_wait(jump, 0):
+        rc = c_ssh2.libssh2_channel_read(jump.channel, <char *>buffer, length)
+    c_ssh2.libssh2_session_set_blocking(jump.outer, blocking)
+    if rc == c_ssh2.LIBSSH2_ERROR_EAGAIN:
+        return -errno.EAGAIN
+    elif rc < 0:
+        return -errno.ECONNRESET
+    return rc
+
+
+cdef ssize_t _jump_send(c_ssh2.libssh2_socket_t sock, const void *buffer,
+                        size_t length, int flags,
+                        void **abstract) noexcept nogil:
+    cdef _jump_transport *jump = &(<_session_state *>abstract[0]).jump
+    cdef int blocking = c_ssh2.libssh2_session_get_blocking(jump.outer)
+    cdef ssize_t rc
+    c_ssh2.libssh2_session_set_blocking(jump.outer, 0)
+    rc = c_ssh2.libssh2_channel_write(jump.channel, <const char *>buffer, length)
+    while rc == c_ssh2.LIBSSH2_ERROR_EAGAIN and _jump_wait(jump, 1):
+        rc = c_ssh2.libssh2_channel_write(
+            jump.channel, <const char *>buffer, length)
+    c_ssh2.libssh2_session_set_blocking(jump.outer, blocking)
+    if rc == c_ssh2.LIBSSH2_ERROR_EAGAIN or (rc == 0 and length > 0):
+        return -errno.EAGAIN
+    elif rc < 0:
+        return -errno.EPIPE
+    return rc
+
+
+# Delay before racing the next address while earlier connects are pending,
+# as recommended by RFC 8305.
+DEF _CONNECT_ATTEMPT_DELAY = 250
+DEF _CONNECT_MAX_ATTEMPTS = 16
+
+
+cdef inline long _monotonic_ms() noexcept nogil:
+    return <long>(monotonic_time() * 1000)
+
+
+cdef int _connect_start(c_net.addrinfo *addr, int send_buffer_size,
+                        int receive_buffer_size) noexcept nogil:
+    """Start a non-blocking connect to addr. Returns the socket, or -1 with
+    errno set."""
+    cdef int error
+    cdef int fd = c_net.socket(
+        addr.ai_family, c_net.SOCK_STREAM | c_net.SOCK_NONBLOCK | c_net.SOCK_CLOEXEC,
+        addr.ai_protocol)
+    if fd < 0:
+        return -1
+    # Buffer sizes must be set before connecting to take effect on the
+    # advertised window.
+    if send_buffer_size > 0:
+        c_net.setsockopt(fd, c_net.SOL_SOCKET, c_net.SO_SNDBUF,
+                         &send_buffer_size, sizeof(send_buffer_size))
+    if receive_buffer_size > 0:
+        c_net.setsockopt(fd, c_net.SOL_SOCKET, c_net.SO_RCVBUF,
+                         &receive_buffer_size, sizeof(receive_buffer_size))
+    if c_net.connect(fd, addr.ai_addr, addr.ai_addrlen) == 0 \
+       or errno.errno == errno.EINPROGRESS:
+        return fd
+    error = errno.errno
+    close(fd)
+    errno.errno = error
+    return -1
+
+
+cdef int _connect_race(c_net.addrinfo *addrs, long deadline, int send_buffer_size,
+                       int receive_buffer_size, int *error) noexcept nogil:
+    """Connect to the first of addrs to accept, alternating address families
+    and starting the next attempt every ``_CONNECT_ATTEMPT_DELAY`` ms while
+    earlier ones are pending.
+
+    Returns the connected socket, or -1 with error set to the last connect
+    error or ``ETIMEDOUT`` once deadline, if not negative, has passed."""
+    cdef c_net.addrinfo *ordered[_CONNECT_MAX_ATTEMPTS]
+    cdef c_net.pollfd pending[_CONNECT_MAX_ATTEMPTS]
+    cdef c_net.addrinfo *first = addrs
+    cdef c_net.addrinfo *other = addrs
+    cdef c_net.socklen_t length
+    cdef int count = 0
+    cdef int started = 0
+    cdef int waiting = 0
+    cdef int fd = -1
+    cdef int result, i
+    cdef long now, wait, next_attempt
+    # Interleave the family of the first address with the other family.
+    while count < _CONNECT_MAX_ATTEMPTS and (first is not NULL or other is not NULL):
+        while first is not NULL and first.ai_family != addrs.ai_family:
+            first = first.ai_next
+        if first is not NULL:
+            ordered[count] = first
+            count += 1
+            first = first.ai_next
+        while other is not NULL and other.ai_family == addrs.ai_family:
+            other = other.ai_next
+        if other is not NULL and count < _CONNECT_MAX_ATTEMPTS:
+            ordered[count] = other
+            count += 1
+            other = other.ai_next
+    error[0] = errno.ECONNREFUSED
+    now = next_attempt = _monotonic_ms()
+    while fd < 0:
+        if started < count and (waiting == 0 or now >= next_attempt):
+            pending[waiting].fd = _connect_start(
+                ordered[started], send_buffer_size, receive_buffer_size)
+            started += 1
+            if pending[waiting].fd < 0:
+                error[0] = errno.errno
+                next_attempt = now
+                continue
+            pending[waiting].events = c_net.POLLOUT
+            pending[waiting].revents = 0
+            waiting += 1
+            next_attempt = now + _CONNECT_ATTEMPT_DELAY
+        if waiting == 0:
+            break
+        wait = next_attempt - now if started < count else -1
+        if deadline >= 0:
+            if now >= deadline:
+                error[0] = errno.ETIMEDOUT
+                break
+            if wait < 0 or deadline - now < wait:
+                wait = deadline - now
+        if c_net.poll(pending, waiting, wait) < 0 and errno.errno != errno.EINTR:
+            error[0] = errno.errno
+            break
+        now = _monotonic_ms()
+        i = 0
+        while i < waiting:
+            if pending[i].revents == 0:
+                i += 1
+                continue
+            result = 0
+            length = sizeof(result)
+            c_net.getsockopt(pending[i].fd, c_net.SOL_SOCKET, c_net.SO_ERROR,
+                             &result, &length)
+            if result == 0:
+                fd = pending[i].fd
+            else:
+                error[0] = result
+                close(pending[i].fd)
+            waiting -= 1
+            pending[i] = pending[waiting]
+            if fd >= 0:
+                break
+    for i in range(waiting):
+        close(pending[i].fd)
+    return fd
+
+
+cdef object _connect(host, int port, long deadline, int send_buffer_size,
+                     int receive_buffer_size):
+    """Resolve host and connect to it, raising :py:class:`socket.gaierror`,
+    :py:class:`ssh2.exceptions.Timeout` or :py:class:`OSError` on failure."""
+    cdef bytes b_host = to_bytes(host)
+    cdef bytes b_port = str(port).encode()
+    cdef const char *_host = b_host
+    cdef const char *_port = b_port
+    cdef c_net.addrinfo hints
+    cdef c_net.addrinfo *addrs = NULL
+    cdef int rc, error = 0
+    cdef int fd
+    cdef int one = 1
+    # Imported on first use rather than with the module, for import time
+    import socket
+    memset(&hints, 0, sizeof(hints))
+    hints.ai_family = c_net.AF_UNSPEC
+    hints.ai_socktype = c_net.SOCK_STREAM
+    hints.ai_flags = c_net.AI_NUMERICSERV
+    with nogil:
+        rc = c_net.getaddrinfo(_host, _port, &hints, &addrs)
+        if rc == 0:
+            fd = _connect_race(addrs, deadline, send_buffer_size,
+                               receive_buffer_size, &error)
+            c_net.freeaddrinfo(addrs)
+            if fd >= 0:
+                c_net.setsockopt(fd, c_net.IPPROTO_TCP, c_net.TCP_NODELAY,
+                                 &one, sizeof(one))
+    if rc != 0:
+        raise socket.gaierror(rc, c_net.gai_strerror(rc).decode())
+    if fd < 0:
+        if error == errno.ETIMEDOUT and deadline >= 0:
+            raise Timeout("Timed out connecting to %s", host)
+        raise OSError(error, os.strerror(error))
+    sock = socket.socket(fileno=fd)
+    sock.setblocking(True)
+    return sock
+
+
+cdef ssize_t _locked_recv(c_ssh2.libssh2_socket_t sock, void *buffer,
+                          size_t length, int flags,
+                          void **abstract) noexcept nogil:
+    """Transport receive of locked sessions. Counts reads so that threads
+    waiting on the socket know when another thread read what they wait
+    for."""
+    cdef _session_state *state = <_session_state *>abstract[0]
+    cdef ssize_t rc
+    if state.jump.channel is not NULL:
+        rc = _jump_recv(sock, buffer, length, flags, abstract)
+    else:
+        rc = c_net.recv(sock, buffer, length, flags)
+        if rc < 0:
+            rc = -errno.errno
+    if rc > 0 and state.lock.enabled:
+        _session_wake(&state.lock)
+    return rc
+
+
+cdef void _session_wake(_session_lock *lock) noexcept nogil:
+    """Count a read and wake threads waiting in :c:func:`_session_wait`,
+    which then repeat their calls."""
+    cdef uint64_t one = 1
+    c_pthread.pthread_mutex_lock(&lock.wait_mutex)
+    lock.reads += 1
+    c_pthread.pthread_cond_broadcast(&lock.wait_cond)
+    if lock.polling:
+        write(lock.wake_fd, &one, sizeof(one))
+    c_pthread.pthread_mutex_unlock(&lock.wait_mutex)
+
+
+cdef long _call_remaining(_session_lock *lock, _session_call *call) noexcept nogil:
+    """Milliseconds left of the session timeout for call, -1 for none."""
+    cdef long timeout = c_ssh2.libssh2_session_get_timeout(lock.session)
+    cdef long now
+    if timeout <= 0:
+        return -1
+    now = _monotonic_ms()
+    if call.start < 0:
+        call.start = now
+    if now - call.start >= timeout:
+        return 0
+    return call.start + timeout - now
+
+
+cdef bint _session_wait(_session_lock *lock, _session_call *call) noexcept nogil:
+    """Wait without the session lock until the socket is readable or another
+    thread has read from it since call last ran. One waiting thread polls
+    the socket, and the wake up file for reads by other threads, the others
+    wait for it or for a read. Returns 0 on timeout."""
+    cdef c_net.pollfd pfds[2]
+    cdef uint64_t count
+    cdef timespec deadline
+    cdef long timeout
+    cdef int rc
+    c_pthread.pthread_mutex_lock(&lock.wait_mutex)
+    while lock.reads == call.reads:
+        timeout = _call_remaining(lock, call)
+        if timeout == 0:
+            c_pthread.pthread_mutex_unlock(&lock.wait_mutex)
+            return 0
+        if not lock.polling:
+            lock.polling = 1
+            c_pthread.pthread_mutex_unlock(&lock.wait_mutex)
+            pfds[0].fd = lock.sock
+            pfds[0].events = c_net.POLLIN
+            pfds[0].revents = 0
+            pfds[1].fd = lock.wake_fd
+            pfds[1].events = c_net.POLLIN
+            pfds[1].revents = 0
+            rc = c_net.poll(pfds, 2, timeout)
+            c_pthread.pthread_mutex_lock(&lock.wait_mutex)
+            if pfds[1].revents:
+                read(lock.wake_fd, &count, sizeof(count))
+            lock.polling = 0
+            # Let another waiter take over polling if this one's call does
+            # not read from the socket
+            c_pthread.pthread_cond_broadcast(&lock.wait_cond)
+            if rc != 0:
+                break
+        elif timeout < 0:
+            c_pthread.pthread_cond_wait(&lock.wait_cond, &lock.wait_mutex)
+        else:
+            clock_gettime(CLOCK_MONOTONIC, &deadline)
+            deadline.tv_sec += timeout // 1000 + (
+                deadline.tv_nsec + timeout % 1000 * 1000000) // 1000000000
+            deadline.tv_nsec = (
+                deadline.tv_nsec + timeout % 1000 * 1000000) % 1000000000
+            c_pthread.pthread_cond_timedwait(
+                &lock.wait_cond, &lock.wait_mutex, &deadline)
+    c_pthread.pthread_mutex_unlock(&lock.wait_mutex)
+    return 1
+
+
+cdef void _lock_init(_session_lock *lock) noexcept:
+    """Set up the mutexes and condition of locked mode, left out of session
+    construction as most sessions are never shared."""
+    cdef c_pthread.pthread_condattr_t attr
+    c_pthread.pthread_mutex_init(&lock.mutex, NULL)
+    c_pthread.pthread_mutex_init(&lock.op, NULL)
+    c_pthread.pthread_mutex_init(&lock.wait_mutex, NULL)
+    c_pthread.pthread_condattr_init(&attr)
+    c_pthread.pthread_condattr_setclock(&attr, CLOCK_MONOTONIC)
+    c_pthread.pthread_cond_init(&lock.wait_cond, &attr)
+    c_pthread.pthread_condattr_destroy(&attr)
+    lock.initialised = 1
+
+
+cdef void _session_acquire(_session_state *state, _session_call *call) noexcept nogil:
+    c_pthread.pthread_mutex_lock(&state.lock.mutex)
+    call.reads = state.lock.reads
+
+
+cdef int _session_release(_session_state *state, _session_call *call,
+                          bint again) noexcept nogil:
+    """Release the session after a call, waiting for the socket first if the
+    call would block. Returns 1 with the session locked again for the call
+    to be repeated, 0 when done and -1 on timeout."""
+    cdef _session_lock *lock = &state.lock
+    cdef c_net.pollfd pfd
+    cdef int rc = 0
+    if again:
+        if c_ssh2.libssh2_session_block_directions(lock.session) \
+           & c_ssh2.LIBSSH2_SESSION_BLOCK_OUTBOUND:
+            # A partly sent packet has to be completed by repeating the same
+            # call before anything else is sent, so no other thread may run
+            # in between - wait with the lock held, also in non-blocking mode.
+            pfd.fd = lock.sock
+            pfd.events = c_net.POLLOUT
+            pfd.revents = 0
+            if c_net.poll(&pfd, 1, _call_remaining(lock, call)) != 0:
+                return 1
+            rc = -1
+        elif lock.blocking:
+            c_pthread.pthread_mutex_unlock(&lock.mutex)
+            if _session_wait(lock, call):
+                _session_acquire(state, call)
+                return 1
+            c_pthread.pthread_mutex_lock(&lock.mutex)
+            rc = -1
+    IF EMBEDDED_LIB:
+        if rc < 0:
+            c_ssh2.libssh2_session_set_last_error(
+                lock.session, error_codes._LIBSSH2_ERROR_TIMEOUT,
+                b"Timed out waiting on socket")
+    c_pthread.pthread_mutex_unlock(&lock.mutex)
+    if call.op is not NULL:
+        c_pthread.pthread_mutex_unlock(call.op)
+    return rc
+
+
+cdef class MemoryStats:
+    """Snapshot of a session's libssh2 memory use, as returned by
+    :py:func:`Session.memory_stats`.
+
+    ``current`` and ``peak`` are bytes allocated by libssh2 for the session,
+    ``allocations`` and ``frees`` the number of calls to its allocator.
+    ``pool_hits`` is the number of allocations served from the session's
+    buffer pool and ``pool_size`` the bytes of free blocks held in it."""
+
+    def __repr__(self):
+        return "<MemoryStats current=%s peak=%s allocations=%s frees=%s " \
+            "pool_hits=%s pool_size=%s>" % (
+                self.current, self.peak, self.allocations, self.frees,
+                self.pool_hits, self.pool_size)
 
 
 cdef class Session:
@@ -65,13 +660,15 @@ cdef class Session:
     """LibSSH2 Session class providing session functions"""
 
     def __cinit__(self):
-        c_ssh2.libssh2_init(0)
+        _libssh2_ref()
+        self._state.lock.wake_fd = -1
         self._session = c_ssh2.libssh2_session_init_ex(PySSH2_Malloc,
                                                        PySSH2_Free,
                                                        PySSH2_Realloc,
-                                                       <void *> NULL)
+                                                       <void *> &self._state)
         if self._session is NULL:
             raise MemoryError()
+        self._state.lock.session = self._session
         self._sock = 0
         self.sock = None
 
@@ -79,12 +676,24 @@ cdef class Session:
         if self._session is not NULL:
             c_ssh2.libssh2_session_free(self._session)
         self._session = NULL
-        c_ssh2.libssh2_exit()
+        _pool_drain(&self._state.memory)
+        if self._state.lock.initialised:
+            c_pthread.pthread_mutex_destroy(&self._state.lock.mutex)
+            c_pthread.pthread_mutex_destroy(&self._state.lock.op)
+            c_pthread.pthread_mutex_destroy(&self._state.lock.wait_mutex)
+            c_pthread.pthread_cond_destroy(&self._state.lock.wait_cond)
+        if self._state.lock.wake_fd >= 0:
+            close(self._state.lock.wake_fd)
+        _libssh2_unref()
 
     def disconnect(self):
+        cdef _session_call call
         cdef int rc
         with nogil:
+            session_lock(&self._state, &call, &self._state.lock.op)
             rc = c_ssh2.libssh2_session_disconnect(self._session, b"end")
+            while session_again(&self._state, &call, &rc):
+                rc = c_ssh2.libssh2_session_disconnect(self._session, b"end")
         return handle_error_codes(rc)
 
     def handshake(self, sock not None):
@@ -92,13 +701,135 @@ cdef class Session:
 
         Must be called after Session initialisation."""
         cdef int _sock = PyObject_AsFileDescriptor(sock)
+        cdef _session_call call
         cdef int rc
+        self._state.lock.sock = _sock
         with nogil:
+            session_lock(&self._state, &call, &self._state.lock.op)
             rc = c_ssh2.libssh2_session_handshake(self._session, _sock)
+            while session_again(&self._state, &call, &rc):
+                rc = c_ssh2.libssh2_session_handshake(self._session, _sock)
             self._sock = _sock
         self.sock = sock
         return handle_error_codes(rc)
 
+    def connect(self, host not None, int port=22, timeout=None,
+                int send_buffer_size=0, int receive_buffer_size=0):
+        """Connect to ``host:port`` and perform SSH handshake.
+
+        All addresses host resolves to are tried, alternating between IPv6
+        and IPv4 and starting the next connection attempt every 250ms while
+        earlier ones are pending, so that one unreachable address does not
+        hold up connecting to the others. The first connection to succeed is
+        used and the rest are closed.
+
+        ``TCP_NODELAY`` is set on the socket. Socket buffer sizes are left to
+        the system unless given - setting them turns off the system's buffer
+        auto-tuning.
+
+        The connected socket is available as :py:attr:`sock` afterwards.
+
+        :param host: Host name or address to connect to.
+        :type host: str
+        :param port: SSH port of host.
+        :type port: int
+        :param timeout: Seconds connecting and handshake may take in total,
+          or ``None`` for no limit. Connecting, and on blocking sessions the
+          handshake, not completing in time raises
+          :py:class:`ssh2.exceptions.Timeout`.
+        :type timeout: float
+        :param send_buffer_size: ``SO_SNDBUF`` size in bytes, or ``0`` for the
+          system default.
+        :type send_buffer_size: int
+        :param receive_buffer_size: ``SO_RCVBUF`` size in bytes, or ``0`` for
+          the system default.
+        :type receive_buffer_size: int
+
+        :raises: :py:class:`socket.gaierror` if host cannot be resolved,
+          :py:class:`ssh2.exceptions.Timeout` if no connection could be made
+          within timeout and :py:class:`OSError` on any other connection
+          error."""
+        cdef long deadline = -1
+        cdef long remaining
+        cdef long previous_timeout
+        if timeout is not None:
+            if timeout <= 0:
+                raise ValueError("timeout must be greater than zero")
+            deadline = _monotonic_ms() + <long>(timeout * 1000)
+        if send_buffer_size < 0 or receive_buffer_size < 0:
+            raise ValueError("Buffer sizes must not be negative")
+        sock = _connect(host, port, deadline, send_buffer_size,
+                        receive_buffer_size)
+        if deadline < 0:
+            return self.handshake(sock)
+        remaining = deadline - _monotonic_ms()
+        if remaining <= 0:
+            sock.close()
+            raise Timeout("Timed out connecting to %s", host)
+        previous_timeout = c_ssh2.libssh2_session_get_timeout(self._session)
+        if previous_timeout > 0 and previous_timeout < remaining:
+            remaining = previous_timeout
+        c_ssh2.libssh2_session_set_timeout(self._session, remaining)
+        try:
+            return self.handshake(sock)
+        finally:
+            c_ssh2.libssh2_session_set_timeout(self._session, previous_timeout)
+
+    def handshake_channel(self, Channel channel not None):
+        """Perform SSH handshake over a channel of another session instead of
+        a socket, for example a direct TCP/IP channel opened on a jump host.
+
+        The outer session's socket is used for waiting on the session, so
+        :py:attr:`sock` and :py:func:`block_directions` work as for a session
+        connected directly, and sessions can be chained over any number of
+        jump hosts without relay threads.
+
+        The outer session is used by this session's calls and must not be
+        used from another thread at the same time. The channel is kept open
+        for the lifetime of this session.
+
+        :param channel: Channel to run the session over.
+        :type channel: :py:class:`ssh2.channel.Channel`"""
+        cdef Session outer = channel._session
+        cdef int rc
+        self._state.jump.session = self._session
+        self._state.jump.outer = outer._session
+        self._state.jump.channel = channel._channel
+        self._state.jump.sock = outer._sock
+        self._jump_channel = channel
+        self._state.lock.sock = outer._sock
+        c_ssh2.libssh2_session_callback_set(
+            self._session, c_ssh2.LIBSSH2_CALLBACK_RECV,
+            <void *>_locked_recv if self._state.lock.enabled else <void *>_jump_recv)
+        c_ssh2.libssh2_session_callback_set(
+            self._session, c_ssh2.LIBSSH2_CALLBACK_SEND, <void *>_jump_send)
+        with nogil:
+            rc = c_ssh2.libssh2_session_handshake(
+                self._session, self._state.jump.sock)
+            self._sock = self._state.jump.sock
+        self.sock = outer.sock
+        return handle_error_codes(rc)
+
+    def proxy_jump(self, host not None, int port=22):
+        """Open a session to ``host:port`` through this session's server,
+        like ``ssh -J``.
+
+        A direct TCP/IP channel to ``host:port`` is opened on this session and
+        a new session handshaked over it with :py:func:`handshake_channel`.
+        The new session can in turn be used to jump to a further host. This
+        session must be authenticated and in blocking mode.
+
+        :param host: Host to connect to from this session's server.
+        :type host: str
+        :param port: SSH port of host.
+        :type port: int
+
+        :returns: New session, handshaked but not yet authenticated.
+        :rtype: :py:class:`ssh2.session.Session`"""
+        cdef Session session = Session()
+        session.handshake_channel(self.direct_tcpip(host, port))
+        return session
+
     def startup(self, sock):
         """Deprecated - use self.handshake"""
         cdef int _sock = PyObject_AsFileDescriptor(sock)
@@ -112,6 +843,9 @@ cdef class Session:
         :param blocking: ``False`` for non-blocking, ``True`` for blocking.
           Session default is blocking unless set otherwise.
         :type blocking: bool"""
+        if self._state.lock.enabled:
+            self._state.lock.blocking = blocking
+            return
         with nogil:
             c_ssh2.libssh2_session_set_blocking(
                 self._session, blocking)
@@ -121,10 +855,69 @@ cdef class Session:
 
         :rtype: bool"""
         cdef int rc
+        if self._state.lock.enabled:
+            return bool(self._state.lock.blocking)
         with nogil:
             rc = c_ssh2.libssh2_session_get_blocking(self._session)
         return bool(rc)
 
+    def set_locking(self, bint enabled):
+        """Turn locked mode on or off, for the session to be shared by
+        threads.
+
+        In locked mode channel and SFTP functions, and those of the session
+        opening channels, lock the session around each libssh2 call and
+        unlock it while waiting on the socket in blocking mode. Threads can
+        then each use their own channels or SFTP sessions of one session at
+        the same time, with their waits overlapping. A channel, or an SFTP
+        session with its handles, is still to be used by one thread at a
+        time.
+
+        Opening channels and SFTP functions are serialised for their whole
+        duration, as libssh2 keeps their progress on the session and SFTP
+        session. Non-blocking calls may wait for the socket to be writable
+        when a packet was partly sent, as the same call has to complete it
+        before another thread can send.
+
+        Authentication, host key and agent functions do not lock the session
+        and should be done before it is shared. Forwarders and multiplexers
+        must not be used on a session shared by threads.
+
+        :param enabled: ``True`` to lock, ``False`` to not. Off by default.
+        :type enabled: bool"""
+        cdef int err = 0
+        with cython.critical_section(self):
+            if enabled == self._state.lock.enabled:
+                return
+            if enabled:
+                if not self._state.lock.initialised:
+                    _lock_init(&self._state.lock)
+                if self._state.lock.wake_fd < 0:
+                    self._state.lock.wake_fd = c_net.eventfd(
+                        0, c_net.EFD_CLOEXEC | c_net.EFD_NONBLOCK)
+                    if self._state.lock.wake_fd < 0:
+                        err = errno.errno
+                if not err:
+                    self._state.lock.blocking = \
+                        c_ssh2.libssh2_session_get_blocking(self._session)
+                    c_ssh2.libssh2_session_set_blocking(self._session, 0)
+                    c_ssh2.libssh2_session_callback_set(
+                        self._session, c_ssh2.LIBSSH2_CALLBACK_RECV,
+                        <void *>_locked_recv)
+                    self._state.lock.enabled = 1
+            else:
+                self._state.lock.enabled = 0
+                c_ssh2.libssh2_session_set_blocking(
+                    self._session, self._state.lock.blocking)
+        if err:
+            raise OSError(err, os.strerror(err))
+
+    def get_locking(self):
+        """Get whether locked mode is on.
+
+        :rtype: bool"""
+        return bool(self._state.lock.enabled)
+
     def set_timeout(self, long timeout):
         """Set the timeout in milliseconds for how long a blocking
         call may wait until the situation is considered an error and
@@ -143,6 +936,48 @@ cdef class Session:
             timeout = c_ssh2.libssh2_session_get_timeout(self._session)
         return timeout
 
+    def memory_stats(self):
+        """Get memory allocated by libssh2 for this session, including its
+        channels, SFTP handles and packets, and allocator call counts.
+
+        :rtype: :py:class:`ssh2.session.MemoryStats`"""
+        cdef MemoryStats stats = MemoryStats.__new__(MemoryStats)
+        cdef _session_memory *memory = &self._state.memory
+        stats.current = memory.current
+        stats.peak = memory.peak
+        stats.allocations = memory.allocations
+        stats.frees = memory.frees
+        stats.pool_hits = memory.pool_hits
+        stats.pool_size = memory.pool_size
+        return stats
+
+    def set_buffer_pool(self, bint enabled):
+        """Enable or disable re-use of freed libssh2 buffers of up to 64KB,
+        such as packets, by this session.
+
+        Saves allocator calls for sessions transferring many packets at the
+        cost of keeping up to 1MB of free buffers per session. Disabling
+        frees any buffers held.
+
+        In locked mode, waits for the session lock, as other threads' libssh2
+        calls allocate from and free to the pool.
+
+        :param enabled: ``True`` to enable. Default is disabled.
+        :type enabled: bool"""
+        cdef _session_call call
+        with nogil:
+            session_lock(&self._state, &call, NULL)
+            self._state.memory.pool = enabled
+            if not enabled:
+                _pool_drain(&self._state.memory)
+            session_unlock(&self._state, &call)
+
+    def get_buffer_pool(self):
+        """Get whether buffer pool is enabled.
+
+        :rtype: bool"""
+        return self._state.memory.pool
+
     def userauth_authenticated(self):
         """True/False for is user authenticated or not.
 
@@ -263,6 +1098,36 @@ cdef class Session:
                 privatekeydata_len, _passphrase)
         return handle_error_codes(rc)
 
+    def userauth_publickey_fromkey(self, username not None,
+                                   PrivateKey privatekey not None):
+        """Authenticate with a private key loaded and decrypted before hand.
+
+        The same :py:class:`ssh2.pkey.PrivateKey` can be used to authenticate
+        any number of sessions, without reading or decrypting the key file
+        again.
+
+        :param username: User name to authenticate as.
+        :type username: str
+        :param privatekey: Loaded private key.
+        :type privatekey: :py:class:`ssh2.pkey.PrivateKey`
+
+        :rtype: int"""
+        cdef int rc
+        cdef bytes b_username = to_bytes(username)
+        cdef char *_username = b_username
+        cdef size_t username_len = len(b_username)
+        cdef bytes publickeydata = privatekey.publickeydata
+        cdef const char *_publickeydata = NULL
+        cdef size_t publickeydata_len = 0
+        if publickeydata is not None:
+            _publickeydata = publickeydata
+            publickeydata_len = len(publickeydata)
+        with nogil:
+            rc = c_ssh2.libssh2_userauth_publickey_frommemory(
+                self._session, _username, username_len, _publickeydata,
+                publickeydata_len, privatekey._data, privatekey._len, "")
+        return handle_error_codes(rc)
+
     def userauth_password(self, username not None, password not None):
         """Perform password authentication
 
@@ -290,12 +1155,16 @@ cdef class Session:
             agent = agent_init(self._session)
         return PyAgent(agent, self)
 
-    def agent_auth(self, username not None):
+    def agent_auth(self, username not None, SharedAgent agent=None):
         """Convenience function for performing user authentication via SSH Agent.
 
         Initialises, connects to, gets list of identities from and attempts
         authentication with each identity from SSH agent.
 
+        With ``agent`` set, authenticates through that
+        :py:class:`ssh2.agent.SharedAgent` instead, reusing its agent
+        connection and cached identities.
+
         Note that agent connections cannot be used in non-blocking mode -
         clients should call `set_blocking(0)` *after* calling this function.
 
@@ -318,14 +1187,20 @@ cdef class Session:
         :rtype: None"""
         cdef bytes b_username = to_bytes(username)
         cdef char *_username = b_username
-        cdef c_ssh2.LIBSSH2_AGENT *agent = NULL
+        cdef c_ssh2.LIBSSH2_AGENT *_agent = NULL
         cdef c_ssh2.libssh2_agent_publickey *identity = NULL
         cdef c_ssh2.libssh2_agent_publickey *prev = NULL
-        agent = init_connect_agent(self._session)
+        if agent is not None:
+            agent.userauth(self, username)
+            return
+        _agent = init_connect_agent(self._session)
         with nogil:
-            agent_auth(_username, agent)
+            agent_auth(_username, _agent)
 
-    def open_channel(self, channeltype not None, message not None):
+    def open_channel(self, channeltype not None, message not None,
+                     unsigned long window_size=c_ssh2.LIBSSH2_CHANNEL_WINDOW_DEFAULT,
+                     unsigned long packet_size=c_ssh2.LIBSSH2_CHANNEL_PACKET_DEFAULT,
+                     unsigned long max_window_size=0):
         """Open a generic channel with custom message.
 
 
@@ -333,42 +1208,84 @@ cdef class Session:
         :type channeltype: str or bytes
         :param message: the message body as packed parameters according to the channel type.
         :type channeltype: str or bytes
+        :param window_size: Initial receive window size.
+        :type window_size: int
+        :param packet_size: Maximum size of packets the remote side may send,
+          at most 32768 bytes.
+        :type packet_size: int
+        :param max_window_size: Grow the receive window automatically up to
+          this size, see :py:func:`open_session`. Zero to not grow it.
+        :type max_window_size: int
 
         :rtype: :py:class:`ssh2.channel.Channel`
         """
-        cdef bytes b_channeltype = to_bytes(channeltype)
-        cdef bytes b_message = to_bytes(message)
-        cdef c_ssh2.LIBSSH2_CHANNEL *channel
-
-        cdef char *channel_type = b_channeltype
-        cdef unsigned int channeltype_len = len(b_channeltype)
-        cdef char *c_message = b_message
-        cdef unsigned int message_len = len(b_message)
+        return self._open_channel(to_bytes(channeltype), to_bytes(message),
+                                  window_size, packet_size, max_window_size)
 
-        with nogil:
-            channel = c_ssh2.libssh2_channel_open_ex(self._session,
-                                                     channel_type,
-                                                     channeltype_len,
-                                                     c_ssh2.LIBSSH2_CHANNEL_WINDOW_DEFAULT,
-                                                     c_ssh2.LIBSSH2_CHANNEL_PACKET_DEFAULT,
-                                                     c_message,
-                                                     message_len)
-        if channel is NULL:
-            return handle_error_codes(c_ssh2.libssh2_session_last_errno(self._session))
-        return PyChannel(channel, self)
-
-    def open_session(self):
+    def open_session(self,
+                     unsigned long window_size=c_ssh2.LIBSSH2_CHANNEL_WINDOW_DEFAULT,
+                     unsigned long packet_size=c_ssh2.LIBSSH2_CHANNEL_PACKET_DEFAULT,
+                     unsigned long max_window_size=0):
         """Open new channel session.
 
+        On links with a large bandwidth delay product the default two MB
+        receive window limits throughput to two MB per round trip. Either
+        open the channel with a larger ``window_size``, or set
+        ``max_window_size`` for the window to be grown automatically to
+        twice the bandwidth delay product measured from the round trip time
+        of opening the channel and the rate data is read from it.
+
+        :param window_size: Initial receive window size.
+        :type window_size: int
+        :param packet_size: Maximum size of packets the remote side may send,
+          at most 32768 bytes.
+        :type packet_size: int
+        :param max_window_size: Grow the receive window automatically up to
+          this size, at most 1 GB. Zero to not grow it.
+        :type max_window_size: int
+
         :rtype: :py:class:`ssh2.channel.Channel`
         """
+        return self._open_channel(b"session", b"", window_size, packet_size,
+                                  max_window_size)
+
+    cdef object _open_channel(self, bytes channeltype, bytes message,
+                              unsigned long window_size,
+                              unsigned long packet_size,
+                              unsigned long max_window_size):
         cdef c_ssh2.LIBSSH2_CHANNEL *channel
+        cdef Channel chan
+        cdef const char *channel_type = channeltype
+        cdef unsigned int channeltype_len = len(channeltype)
+        cdef const char *c_message = message
+        cdef unsigned int message_len = len(message)
+        cdef double rtt = 0
+        cdef _session_call call
+        cdef int rc
+        _check_window_sizes(window_size, packet_size, max_window_size)
         with nogil:
-            channel = c_ssh2.libssh2_channel_open_session(self._session)
+            session_lock(&self._state, &call, &self._state.lock.op)
+            # Only one channel open is in progress at a time, so its round
+            # trip can be timed across calls returning EAGAIN.
+            if self._open_started == 0:
+                self._open_started = monotonic_time()
+            channel = c_ssh2.libssh2_channel_open_ex(
+                self._session, channel_type, channeltype_len, window_size,
+                packet_size, c_message, message_len)
+            while session_again_ptr(&self._state, &call, channel, &rc):
+                channel = c_ssh2.libssh2_channel_open_ex(
+                    self._session, channel_type, channeltype_len, window_size,
+                    packet_size, c_message, message_len)
+            if channel is not NULL:
+                rtt = monotonic_time() - self._open_started
+                self._open_started = 0
+            elif rc != c_ssh2.LIBSSH2_ERROR_EAGAIN:
+                self._open_started = 0
         if channel is NULL:
-            return handle_error_codes(c_ssh2.libssh2_session_last_errno(
-                self._session))
-        return PyChannel(channel, self)
+            return handle_error_codes(rc)
+        chan = PyChannel(channel, self)
+        chan._init_window(window_size, max_window_size, rtt)
+        return chan
 
     def direct_tcpip_ex(self, host not None, int port,
                         shost not None, int sport):
@@ -377,12 +1294,17 @@ cdef class Session:
         cdef bytes b_shost = to_bytes(shost)
         cdef char *_host = b_host
         cdef char *_shost = b_shost
+        cdef _session_call call
+        cdef int rc
         with nogil:
+            session_lock(&self._state, &call, &self._state.lock.op)
             channel = c_ssh2.libssh2_channel_direct_tcpip_ex(
                 self._session, _host, port, _shost, sport)
+            while session_again_ptr(&self._state, &call, channel, &rc):
+                channel = c_ssh2.libssh2_channel_direct_tcpip_ex(
+                    self._session, _host, port, _shost, sport)
         if channel is NULL:
-            return handle_error_codes(c_ssh2.libssh2_session_last_errno(
-                self._session))
+            return handle_error_codes(rc)
         return PyChannel(channel, self)
 
     def direct_tcpip(self, host not None, int port):
@@ -394,12 +1316,17 @@ cdef class Session:
         cdef c_ssh2.LIBSSH2_CHANNEL *channel
         cdef bytes b_host = to_bytes(host)
         cdef char *_host = b_host
+        cdef _session_call call
+        cdef int rc
         with nogil:
+            session_lock(&self._state, &call, &self._state.lock.op)
             channel = c_ssh2.libssh2_channel_direct_tcpip(
                 self._session, _host, port)
+            while session_again_ptr(&self._state, &call, channel, &rc):
+                channel = c_ssh2.libssh2_channel_direct_tcpip(
+                    self._session, _host, port)
         if channel is NULL:
-            return handle_error_codes(c_ssh2.libssh2_session_last_errno(
-                self._session))
+            return handle_error_codes(rc)
         return PyChannel(channel, self)
 
     def block_directions(self):
@@ -437,12 +1364,17 @@ cdef class Session:
 
         :rtype: :py:class:`ssh2.listener.Listener` or None"""
         cdef c_ssh2.LIBSSH2_LISTENER *listener
+        cdef _session_call call
+        cdef int rc
         with nogil:
+            session_lock(&self._state, &call, &self._state.lock.op)
             listener = c_ssh2.libssh2_channel_forward_listen(
                 self._session, port)
+            while session_again_ptr(&self._state, &call, listener, &rc):
+                listener = c_ssh2.libssh2_channel_forward_listen(
+                    self._session, port)
         if listener is NULL:
-            return handle_error_codes(c_ssh2.libssh2_session_last_errno(
-                self._session))
+            return handle_error_codes(rc)
         return PyListener(listener, self)
 
     def forward_listen_ex(self, host not None, int port,
@@ -450,25 +1382,202 @@ cdef class Session:
         cdef c_ssh2.LIBSSH2_LISTENER *listener
         cdef bytes b_host = to_bytes(host)
         cdef char *_host = b_host
+        cdef _session_call call
+        cdef int rc
         with nogil:
+            session_lock(&self._state, &call, &self._state.lock.op)
             listener = c_ssh2.libssh2_channel_forward_listen_ex(
                 self._session, _host, port, &bound_port, queue_maxsize)
+            while session_again_ptr(&self._state, &call, listener, &rc):
+                listener = c_ssh2.libssh2_channel_forward_listen_ex(
+                    self._session, _host, port, &bound_port, queue_maxsize)
         if listener is NULL:
-            return handle_error_codes(c_ssh2.libssh2_session_last_errno(
-                self._session))
+            return handle_error_codes(rc)
         return PyListener(listener, self)
 
-    def sftp_init(self):
+    def forward_local(self, host not None, int port, local_host="127.0.0.1",
+                      int local_port=0, int max_channels=0, int backlog=128,
+                      size_t buffer_size=65536):
+        """Forward connections to a local port to ``host:port`` from the
+        remote side, like ``ssh -L``.
+
+        Binds the local port and returns a :py:class:`ssh2.forward.Forwarder`
+        for it. Connections are accepted and forwarded while
+        :py:func:`Forwarder.run <ssh2.forward.Forwarder.run>` is running.
+
+        :param host: Host to connect to from the remote side.
+        :type host: str
+        :param port: Port to connect to from the remote side.
+        :type port: int
+        :param local_host: Local address to listen on.
+        :type local_host: str
+        :param local_port: Local port to listen on. Zero picks a free port,
+          see :py:attr:`ssh2.forward.Forwarder.local_address`.
+        :type local_port: int
+        :param max_channels: Maximum number of connections forwarded at once,
+          each over its own channel. Zero for no limit.
+        :type max_channels: int
+        :param backlog: Listen backlog of the local socket.
+        :type backlog: int
+        :param buffer_size: Buffer size per direction of each connection.
+        :type buffer_size: int
+
+        :rtype: :py:class:`ssh2.forward.Forwarder`"""
+        return forward_local(self, host, port, local_host, local_port,
+                             max_channels, backlog, buffer_size)
+
+    def forward_socks(self, local_host="127.0.0.1", int local_port=0,
+                      int max_channels=64, int backlog=128,
+                      size_t buffer_size=65536):
+        """Run a SOCKS5 proxy on a local port that connects to the requested
+        targets from the remote side, like ``ssh -D``.
+
+        Binds the local port and returns a :py:class:`ssh2.forward.Forwarder`
+        for it. While :py:func:`Forwarder.run <ssh2.forward.Forwarder.run>`
+        is running, each connection's SOCKS5 handshake is answered and a
+        direct TCP/IP channel opened to its target, all over this session.
+
+        Only the connect command without authentication is supported. Host
+        names are resolved by the server.
+
+        :param local_host: Local address to listen on.
+        :type local_host: str
+        :param local_port: Local port to listen on. Zero picks a free port,
+          see :py:attr:`ssh2.forward.Forwarder.local_address`.
+        :type local_port: int
+        :param max_channels: Maximum number of connections forwarded at once,
+          each over its own channel. Zero for no limit.
+        :type max_channels: int
+        :param backlog: Listen backlog of the local socket.
+        :type backlog: int
+        :param buffer_size: Buffer size per direction of each connection,
+          at least 512 bytes.
+        :type buffer_size: int
+
+        :rtype: :py:class:`ssh2.forward.Forwarder`"""
+        return forward_socks(self, local_host, local_port, max_channels, backlog,
+                             buffer_size)
+
+    def forward_remote(self, host not None, int port,
+                       remote_host="localhost", int remote_port=0,
+                       int queue_maxsize=16, size_t buffer_size=65536):
+        """Forward connections to a port on the remote side to ``host:port``
+        from this side, like ``ssh -R``.
+
+        Requests a listener on the server and returns a
+        :py:class:`ssh2.forward.Forwarder` for it. Connections are accepted
+        and forwarded while
+        :py:func:`Forwarder.run <ssh2.forward.Forwarder.run>` is running.
+
+        :param host: Host to connect to from this side.
+        :type host: str
+        :param port: Port to connect to from this side.
+        :type port: int
+        :param remote_host: Address for the server to listen on.
+        :type remote_host: str
+        :param remote_port: Port for the server to listen on. Zero lets the
+          server pick one, see :py:attr:`ssh2.forward.Forwarder.bound_port`.
+        :type remote_port: int
+        :param queue_maxsize: Maximum number of connections to queue on the
+          listener before they are accepted.
+        :type queue_maxsize: int
+        :param buffer_size: Buffer size per direction of each connection.
+        :type buffer_size: int
+
+        In non-blocking mode, returns ``LIBSSH2_ERROR_EAGAIN`` while the
+        listener request is in progress. Call again with the same arguments
+        to continue it.
+
+        :rtype: :py:class:`ssh2.forward.Forwarder` or ``int``"""
+        return forward_remote(self, host, port, remote_host, remote_port,
+                              queue_maxsize, buffer_size)
+
+    def multiplexer(self, int max_channels=10, size_t buffer_size=65536):
+        """Create a :py:class:`ssh2.multiplex.Multiplexer` to run many
+        commands concurrently over channels of this session.
+
+        :param max_channels: Maximum number of channels to use at once. The
+          default is the OpenSSH server's default ``MaxSessions``. Zero for
+          no limit other than the server's.
+        :type max_channels: int
+        :param buffer_size: Size of each read from a channel. Every channel
+          gets one read of stdout and stderr in turn.
+        :type buffer_size: int
+
+        :rtype: :py:class:`ssh2.multiplex.Multiplexer`"""
+        return multiplexer(self, max_channels, buffer_size)
+
+    def reactor(self, size_t buffer_size=65536):
+        """Create a :py:class:`ssh2.reactor.Reactor` to call back on the
+        output, end of file and exit of channels of this session.
+
+        :param buffer_size: Maximum number of bytes of a channel's stdout
+          or stderr passed to one callback.
+        :type buffer_size: int
+
+        :rtype: :py:class:`ssh2.reactor.Reactor`"""
+        return reactor(self, buffer_size)
+
+    def shell_executor(self, bint pty=False, shell=None):
+        """Open a shell and create a :py:class:`ssh2.executor.ShellExecutor`
+        to run many commands in it without a channel per command.
+
+        :param pty: Request a pty for the shell.
+        :type pty: bool
+        :param shell: Command to execute as the shell, for example ``sh``,
+          or ``None`` to request the user's login shell.
+        :type shell: str
+
+        :rtype: :py:class:`ssh2.executor.ShellExecutor`"""
+        return shell_executor(self, pty, shell)
+
+    def start_io_thread(self, size_t buffer_size=262144):
+        """Start a :py:class:`ssh2.iothread.IOThread` to read channels of
+        this session on a native thread, overlapping network I/O and
+        decryption with Python code processing the data read.
+
+        Turns on locked mode, see :py:func:`set_locking`.
+
+        :param buffer_size: Size of the stdout and stderr buffers of each
+          channel added to the thread.
+        :type buffer_size: int
+
+        :rtype: :py:class:`ssh2.iothread.IOThread`"""
+        return io_thread(self, buffer_size)
+
+    def sftp_init(self,
+                  unsigned long window_size=c_ssh2.LIBSSH2_CHANNEL_WINDOW_DEFAULT,
+                  unsigned long packet_size=c_ssh2.LIBSSH2_CHANNEL_PACKET_DEFAULT):
         """Initialise SFTP channel.
 
+        :param window_size: Receive window size of the SFTP channel. A
+          larger window allows more read data in flight, see
+          :py:func:`open_session`.
+        :type window_size: int
+        :param packet_size: Maximum size of packets the remote side may send,
+          at most 32768 bytes.
+        :type packet_size: int
+
+        Sizes other than the defaults need the embedded ``libssh2``.
+
         :rtype: :py:class:`ssh2.sftp.SFTP`
         """
         cdef c_sftp.LIBSSH2_SFTP *_sftp
+        cdef _session_call call
+        cdef int rc
+        _check_window_sizes(window_size, packet_size, 0)
+        IF not EMBEDDED_LIB:
+            if window_size != c_ssh2.LIBSSH2_CHANNEL_WINDOW_DEFAULT or \
+                    packet_size != c_ssh2.LIBSSH2_CHANNEL_PACKET_DEFAULT:
+                raise NotImplementedError(
+                    "SFTP window and packet sizes need the embedded libssh2")
         with nogil:
-            _sftp = c_sftp.libssh2_sftp_init(self._session)
+            session_lock(&self._state, &call, &self._state.lock.op)
+            _sftp = _sftp_init(self._session, window_size, packet_size)
+            while session_again_ptr(&self._state, &call, _sftp, &rc):
+                _sftp = _sftp_init(self._session, window_size, packet_size)
         if _sftp is NULL:
-            return handle_error_codes(c_ssh2.libssh2_session_last_errno(
-                self._session))
+            return handle_error_codes(rc)
         return PySFTP(_sftp, self)
 
     def last_error(self, size_t msg_size=1024):
@@ -477,11 +1586,10 @@ cdef class Session:
 
         :rtype: str
         """
-        cdef char *_error_msg
+        cdef char *_error_msg = NULL
         cdef bytes msg = b''
         cdef int errmsg_len = 0
         with nogil:
-            _error_msg = <char *>PyMem_RawMalloc(sizeof(char) * msg_size)
             c_ssh2.libssh2_session_last_error(
                 self._session, &_error_msg, &errmsg_len, 1)
         try:
@@ -489,7 +1597,8 @@ cdef class Session:
                 msg = _error_msg[:errmsg_len]
             return msg
         finally:
-            PyMem_RawFree(_error_msg)
+            # Allocated by libssh2 with the session's allocator
+            c_ssh2.libssh2_free(self._session, _error_msg)
 
     def last_errno(self):
         """Retrieve last error number from libssh2, if any.
@@ -528,12 +1637,17 @@ cdef class Session:
             cdef bytes b_path = to_bytes(path)
             cdef char *_path = b_path
             cdef c_ssh2.LIBSSH2_CHANNEL *channel
+            cdef _session_call call
+            cdef int rc
             with nogil:
+                session_lock(&self._state, &call, &self._state.lock.op)
                 channel = c_ssh2.libssh2_scp_recv2(
-                    self._session, _path, fileinfo._stat)
+                    self._session, _path, &fileinfo._stat)
+                while session_again_ptr(&self._state, &call, channel, &rc):
+                    channel = c_ssh2.libssh2_scp_recv2(
+                        self._session, _path, &fileinfo._stat)
             if channel is NULL:
-                return handle_error_codes(c_ssh2.libssh2_session_last_errno(
-                    self._session))
+                return handle_error_codes(rc)
             return PyChannel(channel, self), fileinfo
 
     def scp_send(self, path not None, int mode, size_t size):
@@ -550,12 +1664,17 @@ cdef class Session:
         cdef bytes b_path = to_bytes(path)
         cdef char *_path = b_path
         cdef c_ssh2.LIBSSH2_CHANNEL *channel
+        cdef _session_call call
+        cdef int rc
         with nogil:
+            session_lock(&self._state, &call, &self._state.lock.op)
             channel = c_ssh2.libssh2_scp_send(
                 self._session, _path, mode, size)
+            while session_again_ptr(&self._state, &call, channel, &rc):
+                channel = c_ssh2.libssh2_scp_send(
+                    self._session, _path, mode, size)
         if channel is NULL:
-            return handle_error_codes(c_ssh2.libssh2_session_last_errno(
-                self._session))
+            return handle_error_codes(rc)
         return PyChannel(channel, self)
 
     def scp_send64(self, path not None, int mode, c_ssh2.libssh2_uint64_t size,
@@ -573,12 +1692,17 @@ cdef class Session:
         cdef bytes b_path = to_bytes(path)
         cdef char *_path = b_path
         cdef c_ssh2.LIBSSH2_CHANNEL *channel
+        cdef _session_call call
+        cdef int rc
         with nogil:
+            session_lock(&self._state, &call, &self._state.lock.op)
             channel = c_ssh2.libssh2_scp_send64(
                 self._session, _path, mode, size, mtime, atime)
+            while session_again_ptr(&self._state, &call, channel, &rc):
+                channel = c_ssh2.libssh2_scp_send64(
+                    self._session, _path, mode, size, mtime, atime)
         if channel is NULL:
-            return handle_error_codes(c_ssh2.libssh2_session_last_errno(
-                self._session))
+            return handle_error_codes(rc)
         return PyChannel(channel, self)
 
     def publickey_init(self):
@@ -630,6 +1754,30 @@ cdef class Session:
         key = _key[:key_len]
         return key, key_type
 
+    def verify_host_key(self, host not None, int port,
+                        HostKeyVerifier verifier not None):
+        """Verify this session's server host key against known hosts.
+
+        Must be called after :py:func:`Session.handshake`.
+
+        :param host: Host name or address the session is connected to.
+        :type host: str
+        :param port: Port the session is connected to, ``-1`` to check the
+          host name only.
+        :type port: int
+        :param verifier: Host key verifier to use, for example the process
+          wide one from :py:func:`ssh2.knownhost.get_verifier`.
+        :type verifier: :py:class:`ssh2.knownhost.HostKeyVerifier`
+
+        :raises: :py:class:`ssh2.exceptions.KnownHostCheckMisMatchError` on
+          server host key not matching known host key.
+        :raises: :py:class:`ssh2.exceptions.KnownHostCheckNotFoundError` on
+          host not found in known hosts.
+
+        :rtype: :py:class:`ssh2.knownhost.KnownHostStoreEntry`"""
+        key, key_type = self.hostkey()
+        return verifier.verify(to_bytes(host), port, key, key_type)
+
     def knownhost_init(self):
         """Initialise a collection of known hosts for this session.
 
@@ -663,8 +1811,12 @@ cdef class Session:
         :rtype: int"""
         cdef int seconds = 0
         cdef int c_seconds = 0
+        cdef _session_call call
         cdef int rc
         with nogil:
+            session_lock(&self._state, &call, NULL)
             rc = c_ssh2.libssh2_keepalive_send(self._session, &c_seconds)
+            while session_again(&self._state, &call, &rc):
+                rc = c_ssh2.libssh2_keepalive_send(self._session, &c_seconds)
         handle_error_codes(rc)
         return c_seconds
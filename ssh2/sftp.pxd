@@ -18,6 +18,7 @@ from ssh2.session cimport Session
 
 from ssh2 cimport c_ssh2
 from ssh2 cimport c_sftp
+from ssh2 cimport c_pthread
 
 
 cdef object PySFTP(c_sftp.LIBSSH2_SFTP *sftp, Session session)
@@ -26,3 +27,6 @@ cdef object PySFTP(c_sftp.LIBSSH2_SFTP *sftp, Session session)
 cdef class SFTP:
     cdef c_sftp.LIBSSH2_SFTP *_sftp
     cdef Session _session
+    # Held for the duration of each call, libssh2 keeps the state of
+    # calls that would block per SFTP session
+    cdef c_pthread.pthread_mutex_t _lock
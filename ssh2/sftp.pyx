@@ -75,13 +75,15 @@ ___________________
 
 from cpython.mem cimport PyMem_RawMalloc, PyMem_RawFree
 
-from ssh2.session cimport Session
+from ssh2.session cimport Session, _session_call, session_lock, \
+    session_unlock, session_again, session_again_ptr
 from ssh2.channel cimport Channel, PyChannel
 from ssh2.utils cimport to_bytes, to_str_len, handle_error_codes
 from ssh2.sftp_handle cimport SFTPHandle, PySFTPHandle, SFTPAttributes, SFTPStatVFS
 
 from ssh2 cimport c_ssh2
 from ssh2 cimport c_sftp
+from ssh2 cimport c_pthread
 
 
 # File types
@@ -153,10 +155,17 @@ cdef class SFTP:
     def __cinit__(self, session):
         self._sftp = NULL
         self._session = session
+        c_pthread.pthread_mutex_init(&self._lock, NULL)
 
     def __dealloc__(self):
+        cdef _session_call call
+        cdef int rc
         with nogil:
-            c_sftp.libssh2_sftp_shutdown(self._sftp)
+            session_lock(&self._session._state, &call, &self._lock)
+            rc = c_sftp.libssh2_sftp_shutdown(self._sftp)
+            while session_again(&self._session._state, &call, &rc):
+                rc = c_sftp.libssh2_sftp_shutdown(self._sftp)
+        c_pthread.pthread_mutex_destroy(&self._lock)
 
     @property
     def session(self):
@@ -166,8 +175,11 @@ cdef class SFTP:
     def get_channel(self):
         """Get new channel from the SFTP session"""
         cdef c_ssh2.LIBSSH2_CHANNEL *_channel
+        cdef _session_call call
         with nogil:
+            session_lock(&self._session._state, &call, &self._lock)
             _channel = c_sftp.libssh2_sftp_get_channel(self._sftp)
+            session_unlock(&self._session._state, &call)
         if _channel is NULL:
             return handle_error_codes(c_ssh2.libssh2_session_last_errno(
                 self._session._session))
@@ -178,14 +190,20 @@ cdef class SFTP:
                 unsigned long flags,
                 long mode, int open_type):
         cdef c_sftp.LIBSSH2_SFTP_HANDLE *_handle
+        cdef int rc
         cdef SFTPHandle handle
+        cdef _session_call call
         with nogil:
+            session_lock(&self._session._state, &call, &self._lock)
             _handle = c_sftp.libssh2_sftp_open_ex(
                 self._sftp, filename, filename_len, flags,
                 mode, open_type)
+            while session_again_ptr(&self._session._state, &call, _handle, &rc):
+                _handle = c_sftp.libssh2_sftp_open_ex(
+                    self._sftp, filename, filename_len, flags,
+                    mode, open_type)
         if _handle is NULL:
-            return handle_error_codes(c_ssh2.libssh2_session_last_errno(
-                self._session._session))
+            return handle_error_codes(rc)
         handle = PySFTPHandle(_handle, self)
         return handle
 
@@ -222,14 +240,19 @@ cdef class SFTP:
           file.
         """  # noqa: W605
         cdef c_sftp.LIBSSH2_SFTP_HANDLE *_handle
+        cdef int rc
         cdef bytes b_filename = to_bytes(filename)
         cdef char *_filename = b_filename
+        cdef _session_call call
         with nogil:
+            session_lock(&self._session._state, &call, &self._lock)
             _handle = c_sftp.libssh2_sftp_open(
                 self._sftp, _filename, flags, mode)
+            while session_again_ptr(&self._session._state, &call, _handle, &rc):
+                _handle = c_sftp.libssh2_sftp_open(
+                    self._sftp, _filename, flags, mode)
         if _handle is NULL:
-            return handle_error_codes(c_ssh2.libssh2_session_last_errno(
-                self._session._session))
+            return handle_error_codes(rc)
         return PySFTPHandle(_handle, self)
 
     def opendir(self, path not None):
@@ -244,13 +267,17 @@ cdef class SFTP:
           directory.
         """
         cdef c_sftp.LIBSSH2_SFTP_HANDLE *_handle
+        cdef int rc
         cdef bytes b_path = to_bytes(path)
         cdef char *_path = b_path
+        cdef _session_call call
         with nogil:
+            session_lock(&self._session._state, &call, &self._lock)
             _handle = c_sftp.libssh2_sftp_opendir(self._sftp, _path)
+            while session_again_ptr(&self._session._state, &call, _handle, &rc):
+                _handle = c_sftp.libssh2_sftp_opendir(self._sftp, _path)
         if _handle is NULL:
-            return handle_error_codes(c_ssh2.libssh2_session_last_errno(
-                self._session._session))
+            return handle_error_codes(rc)
         return PySFTPHandle(_handle, self)
 
     def rename_ex(self, const char *source_filename,
@@ -259,10 +286,16 @@ cdef class SFTP:
                   unsigned int dest_filename_len,
                   long flags):
         cdef int rc
+        cdef _session_call call
         with nogil:
+            session_lock(&self._session._state, &call, &self._lock)
             rc = c_sftp.libssh2_sftp_rename_ex(
                 self._sftp, source_filename, source_filename_len,
                 dest_filename, dest_filename_len, flags)
+            while session_again(&self._session._state, &call, &rc):
+                rc = c_sftp.libssh2_sftp_rename_ex(
+                    self._sftp, source_filename, source_filename_len,
+                    dest_filename, dest_filename_len, flags)
         return handle_error_codes(rc)
 
     def rename(self, source_filename not None, dest_filename not None):
@@ -277,9 +310,14 @@ cdef class SFTP:
         cdef bytes b_dest_filename = to_bytes(dest_filename)
         cdef char *_source_filename = b_source_filename
         cdef char *_dest_filename = b_dest_filename
+        cdef _session_call call
         with nogil:
+            session_lock(&self._session._state, &call, &self._lock)
             rc = c_sftp.libssh2_sftp_rename(
                 self._sftp, _source_filename, _dest_filename)
+            while session_again(&self._session._state, &call, &rc):
+                rc = c_sftp.libssh2_sftp_rename(
+                    self._sftp, _source_filename, _dest_filename)
         return handle_error_codes(rc)
 
     def unlink(self, filename not None):
@@ -290,8 +328,12 @@ cdef class SFTP:
         cdef int rc
         cdef bytes b_filename = to_bytes(filename)
         cdef char *_filename = b_filename
+        cdef _session_call call
         with nogil:
+            session_lock(&self._session._state, &call, &self._lock)
             rc = c_sftp.libssh2_sftp_unlink(self._sftp, _filename)
+            while session_again(&self._session._state, &call, &rc):
+                rc = c_sftp.libssh2_sftp_unlink(self._sftp, _filename)
         return handle_error_codes(rc)
 
     def statvfs(self, path):
@@ -302,9 +344,14 @@ cdef class SFTP:
         cdef bytes b_path = to_bytes(path)
         cdef char *_path = b_path
         cdef size_t path_len = len(b_path)
+        cdef _session_call call
         with nogil:
+            session_lock(&self._session._state, &call, &self._lock)
             rc = c_sftp.libssh2_sftp_statvfs(
-                self._sftp, _path, path_len, vfs._ptr)
+                self._sftp, _path, path_len, &vfs._statvfs)
+            while session_again(&self._session._state, &call, &rc):
+                rc = c_sftp.libssh2_sftp_statvfs(
+                    self._sftp, _path, path_len, &vfs._statvfs)
         return handle_error_codes(rc) if rc != 0 else vfs
 
     def mkdir(self, path not None, long mode):
@@ -322,8 +369,12 @@ cdef class SFTP:
         cdef int rc
         cdef bytes b_path = to_bytes(path)
         cdef char *_path = b_path
+        cdef _session_call call
         with nogil:
+            session_lock(&self._session._state, &call, &self._lock)
             rc = c_sftp.libssh2_sftp_mkdir(self._sftp, _path, mode)
+            while session_again(&self._session._state, &call, &rc):
+                rc = c_sftp.libssh2_sftp_mkdir(self._sftp, _path, mode)
         return handle_error_codes(rc)
 
     def rmdir(self, path not None):
@@ -336,8 +387,12 @@ cdef class SFTP:
         cdef int rc
         cdef bytes b_path = to_bytes(path)
         cdef char *_path = b_path
+        cdef _session_call call
         with nogil:
+            session_lock(&self._session._state, &call, &self._lock)
             rc = c_sftp.libssh2_sftp_rmdir(self._sftp, _path)
+            while session_again(&self._session._state, &call, &rc):
+                rc = c_sftp.libssh2_sftp_rmdir(self._sftp, _path)
         return handle_error_codes(rc)
 
     def stat(self, path not None):
@@ -352,9 +407,14 @@ cdef class SFTP:
         cdef bytes b_path = to_bytes(path)
         cdef char *_path = b_path
         cdef SFTPAttributes attrs = SFTPAttributes()
+        cdef _session_call call
         with nogil:
+            session_lock(&self._session._state, &call, &self._lock)
             rc = c_sftp.libssh2_sftp_stat(
-                self._sftp, _path, attrs._attrs)
+                self._sftp, _path, &attrs._attrs)
+            while session_again(&self._session._state, &call, &rc):
+                rc = c_sftp.libssh2_sftp_stat(
+                    self._sftp, _path, &attrs._attrs)
         return handle_error_codes(rc) if rc != 0 else attrs
 
     def lstat(self, path not None):
@@ -363,9 +423,14 @@ cdef class SFTP:
         cdef bytes b_path = to_bytes(path)
         cdef char *_path = b_path
         cdef SFTPAttributes attrs = SFTPAttributes()
+        cdef _session_call call
         with nogil:
+            session_lock(&self._session._state, &call, &self._lock)
             rc = c_sftp.libssh2_sftp_lstat(
-                self._sftp, _path, attrs._attrs)
+                self._sftp, _path, &attrs._attrs)
+            while session_again(&self._session._state, &call, &rc):
+                rc = c_sftp.libssh2_sftp_lstat(
+                    self._sftp, _path, &attrs._attrs)
         return handle_error_codes(rc) if rc != 0 else attrs
 
     def setstat(self, path not None, SFTPAttributes attrs):
@@ -380,9 +445,14 @@ cdef class SFTP:
         cdef int rc
         cdef bytes b_path = to_bytes(path)
         cdef char *_path = b_path
+        cdef _session_call call
         with nogil:
+            session_lock(&self._session._state, &call, &self._lock)
             rc = c_sftp.libssh2_sftp_setstat(
-                self._sftp, _path, attrs._attrs)
+                self._sftp, _path, &attrs._attrs)
+            while session_again(&self._session._state, &call, &rc):
+                rc = c_sftp.libssh2_sftp_setstat(
+                    self._sftp, _path, &attrs._attrs)
         return handle_error_codes(rc)
 
     def symlink(self, path not None, target not None):
@@ -399,8 +469,12 @@ cdef class SFTP:
         cdef char *_path = b_path
         cdef bytes b_target = to_bytes(target)
         cdef char *_target = b_target
+        cdef _session_call call
         with nogil:
+            session_lock(&self._session._state, &call, &self._lock)
             rc = c_sftp.libssh2_sftp_symlink(self._sftp, _path, _target)
+            while session_again(&self._session._state, &call, &rc):
+                rc = c_sftp.libssh2_sftp_symlink(self._sftp, _path, _target)
         return handle_error_codes(rc)
 
     def realpath(self, path not None, size_t max_len=256):
@@ -416,6 +490,7 @@ cdef class SFTP:
         :raises: :py:class:`ssh2.exceptions.SFTPBufferTooSmall` on max_len less
           than real path length."""
         cdef char *_target = <char *>PyMem_RawMalloc(sizeof(char)*max_len)
+        cdef _session_call call
         if _target is NULL:
             raise MemoryError
         cdef int rc
@@ -423,8 +498,12 @@ cdef class SFTP:
         cdef char *_path = b_path
         try:
             with nogil:
+                session_lock(&self._session._state, &call, &self._lock)
                 rc = c_sftp.libssh2_sftp_realpath(
                     self._sftp, _path, _target, max_len)
+                while session_again(&self._session._state, &call, &rc):
+                    rc = c_sftp.libssh2_sftp_realpath(
+                        self._sftp, _path, _target, max_len)
                 if rc < 0:
                     with gil:
                         return handle_error_codes(rc)
@@ -437,6 +516,9 @@ cdef class SFTP:
 
         :rtype: int"""
         cdef unsigned long rc
+        cdef _session_call call
         with nogil:
+            session_lock(&self._session._state, &call, &self._lock)
             rc = c_sftp.libssh2_sftp_last_error(self._sftp)
+            session_unlock(&self._session._state, &call)
         return rc
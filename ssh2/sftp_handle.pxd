@@ -17,6 +17,7 @@
 from ssh2.sftp cimport SFTP
 
 from ssh2 cimport c_sftp
+from ssh2.utils cimport scratch_buffer
 
 
 cdef object PySFTPHandle(c_sftp.LIBSSH2_SFTP_HANDLE *handle, SFTP sftp)
@@ -26,12 +27,15 @@ cdef class SFTPHandle:
     cdef c_sftp.LIBSSH2_SFTP_HANDLE *_handle
     cdef SFTP _sftp
     cdef bint closed
+    cdef scratch_buffer _scratch
+    # Size returned by the last read, to tell bulk reads from short ones
+    cdef size_t _last_read
 
 
 cdef class SFTPAttributes:
-    cdef c_sftp.LIBSSH2_SFTP_ATTRIBUTES *_attrs
+    cdef c_sftp.LIBSSH2_SFTP_ATTRIBUTES _attrs
 
 
 cdef class SFTPStatVFS:
-    cdef c_sftp.LIBSSH2_SFTP_STATVFS *_ptr
+    cdef c_sftp.LIBSSH2_SFTP_STATVFS _statvfs
     cdef object _sftp_ref
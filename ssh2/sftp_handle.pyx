@@ -17,13 +17,24 @@
 
 """SFTP handle, attributes and stat VFS classes."""
 
-from cpython.mem cimport PyMem_RawMalloc, PyMem_RawFree
-
-from ssh2.utils cimport handle_error_codes
+from cpython.buffer cimport PyObject_GetBuffer, PyBuffer_Release, PyBUF_WRITABLE
+from cpython.bytes cimport PyBytes_AS_STRING
+from cpython.ref cimport PyObject, Py_XDECREF
+from ssh2.utils cimport handle_error_codes, scratch_acquire, scratch_release, \
+    scratch_clear, new_bytes, finish_bytes
+from ssh2.session cimport _session_call, session_lock, session_unlock, \
+    session_again, session_again_size, session_blocking
 
 from ssh2 cimport c_ssh2
 from ssh2 cimport c_sftp
 
+cimport cython
+
+
+# Returned as is on EAGAIN so that retrying a read allocates nothing
+cdef object _EAGAIN = c_ssh2.LIBSSH2_ERROR_EAGAIN
+cdef tuple _EAGAIN_READ = (c_ssh2.LIBSSH2_ERROR_EAGAIN, b'')
+
 
 cdef object PySFTPHandle(c_sftp.LIBSSH2_SFTP_HANDLE *handle, SFTP sftp):
     cdef SFTPHandle _handle = SFTPHandle.__new__(SFTPHandle, sftp)
@@ -31,27 +42,11 @@ cdef object PySFTPHandle(c_sftp.LIBSSH2_SFTP_HANDLE *handle, SFTP sftp):
     return _handle
 
 
+# Created per directory entry and stat call - the C struct is stored inline
+# and freed objects are kept for re-use
+@cython.freelist(256)
 cdef class SFTPAttributes:
 
-    def __cinit__(self):
-        with nogil:
-            self._attrs = <c_sftp.LIBSSH2_SFTP_ATTRIBUTES *>PyMem_RawMalloc(
-                sizeof(c_sftp.LIBSSH2_SFTP_ATTRIBUTES))
-            if self._attrs is NULL:
-                with gil:
-                    raise MemoryError
-            self._attrs.flags = 0
-            self._attrs.filesize = 0
-            self._attrs.uid = 0
-            self._attrs.gid = 0
-            self._attrs.permissions = 0
-            self._attrs.atime = 0
-            self._attrs.mtime = 0
-
-    def __dealloc__(self):
-        with nogil:
-            PyMem_RawFree(self._attrs)
-
     @property
     def flags(self):
         return self._attrs.flags
@@ -117,10 +112,17 @@ cdef class SFTPHandle:
         self.closed = 0
 
     def __dealloc__(self):
+        cdef _session_call call
+        cdef int rc
         if self.closed == 0:
             with nogil:
-                c_sftp.libssh2_sftp_close_handle(self._handle)
+                session_lock(&self._sftp._session._state, &call,
+                             &self._sftp._lock)
+                rc = c_sftp.libssh2_sftp_close_handle(self._handle)
+                while session_again(&self._sftp._session._state, &call, &rc):
+                    rc = c_sftp.libssh2_sftp_close_handle(self._handle)
             self.closed = 1
+        scratch_clear(&self._scratch)
 
     def __iter__(self):
         return self
@@ -145,12 +147,19 @@ cdef class SFTPHandle:
 
         :rtype: int"""
         cdef int rc
-        if self.closed == 0:
-            with nogil:
-                rc = c_sftp.libssh2_sftp_close_handle(self._handle)
+        cdef _session_call call
+        # Only one of the threads closing a handle at the same time closes it
+        with cython.critical_section(self):
+            if self.closed:
+                return
             self.closed = 1
-        else:
-            return
+        with nogil:
+            session_lock(&self._sftp._session._state, &call,
+                         &self._sftp._lock)
+            rc = c_sftp.libssh2_sftp_close_handle(self._handle)
+            while session_again(&self._sftp._session._state, &call, &rc):
+                rc = c_sftp.libssh2_sftp_close_handle(self._handle)
+        scratch_clear(&self._scratch)
         return rc
 
     def read(self, size_t buffer_maxlen=c_ssh2.LIBSSH2_CHANNEL_WINDOW_DEFAULT):
@@ -163,20 +172,120 @@ cdef class SFTPHandle:
         cdef ssize_t rc
         cdef bytes buf = b''
         cdef char *cbuf
-        with nogil:
-            cbuf = <char *>PyMem_RawMalloc(sizeof(char)*buffer_maxlen)
-            if cbuf is NULL:
-                with gil:
-                    raise MemoryError
-            rc = c_sftp.libssh2_sftp_read(
-                self._handle, cbuf, buffer_maxlen)
-        try:
+        cdef PyObject *raw
+        cdef _session_call call
+        # libssh2 sizes its read-ahead by buffer_maxlen, so the read gets all
+        # of it even though it returns what has arrived so far, often much
+        # less. Reads go straight into the returned bytes only while they
+        # fill the buffer, and otherwise through the scratch buffer.
+        if session_blocking(&self._sftp._session._state) and \
+                self._last_read >= buffer_maxlen // 2:
+            raw = new_bytes(buffer_maxlen)
+            cbuf = PyBytes_AS_STRING(<object>raw)
+            with nogil:
+                session_lock(&self._sftp._session._state, &call,
+                             &self._sftp._lock)
+                rc = c_sftp.libssh2_sftp_read(
+                    self._handle, cbuf, buffer_maxlen)
+                while session_again_size(
+                        &self._sftp._session._state, &call, &rc):
+                    rc = c_sftp.libssh2_sftp_read(
+                        self._handle, cbuf, buffer_maxlen)
             if rc > 0:
-                buf = cbuf[:rc]
-        finally:
-            PyMem_RawFree(cbuf)
+                buf = finish_bytes(raw, rc)
+            else:
+                Py_XDECREF(raw)
+        else:
+            cbuf = scratch_acquire(&self._scratch, buffer_maxlen)
+            if cbuf is NULL:
+                raise MemoryError
+            with nogil:
+                session_lock(&self._sftp._session._state, &call,
+                             &self._sftp._lock)
+                rc = c_sftp.libssh2_sftp_read(
+                    self._handle, cbuf, buffer_maxlen)
+                while session_again_size(
+                        &self._sftp._session._state, &call, &rc):
+                    rc = c_sftp.libssh2_sftp_read(
+                        self._handle, cbuf, buffer_maxlen)
+            try:
+                if rc > 0:
+                    buf = cbuf[:rc]
+            finally:
+                scratch_release(&self._scratch, cbuf)
+        if rc == c_ssh2.LIBSSH2_ERROR_EAGAIN:
+            return _EAGAIN_READ
+        elif rc >= 0:
+            self._last_read = rc
+        if rc == 0:
+            # End of file, do not hold on to the buffer
+            scratch_clear(&self._scratch)
         return rc, buf
 
+    def read_into(self, buffer not None):
+        """Read from file handle into a writable buffer.
+
+        Allocation free alternative to :py:func:`read` for non-blocking
+        clients - neither a bytes object nor a tuple is created, including on
+        ``LIBSSH2_ERROR_EAGAIN``.
+
+        :param buffer: Writable contiguous buffer, for example a
+          ``bytearray`` or a ``memoryview`` of one.
+
+        :returns: Number of bytes written to ``buffer``, zero on end of file
+          or negative error code.
+        :rtype: int"""
+        cdef Py_buffer view
+        cdef ssize_t rc
+        cdef _session_call call
+        PyObject_GetBuffer(buffer, &view, PyBUF_WRITABLE)
+        with nogil:
+            session_lock(&self._sftp._session._state, &call, &self._sftp._lock)
+            rc = c_sftp.libssh2_sftp_read(
+                self._handle, <char *>view.buf, view.len)
+            while session_again_size(&self._sftp._session._state, &call, &rc):
+                rc = c_sftp.libssh2_sftp_read(
+                    self._handle, <char *>view.buf, view.len)
+        PyBuffer_Release(&view)
+        if rc == c_ssh2.LIBSSH2_ERROR_EAGAIN:
+            return _EAGAIN
+        elif rc < 0:
+            handle_error_codes(rc)
+        return rc
+
+    def readdir_into(self, buffer not None, SFTPAttributes attrs not None):
+        """Read next directory entry into a writable buffer.
+
+        Allocation free alternative to :py:func:`readdir` for non-blocking
+        clients. The file name is written to ``buffer`` and the entry's
+        attributes to ``attrs``, which can be re-used for every entry.
+
+        File handle *must* be opened with :py:func:`ssh2.sftp.SFTP.opendir()`
+
+        :param buffer: Writable contiguous buffer, for example a
+          ``bytearray`` or a ``memoryview`` of one.
+        :param attrs: Attributes object to fill in.
+        :type attrs: :py:class:`SFTPAttributes`
+
+        :returns: Length of file name written to ``buffer``, zero when there
+          are no more entries or negative error code.
+        :rtype: int"""
+        cdef Py_buffer view
+        cdef int rc
+        cdef _session_call call
+        PyObject_GetBuffer(buffer, &view, PyBUF_WRITABLE)
+        with nogil:
+            session_lock(&self._sftp._session._state, &call, &self._sftp._lock)
+            rc = c_sftp.libssh2_sftp_readdir(
+                self._handle, <char *>view.buf, view.len, &attrs._attrs)
+            while session_again(&self._sftp._session._state, &call, &rc):
+                rc = c_sftp.libssh2_sftp_readdir(
+                    self._handle, <char *>view.buf, view.len, &attrs._attrs)
+        PyBuffer_Release(&view)
+        if rc == c_ssh2.LIBSSH2_ERROR_EAGAIN:
+            return _EAGAIN
+        return handle_error_codes(rc)
+
     def readdir_ex(self,
                    size_t longentry_maxlen=1024,
                    size_t buffer_maxlen=1024):
@@ -205,25 +314,30 @@ cdef class SFTPHandle:
                     size_t buffer_maxlen=1024):
         cdef bytes buf = b''
         cdef bytes b_longentry = b''
-        cdef char *cbuf
+        cdef char *cbuf = scratch_acquire(
+            &self._scratch, buffer_maxlen + longentry_maxlen)
         cdef char *longentry
         cdef SFTPAttributes attrs = SFTPAttributes()
+        cdef _session_call call
+        cdef int rc
+        if cbuf is NULL:
+            raise MemoryError
+        longentry = cbuf + buffer_maxlen
         with nogil:
-            cbuf = <char *>PyMem_RawMalloc(sizeof(char)*buffer_maxlen)
-            longentry = <char *>PyMem_RawMalloc(sizeof(char)*longentry_maxlen)
-            if cbuf is NULL or longentry is NULL:
-                with gil:
-                    raise MemoryError
+            session_lock(&self._sftp._session._state, &call, &self._sftp._lock)
             rc = c_sftp.libssh2_sftp_readdir_ex(
                 self._handle, cbuf, buffer_maxlen, longentry,
-                longentry_maxlen, attrs._attrs)
+                longentry_maxlen, &attrs._attrs)
+            while session_again(&self._sftp._session._state, &call, &rc):
+                rc = c_sftp.libssh2_sftp_readdir_ex(
+                    self._handle, cbuf, buffer_maxlen, longentry,
+                    longentry_maxlen, &attrs._attrs)
         try:
             if rc > 0:
                 buf = cbuf[:rc]
                 b_longentry = longentry
         finally:
-            PyMem_RawFree(cbuf)
-            PyMem_RawFree(longentry)
+            scratch_release(&self._scratch, cbuf)
         return rc, buf, b_longentry, attrs
 
     def readdir(self, size_t buffer_maxlen=1024):
@@ -244,20 +358,24 @@ cdef class SFTPHandle:
     def _readdir(self,
                  size_t buffer_maxlen=1024):
         cdef bytes buf = b''
-        cdef char *cbuf
+        cdef char *cbuf = scratch_acquire(&self._scratch, buffer_maxlen)
         cdef SFTPAttributes attrs = SFTPAttributes()
+        cdef _session_call call
+        cdef int rc
+        if cbuf is NULL:
+            raise MemoryError
         with nogil:
-            cbuf = <char *>PyMem_RawMalloc(sizeof(char)*buffer_maxlen)
-            if cbuf is NULL:
-                with gil:
-                    raise MemoryError
+            session_lock(&self._sftp._session._state, &call, &self._sftp._lock)
             rc = c_sftp.libssh2_sftp_readdir(
-                self._handle, cbuf, buffer_maxlen, attrs._attrs)
+                self._handle, cbuf, buffer_maxlen, &attrs._attrs)
+            while session_again(&self._sftp._session._state, &call, &rc):
+                rc = c_sftp.libssh2_sftp_readdir(
+                    self._handle, cbuf, buffer_maxlen, &attrs._attrs)
         try:
             if rc > 0:
                 buf = cbuf[:rc]
         finally:
-            PyMem_RawFree(cbuf)
+            scratch_release(&self._scratch, cbuf)
         return rc, buf, attrs
 
     def write(self, bytes buf):
@@ -283,9 +401,15 @@ cdef class SFTPHandle:
         cdef size_t bytes_written = 0
         cdef char *cbuf = buf
         cdef ssize_t rc = 0
+        cdef _session_call call
         with nogil:
             while _size > 0:
+                session_lock(&self._sftp._session._state, &call,
+                             &self._sftp._lock)
                 rc = c_sftp.libssh2_sftp_write(self._handle, cbuf, _size)
+                while session_again_size(
+                        &self._sftp._session._state, &call, &rc):
+                    rc = c_sftp.libssh2_sftp_write(self._handle, cbuf, _size)
                 if rc < 0 and rc != c_ssh2.LIBSSH2_ERROR_EAGAIN:
                     # Error we cannot resume from, exception will be raised
                     with gil:
@@ -305,8 +429,13 @@ cdef class SFTPHandle:
 
             :rtype: int"""
             cdef int rc
+            cdef _session_call call
             with nogil:
+                session_lock(&self._sftp._session._state, &call,
+                             &self._sftp._lock)
                 rc = c_sftp.libssh2_sftp_fsync(self._handle)
+                while session_again(&self._sftp._session._state, &call, &rc):
+                    rc = c_sftp.libssh2_sftp_fsync(self._handle)
             return handle_error_codes(rc)
 
     def seek(self, size_t offset):
@@ -318,8 +447,11 @@ cdef class SFTPHandle:
         :type offset: int
 
         :rtype: None"""
+        cdef _session_call call
         with nogil:
+            session_lock(&self._sftp._session._state, &call, &self._sftp._lock)
             c_sftp.libssh2_sftp_seek(self._handle, offset)
+            session_unlock(&self._sftp._session._state, &call)
 
     def seek64(self, c_ssh2.libssh2_uint64_t offset):
         """Seek file to given 64-bit offset.
@@ -328,15 +460,21 @@ cdef class SFTPHandle:
         :type offset: int
 
         :rtype: None"""
+        cdef _session_call call
         with nogil:
+            session_lock(&self._sftp._session._state, &call, &self._sftp._lock)
             c_sftp.libssh2_sftp_seek64(self._handle, offset)
+            session_unlock(&self._sftp._session._state, &call)
 
     def rewind(self):
         """Rewind file handle to beginning of file.
 
         :rtype: None"""
+        cdef _session_call call
         with nogil:
+            session_lock(&self._sftp._session._state, &call, &self._sftp._lock)
             c_sftp.libssh2_sftp_rewind(self._handle)
+            session_unlock(&self._sftp._session._state, &call)
 
     def tell(self):
         """Deprecated, use tell64.
@@ -345,8 +483,11 @@ cdef class SFTPHandle:
 
         :rtype: int"""
         cdef size_t rc
+        cdef _session_call call
         with nogil:
+            session_lock(&self._sftp._session._state, &call, &self._sftp._lock)
             rc = c_sftp.libssh2_sftp_tell(self._handle)
+            session_unlock(&self._sftp._session._state, &call)
         return handle_error_codes(rc)
 
     def tell64(self):
@@ -354,17 +495,25 @@ cdef class SFTPHandle:
 
         :rtype: int"""
         cdef c_ssh2.libssh2_uint64_t rc
+        cdef _session_call call
         with nogil:
+            session_lock(&self._sftp._session._state, &call, &self._sftp._lock)
             rc = c_sftp.libssh2_sftp_tell(self._handle)
+            session_unlock(&self._sftp._session._state, &call)
         return handle_error_codes(rc)
 
     def fstat_ex(self, SFTPAttributes attrs, int setstat):
         """Get or set file attributes. Clients would typically use one of the
         fstat or fsetstat functions instead"""
         cdef int rc
+        cdef _session_call call
         with nogil:
+            session_lock(&self._sftp._session._state, &call, &self._sftp._lock)
             rc = c_sftp.libssh2_sftp_fstat_ex(
-                self._handle, attrs._attrs, setstat)
+                self._handle, &attrs._attrs, setstat)
+            while session_again(&self._sftp._session._state, &call, &rc):
+                rc = c_sftp.libssh2_sftp_fstat_ex(
+                    self._handle, &attrs._attrs, setstat)
         return handle_error_codes(rc)
 
     def fstat(self):
@@ -373,8 +522,12 @@ cdef class SFTPHandle:
         :rtype: tuple(int, :py:class:`ssh2.sftp.SFTPAttributes`)"""
         cdef int rc
         cdef SFTPAttributes attrs = SFTPAttributes()
+        cdef _session_call call
         with nogil:
-            rc = c_sftp.libssh2_sftp_fstat(self._handle, attrs._attrs)
+            session_lock(&self._sftp._session._state, &call, &self._sftp._lock)
+            rc = c_sftp.libssh2_sftp_fstat(self._handle, &attrs._attrs)
+            while session_again(&self._sftp._session._state, &call, &rc):
+                rc = c_sftp.libssh2_sftp_fstat(self._handle, &attrs._attrs)
         if rc != 0:
             return handle_error_codes(rc)
         return attrs
@@ -385,8 +538,12 @@ cdef class SFTPHandle:
         :param attrs: Attributes to set.
         :type attrs: :py:class:`ssh2.sftp.SFTPAttributes`"""
         cdef int rc
+        cdef _session_call call
         with nogil:
-            rc = c_sftp.libssh2_sftp_fsetstat(self._handle, attrs._attrs)
+            session_lock(&self._sftp._session._state, &call, &self._sftp._lock)
+            rc = c_sftp.libssh2_sftp_fsetstat(self._handle, &attrs._attrs)
+            while session_again(&self._sftp._session._state, &call, &rc):
+                rc = c_sftp.libssh2_sftp_fsetstat(self._handle, &attrs._attrs)
         return handle_error_codes(rc)
 
     def fstatvfs(self):
@@ -395,85 +552,68 @@ cdef class SFTPHandle:
         :rtype: `ssh2.sftp.SFTPStatVFS`"""
         cdef SFTPStatVFS vfs = SFTPStatVFS(self)
         cdef int rc
+        cdef _session_call call
         with nogil:
-            rc = c_sftp.libssh2_sftp_fstatvfs(self._handle, vfs._ptr)
+            session_lock(&self._sftp._session._state, &call, &self._sftp._lock)
+            rc = c_sftp.libssh2_sftp_fstatvfs(self._handle, &vfs._statvfs)
+            while session_again(&self._sftp._session._state, &call, &rc):
+                rc = c_sftp.libssh2_sftp_fstatvfs(self._handle, &vfs._statvfs)
         if rc != 0:
             return handle_error_codes(rc)
         return vfs
 
 
+@cython.freelist(8)
 cdef class SFTPStatVFS:
     """File system statistics"""
 
     def __cinit__(self, _sftp_ref):
         self._sftp_ref = _sftp_ref
-        with nogil:
-            self._ptr = <c_sftp.LIBSSH2_SFTP_STATVFS *>PyMem_RawMalloc(
-                sizeof(c_sftp.LIBSSH2_SFTP_STATVFS))
-            if self._ptr is NULL:
-                with gil:
-                    raise MemoryError
-            self._ptr.f_bsize = 0
-            self._ptr.f_frsize = 0
-            self._ptr.f_blocks = 0
-            self._ptr.f_bfree = 0
-            self._ptr.f_bavail = 0
-            self._ptr.f_files = 0
-            self._ptr.f_ffree = 0
-            self._ptr.f_favail = 0
-            self._ptr.f_fsid = 0
-            self._ptr.f_flag = 0
-            self._ptr.f_namemax = 0
-
-    def __dealloc__(self):
-        with nogil:
-            if self._ptr is not NULL:
-                PyMem_RawFree(self._ptr)
 
     @property
     def f_bsize(self):
         """File system block size"""
-        return self._ptr.f_bsize
+        return self._statvfs.f_bsize
 
     @property
     def f_frsize(self):
         """Fragment size"""
-        return self._ptr.f_frsize
+        return self._statvfs.f_frsize
 
     @property
     def f_blocks(self):
         """Size of fs in f_frsize units"""
-        return self._ptr.f_blocks
+        return self._statvfs.f_blocks
 
     @property
     def f_bfree(self):
         """Free blocks"""
-        return self._ptr.f_bfree
+        return self._statvfs.f_bfree
 
     @property
     def f_bavail(self):
         """Free blocks for non-root"""
-        return self._ptr.f_bavail
+        return self._statvfs.f_bavail
 
     @property
     def f_files(self):
         """Inodes"""
-        return self._ptr.f_files
+        return self._statvfs.f_files
 
     @property
     def f_ffree(self):
         """Free inodes"""
-        return self._ptr.f_ffree
+        return self._statvfs.f_ffree
 
     @property
     def f_favail(self):
         """Free inodes for non-root"""
-        return self._ptr.f_favail
+        return self._statvfs.f_favail
 
     @property
     def f_fsid(self):
         """File system ID"""
-        return self._ptr.f_fsid
+        return self._statvfs.f_fsid
 
     @property
     def f_flag(self):
@@ -481,9 +621,9 @@ cdef class SFTPStatVFS:
 
         This property is a bit mask with defined bits
         ``LIBSSH2_SFTP_ST_RDONLY`` and ``LIBSSH2_SFTP_ST_NOSUID``"""
-        return self._ptr.f_flag
+        return self._statvfs.f_flag
 
     @property
     def f_namemax(self):
         """Maximum filename length"""
-        return self._ptr.f_namemax
+        return self._statvfs.f_namemax
@@ -19,4 +19,4 @@ from ssh2.c_stat cimport struct_stat
 
 cdef class StatInfo:
     """Representation of stat structure - older version"""
-    cdef struct_stat* _stat
+    cdef struct_stat _stat
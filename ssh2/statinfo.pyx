@@ -15,24 +15,13 @@
 # License along with this library; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
 
-from cpython.mem cimport PyMem_RawMalloc, PyMem_RawFree
-
-from ssh2.c_stat cimport struct_stat
+cimport cython
 
 
+@cython.freelist(64)
 cdef class StatInfo:
     """Representation of stat structure - libssh2 <1.7 version"""
 
-    def __cinit__(self):
-        with nogil:
-            self._stat = <struct_stat *>PyMem_RawMalloc(sizeof(struct_stat))
-            if self._stat is NULL:
-                with gil:
-                    raise MemoryError
-
-    def __dealloc__(self):
-        PyMem_RawFree(self._stat)
-
     @property
     def st_size(self):
         return self._stat.st_size
@@ -1,4 +1,23 @@
+from cpython.ref cimport PyObject
+
+
 cdef bytes to_bytes(_str)
 cdef object to_str(char *c_str)
 cdef object to_str_len(char *c_str, int length)
 cpdef int handle_error_codes(int errcode) except -1
+cdef double monotonic_time() noexcept nogil
+
+
+# Read buffer kept by a channel or SFTP handle between calls
+cdef struct scratch_buffer:
+    char *data
+    size_t size
+    size_t small_reads
+    int busy
+
+cdef PyObject *new_bytes(Py_ssize_t size) except NULL
+cdef bytes finish_bytes(PyObject *raw, Py_ssize_t size)
+
+cdef char *scratch_acquire(scratch_buffer *scratch, size_t size) noexcept
+cdef void scratch_release(scratch_buffer *scratch, char *buf) noexcept
+cdef void scratch_clear(scratch_buffer *scratch) noexcept
@@ -17,14 +17,42 @@
 
 from select import select
 
+from cpython.mem cimport PyMem_RawMalloc, PyMem_RawFree
+from cpython.ref cimport Py_DECREF
+from posix.time cimport clock_gettime, timespec, CLOCK_MONOTONIC
+
 from ssh2.session cimport Session
 from ssh2 import exceptions
 from ssh2 cimport c_ssh2
 from ssh2 cimport error_codes
 
 
+cdef extern from "Python.h":
+    PyObject *_bytes_new "PyBytes_FromStringAndSize" (
+        const char *v, Py_ssize_t size) except NULL
+    int _bytes_resize "_PyBytes_Resize" (
+        PyObject **string, Py_ssize_t size) except -1
+    Py_ssize_t _bytes_size "PyBytes_GET_SIZE" (PyObject *string)
+
+
+# The GIL does not keep threads apart on free-threaded Python, so the scratch
+# buffer is taken and given back atomically.
+cdef extern from * nogil:
+    """
+    #define _ssh2_scratch_take(busy) __atomic_exchange_n((busy), 1, __ATOMIC_ACQUIRE)
+    #define _ssh2_scratch_give(busy) __atomic_store_n((busy), 0, __ATOMIC_RELEASE)
+    """
+    int _scratch_take "_ssh2_scratch_take" (int *busy)
+    void _scratch_give "_ssh2_scratch_give" (int *busy)
+
+
 ENCODING='utf-8'
 
+# Larger reads use a buffer of their own that is freed after the call
+DEF _SCRATCH_MAX_SIZE = 4 * 1024 * 1024
+# Consecutive reads of a quarter of the buffer or less before it is shrunk
+DEF _SCRATCH_SHRINK_READS = 64
+
 
 cdef bytes to_bytes(_str):
     if isinstance(_str, bytes):
@@ -41,6 +69,79 @@ cdef object to_str_len(char *c_str, int length):
     return c_str[:length].decode(ENCODING)
 
 
+cdef double monotonic_time() noexcept nogil:
+    cdef timespec ts
+    clock_gettime(CLOCK_MONOTONIC, &ts)
+    return ts.tv_sec + ts.tv_nsec / 1e9
+
+
+cdef PyObject *new_bytes(Py_ssize_t size) except NULL:
+    """New bytes object of size with uninitialised contents for reading into.
+
+    Returns a new reference that must be passed to :c:func:`finish_bytes`
+    or released with ``Py_XDECREF``."""
+    return _bytes_new(NULL, size)
+
+
+cdef bytes finish_bytes(PyObject *raw, Py_ssize_t size):
+    """Shrink bytes object from :c:func:`new_bytes` to size, which must be
+    positive, and take over its reference."""
+    cdef bytes buf
+    if size < _bytes_size(raw):
+        _bytes_resize(&raw, size)
+    buf = <bytes>raw
+    Py_DECREF(buf)
+    return buf
+
+
+cdef char *scratch_acquire(scratch_buffer *scratch, size_t size) noexcept:
+    """Get a buffer of at least size bytes, re-using the scratch buffer when
+    possible and no other thread is using it. The buffer must be given back
+    with :c:func:`scratch_release`.
+
+    Returns NULL on allocation failure."""
+    if size > _SCRATCH_MAX_SIZE or _scratch_take(&scratch.busy):
+        return <char *>PyMem_RawMalloc(size)
+    if scratch.data is NULL or size > scratch.size:
+        scratch.small_reads = 0
+    elif size <= scratch.size // 4:
+        scratch.small_reads += 1
+        if scratch.small_reads < _SCRATCH_SHRINK_READS:
+            return scratch.data
+        scratch.small_reads = 0
+    else:
+        scratch.small_reads = 0
+        return scratch.data
+    # Contents need not be kept so free and allocate rather than realloc
+    PyMem_RawFree(scratch.data)
+    scratch.data = <char *>PyMem_RawMalloc(size)
+    if scratch.data is NULL:
+        scratch.size = 0
+        _scratch_give(&scratch.busy)
+        return NULL
+    scratch.size = size
+    return scratch.data
+
+
+cdef void scratch_release(scratch_buffer *scratch, char *buf) noexcept:
+    """Give back a buffer from :c:func:`scratch_acquire`."""
+    if buf is not NULL and buf is scratch.data:
+        _scratch_give(&scratch.busy)
+    else:
+        PyMem_RawFree(buf)
+
+
+cdef void scratch_clear(scratch_buffer *scratch) noexcept:
+    """Free the scratch buffer unless it is in use."""
+    if _scratch_take(&scratch.busy):
+        return
+    PyMem_RawFree(scratch.data)
+    scratch.data = NULL
+    scratch.size = 0
+    scratch.small_reads = 0
+    _scratch_give(&scratch.busy)
+
+
 def version(int required_version=0):
     """Get libssh2 version string.
 
@@ -89,12 +190,11 @@ cpdef int handle_error_codes(int errcode) except -1:
     :param errcode: Error code as returned by
       :py:func:`ssh2.session.Session.last_errno`
     """
-    # Cython generates a C switch from this code - only use equality checks
-    if errcode == 0:
-        return 0
-    elif errcode == error_codes._LIBSSH2_ERROR_EAGAIN:
+    # Success, sizes and EAGAIN return before the switch is reached
+    if errcode >= 0 or errcode == error_codes._LIBSSH2_ERROR_EAGAIN:
         return errcode
-    elif errcode == error_codes._LIBSSH2_ERROR_SOCKET_NONE:
+    # Cython generates a C switch from this code - only use equality checks
+    if errcode == error_codes._LIBSSH2_ERROR_SOCKET_NONE:
         raise exceptions.SSH2Error
     elif errcode == error_codes._LIBSSH2_ERROR_BANNER_RECV:
         raise exceptions.BannerRecvError
@@ -184,6 +284,4 @@ cpdef int handle_error_codes(int errcode) except -1:
         raise exceptions.KeyfileAuthFailed
     else:
         # Switch default
-        if errcode < 0:
-            raise exceptions.UnknownError("Error code %s not known", errcode)
-        return errcode
+        raise exceptions.UnknownError("Error code %s not known", errcode)
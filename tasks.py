@@ -97,6 +97,17 @@ def test(ctx, testfile=None, ls=False):
         ctx.run(f"{PYTHONBIN} -m pytest tests", hide=False, pty=True, in_stream=False)
 
 
+@task
+def bench(ctx, output=None, only=None, quick=False):
+    """Run the benchmark suite against the embedded server. Save JSON results with output."""
+    opts = f" -o {output}" if output else ""
+    if only:
+        opts += f" --only {only}"
+    if quick:
+        opts += " --quick"
+    ctx.run(f"{PYTHONBIN} -m benchmarks run{opts}", hide=False, pty=True, in_stream=False)
+
+
 @task(cleandist)
 def sdist(ctx):
     """Build source distribution."""
@@ -1,10 +1,13 @@
+import time
 from unittest import skipUnless
 
 from .base_test import SSH2TestCase
 
-from ssh2.exceptions import SocketSendError
+from ssh2.exceptions import SocketSendError, Timeout
 from ssh2.session import Session
 from ssh2.channel import Channel
+from ssh2.error_codes import LIBSSH2_ERROR_EAGAIN
+from ssh2.utils import wait_socket
 
 
 class ChannelTestCase(SSH2TestCase):
@@ -161,6 +164,155 @@ class ChannelTestCase(SSH2TestCase):
         self.assertTrue(chan.close() == 0)
         self.assertTrue(chan.wait_eof() == 0)
 
+    def test_window_size(self):
+        self.assertEqual(self._auth(), 0)
+        chan = self.session.open_session()
+        self.assertEqual(chan.receive_window_size, 2 * 1024 * 1024)
+        self.assertEqual(chan.max_window_size, 0)
+        self.assertTrue(chan.rtt > 0)
+        chan = self.session.open_session(window_size=65536, packet_size=16384)
+        self.assertEqual(chan.receive_window_size, 65536)
+        size = 4 * 1024 * 1024
+        chan.execute('head -c %s /dev/zero' % (size,))
+        total = 0
+        rc, data = chan.read(65536)
+        while rc > 0:
+            total += rc
+            rc, data = chan.read(65536)
+        self.assertEqual(total, size)
+        self.assertRaises(ValueError, self.session.open_session, packet_size=65536)
+        self.assertRaises(ValueError, self.session.open_session, window_size=0)
+        self.assertRaises(ValueError, self.session.open_session,
+                          window_size=65536, max_window_size=32768)
+
+    def test_window_auto_tuning(self):
+        self.assertEqual(self._auth(), 0)
+        chan = self.session.open_session(window_size=32768,
+                                         max_window_size=1024 * 1024)
+        self.assertEqual(chan.max_window_size, 1024 * 1024)
+        size = 16 * 1024 * 1024
+        chan.execute('head -c %s /dev/zero' % (size,))
+        total = 0
+        rc, data = chan.read(65536)
+        while rc > 0:
+            total += rc
+            self.assertTrue(32768 <= chan.receive_window_size <= 1024 * 1024)
+            rc, data = chan.read(65536)
+        self.assertEqual(total, size)
+        self.assertEqual(chan.wait_eof(), 0)
+
+    def test_read_sizes(self):
+        self.assertEqual(self._auth(), 0)
+        chan = self.session.open_session()
+        chan.execute('seq 1 200000')
+        expected = ''.join('%s\n' % (i,) for i in range(1, 200001)).encode()
+        output = []
+        # Large read followed by enough small ones for the buffer to shrink
+        sizes = [2 * 1024 * 1024, 8 * 1024 * 1024] + [100] * 200 + [65536]
+        i = 0
+        size, data = chan.read(sizes[0])
+        while size > 0:
+            output.append(data)
+            i += 1
+            size, data = chan.read(sizes[i % len(sizes)])
+        self.assertEqual(b''.join(output), expected)
+
+    def test_read_into(self):
+        self.assertEqual(self._auth(), 0)
+        chan = self.session.open_session()
+        chan.execute('echo out; echo err >&2')
+        buf = bytearray(1024)
+        size = chan.read_into(buf)
+        self.assertEqual(buf[:size], b'out\n')
+        view = memoryview(buf)
+        # Stream id 1 is stderr
+        size = chan.read_into(view[10:], 1)
+        self.assertEqual(buf[10:10 + size], b'err\n')
+        self.assertEqual(chan.read_into(buf), 0)
+        self.assertRaises(BufferError, chan.read_into, b'read only')
+        self.assertEqual(chan.wait_closed(), 0)
+
+    def test_read_into_non_blocking(self):
+        self.assertEqual(self._auth(), 0)
+        chan = self.session.open_session()
+        size = 1024 * 1024
+        chan.execute('sleep 0.2; head -c %s /dev/zero' % (size,))
+        self.session.set_blocking(False)
+        buf = bytearray(65536)
+        total = 0
+        again = 0
+        rc = chan.read_into(buf)
+        while rc != 0:
+            if rc == LIBSSH2_ERROR_EAGAIN:
+                again += 1
+                wait_socket(self.sock, self.session)
+            else:
+                total += rc
+            rc = chan.read_into(buf)
+        self.assertEqual(total, size)
+        self.assertTrue(again > 0)
+        self.assertEqual(chan.read(), (0, b''))
+
+    def test_expect(self):
+        self.assertEqual(self._auth(), 0)
+        chan = self.session.open_session()
+        chan.execute('seq 1 20000; echo "host> "; sleep 0.2; printf "id-12345-end\\n"')
+        index, match, before = chan.expect(rb'host> ')
+        self.assertEqual((index, match.group()), (0, b'host> '))
+        self.assertEqual(before.splitlines(), [str(i).encode() for i in range(1, 20001)])
+        # Earliest match wins, a match split across reads is still found
+        index, match, before = chan.expect(['never', r'(\d+)-end', '-'], size=1)
+        self.assertEqual((index, match.group(), before), (2, b'-', b'\nid'))
+        index, match, before = chan.expect(['never', r'(\d+)-end'], size=1)
+        self.assertEqual((index, match.group(1), before), (1, b'12345', b''))
+        self.assertIsNone(chan.expect('never'))
+        self.assertEqual(chan.flush_expect(), b'\n')
+        self.assertEqual(chan.flush_expect(), b'')
+        self.assertRaises(ValueError, chan.expect, [])
+        self.assertRaises(ValueError, chan.expect, 'never', max_match=0)
+
+    def test_expect_timeout(self):
+        self.assertEqual(self._auth(), 0)
+        chan = self.session.open_session()
+        chan.execute('echo before; sleep 1; echo late')
+        self.session.set_timeout(5000)
+        self.assertRaises(Timeout, chan.expect, 'late', timeout=0.2)
+        self.assertEqual(self.session.get_timeout(), 5000)
+        # Output searched for other patterns before is searched again
+        index, match, before = chan.expect(['late', 'bef(ore)'], timeout=5)
+        self.assertEqual((index, match.group(1), before), (1, b'ore', b''))
+        self.assertIsInstance(match.group(), bytes)
+        self.assertEqual(chan.expect('late', timeout=5)[2], b'\n')
+
+    def test_expect_stderr_eof(self):
+        self.assertEqual(self._auth(), 0)
+        chan = self.session.open_session()
+        chan.execute('echo out; echo err >&2; exit')
+        # Queued stderr keeps eof() false after stdout has ended
+        start = time.monotonic()
+        self.assertIsNone(chan.expect('never', timeout=5))
+        self.assertTrue(time.monotonic() - start < 2)
+        self.assertEqual(chan.flush_expect(), b'out\n')
+        self.assertEqual(chan.read_stderr(), (4, b'err\n'))
+
+    def test_expect_non_blocking(self):
+        self.assertEqual(self._auth(), 0)
+        chan = self.session.open_session()
+        self.assertEqual(chan.pty(), 0)
+        self.assertEqual(chan.shell(), 0)
+        self.session.set_blocking(False)
+        chan.write('sleep 0.2; echo done$((1 + 1))\n')
+        again = 0
+        rc = chan.expect(r'done(\d)')
+        while rc == LIBSSH2_ERROR_EAGAIN:
+            again += 1
+            wait_socket(self.sock, self.session)
+            rc = chan.expect(r'done(\d)')
+        index, match, before = rc
+        self.assertEqual(match.group(1), b'2')
+        self.assertIn(b'done$((1 + 1))', before)
+        self.assertTrue(again > 0)
+
     @skipUnless(hasattr(Channel, 'request_auth_agent'),
                 "No agent forwarding implementation")
     def test_agent_forwarding(self):
@@ -47,6 +47,8 @@ class ErrorCodeExceptionsTest(unittest.TestCase):
     def test_no_exceptions(self):
         self.assertEqual(handle_error_codes(0), 0)
         self.assertEqual(handle_error_codes(LIBSSH2_ERROR_EAGAIN), LIBSSH2_ERROR_EAGAIN)
+        self.assertEqual(handle_error_codes(1024), 1024)
+        self.assertRaises(UnknownError, handle_error_codes, -9999)
 
     def test_general_errors(self):
         self.assertRaises(AuthenticationError, handle_error_codes, LIBSSH2_ERROR_PUBLICKEY_UNRECOGNIZED)
@@ -0,0 +1,74 @@
+from .base_test import SSH2TestCase
+from ssh2.executor import ShellExecutor
+from ssh2.multiplex import CommandResult
+from ssh2.exceptions import BadUseError, ChannelClosedError
+
+
+class ShellExecutorTestCase(SSH2TestCase):
+
+    def setUp(self):
+        super(ShellExecutorTestCase, self).setUp()
+        self.assertEqual(self._auth(), 0)
+
+    def test_execute(self):
+        with self.session.shell_executor(shell='sh') as executor:
+            self.assertIsInstance(executor, ShellExecutor)
+            result = executor.execute(
+                'echo out; echo err >&2; exit_code() { return 3; }; exit_code')
+            self.assertIsInstance(result, CommandResult)
+            self.assertEqual(result.id, 0)
+            self.assertEqual(result.stdout, b'out\n')
+            self.assertEqual(result.stderr, b'err\n')
+            self.assertEqual(result.exit_status, 3)
+            self.assertIsNone(result.error)
+            # State of the shell carries over
+            executor.execute('cd /; FOO=bar')
+            result = executor.execute('pwd; echo $FOO')
+            self.assertEqual(result.stdout, b'/\nbar\n')
+            # No trailing line break, empty commands and no reading of the
+            # commands after
+            result = executor.execute('printf partial; cat')
+            self.assertEqual(result.stdout, b'partial')
+            result = executor.execute('')
+            self.assertEqual((result.stdout, result.exit_status), (b'', 0))
+        self.assertRaises(BadUseError, executor.submit, self.cmd)
+
+    def test_run(self):
+        executor = self.session.shell_executor(shell='sh')
+        count = 500
+        ids = [executor.submit('echo %s; echo %s >&2' % (i, i)) for i in range(count)]
+        executor.submit('head -c 3000000 /dev/zero')
+        self.assertEqual(executor.queued, count + 1)
+        results = list(executor.run())
+        self.assertEqual([r.id for r in results], ids + [count])
+        for result in results[:-1]:
+            self.assertEqual(result.stdout, ('%s\n' % (result.id,)).encode())
+            self.assertEqual(result.stderr, ('%s\n' % (result.id,)).encode())
+            self.assertEqual(result.exit_status, 0)
+        self.assertEqual(results[-1].stdout, bytes(3000000))
+        self.assertEqual(executor.queued, 0)
+        self.assertTrue(self.session.get_blocking())
+        executor.close()
+
+    def test_shell_exit(self):
+        executor = self.session.shell_executor(shell='sh')
+        first = executor.submit('echo me; exit 5')
+        second = executor.submit(self.cmd)
+        results = list(executor.run())
+        self.assertEqual([r.id for r in results], [first, second])
+        self.assertEqual(results[0].stdout, b'me\n')
+        self.assertEqual(results[0].exit_status, 5)
+        self.assertIsNone(results[0].error)
+        self.assertIsInstance(results[1].error, ChannelClosedError)
+        self.assertRaises(BadUseError, executor.submit, self.cmd)
+
+    def test_pty(self):
+        with self.session.shell_executor(pty=True) as executor:
+            result = executor.execute('echo out; echo err >&2; false')
+            self.assertEqual(result.stdout, b'out\r\nerr\r\n')
+            self.assertEqual(result.stderr, b'')
+            self.assertEqual(result.exit_status, 1)
+            results = [executor.submit('echo %s' % (i,)) for i in range(50)]
+            results = list(executor.run())
+            for i, result in enumerate(results):
+                self.assertEqual(result.stdout, ('%s\r\n' % (i,)).encode())
@@ -0,0 +1,281 @@
+import os
+import socket
+import threading
+
+from .base_test import SSH2TestCase
+from ssh2.error_codes import LIBSSH2_ERROR_EAGAIN
+from ssh2.exceptions import BadUseError
+from ssh2.utils import wait_socket
+
+
+class EchoServer(object):
+    """Local TCP server echoing back everything it receives."""
+
+    def __init__(self):
+        self.sock = socket.create_server(('127.0.0.1', 0))
+        self.port = self.sock.getsockname()[1]
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._echo, args=(conn,), daemon=True).start()
+
+    def _echo(self, conn):
+        with conn:
+            data = conn.recv(65536)
+            while data:
+                conn.sendall(data)
+                data = conn.recv(65536)
+
+    def close(self):
+        self.sock.close()
+
+
+def closed_port():
+    """A local port with nothing listening on it."""
+    with socket.create_server(('127.0.0.1', 0)) as sock:
+        return sock.getsockname()[1]
+
+
+def roundtrip(address, size):
+    """Send size random bytes to address and return what comes back."""
+    data = os.urandom(size)
+    received = bytearray()
+    with socket.create_connection(address, timeout=30) as sock:
+        reader = threading.Thread(target=_read_all, args=(sock, received))
+        reader.start()
+        sock.sendall(data)
+        sock.shutdown(socket.SHUT_WR)
+        reader.join()
+    return data, bytes(received)
+
+
+def _read_all(sock, received):
+    data = sock.recv(65536)
+    while data:
+        received.extend(data)
+        data = sock.recv(65536)
+
+
+class BaseForwardTestCase(SSH2TestCase):
+
+    def setUp(self):
+        super(BaseForwardTestCase, self).setUp()
+        self.assertEqual(self._auth(), 0)
+        self.echo = EchoServer()
+
+    def tearDown(self):
+        self.echo.close()
+        super(BaseForwardTestCase, self).tearDown()
+
+    def _start(self, forwarder):
+        thread = threading.Thread(target=forwarder.run)
+        thread.start()
+        return thread
+
+    def _stop(self, forwarder, thread):
+        forwarder.stop()
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+
+
+class ForwardTestCase(BaseForwardTestCase):
+
+    def test_forward_local(self):
+        fwd = self.session.forward_local('127.0.0.1', self.echo.port)
+        host, port = fwd.local_address
+        self.assertEqual(host, '127.0.0.1')
+        self.assertTrue(port > 0)
+        thread = self._start(fwd)
+        try:
+            for size in (1, 100000, 4 * 1024 * 1024):
+                sent, received = roundtrip(fwd.local_address, size)
+                self.assertEqual(sent, received)
+        finally:
+            self._stop(fwd, thread)
+        self.assertEqual(fwd.connections, 3)
+        self.assertEqual(fwd.bytes_sent, 1 + 100000 + 4 * 1024 * 1024)
+        self.assertEqual(fwd.bytes_received, fwd.bytes_sent)
+        self.assertEqual(fwd.active, 0)
+        self.assertTrue(self.session.get_blocking())
+        self.assertEqual(fwd.close(), 0)
+        # Session is still usable
+        chan = self.session.open_session()
+        chan.execute(self.cmd)
+        self.assertEqual(chan.read()[1].strip(), self.resp.encode())
+
+    def test_forward_local_concurrent(self):
+        fwd = self.session.forward_local('127.0.0.1', self.echo.port, buffer_size=8192)
+        thread = self._start(fwd)
+        results = []
+
+        def client():
+            results.append(roundtrip(fwd.local_address, 200000))
+        clients = [threading.Thread(target=client) for _ in range(20)]
+        try:
+            for client_thread in clients:
+                client_thread.start()
+            for client_thread in clients:
+                client_thread.join()
+        finally:
+            self._stop(fwd, thread)
+        self.assertEqual(len(results), 20)
+        for sent, received in results:
+            self.assertEqual(sent, received)
+        self.assertEqual(fwd.connections, 20)
+
+    def test_forward_local_refused(self):
+        fwd = self.session.forward_local('127.0.0.1', closed_port())
+        thread = self._start(fwd)
+        try:
+            with socket.create_connection(fwd.local_address, timeout=10) as sock:
+                self.assertEqual(sock.recv(1), b'')
+        finally:
+            self._stop(fwd, thread)
+        self.assertEqual(fwd.active, 0)
+
+    def test_forward_local_stop(self):
+        fwd = self.session.forward_local('127.0.0.1', self.echo.port)
+        thread = self._start(fwd)
+        with socket.create_connection(fwd.local_address, timeout=10) as sock:
+            sock.sendall(b'data')
+            self.assertEqual(sock.recv(4), b'data')
+            self.assertRaises(BadUseError, fwd.run)
+            self._stop(fwd, thread)
+            self.assertEqual(sock.recv(1), b'')
+        self.assertEqual(fwd.active, 0)
+
+    def test_forward_remote(self):
+        fwd = self.session.forward_remote('127.0.0.1', self.echo.port,
+                                          remote_host='127.0.0.1')
+        self.assertIsNone(fwd.local_address)
+        self.assertTrue(fwd.bound_port > 0)
+        thread = self._start(fwd)
+        try:
+            for size in (1, 2 * 1024 * 1024):
+                sent, received = roundtrip(('127.0.0.1', fwd.bound_port), size)
+                self.assertEqual(sent, received)
+        finally:
+            self._stop(fwd, thread)
+        self.assertEqual(fwd.connections, 2)
+        self.assertEqual(fwd.bytes_received, 1 + 2 * 1024 * 1024)
+        self.assertEqual(fwd.close(), 0)
+        self.assertRaises(BadUseError, fwd.run)
+
+    def test_forward_remote_non_blocking(self):
+        self.session.set_blocking(False)
+        fwd = self.session.forward_remote('127.0.0.1', self.echo.port,
+                                          remote_host='127.0.0.1')
+        while fwd == LIBSSH2_ERROR_EAGAIN:
+            wait_socket(self.sock, self.session)
+            fwd = self.session.forward_remote('127.0.0.1', self.echo.port,
+                                              remote_host='127.0.0.1')
+        self.assertTrue(fwd.bound_port > 0)
+        thread = self._start(fwd)
+        try:
+            sent, received = roundtrip(('127.0.0.1', fwd.bound_port), 100000)
+            self.assertEqual(sent, received)
+        finally:
+            self._stop(fwd, thread)
+        self.assertFalse(self.session.get_blocking())
+        self.assertEqual(fwd.connections, 1)
+
+    def test_buffer_size(self):
+        self.assertRaises(ValueError, self.session.forward_local,
+                          '127.0.0.1', self.echo.port, buffer_size=0)
+
+
+def socks_connect(address, host, port, timeout=30):
+    """Connect to host:port through the SOCKS5 proxy at address."""
+    sock = socket.create_connection(address, timeout=timeout)
+    sock.sendall(b'\x05\x01\x00')
+    assert sock.recv(2) == b'\x05\x00'
+    try:
+        request = b'\x05\x01\x00\x01' + socket.inet_aton(host)
+    except OSError:
+        request = b'\x05\x01\x00\x03' + bytes([len(host)]) + host.encode()
+    sock.sendall(request + port.to_bytes(2, 'big'))
+    reply = _recv_exactly(sock, 10)
+    if reply[1] != 0:
+        sock.close()
+        raise ConnectionError("SOCKS reply %s" % (reply[1],))
+    return sock
+
+
+def _recv_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+class SocksForwardTestCase(BaseForwardTestCase):
+
+    def test_forward_socks(self):
+        fwd = self.session.forward_socks()
+        self.assertEqual(fwd.max_channels, 64)
+        thread = self._start(fwd)
+        try:
+            for host in ('127.0.0.1', 'localhost'):
+                with socks_connect(fwd.local_address, host, self.echo.port) as sock:
+                    data = os.urandom(300000)
+                    received = bytearray()
+                    reader = threading.Thread(target=_read_all, args=(sock, received))
+                    reader.start()
+                    sock.sendall(data)
+                    sock.shutdown(socket.SHUT_WR)
+                    reader.join()
+                    self.assertEqual(bytes(received), data)
+        finally:
+            self._stop(fwd, thread)
+        self.assertEqual(fwd.connections, 2)
+        self.assertEqual(fwd.active, 0)
+
+    def test_forward_socks_errors(self):
+        fwd = self.session.forward_socks()
+        thread = self._start(fwd)
+        try:
+            # Only the no authentication method is supported
+            with socket.create_connection(fwd.local_address, timeout=10) as sock:
+                sock.sendall(b'\x05\x01\x02')
+                self.assertEqual(sock.recv(2), b'\x05\xff')
+                self.assertEqual(sock.recv(1), b'')
+            # Bind command is not supported
+            with socket.create_connection(fwd.local_address, timeout=10) as sock:
+                sock.sendall(b'\x05\x01\x00')
+                self.assertEqual(sock.recv(2), b'\x05\x00')
+                sock.sendall(b'\x05\x02\x00\x01\x7f\x00\x00\x01\x00\x50')
+                self.assertEqual(_recv_exactly(sock, 10)[1], 7)
+            # Nothing listening on target
+            self.assertRaises(ConnectionError, socks_connect, fwd.local_address,
+                              '127.0.0.1', closed_port())
+        finally:
+            self._stop(fwd, thread)
+
+    def test_forward_socks_max_channels(self):
+        fwd = self.session.forward_socks(max_channels=2)
+        thread = self._start(fwd)
+        try:
+            first = socks_connect(fwd.local_address, '127.0.0.1', self.echo.port)
+            second = socks_connect(fwd.local_address, '127.0.0.1', self.echo.port)
+            # Third connection waits in the listen backlog
+            third = socket.create_connection(fwd.local_address, timeout=0.5)
+            third.sendall(b'\x05\x01\x00')
+            self.assertRaises(socket.timeout, third.recv, 2)
+            self.assertEqual(fwd.active, 2)
+            first.close()
+            third.settimeout(10)
+            self.assertEqual(third.recv(2), b'\x05\x00')
+            second.close()
+            third.close()
+        finally:
+            self._stop(fwd, thread)
+        self.assertEqual(fwd.connections, 3)
@@ -0,0 +1,36 @@
+import subprocess
+import sys
+import unittest
+
+import ssh2
+
+
+class ImportTestCase(unittest.TestCase):
+
+    def _run(self, code):
+        return subprocess.check_output(
+            [sys.executable, '-c', code]).decode().split()
+
+    def test_lazy_submodules(self):
+        loaded = self._run(
+            "import sys, ssh2; "
+            "print(*sorted(m for m in sys.modules if m.startswith('ssh2.')))")
+        self.assertNotIn('ssh2.session', loaded)
+        self.assertNotIn('ssh2.sftp', loaded)
+        self.assertNotIn('ssh2._version', loaded)
+
+    def test_lazy_stdlib(self):
+        loaded = self._run(
+            "import sys, ssh2.session, ssh2.knownhost; "
+            "print(*(m for m in ('socket', 'threading', 'base64') "
+            "if m in sys.modules))")
+        self.assertEqual(loaded, [])
+
+    def test_attributes(self):
+        # Loaded on first attribute access
+        self.assertIs(ssh2.session, sys.modules['ssh2.session'])
+        self.assertIs(ssh2.sftp_handle, sys.modules['ssh2.sftp_handle'])
+        self.assertIsInstance(ssh2.__version__, str)
+        self.assertIn('channel', dir(ssh2))
+        self.assertIn('__version__', dir(ssh2))
+        self.assertRaises(AttributeError, getattr, ssh2, 'no_such_module')
@@ -0,0 +1,88 @@
+import threading
+
+from .base_test import SSH2TestCase
+from ssh2.iothread import IOThread, ChannelStream
+from ssh2.exceptions import BadUseError, Timeout
+
+
+class IOThreadTestCase(SSH2TestCase):
+
+    def setUp(self):
+        super(IOThreadTestCase, self).setUp()
+        self.assertEqual(self._auth(), 0)
+
+    def _execute(self, command):
+        chan = self.session.open_session()
+        chan.execute(command)
+        return chan
+
+    def test_read(self):
+        with self.session.start_io_thread() as io:
+            self.assertIsInstance(io, IOThread)
+            self.assertTrue(io.running)
+            self.assertTrue(self.session.get_locking())
+            chan = self._execute('echo out; echo err >&2')
+            stream = io.add(chan)
+            self.assertIsInstance(stream, ChannelStream)
+            self.assertIs(stream.channel, chan)
+            self.assertEqual(b''.join(stream), b'out\n')
+            self.assertEqual(stream.read_stderr(), b'err\n')
+            self.assertEqual(stream.read_stderr(), b'')
+            self.assertTrue(stream.eof())
+            chan.close()
+            chan.wait_closed()
+            self.assertEqual(chan.get_exit_status(), 0)
+        self.assertFalse(io.running)
+
+    def test_large_output(self):
+        # Output many times the buffer size, held back while unread
+        size = 8 * 1024 * 1024
+        with self.session.start_io_thread(buffer_size=65536) as io:
+            streams = [io.add(self._execute('head -c %s /dev/zero' % (size,)))
+                       for _ in range(3)]
+            for stream in streams:
+                total = 0
+                for data in stream:
+                    self.assertLessEqual(len(data), 65536)
+                    self.assertEqual(data, bytes(len(data)))
+                    total += len(data)
+                self.assertEqual(total, size)
+
+    def test_threads(self):
+        # Other threads write to and read from their own streams
+        errors = []
+        outputs = {}
+        with self.session.start_io_thread() as io:
+
+            def run(worker):
+                try:
+                    chan = self._execute('cat')
+                    stream = io.add(chan)
+                    chan.write(b'%d\n' % (worker,) * 1000)
+                    chan.send_eof()
+                    outputs[worker] = b''.join(stream)
+                except Exception as ex:
+                    errors.append(ex)
+
+            threads = [threading.Thread(target=run, args=(w,)) for w in range(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(errors, [])
+        for worker, output in outputs.items():
+            self.assertEqual(output, b'%d\n' % (worker,) * 1000)
+
+    def test_timeout_and_close(self):
+        with self.session.start_io_thread() as io:
+            chan = self._execute('sleep 1; echo me')
+            stream = io.add(chan)
+            self.assertRaises(BadUseError, io.add, chan)
+            self.assertRaises(Timeout, stream.read, timeout=50)
+            self.assertEqual(stream.read(), b'me\n')
+            stream.close()
+            self.assertRaises(BadUseError, stream.read)
+        self.assertRaises(BadUseError, io.add, self._execute(self.cmd))
+
+    def test_invalid_arguments(self):
+        self.assertRaises(ValueError, self.session.start_io_thread, buffer_size=0)
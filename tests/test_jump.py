@@ -0,0 +1,77 @@
+from .base_test import SSH2TestCase
+from ssh2.session import Session
+from ssh2.error_codes import LIBSSH2_ERROR_EAGAIN
+from ssh2.utils import wait_socket
+
+
+class JumpTestCase(SSH2TestCase):
+
+    def setUp(self):
+        super(JumpTestCase, self).setUp()
+        self.assertEqual(self._auth(), 0)
+
+    def _jump(self, session):
+        jumped = session.proxy_jump(self.host, self.port)
+        self.assertIsInstance(jumped, Session)
+        self.assertEqual(jumped.userauth_publickey_fromfile(self.user, self.user_key), 0)
+        self.assertTrue(jumped.userauth_authenticated())
+        return jumped
+
+    def _execute(self, session, command, data=None):
+        chan = session.open_session()
+        chan.execute(command)
+        if data is not None:
+            self.assertEqual(chan.write(data)[1], len(data))
+            chan.send_eof()
+        output = b''
+        size, chunk = chan.read()
+        while size > 0:
+            output += chunk
+            size, chunk = chan.read()
+        chan.close()
+        return output
+
+    def test_proxy_jump(self):
+        jumped = self._jump(self.session)
+        self.assertIs(jumped.sock, self.sock)
+        self.assertEqual(self._execute(jumped, self.cmd).strip(), self.resp.encode())
+        size = 4 * 1024 * 1024
+        self.assertEqual(len(self._execute(jumped, 'head -c %s /dev/zero' % (size,))), size)
+        data = b'x' * size
+        self.assertEqual(self._execute(jumped, 'wc -c', data).strip(), str(size).encode())
+        # Outer session is still usable
+        self.assertEqual(self._execute(self.session, self.cmd).strip(), self.resp.encode())
+
+    def test_proxy_jump_chain(self):
+        first = self._jump(self.session)
+        second = self._jump(first)
+        self.assertEqual(self._execute(second, self.cmd).strip(), self.resp.encode())
+        self.assertEqual(second.disconnect(), 0)
+        self.assertEqual(self._execute(first, self.cmd).strip(), self.resp.encode())
+
+    def test_proxy_jump_non_blocking(self):
+        jumped = self._jump(self.session)
+        jumped.set_blocking(False)
+        chan = jumped.open_session()
+        while chan == LIBSSH2_ERROR_EAGAIN:
+            wait_socket(jumped.sock, jumped)
+            chan = jumped.open_session()
+        while chan.execute(self.cmd) == LIBSSH2_ERROR_EAGAIN:
+            wait_socket(jumped.sock, jumped)
+        output = b''
+        while not chan.eof():
+            size, data = chan.read()
+            while size > 0:
+                output += data
+                size, data = chan.read()
+            if size == LIBSSH2_ERROR_EAGAIN:
+                wait_socket(jumped.sock, jumped)
+        self.assertEqual(output.strip(), self.resp.encode())
+        self.assertTrue(self.session.get_blocking())
+
+    def test_handshake_channel(self):
+        chan = self.session.direct_tcpip(self.host, self.port)
+        session = Session()
+        self.assertEqual(session.handshake_channel(chan), 0)
+        self.assertTrue(len(session.hostkey()[0]) > 0)
+        self.assertRaises(TypeError, session.handshake_channel, None)
@@ -1,11 +1,24 @@
 import os
+import hmac
+import shutil
+import tempfile
+import threading
+from unittest import TestCase
 from base64 import b64encode
 
 from ssh2.knownhost import (LIBSSH2_KNOWNHOST_TYPE_PLAIN, LIBSSH2_KNOWNHOST_KEYENC_RAW,  # noqa
                             LIBSSH2_KNOWNHOST_KEY_SSHRSA, LIBSSH2_KNOWNHOST_KEYENC_BASE64,
                             LIBSSH2_KNOWNHOST_TYPE_SHA1, LIBSSH2_KNOWNHOST_KEY_SSHDSS)  # noqa
 from ssh2.session import LIBSSH2_HOSTKEY_HASH_SHA1, LIBSSH2_HOSTKEY_TYPE_RSA  # noqa
-from ssh2.exceptions import KnownHostDeleteError, KnownHostCheckError
+from ssh2.knownhost import (KnownHostIterator, KnownHostStore, HostKeyVerifier, get_verifier,
+                            shared_store,
+                            LIBSSH2_KNOWNHOST_CHECK_MATCH, LIBSSH2_KNOWNHOST_CHECK_MISMATCH,
+                            LIBSSH2_KNOWNHOST_CHECK_NOTFOUND, LIBSSH2_KNOWNHOST_CHECK_FAILURE,
+                            LIBSSH2_KNOWNHOST_TYPE_CUSTOM)
+from ssh2.session import Session
+from ssh2.exceptions import KnownHostDeleteError, KnownHostCheckError, \
+    KnownHostCheckNotFoundError, KnownHostCheckMisMatchError, KnownHostCheckFailure, \
+    KnownHostReadFileError, KnownHostReadLineError, KnownHostAddError
 
 from .base_test import SSH2TestCase
 
@@ -140,3 +153,260 @@ class KnownHostTestCase(SSH2TestCase):
         self.assertEqual(kh.readfile(server_known_hosts), 1)
         entry = kh.checkp(b'127.0.0.1', self.port, host_key, type_mask)
         self.assertTrue(entry is not None)
+
+    def test_verify_host_key(self):
+        self.assertEqual(self._auth(), 0)
+        server_known_hosts = os.path.join(BASE_DIR, 'embedded_server', 'known_hosts')
+        verifier = get_verifier(server_known_hosts)
+        self.assertIs(verifier, get_verifier(server_known_hosts))
+        entry = self.session.verify_host_key('127.0.0.1', self.port, verifier)
+        self.assertTrue(entry is not None)
+        self.assertRaises(KnownHostCheckNotFoundError, self.session.verify_host_key,
+                          '127.0.0.2', self.port, verifier)
+
+
+def _hashed_host(host, salt):
+    digest = hmac.digest(salt, host, "sha1")
+    return b"|1|" + b64encode(salt) + b"|" + b64encode(digest)
+
+
+class KnownHostStoreTestCase(TestCase):
+    """Known host store checks compared against libssh2's own, no server
+    needed."""
+
+    key = os.urandom(279)
+    other_key = os.urandom(279)
+    type_mask = (LIBSSH2_KNOWNHOST_TYPE_PLAIN | LIBSSH2_KNOWNHOST_KEYENC_RAW |
+                 LIBSSH2_KNOWNHOST_KEY_SSHRSA)
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'known_hosts')
+        lines = [
+            b"# comment line",
+            b"plain.example.com,10.0.0.1 ssh-rsa " + b64encode(self.key) + b" a comment",
+            b"[plain.example.com]:2222 ssh-rsa " + b64encode(self.other_key),
+            b"dsa.example.com ssh-dss " + b64encode(self.key),
+            b"mismatch.example.com ssh-rsa " + b64encode(self.other_key),
+            _hashed_host(b"hashed.example.com", os.urandom(20)) + b" ssh-rsa " +
+            b64encode(self.key),
+            _hashed_host(b"[hashed.example.com]:2222", os.urandom(20)) + b" ssh-rsa " +
+            b64encode(self.other_key),
+            _hashed_host(b"hashed-mismatch.example.com", os.urandom(20)) + b" ssh-rsa " +
+            b64encode(self.other_key),
+        ]
+        for i in range(100):
+            lines.append(_hashed_host(b"10.1.0.%d" % i, os.urandom(20)) + b" ssh-rsa " +
+                         b64encode(os.urandom(279)))
+        with open(self.filename, 'wb') as fh:
+            fh.write(b"\n".join(lines) + b"\n")
+        self.session = Session()
+        self.kh = self.session.knownhost_init()
+        self.kh.readfile(self.filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _libssh2_check(self, host, port, key, type_mask):
+        try:
+            self.kh.checkp(host, port, key, type_mask)
+        except KnownHostCheckMisMatchError:
+            return LIBSSH2_KNOWNHOST_CHECK_MISMATCH
+        except KnownHostCheckNotFoundError:
+            return LIBSSH2_KNOWNHOST_CHECK_NOTFOUND
+        except KnownHostCheckFailure:
+            return LIBSSH2_KNOWNHOST_CHECK_FAILURE
+        return LIBSSH2_KNOWNHOST_CHECK_MATCH
+
+    def test_readfile(self):
+        store = KnownHostStore()
+        self.assertEqual(len(store), 0)
+        self.assertEqual(store.readfile(self.filename),
+                         len(open(self.filename, 'rb').readlines()))
+        self.assertEqual(len(store), len(self.kh.get()))
+        # libssh2 does not keep hashed host names and adds the names of a
+        # line in reverse order
+        self.assertEqual(
+            sorted(e.name for e in store.get() if not e.name.startswith(b"|1|")),
+            sorted(e.name for e in self.kh.get() if e.name is not None))
+        self.assertEqual(sorted(e.key for e in store.get()),
+                         sorted(e.key for e in self.kh.get()))
+        self.assertRaises(KnownHostReadFileError, store.readfile,
+                          os.path.join(self.tmpdir, 'missing'))
+        self.assertRaises(KnownHostReadLineError, store.readline, b"host ssh-rsa")
+
+    def test_check_matches_libssh2(self):
+        store = KnownHostStore(self.filename)
+        hosts = [b"plain.example.com", b"10.0.0.1", b"dsa.example.com",
+                 b"mismatch.example.com", b"hashed.example.com",
+                 b"hashed-mismatch.example.com", b"10.1.0.50", b"unknown.example.com",
+                 b"x" * 300]
+        type_masks = [
+            self.type_mask,
+            LIBSSH2_KNOWNHOST_TYPE_PLAIN | LIBSSH2_KNOWNHOST_KEYENC_RAW,
+            LIBSSH2_KNOWNHOST_TYPE_PLAIN | LIBSSH2_KNOWNHOST_KEYENC_RAW |
+            LIBSSH2_KNOWNHOST_KEY_SSHDSS,
+            LIBSSH2_KNOWNHOST_TYPE_SHA1 | LIBSSH2_KNOWNHOST_KEYENC_RAW |
+            LIBSSH2_KNOWNHOST_KEY_SSHRSA,
+        ]
+        for host in hosts:
+            for port in (-1, 22, 2222):
+                for key in (self.key, self.other_key):
+                    for type_mask in type_masks:
+                        expected = self._libssh2_check(host, port, key, type_mask)
+                        self.assertEqual(
+                            store.check(host, port, key, type_mask), expected,
+                            (host, port, type_mask))
+                        # Cached result
+                        self.assertEqual(
+                            store.check(host, port, key, type_mask), expected)
+                    b64_mask = (self.type_mask & ~LIBSSH2_KNOWNHOST_KEYENC_RAW) | \
+                        LIBSSH2_KNOWNHOST_KEYENC_BASE64
+                    self.assertEqual(
+                        store.check(host, port, b64encode(key), b64_mask),
+                        self._libssh2_check(host, port, key, self.type_mask))
+
+    def test_checkp(self):
+        store = KnownHostStore(self.filename)
+        entry = store.checkp(b"plain.example.com", 22, self.key, self.type_mask)
+        self.assertEqual(entry.name, b"plain.example.com")
+        self.assertEqual(entry.key, self.key)
+        self.assertEqual(entry.comment, b"a comment")
+        entry = store.checkp(b"hashed.example.com", 2222, self.other_key, self.type_mask)
+        self.assertTrue(entry.name.startswith(b"|1|"))
+        self.assertEqual(entry.typemask & LIBSSH2_KNOWNHOST_TYPE_SHA1,
+                         LIBSSH2_KNOWNHOST_TYPE_SHA1)
+        self.assertRaises(KnownHostCheckMisMatchError, store.checkp,
+                          b"hashed.example.com", 22, self.other_key, self.type_mask)
+        self.assertRaises(KnownHostCheckNotFoundError, store.checkp,
+                          b"unknown.example.com", 22, self.key, self.type_mask)
+        self.assertRaises(KnownHostCheckFailure, store.checkp,
+                          b"x" * 300, 22, self.key, self.type_mask)
+
+    def test_addc(self):
+        store = KnownHostStore()
+        store.addc(b"added.example.com", self.key, self.type_mask)
+        salt = os.urandom(20)
+        host_hash = hmac.digest(salt, b"hashed-add.example.com", "sha1")
+        store.addc(b64encode(host_hash), self.key,
+                   LIBSSH2_KNOWNHOST_TYPE_SHA1 | LIBSSH2_KNOWNHOST_KEYENC_RAW |
+                   LIBSSH2_KNOWNHOST_KEY_SSHRSA, salt=b64encode(salt))
+        custom_mask = (LIBSSH2_KNOWNHOST_TYPE_CUSTOM | LIBSSH2_KNOWNHOST_KEYENC_RAW |
+                       LIBSSH2_KNOWNHOST_KEY_SSHRSA)
+        store.addc(b"custom", self.key, custom_mask)
+        self.assertEqual(len(store), 3)
+        for host in (b"added.example.com", b"hashed-add.example.com"):
+            self.assertEqual(store.check(host, 22, self.key, self.type_mask),
+                             LIBSSH2_KNOWNHOST_CHECK_MATCH)
+        self.assertEqual(store.check(b"custom", -1, self.key, self.type_mask),
+                         LIBSSH2_KNOWNHOST_CHECK_NOTFOUND)
+        self.assertEqual(store.check(b"custom", -1, self.key, custom_mask),
+                         LIBSSH2_KNOWNHOST_CHECK_MATCH)
+        self.assertRaises(KnownHostAddError, store.addc, b"host", self.key,
+                          LIBSSH2_KNOWNHOST_TYPE_PLAIN | LIBSSH2_KNOWNHOST_KEYENC_RAW)
+
+    def test_shared_store(self):
+        store = shared_store(self.filename)
+        self.assertIs(store, shared_store(self.filename))
+        self.assertEqual(len(store), len(self.kh.get()))
+
+
+class HostKeyVerifierTestCase(TestCase):
+
+    key = os.urandom(279)
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'known_hosts')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, *hosts):
+        with open(self.filename, 'wb') as fh:
+            for host in hosts:
+                fh.write(host + b" ssh-rsa " + b64encode(self.key) + b"\n")
+
+    def test_reload_on_change(self):
+        verifier = HostKeyVerifier(self.filename)
+        self.assertEqual(verifier.check(b"host1", 22, self.key, LIBSSH2_HOSTKEY_TYPE_RSA),
+                         LIBSSH2_KNOWNHOST_CHECK_NOTFOUND)
+        self._write(b"host1")
+        entry = verifier.verify(b"host1", 22, self.key, LIBSSH2_HOSTKEY_TYPE_RSA)
+        self.assertEqual(entry.name, b"host1")
+        store = verifier.store
+        self.assertIs(store, verifier.store)
+        self._write(b"host1", b"host2")
+        self.assertEqual(verifier.check(b"host2", 22, self.key, LIBSSH2_HOSTKEY_TYPE_RSA),
+                         LIBSSH2_KNOWNHOST_CHECK_MATCH)
+        self.assertIsNot(store, verifier.store)
+        self.assertRaises(KnownHostCheckMisMatchError, verifier.verify,
+                          b"host2", 22, os.urandom(279), LIBSSH2_HOSTKEY_TYPE_RSA)
+        store = verifier.store
+        verifier.reload()
+        self.assertIsNot(store, verifier.store)
+
+    def test_concurrent_verify(self):
+        self._write(*(b"host%d" % i for i in range(100)))
+        verifier = HostKeyVerifier(self.filename)
+        errors = []
+
+        def verify():
+            try:
+                for i in range(100):
+                    verifier.verify(b"host%d" % i, 22, self.key, LIBSSH2_HOSTKEY_TYPE_RSA)
+            except Exception as exc:
+                errors.append(exc)
+        threads = [threading.Thread(target=verify) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+
+class KnownHostBulkTestCase(TestCase):
+
+    type_mask = (LIBSSH2_KNOWNHOST_TYPE_PLAIN | LIBSSH2_KNOWNHOST_KEYENC_RAW |
+                 LIBSSH2_KNOWNHOST_KEY_SSHRSA)
+
+    def setUp(self):
+        self.session = Session()
+        self.kh = self.session.knownhost_init()
+        self.key = os.urandom(279)
+        self.entries = [(b"10.0.%d.%d" % (i >> 8, i & 0xff), self.key, self.type_mask)
+                        for i in range(1000)]
+
+    def test_addc_many(self):
+        self.assertEqual(self.kh.addc_many(iter(self.entries)), len(self.entries))
+        self.assertEqual([entry.name for entry in self.kh.get()],
+                         [host for host, _, _ in self.entries])
+        self.assertEqual(self.kh.addc_many([]), 0)
+        self.assertEqual(self.kh.addc_many(
+            [(b"commented", self.key, self.type_mask, None, b"a comment")]), 1)
+        self.assertTrue(self.kh.writebuf().endswith(b" a comment\n"))
+        bad_mask = (LIBSSH2_KNOWNHOST_TYPE_SHA1 | LIBSSH2_KNOWNHOST_KEYENC_RAW |
+                    LIBSSH2_KNOWNHOST_KEY_SSHRSA)
+        self.assertRaises(KnownHostAddError, self.kh.addc_many,
+                          [(b"added", self.key, self.type_mask),
+                           (b"b", self.key, bad_mask, b"b")])
+        self.assertEqual(len(self.kh.get()), len(self.entries) + 2)
+
+    def test_iter(self):
+        self.assertEqual(list(self.kh), [])
+        self.kh.addc_many(self.entries)
+        entries = iter(self.kh)
+        self.assertIsInstance(entries, KnownHostIterator)
+        self.assertEqual([entry.name for entry in entries],
+                         [host for host, _, _ in self.entries])
+        self.assertRaises(StopIteration, next, entries)
+        prev = self.kh.get()[-3]
+        self.assertEqual([entry.name for entry in self.kh.get(prev)],
+                         [host for host, _, _ in self.entries[-2:]])
+
+    def test_writebuf(self):
+        self.assertEqual(self.kh.writebuf(), b"")
+        self.kh.addc_many(self.entries)
+        lines = b"".join(self.kh.writeline(entry) for entry in self.kh)
+        self.assertEqual(self.kh.writebuf(), lines)
+        self.assertEqual(lines.count(b"\n"), len(self.entries))
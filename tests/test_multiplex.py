@@ -0,0 +1,85 @@
+from .base_test import SSH2TestCase
+from ssh2.multiplex import Multiplexer, CommandResult
+from ssh2.exceptions import BadUseError
+
+
+class MultiplexerTestCase(SSH2TestCase):
+
+    def setUp(self):
+        super(MultiplexerTestCase, self).setUp()
+        self.assertEqual(self._auth(), 0)
+
+    def test_multiplexer(self):
+        mux = self.session.multiplexer(max_channels=5)
+        self.assertIsInstance(mux, Multiplexer)
+        self.assertEqual(mux.max_channels, 5)
+        ids = [mux.submit('echo %s' % (i,)) for i in range(30)]
+        self.assertEqual(ids, list(range(30)))
+        self.assertEqual(mux.queued, 30)
+        results = list(mux.run())
+        self.assertEqual(len(results), 30)
+        self.assertEqual(sorted(r.id for r in results), ids)
+        for result in results:
+            self.assertIsInstance(result, CommandResult)
+            self.assertEqual(result.command, 'echo %s' % (result.id,))
+            self.assertEqual(result.stdout, ('%s\n' % (result.id,)).encode())
+            self.assertEqual(result.stderr, b'')
+            self.assertEqual(result.exit_status, 0)
+            self.assertIsNone(result.error)
+        self.assertEqual(mux.queued, 0)
+        self.assertEqual(mux.active, 0)
+        self.assertTrue(self.session.get_blocking())
+        # Session is still usable
+        chan = self.session.open_session()
+        chan.execute(self.cmd)
+        self.assertEqual(chan.read()[1].strip(), self.resp.encode())
+
+    def test_stderr_exit_status(self):
+        mux = self.session.multiplexer()
+        mux.submit('echo out; echo err >&2; exit 3')
+        mux.submit('head -c 3000000 /dev/zero')
+        first, second = sorted(mux.run(), key=lambda r: r.id)
+        self.assertEqual(first.stdout, b'out\n')
+        self.assertEqual(first.stderr, b'err\n')
+        self.assertEqual(first.exit_status, 3)
+        self.assertEqual(second.stdout, bytes(3000000))
+        self.assertEqual(second.exit_status, 0)
+
+    def test_slow_command(self):
+        mux = self.session.multiplexer()
+        mux.submit('sleep 1; echo slow')
+        for _ in range(5):
+            mux.submit(self.cmd)
+        results = list(mux.run())
+        self.assertEqual(len(results), 6)
+        # Fast commands are not held up by the slow one
+        self.assertEqual(results[-1].id, 0)
+        self.assertEqual(results[-1].stdout, b'slow\n')
+
+    def test_max_sessions(self):
+        # More channels than the server allows per session at once
+        mux = self.session.multiplexer(max_channels=0)
+        self.assertEqual(mux.max_channels, 0)
+        for _ in range(25):
+            mux.submit('sleep 0.5; echo me')
+        results = list(mux.run())
+        self.assertEqual(len(results), 25)
+        for result in results:
+            self.assertIsNone(result.error)
+            self.assertEqual(result.stdout, b'me\n')
+        self.assertTrue(0 < mux.max_channels <= 10)
+
+    def test_submit_while_running(self):
+        mux = self.session.multiplexer()
+        mux.submit(self.cmd)
+        results = []
+        for result in mux.run():
+            results.append(result)
+            if len(results) < 3:
+                mux.submit(self.cmd)
+            self.assertRaises(BadUseError, next, mux.run())
+        self.assertEqual([r.id for r in results], [0, 1, 2])
+
+    def test_invalid_arguments(self):
+        self.assertRaises(ValueError, self.session.multiplexer, max_channels=-1)
+        self.assertRaises(ValueError, self.session.multiplexer, buffer_size=0)
@@ -0,0 +1,91 @@
+from .base_test import SSH2TestCase
+from ssh2.reactor import Reactor
+from ssh2.exceptions import BadUseError
+
+
+class ReactorTestCase(SSH2TestCase):
+
+    def setUp(self):
+        super(ReactorTestCase, self).setUp()
+        self.assertEqual(self._auth(), 0)
+
+    def _execute(self, command):
+        chan = self.session.open_session()
+        chan.execute(command)
+        return chan
+
+    def _add(self, reactor, chan, events, name):
+        reactor.add(
+            chan,
+            on_stdout=lambda data: events.append((name, 'stdout', data)),
+            on_stderr=lambda data: events.append((name, 'stderr', data)),
+            on_eof=lambda: events.append((name, 'eof')),
+            on_exit=lambda status, signal: events.append(
+                (name, 'exit', status, signal)))
+
+    def test_callbacks(self):
+        reactor = self.session.reactor()
+        self.assertIsInstance(reactor, Reactor)
+        events = []
+        for i in range(5):
+            self._add(reactor, self._execute('echo out%s; echo err%s >&2; exit %s' % (
+                i, i, i)), events, i)
+        self.assertEqual(reactor.active, 5)
+        reactor.run()
+        self.assertEqual(reactor.active, 0)
+        for i in range(5):
+            mine = [event[1:] for event in events if event[0] == i]
+            self.assertEqual(b''.join(e[1] for e in mine if e[0] == 'stdout'),
+                             ('out%s\n' % (i,)).encode())
+            self.assertEqual(b''.join(e[1] for e in mine if e[0] == 'stderr'),
+                             ('err%s\n' % (i,)).encode())
+            self.assertEqual(mine[-2:], [('eof',), ('exit', i, None)])
+        self.assertTrue(self.session.get_blocking())
+
+    def test_batches(self):
+        size = 4 * 1024 * 1024
+        reactor = self.session.reactor(buffer_size=1024 * 1024)
+        chunks = []
+        reactor.add(self._execute('head -c %s /dev/zero' % (size,)),
+                    on_stdout=chunks.append)
+        reactor.run()
+        self.assertEqual(sum(len(c) for c in chunks), size)
+        self.assertTrue(all(len(c) <= 1024 * 1024 for c in chunks))
+        # Data available together is passed in one call, not per packet
+        self.assertLess(len(chunks), size // 32768)
+
+    def test_run_once(self):
+        reactor = self.session.reactor()
+        events = []
+        self._add(reactor, self._execute('sleep 1; echo me'), events, 0)
+        self.assertEqual(reactor.run_once(timeout=50), 0)
+        self.assertEqual(events, [])
+        while reactor.active:
+            reactor.run_once()
+        self.assertEqual(events, [(0, 'stdout', b'me\n'), (0, 'eof'),
+                                  (0, 'exit', 0, None)])
+
+    def test_callback_errors(self):
+        events = []
+        chan = self._execute(self.cmd)
+
+        def on_stdout(data):
+            events.append(data)
+            # Channels can be added from callbacks, but not run
+            self._add(reactor, self._execute(self.cmd), events, 1)
+            self.assertRaises(BadUseError, reactor.run)
+            raise RuntimeError(data)
+
+        reactor = self.session.reactor()
+        reactor.add(chan, on_stdout=on_stdout, on_exit=lambda *args: events.append(args))
+        self.assertRaises(BadUseError, reactor.add, chan)
+        self.assertRaises(RuntimeError, reactor.run)
+        self.assertEqual(reactor.active, 2)
+        # Events after the failed callback are kept
+        reactor.run()
+        self.assertEqual(events[0], b'me\n')
+        self.assertIn((0, None), events)
+        self.assertIn((1, 'stdout', b'me\n'), events)
+
+    def test_invalid_arguments(self):
+        self.assertRaises(ValueError, self.session.reactor, buffer_size=0)
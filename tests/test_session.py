@@ -1,14 +1,20 @@
 import os
 import socket
+import threading
+import time
+from unittest import skipUnless
 
 from .base_test import SSH2TestCase
-from ssh2.session import Session, LIBSSH2_HOSTKEY_HASH_MD5, LIBSSH2_HOSTKEY_HASH_SHA1
+from ssh2.session import Session, MemoryStats, LIBSSH2_HOSTKEY_HASH_MD5, \
+    LIBSSH2_HOSTKEY_HASH_SHA1
 from ssh2.sftp import SFTP
+from ssh2.agent import SharedAgent
+from ssh2.pkey import PrivateKey
 from ssh2.channel import Channel
 from ssh2.error_codes import LIBSSH2_ERROR_EAGAIN
 from ssh2.exceptions import (AuthenticationError, AgentAuthenticationError, SCPProtocolError,
                              RequestDeniedError, InvalidRequestError, SocketSendError, FileError,
-                             PublickeyUnverifiedError)
+                             PublickeyUnverifiedError, Timeout)
 
 from ssh2.utils import wait_socket
 
@@ -19,6 +25,21 @@ class SessionTestCase(SSH2TestCase):
         self.assertEqual(self.session.userauth_publickey_fromfile(
             self.user, self.user_key, publickey=self.user_pub_key, passphrase=''), 0)
 
+    def test_pubkey_auth_fromkey(self):
+        key = PrivateKey.fromfile(
+            os.path.join(os.path.dirname(__file__), 'unit_test_key_encrypted'),
+            passphrase='unit test passphrase')
+        self.assertEqual(self.session.userauth_publickey_fromkey(self.user, key), 0)
+        self.assertTrue(self.session.userauth_authenticated())
+        # Same key authenticates another session
+        sock = socket.create_connection((self.host, self.port))
+        try:
+            session = Session()
+            session.handshake(sock)
+            self.assertEqual(session.userauth_publickey_fromkey(self.user, key), 0)
+        finally:
+            sock.close()
+
     def test_failed_password_auth(self):
         self.assertRaises(
             AuthenticationError,
@@ -63,6 +84,30 @@ class SessionTestCase(SSH2TestCase):
         self.assertRaises(AgentAuthenticationError,
                           self.session.agent_auth, 'FAKE USER')
 
+    def test_shared_agent(self):
+        agent = SharedAgent(ttl=60)
+        identities = agent.get_identities()
+        self.assertEqual([pkey.blob for pkey in agent.get_identities()],
+                         [pkey.blob for pkey in identities])
+        self.assertRaises(AgentAuthenticationError,
+                          self.session.agent_auth, 'FAKE USER', agent=agent)
+        self.assertRaises(AgentAuthenticationError,
+                          agent.userauth, self.session, 'FAKE USER', host='localhost')
+
+    def test_shared_agent_refresh(self):
+        agent = SharedAgent(ttl=60)
+        identities = agent.get_identities()
+        self.assertTrue(len(identities) > 0)
+        expected = [(pkey.blob, pkey.comment) for pkey in identities]
+        # Keys own their data - listing again or freeing the agent frees
+        # the agent's list only
+        agent.get_identities(refresh=True)
+        self.assertEqual([(pkey.blob, pkey.comment) for pkey in identities],
+                         expected)
+        del agent
+        self.assertEqual([(pkey.blob, pkey.comment) for pkey in identities],
+                         expected)
+
     def test_failed_pkey_auth(self):
         self.assertRaises(AuthenticationError,
                           self.session.userauth_publickey_fromfile,
@@ -207,3 +252,193 @@ class SessionTestCase(SSH2TestCase):
         self.assertTrue(seconds >= 59)
         self.session.keepalive_config(False, 0)
         self.assertEqual(self.session.keepalive_send(), 0)
+
+    def test_memory_stats(self):
+        stats = self.session.memory_stats()
+        self.assertIsInstance(stats, MemoryStats)
+        self.assertTrue(stats.current > 0)
+        self.assertTrue(stats.peak >= stats.current)
+        self.assertTrue(stats.allocations > stats.frees)
+        self.assertEqual(stats.pool_hits, 0)
+        self.assertFalse(self.session.get_buffer_pool())
+        self.assertEqual(self._auth(), 0)
+        chan = self.session.open_session()
+        self.assertTrue(self.session.memory_stats().current > stats.current)
+        self.assertTrue(self.session.memory_stats().allocations > stats.allocations)
+        chan.close()
+        # Errors from libssh2 are given back to the session's allocator
+        self.assertEqual(self.session.last_error(), b'')
+
+    def test_buffer_pool(self):
+        self.assertEqual(self._auth(), 0)
+        self.session.set_buffer_pool(True)
+        self.assertTrue(self.session.get_buffer_pool())
+        size = 4 * 1024 * 1024
+        chan = self.session.open_session()
+        chan.execute('head -c %s /dev/zero' % (size,))
+        total = 0
+        rc, data = chan.read(65536)
+        while rc > 0:
+            total += rc
+            rc, data = chan.read(65536)
+        self.assertEqual(total, size)
+        stats = self.session.memory_stats()
+        self.assertTrue(stats.pool_hits > 0)
+        self.assertTrue(0 < stats.pool_size <= 1024 * 1024)
+        self.session.set_buffer_pool(False)
+        self.assertEqual(self.session.memory_stats().pool_size, 0)
+        chan.close()
+
+    def test_buffer_pool_locked(self):
+        # Turned on and off while another thread's reads use the pool
+        self.assertEqual(self._auth(), 0)
+        self.session.set_locking(True)
+        size = 4 * 1024 * 1024
+        chan = self.session.open_session()
+        chan.execute('head -c %s /dev/zero' % (size,))
+        totals = []
+
+        def read():
+            total = 0
+            rc, data = chan.read(65536)
+            while rc > 0:
+                total += rc
+                rc, data = chan.read(65536)
+            totals.append(total)
+        thread = threading.Thread(target=read)
+        thread.start()
+        while thread.is_alive():
+            self.session.set_buffer_pool(True)
+            self.session.set_buffer_pool(False)
+        thread.join()
+        self.assertEqual(totals, [size])
+        self.assertEqual(self.session.memory_stats().pool_size, 0)
+        chan.close()
+
+    def test_connect(self):
+        session = Session()
+        self.assertEqual(session.connect(
+            'localhost', self.port, timeout=10, receive_buffer_size=1024 * 1024), 0)
+        self.assertEqual(session.get_timeout(), 0)
+        sock = session.sock
+        self.assertIsInstance(sock, socket.socket)
+        self.assertEqual(sock.getpeername()[1], self.port)
+        self.assertTrue(sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY))
+        self.assertTrue(sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) >= 1024 * 1024)
+        self.assertEqual(session.userauth_publickey_fromfile(self.user, self.user_key), 0)
+        chan = session.open_session()
+        chan.execute(self.cmd)
+        self.assertEqual(chan.read()[1].strip(), self.resp.encode())
+        chan.close()
+        session.disconnect()
+        sock.close()
+
+    def test_connect_failure(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        port = listener.getsockname()[1]
+        listener.close()
+        self.assertRaises(ConnectionRefusedError, Session().connect, '127.0.0.1', port)
+        self.assertRaises(socket.gaierror, Session().connect, 'host.invalid', self.port)
+        self.assertRaises(ValueError, Session().connect, self.host, self.port, timeout=0)
+        self.assertRaises(ValueError, Session().connect, self.host, self.port,
+                          send_buffer_size=-1)
+
+    def test_connect_timeout(self):
+        # Connection is accepted by the kernel but no server ever talks
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        try:
+            session = Session()
+            session.set_timeout(60000)
+            start = time.monotonic()
+            self.assertRaises(Timeout, session.connect, '127.0.0.1',
+                              listener.getsockname()[1], timeout=0.5)
+            self.assertTrue(time.monotonic() - start < 5)
+            self.assertEqual(session.get_timeout(), 60000)
+        finally:
+            listener.close()
+
+    def test_connect_timeout_before_handshake(self):
+        # Accept queue is kept full, so connecting never completes
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(0)
+        address = listener.getsockname()
+        pending = []
+        try:
+            for _ in range(4):
+                sock = socket.socket()
+                sock.setblocking(False)
+                pending.append(sock)
+                sock.connect_ex(address)
+            session = Session()
+            start = time.monotonic()
+            self.assertRaises(Timeout, session.connect, *address, timeout=0.5)
+            self.assertTrue(time.monotonic() - start < 5)
+            self.assertIsNone(session.sock)
+        finally:
+            for sock in pending:
+                sock.close()
+            listener.close()
+
+    @skipUnless(os.path.isdir('/proc/self/fd'), "Needs /proc/self/fd")
+    def test_locking_unused(self):
+        # Locks are set up on first use, and freed with or without it
+        fds = len(os.listdir('/proc/self/fd'))
+        sessions = [Session() for _ in range(3)]
+        for session in sessions:
+            self.assertFalse(session.get_locking())
+        self.assertEqual(len(os.listdir('/proc/self/fd')), fds)
+        session = sessions.pop()
+        del sessions
+        session.set_locking(True)
+        self.assertEqual(len(os.listdir('/proc/self/fd')), fds + 1)
+        session.set_locking(False)
+        session.set_locking(True)
+        self.assertTrue(session.get_locking())
+        del session
+
+    def test_locking(self):
+        self.assertEqual(self._auth(), 0)
+        self.assertFalse(self.session.get_locking())
+        self.session.set_locking(True)
+        self.assertTrue(self.session.get_locking())
+        self.assertTrue(self.session.get_blocking())
+        size = 1024 * 1024
+        errors = []
+        outputs = {}
+
+        def run(worker):
+            try:
+                for i in range(3):
+                    chan = self.session.open_session()
+                    chan.execute('head -c %s /dev/zero; echo %s' % (size, worker))
+                    output = b''
+                    rc, data = chan.read(65536)
+                    while rc > 0:
+                        output += data
+                        rc, data = chan.read(65536)
+                    chan.close()
+                    chan.wait_closed()
+                    outputs[(worker, i)] = (output, chan.get_exit_status())
+            except Exception as ex:
+                errors.append(ex)
+
+        threads = [threading.Thread(target=run, args=(w,)) for w in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(outputs), 18)
+        for (worker, _), (output, exit_status) in outputs.items():
+            self.assertEqual(output, bytes(size) + ('%s\n' % (worker,)).encode())
+            self.assertEqual(exit_status, 0)
+        # Blocking mode is kept apart from libssh2's while locked
+        self.session.set_blocking(False)
+        self.assertFalse(self.session.get_blocking())
+        self.session.set_locking(False)
+        self.assertFalse(self.session.get_locking())
+        self.assertFalse(self.session.get_blocking())
@@ -4,6 +4,9 @@ import stat
 from sys import version_info
 from unittest import skipUnless
 import shutil
+import sys
+import threading
+import tracemalloc
 
 from .base_test import SSH2TestCase
 from ssh2.session import Session
@@ -25,6 +28,12 @@ class SFTPTestCase(SSH2TestCase):
         self.assertIsInstance(sftp.session, Session)
         self.assertEqual(sftp.session, self.session)
 
+    def test_init_window_size(self):
+        self.assertEqual(self._auth(), 0)
+        sftp = self.session.sftp_init(window_size=8 * 1024 * 1024, packet_size=32768)
+        self.assertIsInstance(sftp, SFTP)
+        self.assertRaises(ValueError, self.session.sftp_init, packet_size=0)
+
     def test_sftp_read(self):
         self.assertEqual(self._auth(), 0)
         sftp = self.session.sftp_init()
@@ -48,6 +57,62 @@ class SFTPTestCase(SSH2TestCase):
             finally:
                 os.unlink(remote_filename)
 
+    def test_sftp_read_short(self):
+        self.assertEqual(self._auth(), 0)
+        sftp = self.session.sftp_init()
+        test_file_data = os.urandom(100000)
+        remote_filename = os.sep.join([os.path.dirname(__file__),
+                                       'remote_test_file'])
+        with open(remote_filename, 'wb') as test_fh:
+            test_fh.write(test_file_data)
+        try:
+            # Reads that fill the buffer, then a short one, then EOF
+            for buffer_maxlen in (30000, 2 * 1024 * 1024):
+                remote_data = b''
+                with sftp.open(remote_filename, 0, 0) as remote_fh:
+                    size, data = remote_fh.read(buffer_maxlen)
+                    # Short reads and EOF do not allocate the whole buffer
+                    # once the first read has set it up
+                    tracemalloc.start()
+                    self.addCleanup(tracemalloc.stop)
+                    while size > 0:
+                        self.assertTrue(size <= buffer_maxlen)
+                        self.assertEqual(len(data), size)
+                        # Not larger than the data returned
+                        self.assertTrue(sys.getsizeof(data) < size + 100)
+                        remote_data += data
+                        size, data = remote_fh.read(buffer_maxlen)
+                    peak = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+                    self.assertTrue(peak < 2 * len(test_file_data) + 100000)
+                    self.assertEqual(size, 0)
+                    self.assertEqual(data, b'')
+                    self.assertEqual(remote_fh.read(buffer_maxlen), (0, b''))
+                self.assertEqual(remote_data, test_file_data)
+        finally:
+            os.unlink(remote_filename)
+
+    def test_sftp_read_into(self):
+        self.assertEqual(self._auth(), 0)
+        sftp = self.session.sftp_init()
+        test_file_data = os.urandom(100000)
+        remote_filename = os.sep.join([os.path.dirname(__file__),
+                                       'remote_test_file'])
+        with open(remote_filename, 'wb') as test_fh:
+            test_fh.write(test_file_data)
+        try:
+            buf = bytearray(30000)
+            remote_data = b''
+            with sftp.open(remote_filename, 0, 0) as remote_fh:
+                size = remote_fh.read_into(buf)
+                while size > 0:
+                    remote_data += buf[:size]
+                    size = remote_fh.read_into(buf)
+                self.assertRaises(BufferError, remote_fh.read_into, b'read only')
+            self.assertEqual(remote_data, test_file_data)
+        finally:
+            os.unlink(remote_filename)
+
     def test_sftp_write(self):
         self.assertEqual(self._auth(), 0)
         sftp = self.session.sftp_init()
@@ -80,6 +145,20 @@ class SFTPTestCase(SSH2TestCase):
         self.assertTrue(attrs is not None)
         del attrs
 
+    def test_sftp_attrs_reuse(self):
+        attrs = SFTPAttributes()
+        attrs.filesize = 2 ** 40
+        attrs.uid = 1000
+        attrs.permissions = 0o644
+        del attrs
+        # Freed objects are re-used and must not carry over previous values
+        for _ in range(1000):
+            attrs = SFTPAttributes()
+            self.assertEqual(attrs.flags, 0)
+            self.assertEqual(attrs.filesize, 0)
+            self.assertEqual(attrs.uid, 0)
+            self.assertEqual(attrs.permissions, 0)
+
     def test_sftp_stat(self):
         self.assertEqual(self._auth(), 0)
         sftp = self.session.sftp_init()
@@ -207,6 +286,21 @@ class SFTPTestCase(SSH2TestCase):
         self.assertTrue(b'..' in (_ls for (_, _ls, _, _) in dir_data))
         self.assertTrue(len(dir_data[0][2].split(b' ')) > 0)
 
+    def test_readdir_into(self):
+        self.assertEqual(self._auth(), 0)
+        sftp = self.session.sftp_init()
+        buf = bytearray(1024)
+        attrs = SFTPAttributes()
+        names = []
+        with sftp.opendir('.') as fh:
+            size = fh.readdir_into(buf, attrs)
+            while size > 0:
+                names.append(bytes(buf[:size]))
+                if names[-1] == b'..':
+                    self.assertTrue(stat.S_ISDIR(attrs.permissions))
+                size = fh.readdir_into(buf, attrs)
+        self.assertTrue(b'..' in names)
+
     def test_readdir_failure(self):
         self.assertEqual(self._auth(), 0)
         sftp = self.session.sftp_init()
@@ -306,3 +400,128 @@ class SFTPTestCase(SSH2TestCase):
             pass
         else:
             raise Exception("Should have raised SFTPProtocolError")
+
+    def test_locking(self):
+        self.assertEqual(self._auth(), 0)
+        self.session.set_locking(True)
+        sftp = self.session.sftp_init()
+        test_file_data = os.urandom(512 * 1024)
+        remote_filename = os.sep.join([os.path.dirname(__file__),
+                                       'remote_test_file'])
+        with open(remote_filename, 'wb') as test_fh:
+            test_fh.write(test_file_data)
+        errors = []
+        outputs = []
+
+        def run():
+            try:
+                for _ in range(3):
+                    with sftp.open(remote_filename, 0, 0) as remote_fh:
+                        remote_data = b""
+                        for rc, data in remote_fh:
+                            remote_data += data
+                    outputs.append(remote_data)
+                    chan = self.session.open_session()
+                    chan.execute(self.cmd)
+                    outputs.append(chan.read()[1])
+                    chan.close()
+            except Exception as ex:
+                errors.append(ex)
+
+        threads = [threading.Thread(target=run) for _ in range(4)]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            os.unlink(remote_filename)
+        self.assertEqual(errors, [])
+        self.assertEqual(len(outputs), 24)
+        self.assertEqual(outputs.count(test_file_data), 12)
+        self.assertEqual(outputs.count(self.resp.encode() + b'\n'), 12)
+
+    def test_close_threads(self):
+        self.assertEqual(self._auth(), 0)
+        sftp = self.session.sftp_init()
+        remote_filename = os.sep.join([os.path.dirname(__file__),
+                                       'remote_test_file'])
+        with open(remote_filename, 'wb') as test_fh:
+            test_fh.write(b'test')
+        try:
+            handles = [sftp.open(remote_filename, 0, 0) for _ in range(20)]
+        finally:
+            os.unlink(remote_filename)
+        for remote_fh in handles:
+            barrier = threading.Barrier(8)
+            results = []
+            errors = []
+
+            def close():
+                barrier.wait()
+                try:
+                    results.append(remote_fh.close())
+                except Exception as ex:
+                    errors.append(ex)
+
+            threads = [threading.Thread(target=close) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            # Closed once - a second close request would fail on the server
+            self.assertEqual(errors, [])
+            self.assertEqual(sorted(results, key=str), [0] + [None] * 7)
+        self.assertIsNotNone(sftp.stat(os.path.dirname(__file__)))
+
+    def test_read_threads(self):
+        self.assertEqual(self._auth(), 0)
+        self.session.set_locking(True)
+        sftp = self.session.sftp_init()
+        test_file_data = os.urandom(2 * 1024 * 1024)
+        remote_filename = os.sep.join([os.path.dirname(__file__),
+                                       'remote_test_file'])
+        with open(remote_filename, 'wb') as test_fh:
+            test_fh.write(test_file_data)
+        try:
+            remote_fh = sftp.open(remote_filename, 0, 0)
+        finally:
+            os.unlink(remote_filename)
+        # Non-blocking reads go through the handle's scratch buffer, threads
+        # finding it in use read into buffers of their own
+        self.session.set_blocking(False)
+        barrier = threading.Barrier(4)
+        chunks = []
+        errors = []
+
+        def read():
+            barrier.wait()
+            try:
+                rc, data = remote_fh.read(8192)
+                while rc != 0:
+                    if rc == LIBSSH2_ERROR_EAGAIN:
+                        wait_socket(self.sock, self.session, timeout=1)
+                    else:
+                        chunks.append(data)
+                    rc, data = remote_fh.read(8192)
+            except Exception as ex:
+                errors.append(ex)
+
+        threads = [threading.Thread(target=read) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.session.set_blocking(True)
+        remote_fh.close()
+        self.assertEqual(errors, [])
+        self.assertEqual(sum(len(chunk) for chunk in chunks), len(test_file_data))
+        # Chunks of random data are found at one offset each, covering the
+        # file once
+        offsets = sorted((test_file_data.find(chunk), chunk)
+                         for chunk in chunks if len(chunk) >= 64)
+        self.assertTrue(all(offset >= 0 for offset, _ in offsets))
+        covered = 0
+        for offset, chunk in offsets:
+            self.assertTrue(offset >= covered)
+            covered = offset + len(chunk)